@@ -0,0 +1 @@
+"""Benchmarks for the DAG definitions, excluded from the DAG folder by .airflowignore"""
@@ -0,0 +1,119 @@
+"""
+
+Benchmark the copy engines of the copy_to_local step of the preprocessing pipeline.
+
+A synthetic session is created in the source folder, made of series folders holding small files with the size of
+DICOM slices, unless --session points to an existing session folder. The session is then copied to a new folder
+inside the target folder by:
+
+* rsync: the rsync -av command used by the rsync copy engine, skipped if rsync is not installed
+* sequential: the files copied one after the other by the Python standard library, for reference
+* parallel: ParallelCopy with the number of workers given by --workers
+
+Place the source folder on the network filesystem hosting the input data and the target folder on the local disk to
+measure the throughput of the copy in production conditions.
+
+Usage, from the root of the project:
+
+    python -m benchmarks.copy_engine --source /mnt/nfs/tmp --target /data/tmp --files 3000 --workers 1,8,32
+
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common_operators.parallel_copy import ParallelCopy, VERIFY_MODES
+
+
+def create_session(source_folder, files, file_size, series):
+    """Create a synthetic session folder, return its path"""
+    session_folder = tempfile.mkdtemp(prefix='copy_engine_', dir=source_folder)
+    data = os.urandom(file_size)
+    for i in range(files):
+        series_folder = os.path.join(session_folder, '%02d' % (i % series))
+        os.makedirs(series_folder, exist_ok=True)
+        with open(os.path.join(series_folder, 'IM%06d.dcm' % i), 'wb') as f:
+            f.write(data)
+    return session_folder
+
+
+def folder_size(folder):
+    files = 0
+    size = 0
+    for path, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            files += 1
+            size += os.path.getsize(os.path.join(path, file_name))
+    return files, size
+
+
+def drop_caches():
+    """Drop the page cache to read the source files from the disk, requires root privileges"""
+    try:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def time_copy(name, copy_fn, session_folder, target_folder, files, size):
+    target = tempfile.mkdtemp(prefix='copy_engine_', dir=target_folder)
+    try:
+        cold = drop_caches()
+        start = time.perf_counter()
+        copy_fn(session_folder, os.path.join(target, 'session'))
+        elapsed = time.perf_counter() - start
+        print("%-20s %10.3f %10.0f %10.1f %6s" % (
+            name, elapsed, files / elapsed, size / elapsed / 1024 / 1024, 'cold' if cold else 'warm'))
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def rsync_copy(source, target):
+    os.makedirs(target)
+    subprocess.check_call(['rsync', '-a', source + '/', target + '/'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the copy engines of copy_to_local')
+    parser.add_argument('--source', default=tempfile.gettempdir(),
+                        help='folder where the synthetic session is created')
+    parser.add_argument('--target', default=tempfile.gettempdir(), help='folder where the session is copied')
+    parser.add_argument('--session', help='existing session folder to copy instead of a synthetic session')
+    parser.add_argument('--files', type=int, default=3000, help='number of files in the synthetic session')
+    parser.add_argument('--file-size', type=int, default=512 * 1024, help='size of the synthetic files in bytes')
+    parser.add_argument('--series', type=int, default=30, help='number of series in the synthetic session')
+    parser.add_argument('--workers', default='1,8,32', help='comma separated list of numbers of workers')
+    parser.add_argument('--verify', default='size', choices=VERIFY_MODES, help='verification of the files copied')
+    args = parser.parse_args()
+
+    session_folder = args.session or create_session(args.source, args.files, args.file_size, args.series)
+    try:
+        files, size = folder_size(session_folder)
+        print("Copy of %d files, %.1f MB from %s to %s" % (files, size / 1024 / 1024, session_folder, args.target))
+        print()
+        print("%-20s %10s %10s %10s %6s" % ('engine', 'time (s)', 'files/s', 'MB/s', 'cache'))
+        if shutil.which('rsync'):
+            time_copy('rsync', rsync_copy, session_folder, args.target, files, size)
+        else:
+            print("%-20s %10s" % ('rsync', 'not installed'))
+        time_copy('sequential', shutil.copytree, session_folder, args.target, files, size)
+        for workers in [int(w) for w in args.workers.split(',')]:
+            engine = ParallelCopy(workers=workers, verify=args.verify)
+            time_copy('parallel x%d' % workers, engine.copy_tree, session_folder, args.target, files, size)
+    finally:
+        if not args.session:
+            shutil.rmtree(session_folder, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+
+Benchmark the parsing of the DAG files.
+
+For each number of datasets, a synthetic configuration is generated and the DAG files are parsed in a fresh Python
+process using the stubs defined in benchmarks.stubs, so neither Airflow nor MATLAB or Docker are required. Reported:
+
+* cold parse: first parse of df_pipelines_init.py, including the imports of the pipeline and step modules
+* warm parse: mean time of the following parses in the same process, as done by the webserver
+* self checks: parse of df_self_checks.py
+* get calls: calls to configuration.get during the cold parse
+* peak memory: peak of the memory allocated during the cold parse, measured with tracemalloc
+
+Usage, from the root of the project:
+
+    python -m benchmarks.dag_parse --datasets 1,10,50,200
+    python -m benchmarks.dag_parse --datasets 100 --max-cold-parse 5
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_dag_files(config_file, repeat):
+    """Parse the DAG files with the stubs installed and return the measures. Runs in a dedicated process."""
+    from benchmarks import stubs
+
+    configuration = stubs.install(config_file)
+    logging.disable(logging.WARNING)
+    dag_file = os.path.join(ROOT_FOLDER, 'df_pipelines_init.py')
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    dag_globals = runpy.run_path(dag_file)
+    cold_parse = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    get_calls = configuration.stats.get_calls
+
+    warm_parses = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        runpy.run_path(dag_file)
+        warm_parses.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    runpy.run_path(os.path.join(ROOT_FOLDER, 'df_self_checks.py'))
+    self_checks = time.perf_counter() - start
+
+    dags = [v for k, v in dag_globals.items() if k.endswith('_dag') and hasattr(v, 'tasks')]
+    return {
+        'dags': len(dags),
+        'tasks': sum(len(dag.tasks) for dag in dags),
+        'cold_parse': cold_parse,
+        'warm_parse': sum(warm_parses) / len(warm_parses) if warm_parses else 0.0,
+        'self_checks': self_checks,
+        'get_calls': get_calls,
+        'peak_memory': peak_memory
+    }
+
+
+def run_benchmark(datasets, repeat, pipelines=None, scanners=None):
+    from benchmarks.synthetic_config import write_synthetic_config
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        config_file = os.path.join(tmp_folder, 'airflow.cfg')
+        write_synthetic_config(config_file, datasets, pipelines=pipelines, scanners=scanners)
+        env = dict(os.environ)
+        env['AIRFLOW_HOME'] = tmp_folder
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.dag_parse', '--worker', config_file, '--repeat', str(repeat)],
+            cwd=ROOT_FOLDER, env=env)
+    result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+    result['datasets'] = datasets
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parsing of the DAG files')
+    parser.add_argument('--datasets', default='1,10,50,100,200',
+                        help='comma separated list of the number of datasets to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='number of warm parses')
+    parser.add_argument('--pipelines', help='PIPELINES used by all datasets, default to a mix of pipelines')
+    parser.add_argument('--scanners', help='SCANNERS used by all datasets, default to a mix of scanners')
+    parser.add_argument('--max-cold-parse', type=float,
+                        help='fail if the cold parse takes more than this number of seconds')
+    parser.add_argument('--worker', metavar='CONFIG_FILE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(parse_dag_files(args.worker, args.repeat)))
+        return 0
+
+    print("%8s %6s %6s %10s %10s %11s %9s %11s" % ('datasets', 'dags', 'tasks', 'cold (s)', 'warm (s)',
+                                                   'checks (s)', 'get calls', 'peak (MiB)'))
+    failed = False
+    for datasets in [int(n) for n in args.datasets.split(',')]:
+        result = run_benchmark(datasets, args.repeat, args.pipelines, args.scanners)
+        print("%8d %6d %6d %10.3f %10.3f %11.3f %9d %11.1f" % (
+            result['datasets'], result['dags'], result['tasks'], result['cold_parse'], result['warm_parse'],
+            result['self_checks'], result['get_calls'], result['peak_memory'] / 1024.0 / 1024.0))
+        if args.max_cold_parse and result['cold_parse'] > args.max_cold_parse:
+            failed = True
+            print("Cold parse of %d datasets took %.3f s, more than %.3f s" % (
+                datasets, result['cold_parse'], args.max_cold_parse))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+
+Benchmark the DICOM to Nifti converters of the dicom_to_nifti step of the preprocessing pipeline.
+
+A synthetic session is created in the source folder, made of series folders holding one DICOM file per slice of a
+3D volume, unless --session points to an existing session folder. The session is then converted by:
+
+* spm: the SPM function DCM2NII_LREN called through MATLAB, including the start of MATLAB, skipped if the MATLAB
+  engine is not installed or if --pipeline-path is not given
+* python: DicomToNiftiConverter with the number of workers given by --workers
+
+Requires pydicom, nibabel and numpy.
+
+Usage, from the root of the project:
+
+    python -m benchmarks.dicom_to_nifti --series 8 --slices 176 --size 256 --workers 1,4,8 \
+        --pipeline-path /opt/airflow-scripts/mri-preprocessing-pipeline/Pipelines/Nifti_Conversion_Pipeline \
+        --misc-library-path /opt/airflow-scripts/mri-preprocessing-pipeline/Miscellaneous\\&Others
+
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from common_operators.dicom_converter import DicomToNiftiConverter, find_series
+
+
+def write_slice(path, series_uid, series_number, protocol, index, slices, size, pixels):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MR'
+    ds.PatientID = 'PR00001'
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.InstanceNumber = index + 1
+    ds.ProtocolName = protocol
+    ds.SeriesDescription = protocol
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [-size / 2, -size / 2, index - slices / 2]
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = size
+    ds.Columns = size
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = pixels.tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+
+def create_session(source_folder, series, slices, size):
+    """Create a synthetic session folder, return its path and the path of its protocols definition file"""
+    session_folder = tempfile.mkdtemp(prefix='dicom_to_nifti_', dir=source_folder)
+    protocol = 'al_B1mapping'
+    random = numpy.random.RandomState(0)
+    for s in range(series):
+        series_folder = os.path.join(session_folder, 'PR00001', protocol, '%02d' % (s + 1))
+        os.makedirs(series_folder)
+        series_uid = generate_uid()
+        # Write the slices in a random order, as found on the scanners
+        for index in random.permutation(slices):
+            pixels = random.randint(0, 4096, size=(size, size)).astype(numpy.int16)
+            write_slice(os.path.join(series_folder, 'IM%04d.dcm' % index), series_uid, s + 1, protocol, index,
+                        slices, size, pixels)
+    protocols_file = os.path.join(session_folder, '.protocols.txt')
+    with open(protocols_file, 'w') as f:
+        f.write("anatomical: %s\n" % protocol)
+    return session_folder, protocols_file
+
+
+def count_files(session_folder, series):
+    return sum(len([f for f in os.listdir(os.path.join(session_folder, s)) if not f.startswith('.')]) for s in series)
+
+
+def time_conversion(name, convert_fn, session_folder, target_folder, series, files):
+    target = tempfile.mkdtemp(prefix='dicom_to_nifti_', dir=target_folder)
+    try:
+        start = time.perf_counter()
+        convert_fn(session_folder, target)
+        elapsed = time.perf_counter() - start
+        print("%-20s %10.3f %10.2f %10.0f" % (name, elapsed, series / elapsed, files / elapsed))
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def spm_convert_fn(args, protocols_file):
+    def convert(session_folder, target):
+        import matlab.engine
+
+        engine = matlab.engine.start_matlab()
+        try:
+            for path in [args.misc_library_path, args.pipeline_path]:
+                if path:
+                    engine.addpath(path)
+            engine.DCM2NII_LREN(os.path.dirname(session_folder), os.path.basename(session_folder), target, '',
+                                protocols_file, os.path.join(args.pipeline_path, 'dcm2nii'))
+        finally:
+            engine.exit()
+    return convert
+
+
+def python_convert_fn(workers, protocols_file):
+    def convert(session_folder, target):
+        with DicomToNiftiConverter(workers, protocols_file) as converter:
+            converter.convert_session(session_folder, target)
+    return convert
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the DICOM to Nifti converters of dicom_to_nifti')
+    parser.add_argument('--source', default=tempfile.gettempdir(),
+                        help='folder where the synthetic session is created')
+    parser.add_argument('--target', default=tempfile.gettempdir(), help='folder where the Nifti files are written')
+    parser.add_argument('--session', help='existing session folder to convert instead of a synthetic session')
+    parser.add_argument('--protocols', help='protocols definition file used with --session')
+    parser.add_argument('--series', type=int, default=8, help='number of series in the synthetic session')
+    parser.add_argument('--slices', type=int, default=176, help='number of slices per synthetic series')
+    parser.add_argument('--size', type=int, default=256, help='number of rows and columns of the synthetic slices')
+    parser.add_argument('--workers', default='1,4,8', help='comma separated list of numbers of workers')
+    parser.add_argument('--pipeline-path', help='folder containing the DCM2NII_LREN SPM function and dcm2nii')
+    parser.add_argument('--misc-library-path', help='Misc&Libraries folder of the SPM pipelines')
+    args = parser.parse_args()
+
+    if args.session:
+        session_folder, protocols_file = args.session, args.protocols
+    else:
+        session_folder, protocols_file = create_session(args.source, args.series, args.slices, args.size)
+    try:
+        all_series = find_series(session_folder)
+        series, files = len(all_series), count_files(session_folder, all_series)
+        print("Conversion of %d series, %d files from %s to %s" % (series, files, session_folder, args.target))
+        print()
+        print("%-20s %10s %10s %10s" % ('converter', 'time (s)', 'series/s', 'files/s'))
+        try:
+            import matlab.engine  # noqa: F401
+            spm_available = bool(args.pipeline_path)
+        except ImportError:
+            spm_available = False
+        if spm_available:
+            time_conversion('spm', spm_convert_fn(args, protocols_file), session_folder, args.target, series, files)
+        else:
+            print("%-20s %10s" % ('spm', 'not available'))
+        for workers in [int(w) for w in args.workers.split(',')]:
+            time_conversion('python x%d' % workers, python_convert_fn(workers, protocols_file), session_folder,
+                            args.target, series, files)
+    finally:
+        if not args.session:
+            shutil.rmtree(session_folder, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
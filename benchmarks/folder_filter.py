@@ -0,0 +1,116 @@
+"""
+
+Microbenchmark of the folder filters used by the scanners.
+
+A million synthetic paths root/<patient>/<session>/<series> are generated in memory. The benchmark measures:
+
+* calls: time to filter all paths with the former accept folder function, which resolved the regex on each call
+  with re.fullmatch, and with a FolderFilter using the same regex or include and exclude patterns per depth
+* traversal: number of folders visited when the filter prunes the rejected sub-trees during the descent, compared to
+  a traversal that visits the whole tree and filters the folders found at the requested depth
+
+Usage, from the root of the project:
+
+    python -m benchmarks.folder_filter --paths 1000000
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from os.path import basename
+from re import fullmatch
+
+from common_operators.folder_filter import FolderFilter
+
+ROOT_FOLDER = '/data/incoming'
+
+INCLUDE = r'PR\d+|S\d+_.*|\d+'
+EXCLUDE = r'(?i).*(delete|phantom).*'
+
+
+def synthetic_tree(paths):
+    """Return the folders of a synthetic tree with 3 levels holding the given number of leaf folders"""
+    patients = max(1, paths // 100)
+    tree = {}
+    for p in range(patients):
+        patient = 'PR%05d' % p if p % 10 else 'PHANTOM%05d' % p
+        sessions = {}
+        for s in range(10):
+            session = 'S%d_%s' % (s, 'delete' if s == 9 else 'mri')
+            sessions[session] = ['%d' % i for i in range(10)]
+        tree[patient] = sessions
+    return tree
+
+
+def synthetic_paths(tree):
+    for patient, sessions in tree.items():
+        for session, series in sessions.items():
+            for serie in series:
+                yield os.path.join(ROOT_FOLDER, patient, session, serie)
+
+
+def time_calls(name, accept, paths):
+    start = time.perf_counter()
+    accepted = 0
+    for path in paths:
+        if accept(path=path):
+            accepted += 1
+    elapsed = time.perf_counter() - start
+    print("%-36s %10d %10.3f %12.0f" % (name, accepted, elapsed, len(paths) / elapsed))
+
+
+def traverse(tree, accept, prune):
+    """Count the folders visited and accepted at depth 3, with or without pruning during the descent"""
+    visited = 0
+    accepted = 0
+    for patient, sessions in tree.items():
+        visited += 1
+        patient_path = os.path.join(ROOT_FOLDER, patient)
+        if prune and not accept(path=patient_path):
+            continue
+        for session, series in sessions.items():
+            visited += 1
+            session_path = os.path.join(patient_path, session)
+            if prune and not accept(path=session_path):
+                continue
+            for serie in series:
+                visited += 1
+                path = os.path.join(session_path, serie)
+                if prune:
+                    accepted += 1 if accept(path=path) else 0
+                elif all(accept(path=p) for p in [patient_path, session_path, path]):
+                    accepted += 1
+    return visited, accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark of the folder filters')
+    parser.add_argument('--paths', type=int, default=1000000, help='number of synthetic paths')
+    args = parser.parse_args()
+
+    tree = synthetic_tree(args.paths)
+    paths = list(synthetic_paths(tree))
+
+    folder_filter = FolderFilter(include=INCLUDE, root_folder=ROOT_FOLDER)
+    depth_filter = FolderFilter(depth_include={1: r'PR\d+', 2: r'S\d+_.*', 3: r'\d+'}, exclude=EXCLUDE,
+                                root_folder=ROOT_FOLDER)
+
+    print("%-36s %10s %10s %12s" % ('calls', 'accepted', 'time (s)', 'paths/s'))
+    time_calls('re.fullmatch(FOLDER_FILTER, basename)', lambda path: fullmatch(INCLUDE, basename(path)), paths)
+    time_calls('FolderFilter(FOLDER_FILTER)', folder_filter, paths)
+    time_calls('FolderFilter(per depth, exclude)', depth_filter, paths)
+
+    print()
+    print("%-36s %10s %10s" % ('traversal', 'visited', 'accepted'))
+    for name, prune in [('filter after the descent', False), ('prune during the descent', True)]:
+        visited, accepted = traverse(tree, depth_filter, prune)
+        print("%-36s %10d %10d" % (name, visited, accepted))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
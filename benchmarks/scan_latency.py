@@ -0,0 +1,106 @@
+"""
+
+Benchmark the latency of the continuous scanner, from the creation of a .ready marker file in a session folder to
+the trigger of the DAG run processing the session.
+
+A temporary input folder is created with a daily folder for today. WatchDailyFolderOperator runs in a background
+thread with the stubs defined in benchmarks.stubs, so the trigger is recorded instead of creating a DAG run in the
+Airflow database, while the main thread creates session folders and their .ready marker files at random intervals.
+
+The modes measured are:
+
+* inotify: changes detected with inotify, used on local filesystems
+* poll: the daily folder is polled every --poll-interval seconds, used on NFS
+
+For reference, the expected latency of the scheduled scan without watch mode is also printed: half of the schedule
+interval on average, the full schedule interval at worst, without the delays of the Airflow scheduler.
+
+Usage, from the root of the project:
+
+    python -m benchmarks.scan_latency --sessions 20 --poll-interval 5
+
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+SCHEDULE_INTERVAL = timedelta(minutes=10)
+
+
+def measure_latency(mode, sessions, poll_interval, max_delay):
+    """Create sessions ready for processing while the operator watches the input folder, return the latencies"""
+    from common_operators.watch_scan_folder_operator import WatchDailyFolderOperator
+
+    root_folder = tempfile.mkdtemp(prefix='scan_latency_')
+    try:
+        now = datetime.now()
+        daily_folder = os.path.join(root_folder, now.strftime('%Y'), now.strftime('%Y%m%d'))
+        os.makedirs(daily_folder)
+        duration = sessions * max_delay + 2 * poll_interval + 2
+        operator = WatchDailyFolderOperator(task_id='scan_dirs_ready_for_preprocessing', dataset='benchmark',
+                                            folder=root_folder, trigger_dag_id='benchmark_pre_process_images',
+                                            watch_duration=timedelta(seconds=duration), poll_interval=poll_interval,
+                                            watch_mode=mode)
+        watcher = threading.Thread(target=operator.execute, args=({'execution_date': now},))
+        watcher.start()
+        time.sleep(0.5)
+
+        ready_times = {}
+        for i in range(sessions):
+            session_folder = os.path.join(daily_folder, 'PR%05d' % i)
+            os.makedirs(os.path.join(session_folder, '1'))
+            time.sleep(random.uniform(0, max_delay))
+            open(os.path.join(session_folder, '.ready'), 'w').close()
+            ready_times[session_folder] = time.time()
+        watcher.join()
+
+        return [triggered_time - ready_times[folder] for folder, triggered_time in operator.triggered
+                if folder in ready_times]
+    finally:
+        shutil.rmtree(root_folder)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the latency between a .ready marker and its DAG run')
+    parser.add_argument('--sessions', type=int, default=10, help='number of session folders to create per mode')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='poll interval in seconds')
+    parser.add_argument('--max-delay', type=float, default=1.0,
+                        help='maximum delay in seconds between the creation of two sessions')
+    parser.add_argument('--modes', default='inotify,poll', help='comma separated list of modes to measure')
+    args = parser.parse_args()
+
+    from benchmarks import stubs
+    stubs.install(os.devnull)
+
+    print("%-10s %9s %11s %11s %11s" % ('mode', 'triggered', 'median (s)', 'p95 (s)', 'max (s)'))
+    failed = False
+    for mode in args.modes.split(','):
+        latencies = measure_latency(mode, args.sessions, args.poll_interval, args.max_delay)
+        if len(latencies) != args.sessions:
+            failed = True
+        if latencies:
+            print("%-10s %9d %11.3f %11.3f %11.3f" % (mode, len(latencies), percentile(latencies, 50),
+                                                      percentile(latencies, 95), max(latencies)))
+        else:
+            print("%-10s %9d" % (mode, 0))
+    interval = SCHEDULE_INTERVAL.total_seconds()
+    print("%-10s %9s %11.3f %11s %11.3f" % ('scheduled', '-', interval / 2, '-', interval))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
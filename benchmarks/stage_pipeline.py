@@ -0,0 +1,239 @@
+"""
+
+Simulate the preprocessing of a backlog of sessions with the per-DAG scheme and with the stage-pipelined execution.
+
+The sessions go through the stages copy_to_local, dicom_to_nifti, mpm_maps and neuro_morphometric_atlas, each stage
+taking a slot of its Airflow pool. The duration of each stage for each session is drawn once from a log-normal
+distribution around the mean given by --durations, so both schemes process the same sessions. The schemes compared
+are:
+
+* dag: up to MAX_ACTIVE_RUNS sessions are processed at the same time, whatever their stage, for each value given by
+  --max-active-runs
+* stages: a session enters a stage when the gate of the stage opens, see common_operators.stage_gate, with the
+  limits given by --stage-slots and --stage-queue
+
+Tasks ready to run take a free slot of their pool in the order of the sessions. The gates are checked as soon as a
+task completes, the delays of the Airflow scheduler and of the gates in reschedule mode are not simulated. The
+sessions waiting at a gate are admitted one at a time, as the gates woken up together are admitted in the order of
+their start, see common_operators.stage_gate.
+
+Reported for each scheme:
+
+* throughput: sessions processed per hour
+* mean and p95 latency: time from the arrival of a session to the end of its last stage
+* busy: ratio of the slots of each pool used during the simulation
+* peak local: maximum number of sessions with files on the local disk, from the start of their copy to the end of
+  their last stage
+
+Usage, from the root of the project:
+
+    python -m benchmarks.stage_pipeline --sessions 200 --max-active-runs 4,8,16,64
+    python -m benchmarks.stage_pipeline --arrival-interval 20 --stage-slots copy_to_local=1,mpm_maps=6
+
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+
+STAGES = ['copy_to_local', 'dicom_to_nifti', 'mpm_maps', 'neuro_morphometric_atlas']
+STAGE_POOLS = {'copy_to_local': 'remote_file_copy',
+               'dicom_to_nifti': 'io_intensive',
+               'mpm_maps': 'image_preprocessing',
+               'neuro_morphometric_atlas': 'image_preprocessing'}
+
+
+def parse_mapping(value, convert):
+    mapping = {}
+    for item in value.split(','):
+        if item.strip():
+            key, item_value = item.split('=')
+            mapping[key.strip()] = convert(item_value)
+    return mapping
+
+
+def draw_durations(sessions, durations, sigma, seed):
+    """Duration in minutes of each stage of each session"""
+    rng = random.Random(seed)
+    return [dict((stage, rng.lognormvariate(0, sigma) * durations[stage]) for stage in STAGES)
+            for _ in range(sessions)]
+
+
+class Simulation:
+
+    """Discrete event simulation of the sessions going through the stages.
+
+    :param session_durations: duration of each stage for each session, in minutes
+    :param arrivals: arrival time of each session, in minutes
+    :param pools: number of slots of each pool
+    :param max_active_runs: maximum number of sessions processed at the same time, None in stage-pipelined mode
+    :param stage_limits: dictionary of stage to (slots, queue size) in stage-pipelined mode
+    """
+
+    def __init__(self, session_durations, arrivals, pools, max_active_runs=None, stage_limits=None):
+        from common_operators.stage_gate import gate_open
+
+        self.gate_open = gate_open
+        self.durations = session_durations
+        self.arrivals = arrivals
+        self.free_slots = dict(pools)
+        self.pools = pools
+        self.max_active_runs = max_active_runs
+        self.stage_limits = stage_limits
+        sessions = len(session_durations)
+        # Index of the stage the session waits for or runs, len(STAGES) when done
+        self.stage = [0] * sessions
+        self.admitted = [False] * sessions
+        self.passed_gate = [False] * sessions
+        self.running = [False] * sessions
+        self.start = [None] * sessions
+        self.end = [None] * sessions
+        self.busy = dict((pool, 0.0) for pool in pools)
+        self.peak_local = 0
+        self.events = []
+        self.now = 0.0
+
+    def run(self):
+        for session, arrival in enumerate(self.arrivals):
+            heapq.heappush(self.events, (arrival, session, None))
+        while self.events:
+            self.now, session, stage = heapq.heappop(self.events)
+            if stage is not None:
+                self.complete(session, stage)
+            self.dispatch()
+        return self
+
+    def arrived(self, session):
+        return self.arrivals[session] <= self.now
+
+    def complete(self, session, stage):
+        pool = STAGE_POOLS[STAGES[stage]]
+        self.free_slots[pool] += 1
+        self.running[session] = False
+        self.passed_gate[session] = False
+        self.stage[session] = stage + 1
+        if self.stage[session] == len(STAGES):
+            self.end[session] = self.now
+
+    def occupancy(self):
+        """Number of sessions in each stage, and number of sessions waiting at the gate of each stage"""
+        in_stage = [0] * len(STAGES)
+        waiting = [0] * (len(STAGES) + 1)
+        for s in range(len(self.stage)):
+            if self.end[s] is not None or not self.arrived(s):
+                continue
+            if self.passed_gate[s]:
+                in_stage[self.stage[s]] += 1
+            else:
+                waiting[self.stage[s]] += 1
+        return in_stage, waiting
+
+    def dispatch(self):
+        sessions = range(len(self.stage))
+        if self.max_active_runs is not None:
+            active = sum(1 for s in sessions if self.admitted[s] and self.end[s] is None)
+            for s in sessions:
+                if active >= self.max_active_runs:
+                    break
+                if not self.admitted[s] and self.arrived(s):
+                    self.admitted[s] = True
+                    active += 1
+        if self.stage_limits is not None:
+            in_stage, waiting = self.occupancy()
+        for s in sessions:
+            if self.end[s] is not None or self.running[s] or not self.arrived(s):
+                continue
+            stage = self.stage[s]
+            if self.stage_limits is not None and not self.passed_gate[s]:
+                slots, queue_size = self.stage_limits[STAGES[stage]]
+                # The sessions waiting at the gate of the first stage are not handed off by a previous stage
+                handed_off = waiting[stage + 1] if stage + 1 < len(STAGES) else 0
+                if not self.gate_open(in_stage[stage], handed_off, slots, queue_size):
+                    continue
+                self.passed_gate[s] = True
+                in_stage[stage] += 1
+                waiting[stage] -= 1
+            elif self.max_active_runs is not None and not self.admitted[s]:
+                continue
+            pool = STAGE_POOLS[STAGES[stage]]
+            if not self.free_slots[pool]:
+                continue
+            self.free_slots[pool] -= 1
+            self.running[s] = True
+            if stage == 0:
+                self.start[s] = self.now
+            duration = self.durations[s][STAGES[stage]]
+            self.busy[pool] += duration
+            heapq.heappush(self.events, (self.now + duration, s, stage))
+        local = sum(1 for s in sessions if self.start[s] is not None and self.end[s] is None)
+        self.peak_local = max(self.peak_local, local)
+
+    def report(self):
+        makespan = max(self.end) - min(self.arrivals)
+        latencies = sorted(end - arrival for end, arrival in zip(self.end, self.arrivals))
+        return {'throughput': len(self.end) / makespan * 60,
+                'mean_latency': sum(latencies) / len(latencies) / 60,
+                'p95_latency': latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))] / 60,
+                'busy': dict((pool, self.busy[pool] / (slots * makespan)) for pool, slots in self.pools.items()),
+                'peak_local': self.peak_local}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the per-DAG and the stage-pipelined execution of the '
+                                                 'preprocessing pipeline')
+    parser.add_argument('--sessions', type=int, default=200, help='number of sessions to process')
+    parser.add_argument('--arrival-interval', type=float, default=0,
+                        help='minutes between the arrival of two sessions, 0 for a backlog available at once')
+    parser.add_argument('--durations', default='copy_to_local=15,dicom_to_nifti=20,mpm_maps=90,'
+                                               'neuro_morphometric_atlas=60',
+                        help='mean duration of each stage in minutes')
+    parser.add_argument('--sigma', type=float, default=0.3, help='sigma of the log-normal distribution of durations')
+    parser.add_argument('--pools', default='remote_file_copy=2,io_intensive=2,image_preprocessing=8',
+                        help='slots of each pool')
+    parser.add_argument('--max-active-runs', default='4,8,16,64',
+                        help='comma separated list of MAX_ACTIVE_RUNS simulated with the per-DAG scheme')
+    parser.add_argument('--stage-slots', default='copy_to_local=2,dicom_to_nifti=2,mpm_maps=6,'
+                                                 'neuro_morphometric_atlas=4',
+                        help='STAGE_SLOTS of each stage in stage-pipelined mode')
+    parser.add_argument('--stage-queue', default='2', help='STAGE_QUEUE of all stages, or of each stage as '
+                                                           'stage=size')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random durations')
+    args = parser.parse_args()
+
+    from benchmarks import stubs
+    stubs.install(os.devnull)
+
+    durations = parse_mapping(args.durations, float)
+    pools = parse_mapping(args.pools, int)
+    stage_slots = parse_mapping(args.stage_slots, int)
+    if '=' in args.stage_queue:
+        stage_queue = parse_mapping(args.stage_queue, int)
+    else:
+        stage_queue = dict((stage, int(args.stage_queue)) for stage in STAGES)
+    stage_limits = dict((stage, (stage_slots[stage], stage_queue[stage])) for stage in STAGES)
+
+    session_durations = draw_durations(args.sessions, durations, args.sigma, args.seed)
+    arrivals = [i * args.arrival_interval for i in range(args.sessions)]
+
+    schemes = [('dag %s' % m, Simulation(session_durations, arrivals, pools, max_active_runs=int(m)))
+               for m in args.max_active_runs.split(',')]
+    schemes.append(('stages', Simulation(session_durations, arrivals, pools, stage_limits=stage_limits)))
+
+    pool_names = sorted(pools)
+    print("%-10s %11s %12s %11s %s %10s" % ('scheme', 'sessions/h', 'latency (h)', 'p95 (h)',
+                                            ' '.join('%20s' % ('busy ' + pool) for pool in pool_names),
+                                            'peak local'))
+    for name, simulation in schemes:
+        report = simulation.run().report()
+        print("%-10s %11.2f %12.2f %11.2f %s %10d" % (name, report['throughput'], report['mean_latency'],
+                                                      report['p95_latency'],
+                                                      ' '.join('%20.0f%%' % (report['busy'][pool] * 100)
+                                                               for pool in pool_names),
+                                                      report['peak_local']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+
+Stub replacements for Airflow and the imaging plugins.
+
+The stubs are enough to build the DAGs defined in this project without Airflow, the Airflow plugins, MATLAB or Docker.
+The stub configuration counts the calls made to it, and the stub scan folder and python pipeline operators
+record the folders and DAGs they trigger instead of creating DAG runs.
+
+"""
+
+import os
+import sys
+import time
+import types
+
+from configparser import ConfigParser, NoOptionError, NoSectionError
+from datetime import datetime, timedelta
+
+
+class ConfigStats:
+
+    def __init__(self):
+        self.get_calls = 0
+        self.has_option_calls = 0
+
+
+class StubConfiguration(types.ModuleType):
+
+    """Mimics airflow.configuration on top of a ConfigParser and counts the calls made to it"""
+
+    def __init__(self, config_file):
+        super(StubConfiguration, self).__init__('airflow.configuration')
+        self.conf = ConfigParser(interpolation=None)
+        self.conf.read(config_file)
+        self.stats = ConfigStats()
+
+    def get(self, section, key, **kwargs):
+        self.stats.get_calls += 1
+        try:
+            return self.conf.get(section.lower(), key.lower())
+        except (NoOptionError, NoSectionError):
+            raise sys.modules['airflow.exceptions'].AirflowConfigException(
+                "section/key [%s/%s] not found in config" % (section, key))
+
+    def getint(self, section, key):
+        return int(self.get(section, key))
+
+    def getfloat(self, section, key):
+        return float(self.get(section, key))
+
+    def getboolean(self, section, key):
+        return self.get(section, key).strip().lower() in ('t', 'true', '1')
+
+    def has_option(self, section, key):
+        self.stats.has_option_calls += 1
+        return self.conf.has_option(section.lower(), key.lower())
+
+    def set(self, section, key, value):
+        if not self.conf.has_section(section.lower()):
+            self.conf.add_section(section.lower())
+        self.conf.set(section.lower(), key.lower(), value)
+
+
+class DAG:
+
+    def __init__(self, dag_id, default_args=None, schedule_interval=None, max_active_runs=16, **kwargs):
+        self.dag_id = dag_id
+        self.default_args = default_args or {}
+        self.schedule_interval = schedule_interval
+        self.max_active_runs = max_active_runs
+        self.tasks = []
+
+
+class BaseOperator:
+
+    def __init__(self, task_id=None, dag=None, priority_weight=1, pool=None, queue='default', **kwargs):
+        self.task_id = task_id
+        self.dag = dag
+        self.priority_weight = priority_weight
+        self.pool = pool
+        self.queue = queue
+        self.kwargs = kwargs
+        self.upstream_list = []
+        self.doc_md = None
+        if dag is not None:
+            dag.tasks.append(self)
+
+    def post_execute(self, context, *args, **kwargs):
+        pass
+
+    def set_upstream(self, task):
+        self.upstream_list.append(task)
+
+    def set_downstream(self, task):
+        task.upstream_list.append(self)
+
+
+class PythonPipelineOperator(BaseOperator):
+
+    """Calls its python callable like the plugin operator, records the DAGs triggered instead of creating DAG runs"""
+
+    def __init__(self, python_callable=None, op_args=None, op_kwargs=None, provide_context=True, parent_task=None,
+                 on_failure_trigger_dag_id=None, software_versions=None, dataset_config=None, organised_folder=True,
+                 **kwargs):
+        super(PythonPipelineOperator, self).__init__(**kwargs)
+        self.python_callable = python_callable
+        self.op_args = op_args or []
+        self.op_kwargs = op_kwargs or {}
+        self.provide_context = provide_context
+        self.parent_task = parent_task
+        self.on_failure_trigger_dag_id = on_failure_trigger_dag_id
+        self.pipeline_xcoms = {}
+        self.triggered_dags = []
+
+    def execute(self, context):
+        op_kwargs = dict(self.op_kwargs)
+        if self.provide_context:
+            op_kwargs.update(context)
+            op_kwargs.update(self.pipeline_xcoms)
+        try:
+            return_value = self.python_callable(*self.op_args, **op_kwargs)
+        except Exception as e:
+            self.trigger_dag(context, self.on_failure_trigger_dag_id, str(e))
+            raise
+        if isinstance(return_value, dict):
+            self.pipeline_xcoms.update(return_value)
+        return return_value
+
+    def trigger_dag(self, context, dag_id, output, error=''):
+        if dag_id:
+            self.triggered_dags.append(dag_id)
+
+
+class ScanFlatFolderOperator(BaseOperator):
+
+    """Records the folders triggered instead of creating DAG runs"""
+
+    def __init__(self, dataset=None, folder=None, trigger_dag_id=None, trigger_dag_run_callable=None,
+                 extract_context_callable=None, accept_folder_callable=None, depth=1, **kwargs):
+        super(ScanFlatFolderOperator, self).__init__(**kwargs)
+        self.dataset = dataset
+        self.folder = folder
+        self.trigger_dag_id = trigger_dag_id
+        self.trigger_dag_run_callable = trigger_dag_run_callable
+        self.extract_context_callable = extract_context_callable
+        self.accept_folder_callable = accept_folder_callable
+        self.depth = depth
+        self.offset = 1
+        self.pipeline_xcoms = None
+        self.triggered = []
+
+    def root_folder(self, context):
+        return self.folder
+
+    def trigger_dag_run(self, context, root_folder, folder, session=None):
+        self.triggered.append((folder, time.time()))
+
+
+class ScanDailyFolderOperator(ScanFlatFolderOperator):
+
+    def __init__(self, build_daily_folder_path_callable=None, look_for_ready_marker_file=None,
+                 ready_marker_file='.ready', depth=0, **kwargs):
+        super(ScanDailyFolderOperator, self).__init__(depth=depth, **kwargs)
+        self.build_daily_folder_path_callable = build_daily_folder_path_callable or _daily_folder_path
+        self.look_for_ready_marker_file = look_for_ready_marker_file or _look_for_ready_marker_file
+        self.ready_marker_file = ready_marker_file
+
+
+def _look_for_ready_marker_file(daily_folder_date):
+    return daily_folder_date.date() == datetime.today().date()
+
+
+def _daily_folder_path(folder, date):
+    return os.path.join(folder, date.strftime('%Y'), date.strftime('%Y%m%d'))
+
+
+class DagRunOrder:
+
+    def __init__(self, run_id=None, payload=None):
+        self.run_id = run_id
+        self.payload = payload
+
+
+def _round_up_time(dt=None, date_delta=timedelta(minutes=1)):
+    dt = dt or datetime.now()
+    seconds = (dt - dt.min).seconds
+    rounding = (seconds + date_delta.total_seconds()) // date_delta.total_seconds() * date_delta.total_seconds()
+    return dt + timedelta(0, rounding - seconds, -dt.microsecond)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _operator(name):
+    return type(name, (BaseOperator,), {})
+
+
+def _apply_defaults(fn):
+    return fn
+
+
+def _provide_session(fn):
+    return fn
+
+
+def install(config_file):
+    """Install the stub modules in sys.modules and return the stub configuration"""
+
+    configuration = StubConfiguration(config_file)
+    sys.modules['airflow.configuration'] = configuration
+
+    class AirflowException(Exception):
+        pass
+
+    exceptions = _module('airflow.exceptions',
+                         AirflowException=AirflowException,
+                         AirflowConfigException=type('AirflowConfigException', (AirflowException,), {}),
+                         AirflowSkipException=type('AirflowSkipException', (AirflowException,), {}),
+                         AirflowSensorTimeout=type('AirflowSensorTimeout', (AirflowException,), {}))
+    _module('airflow', DAG=DAG, configuration=configuration, exceptions=exceptions, __path__=[])
+    _module('airflow.models', BaseOperator=BaseOperator, DagBag=object, DagRun=object, TaskInstance=object,
+            Pool=object, Variable=object)
+    _module('airflow.settings', Session=None, DAGS_FOLDER='')
+    _module('airflow.utils', apply_defaults=_apply_defaults, __path__=[])
+    _module('airflow.utils.db', provide_session=_provide_session)
+    _module('airflow.utils.trigger_rule',
+            TriggerRule=type('TriggerRule', (), {'ALL_SUCCESS': 'all_success', 'ALL_DONE': 'all_done'}))
+    state = type('State', (), {'RUNNING': 'running', 'SUCCESS': 'success', 'FAILED': 'failed', 'QUEUED': 'queued',
+                               'SCHEDULED': 'scheduled', 'UP_FOR_RETRY': 'up_for_retry', 'SKIPPED': 'skipped',
+                               'UPSTREAM_FAILED': 'upstream_failed', 'NONE': None})
+    _module('airflow.utils.state', State=state)
+    _module('airflow.operators', __path__=[])
+    _module('airflow.operators.bash_operator', BashOperator=_operator('BashOperator'))
+    _module('airflow.operators.python_operator', PythonOperator=_operator('PythonOperator'))
+    _module('airflow.operators.latest_only_operator', LatestOnlyOperator=_operator('LatestOnlyOperator'))
+    _module('airflow.operators.slack_operator', SlackAPIPostOperator=_operator('SlackAPIPostOperator'))
+    _module('airflow.operators.dagrun_operator', TriggerDagRunOperator=_operator('TriggerDagRunOperator'),
+            DagRunOrder=DagRunOrder)
+    _module('airflow.operators.sensors', BaseSensorOperator=_operator('BaseSensorOperator'))
+
+    _module('airflow_spm', __path__=[])
+    _module('airflow_spm.operators', SpmOperator=_operator('SpmOperator'),
+            SpmPipelineOperator=_operator('SpmPipelineOperator'))
+    _module('airflow_spm.errors', SPMError=type('SPMError', (Exception,), {}))
+    _module('airflow_pipeline', __path__=[])
+    _module('airflow_pipeline.operators', PreparePipelineOperator=_operator('PreparePipelineOperator'),
+            BashPipelineOperator=_operator('BashPipelineOperator'),
+            DockerPipelineOperator=_operator('DockerPipelineOperator'),
+            PythonPipelineOperator=PythonPipelineOperator)
+    _module('airflow_pipeline.pipelines', pipeline_trigger=lambda parent_task: None,
+            TransferPipelineXComs=object, PIPELINE_XCOMS=[])
+    _module('airflow_freespace', __path__=[])
+    _module('airflow_freespace.operators', FreeSpaceSensor=_operator('FreeSpaceSensor'))
+
+    scan_flat = ScanFlatFolderOperator
+    scan_daily = ScanDailyFolderOperator
+    scan_pipeline = type('ScanFlatFolderPipelineOperator', (scan_flat,), {})
+    common = _module('airflow_scan_folder.operators.common',
+                     default_look_for_ready_marker_file=_look_for_ready_marker_file,
+                     default_extract_context=lambda root_folder, folder, pipeline_xcoms=None: {},
+                     extract_context_from_session_path=lambda root_folder, folder, pipeline_xcoms=None: {},
+                     default_trigger_dagrun=lambda context, dag_run_obj: dag_run_obj,
+                     session_folder_trigger_dagrun=lambda context, dag_run_obj: dag_run_obj,
+                     default_build_daily_folder_path_callable=_daily_folder_path,
+                     default_accept_folder=lambda path: True,
+                     round_up_time=_round_up_time,
+                     FolderOperator=scan_flat)
+    _module('airflow_scan_folder', __path__=[])
+    _module('airflow_scan_folder.operators', ScanFlatFolderOperator=scan_flat, ScanDailyFolderOperator=scan_daily,
+            ScanFlatFolderPipelineOperator=scan_pipeline, common=common, __path__=[])
+    _module('airflow_scan_folder.operators.scan_folder_operator', ScanFlatFolderOperator=scan_flat,
+            ScanDailyFolderOperator=scan_daily)
+
+    try:
+        import sqlalchemy.exc  # noqa: F401
+    except ImportError:
+        _module('sqlalchemy', __path__=[])
+        _module('sqlalchemy.exc', IntegrityError=type('IntegrityError', (Exception,), {}))
+
+    _module('i2b2_import', __path__=[])
+    for name in ['data_catalog_import', 'features_csv_import', 'meta_files_import']:
+        _module('i2b2_import.' + name)
+
+    return configuration
@@ -0,0 +1 @@
+"""Operators used by the pipelines, extending the operators provided by the Airflow imaging plugins"""
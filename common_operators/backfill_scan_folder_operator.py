@@ -0,0 +1,173 @@
+"""
+
+BackfillDailyFolderOperator triggers a DAG run for each folder found in the daily folders matching path
+root_folder/yyyy/yyyyMMdd for a range of dates, scanning the daily folders concurrently.
+
+"""
+
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from airflow.exceptions import AirflowConfigException, AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow_scan_folder.operators import ScanDailyFolderOperator
+
+from common_operators.batch_trigger import BatchTriggerMixin
+from common_operators.scan_index import IGNORED_FOLDERS, ScanFolderMixin
+
+NEWEST_FIRST = 'newest'
+OLDEST_FIRST = 'oldest'
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def parse_backfill_date(value, name):
+    """Parse a date in the format yyyy-mm-dd, or return None if value is empty"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value.strip(), DATE_FORMAT)
+    except ValueError:
+        raise AirflowConfigException("Invalid date '%s' for %s, expected format is yyyy-mm-dd" % (value, name))
+
+
+def parse_backfill_order(value):
+    order = (value or NEWEST_FIRST).strip().lower()
+    if order not in [NEWEST_FIRST, OLDEST_FIRST]:
+        raise AirflowConfigException("Invalid backfill order '%s', expected %s or %s" % (
+            value, NEWEST_FIRST, OLDEST_FIRST))
+    return order
+
+
+class BackfillDailyFolderOperator(ScanFolderMixin, BatchTriggerMixin, ScanDailyFolderOperator):
+
+    """
+    Triggers a DAG run for each folder found in the daily folders of a range of dates.
+
+    The daily folders are scanned concurrently by a pool of threads, then the DAG runs are created in priority order:
+    the folders of the most recent days first if order is 'newest', the folders of the oldest days first if order is
+    'oldest'. The scheduler runs first the DAG runs with the oldest execution dates, so the execution date of each DAG
+    run is assigned from its rank: the first DAG run created gets the oldest execution date. When the DAG runs are
+    created in batches and wait for the running DAG runs to complete, the folders with the highest priority are
+    created first.
+
+    The range of dates can be overridden by the configuration of the DAG run, using the keys 'from', 'to' and 'order'.
+
+    A folder is ready if the ready marker file is not required for its date, or if the ready marker file is found in
+    the daily folder or in the folder itself. Folders containing the processing marker file are skipped.
+
+    :param from_date: first date to scan, as a datetime or a string yyyy-mm-dd
+    :type from_date: datetime
+    :param to_date: last date to scan, as a datetime or a string yyyy-mm-dd. Default to yesterday
+    :type to_date: datetime
+    :param order: 'newest' to trigger the most recent folders first, 'oldest' to trigger the oldest folders first
+    :type order: str
+    :param max_workers: number of threads scanning the daily folders. Default to 8
+    :type max_workers: int
+    :param processing_marker_file: name of the marker file indicating that the processing of a folder has already
+        started. Default to '.processing'
+    :type processing_marker_file: str
+
+    The depth parameter is the depth of the folders to trigger inside the daily folders: 0 to trigger the daily
+    folders themselves, 1 to trigger the session folders they contain.
+
+    See BatchTriggerMixin for the parameters controlling the creation of the DAG runs in batches, and
+    ScanDailyFolderOperator for the other parameters.
+    """
+
+    template_fields = tuple()
+    template_ext = tuple()
+    ui_color = '#cceeeb'
+
+    @apply_defaults
+    def __init__(
+            self,
+            from_date=None,
+            to_date=None,
+            order=NEWEST_FIRST,
+            max_workers=8,
+            processing_marker_file='.processing',
+            *args, **kwargs):
+        super(BackfillDailyFolderOperator, self).__init__(*args, **kwargs)
+        self.from_date = from_date
+        self.to_date = to_date
+        self.order = order
+        self.max_workers = max(1, max_workers)
+        self.processing_marker_file = processing_marker_file
+
+    def execute(self, context):
+        self.backfill_daily_dirs(self.folder, context)
+
+    def backfill_dates(self, context):
+        """Return the dates to scan, in priority order"""
+        dag_run = context.get('dag_run')
+        conf = (dag_run.conf if dag_run else None) or {}
+        from_date = parse_backfill_date(conf.get('from', self.from_date), 'from')
+        to_date = parse_backfill_date(conf.get('to', self.to_date), 'to')
+        order = parse_backfill_order(conf.get('order', self.order))
+        if to_date is None:
+            to_date = datetime.combine((datetime.now() - timedelta(days=1)).date(), datetime.min.time())
+        if from_date is None or from_date > to_date:
+            return []
+        dates = [from_date + timedelta(days=d) for d in range((to_date - from_date).days + 1)]
+        return list(reversed(dates)) if order == NEWEST_FIRST else dates
+
+    def scan_daily_folder(self, date):
+        """Return the folders ready for processing in the daily folder of a date"""
+        daily_folder = self.build_daily_folder_path_callable(self.folder, date)
+        if not os.path.isdir(daily_folder):
+            return []
+        look_for_ready_marker_file = self.look_for_ready_marker_file(date)
+
+        folders = [daily_folder]
+        for _ in range(self.depth):
+            sub_folders = []
+            for folder in folders:
+                try:
+                    with os.scandir(folder) as entries:
+                        sub_folders.extend(sorted(entry.path for entry in entries
+                                                  if entry.name not in IGNORED_FOLDERS and entry.is_dir() and
+                                                  self.accept_folder(entry.path)))
+                except OSError as e:
+                    logging.warning("Cannot list folder %s: %s", folder, e)
+            folders = sub_folders
+
+        ready_folders = []
+        for folder in folders:
+            if os.path.exists(os.path.join(folder, self.processing_marker_file)):
+                continue
+            if self.is_ready(daily_folder, folder, look_for_ready_marker_file):
+                ready_folders.append(folder)
+        return ready_folders
+
+    @provide_session
+    def backfill_daily_dirs(self, folder, context, session=None):
+        if not os.path.exists(folder):
+            raise AirflowSkipException
+
+        dates = self.backfill_dates(context)
+        if not dates:
+            logging.info("No dates to backfill")
+            raise AirflowSkipException
+
+        logging.info("Scan the daily folders from %s to %s with %d threads", min(dates).strftime(DATE_FORMAT),
+                     max(dates).strftime(DATE_FORMAT), self.max_workers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            folders_by_date = list(executor.map(self.scan_daily_folder, dates))
+        folders = [f for date_folders in folders_by_date for f in date_folders]
+        logging.info("%d folder(s) found in %d daily folder(s)", len(folders), len(dates))
+
+        # The execution date of a DAG run is offset minutes before now, the first DAG run created gets the oldest
+        # execution date and is scheduled first
+        base_offset = self.offset
+        for rank, path in enumerate(folders):
+            self.offset = base_offset + len(folders) - 1 - rank
+            logging.info('Prepare trigger for %s : %s', self.trigger_dag_id, path)
+            self.trigger_dag_run(context, root_folder=self.root_folder(context), folder=path, session=session)
+        self.offset = base_offset + len(folders)
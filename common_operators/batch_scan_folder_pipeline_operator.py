@@ -0,0 +1,29 @@
+"""
+
+BatchScanFlatFolderPipelineOperator triggers a DAG run for each folder discovered in a parent folder, where the parent
+folder location is provided by the pipeline XComs, creating the DAG runs in batches.
+
+"""
+
+from airflow.utils import apply_defaults
+from airflow_scan_folder.operators import ScanFlatFolderPipelineOperator
+
+from common_operators.batch_trigger import BatchTriggerMixin
+
+
+class BatchScanFlatFolderPipelineOperator(BatchTriggerMixin, ScanFlatFolderPipelineOperator):
+
+    """
+    Triggers a DAG run for a specified ``dag_id`` for each folder discovered in a parent folder.
+
+    See BatchTriggerMixin for the parameters controlling the creation of the DAG runs in batches, and
+    ScanFlatFolderPipelineOperator for the other parameters.
+    """
+
+    template_fields = ('incoming_parameters',)
+    template_ext = tuple()
+    ui_color = '#cceeeb'
+
+    @apply_defaults
+    def __init__(self, *args, **kwargs):
+        super(BatchScanFlatFolderPipelineOperator, self).__init__(*args, **kwargs)
@@ -0,0 +1,269 @@
+"""
+
+Batched creation of the DAG runs triggered by the scan operators.
+
+By default, the scan operators create and commit one DAG run for each folder found. With BatchTriggerMixin, the DAG
+runs are queued and inserted in the Airflow database in batches, each batch in one transaction, at a limited rate.
+The task instances of the DAG runs of a batch are created once the batch is committed, as DAG.create_dagrun does.
+When the number of DAG runs still running for the triggered DAG reaches a limit, the operator waits for some of them
+to complete before inserting the next batch, so a large scan does not flood the scheduler.
+
+Configuration variables used, in the pipeline section of the scanner or of the trigger steps:
+
+* TRIGGER_BATCH_SIZE: number of DAG runs inserted in one transaction. Default to 1, DAG runs are created one by one
+* TRIGGER_RATE_LIMIT: maximum number of DAG runs created per second. Default to 0, no limit
+* MAX_QUEUED_DAG_RUNS: maximum number of running DAG runs for the triggered DAG before the creation of new DAG runs
+  is suspended. Default to 0, no limit
+
+"""
+
+import copy
+import logging
+import random
+import time
+
+from datetime import datetime, timedelta
+
+# Time to wait between two checks of the number of running DAG runs, in seconds
+BACKPRESSURE_CHECK_INTERVAL = 30
+
+# Attempts to insert a DAG run conflicting with the DAG runs created by a concurrent scan
+MAX_INSERT_ATTEMPTS = 10
+
+# Timeout of the scan tasks waiting for the DAG runs to complete before creating new ones
+BACKPRESSURE_EXECUTION_TIMEOUT = timedelta(hours=24)
+
+
+def trigger_args_from_config(pipeline_config):
+    """Return the arguments of the batched trigger defined in a pipeline section, or an empty dictionary"""
+    trigger_batch_size = pipeline_config.getint('TRIGGER_BATCH_SIZE', '1')
+    trigger_rate_limit = pipeline_config.getfloat('TRIGGER_RATE_LIMIT', '0')
+    max_queued_dag_runs = pipeline_config.getint('MAX_QUEUED_DAG_RUNS', '0')
+    if trigger_batch_size <= 1 and trigger_rate_limit <= 0 and max_queued_dag_runs <= 0:
+        return {}
+    return {'trigger_batch_size': max(1, trigger_batch_size),
+            'trigger_rate_limit': max(0.0, trigger_rate_limit),
+            'max_queued_dag_runs': max(0, max_queued_dag_runs)}
+
+
+def trigger_execution_timeout(trigger_args, execution_timeout):
+    """Extend the execution timeout of a scan task that may wait for the DAG runs it triggered to complete"""
+    if trigger_args.get('max_queued_dag_runs'):
+        return max(execution_timeout, BACKPRESSURE_EXECUTION_TIMEOUT)
+    return execution_timeout
+
+
+def describe_trigger_args(trigger_args):
+    """Describe the batched trigger in Markdown, for the documentation of the tasks"""
+    if not trigger_args:
+        return "DAG runs are created one by one."
+    return "DAG runs are created in batches of __%d__, at most __%s__ per second, while less than __%s__ DAG runs " \
+           "are running." % (trigger_args['trigger_batch_size'], trigger_args['trigger_rate_limit'] or 'unlimited',
+                             trigger_args['max_queued_dag_runs'] or 'unlimited')
+
+
+class BatchTriggerMixin(object):
+
+    """
+    Mixin for the scan operators creating the DAG runs in batches.
+
+    Place it before the scan operator class in the bases of an operator. The DAG runs queued are flushed when a
+    batch is full and after the execution of the operator. If the execution fails, the DAG runs still queued are
+    dropped and the next try of the task triggers them again.
+
+    :param trigger_batch_size: number of DAG runs inserted in one transaction. Default to 1
+    :type trigger_batch_size: int
+    :param trigger_rate_limit: maximum number of DAG runs created per second, 0 for no limit
+    :type trigger_rate_limit: float
+    :param max_queued_dag_runs: maximum number of running DAG runs for the triggered DAG, 0 for no limit
+    :type max_queued_dag_runs: int
+    """
+
+    def __init__(self, trigger_batch_size=1, trigger_rate_limit=0.0, max_queued_dag_runs=0, *args, **kwargs):
+        super(BatchTriggerMixin, self).__init__(*args, **kwargs)
+        self.trigger_batch_size = trigger_batch_size
+        self.trigger_rate_limit = trigger_rate_limit
+        self.max_queued_dag_runs = max_queued_dag_runs
+        self._queued_dag_runs = []
+        self._last_flush_time = None
+        self._triggered_dag = None
+
+    def batch_trigger_enabled(self):
+        return self.trigger_batch_size > 1 or self.trigger_rate_limit > 0 or self.max_queued_dag_runs > 0
+
+    def post_execute(self, context, *args, **kwargs):
+        super(BatchTriggerMixin, self).post_execute(context, *args, **kwargs)
+        if self._queued_dag_runs:
+            self.flush_dag_runs()
+
+    def trigger_dag_run(self, context, root_folder, folder, session=None):
+        if not self.batch_trigger_enabled():
+            return super(BatchTriggerMixin, self).trigger_dag_run(context, root_folder=root_folder, folder=folder,
+                                                                  session=session)
+
+        from airflow.operators.dagrun_operator import DagRunOrder
+        from airflow_scan_folder.operators.common import round_up_time
+
+        context = copy.copy(context)
+        context['params'] = dict(context['params'])
+        context['params']['dataset'] = self.dataset
+        if self.extract_context_callable:
+            context['params'].update(self.extract_context_callable(
+                root_folder=root_folder, folder=folder, pipeline_xcoms=self.pipeline_xcoms))
+
+        execution_date = round_up_time(datetime.now() - timedelta(minutes=self.offset))
+        context['start_date'] = execution_date
+        dro = self.trigger_dag_run_callable(context, DagRunOrder(run_id="trig__%s" % execution_date.isoformat()))
+        if not dro:
+            logging.info("Criteria not met, moving on")
+            return
+
+        self._queued_dag_runs.append((dro.run_id, execution_date, dro.payload))
+        if len(self._queued_dag_runs) >= self.trigger_batch_size:
+            self.flush_dag_runs()
+
+    def flush_dag_runs(self, session=None):
+        """Create the DAG runs queued in one transaction"""
+        from airflow.models import DagRun
+        from airflow.settings import Session
+        from airflow.utils.state import State
+
+        own_session = session is None
+        session = session or Session()
+        try:
+            self.wait_for_running_dag_runs(session)
+            self.wait_for_rate_limit()
+            batch, self._queued_dag_runs = self._queued_dag_runs, []
+            if not batch:
+                return
+
+            # Skip the DAG runs already triggered, and move the execution dates already used further in the past
+            run_ids = [run_id for run_id, _, _ in batch]
+            existing_run_ids = set(r[0] for r in session.query(DagRun.run_id).filter(
+                DagRun.dag_id == self.trigger_dag_id, DagRun.run_id.in_(run_ids)))
+            dates = [execution_date for _, execution_date, _ in batch]
+            window_start = min(dates) - timedelta(minutes=len(batch))
+            used_dates = self.used_execution_dates(session, window_start, max(dates))
+
+            now = datetime.now()
+            dag_runs = []
+            for run_id, execution_date, payload in batch:
+                if run_id in existing_run_ids:
+                    logging.info("DAG run %s already exists for %s, skipped", run_id, self.trigger_dag_id)
+                    continue
+                existing_run_ids.add(run_id)
+                while True:
+                    if execution_date < window_start:
+                        # Moved before the dates already loaded, load the dates used before them
+                        window_end, window_start = window_start, execution_date - timedelta(minutes=len(batch))
+                        used_dates.update(self.used_execution_dates(session, window_start, window_end))
+                    if execution_date not in used_dates:
+                        break
+                    self.offset += 1
+                    execution_date -= timedelta(minutes=1)
+                used_dates.add(execution_date)
+                dag_runs.append(DagRun(dag_id=self.trigger_dag_id, run_id=run_id, execution_date=execution_date,
+                                       start_date=now, state=State.RUNNING, conf=payload, external_trigger=True))
+
+            dag_runs = self.insert_dag_runs(session, dag_runs)
+            self.verify_dag_runs(session, dag_runs)
+            self._last_flush_time = time.time()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if own_session:
+                session.close()
+
+    def used_execution_dates(self, session, start_date, end_date):
+        """Execution dates of the DAG runs of the triggered DAG between two dates, included"""
+        from airflow.models import DagRun
+
+        return set(r[0] for r in session.query(DagRun.execution_date).filter(
+            DagRun.dag_id == self.trigger_dag_id, DagRun.execution_date >= start_date,
+            DagRun.execution_date <= end_date))
+
+    def insert_dag_runs(self, session, dag_runs):
+        """Insert the DAG runs in one transaction, or one by one on conflict, and return the DAG runs created"""
+        from airflow.models import DagRun
+        from sqlalchemy.exc import IntegrityError
+
+        try:
+            session.add_all(dag_runs)
+            session.commit()
+            logging.info("Created %d DagRun(s) for %s", len(dag_runs), self.trigger_dag_id)
+            return dag_runs
+        except IntegrityError:
+            # A concurrent scan created some of the DAG runs, insert the others one by one
+            session.rollback()
+
+        created = []
+        for dag_run in dag_runs:
+            for _ in range(MAX_INSERT_ATTEMPTS):
+                session.add(dag_run)
+                try:
+                    session.commit()
+                    created.append(dag_run)
+                    break
+                except IntegrityError:
+                    session.rollback()
+                if session.query(DagRun).filter(DagRun.dag_id == self.trigger_dag_id,
+                                                DagRun.run_id == dag_run.run_id).count():
+                    logging.info("DAG run %s already created for %s by a concurrent scan, skipped", dag_run.run_id,
+                                 self.trigger_dag_id)
+                    break
+                # The execution date is used by a concurrent scan, retry further in the past like the scan operators
+                shift = random.randint(1, 100)
+                self.offset += shift
+                dag_run.execution_date -= timedelta(minutes=shift)
+            else:
+                logging.warning("Cannot create DagRun %s for %s after %d attempts, it conflicts with existing DagRuns",
+                                dag_run.run_id, self.trigger_dag_id, MAX_INSERT_ATTEMPTS)
+        logging.info("Created %d DagRun(s) for %s", len(created), self.trigger_dag_id)
+        return created
+
+    def verify_dag_runs(self, session, dag_runs):
+        """Create the task instances of the DAG runs created, as DAG.create_dagrun does"""
+        if not dag_runs:
+            return
+        dag = self.triggered_dag()
+        if dag is None:
+            logging.warning("DAG %s not found, the scheduler will create the task instances of its DAG runs",
+                            self.trigger_dag_id)
+            return
+        for dag_run in dag_runs:
+            dag_run.dag = dag
+            dag_run.verify_integrity(session=session)
+
+    def triggered_dag(self):
+        if self._triggered_dag is None:
+            from airflow import settings
+            from airflow.models import DagBag
+
+            self._triggered_dag = DagBag(settings.DAGS_FOLDER).get_dag(self.trigger_dag_id)
+        return self._triggered_dag
+
+    def wait_for_running_dag_runs(self, session):
+        if not self.max_queued_dag_runs:
+            return
+        from airflow.models import DagRun
+        from airflow.utils.state import State
+
+        batch_size = len(self._queued_dag_runs)
+        while True:
+            running = session.query(DagRun).filter(DagRun.dag_id == self.trigger_dag_id,
+                                                   DagRun.state == State.RUNNING).count()
+            if running == 0 or running + batch_size <= self.max_queued_dag_runs:
+                return
+            logging.info("%d DAG runs are running for %s, waiting before creating %d more", running,
+                         self.trigger_dag_id, batch_size)
+            session.commit()
+            time.sleep(BACKPRESSURE_CHECK_INTERVAL)
+
+    def wait_for_rate_limit(self):
+        if not self.trigger_rate_limit or self._last_flush_time is None:
+            return
+        min_interval = len(self._queued_dag_runs) / self.trigger_rate_limit
+        elapsed = time.time() - self._last_flush_time
+        if elapsed < min_interval:
+            time.sleep(min_interval - elapsed)
@@ -0,0 +1,267 @@
+"""
+
+Conversion of DICOM series to Nifti format in Python.
+
+The DCM2NII_LREN SPM function converts a session by starting MATLAB and calling the dcm2nii program on each series.
+For the standard anatomical protocols, made of one 2D image per file stacked into a 3D volume, the conversion only
+requires the geometry found in the DICOM headers: DicomToNiftiConverter reads the headers with pydicom, sorts the
+slices along the normal of the image plane, stacks the pixel data and writes the volume with nibabel, without MATLAB.
+The series are converted in parallel by a pool of processes.
+
+The series which cannot be converted this way are skipped and reported with the reason, for example multi-frame or
+mosaic images, compressed pixel data, several volumes in one series or slices not evenly spaced.
+
+When a protocols definition file is given, only the series whose protocol name (or series description when the
+protocol name is missing) is listed in the file are converted, see common_operators.series_index.read_protocols().
+With the series index of the session, the series folders of other protocols are skipped without reading their files.
+
+Importing this module loads pydicom, nibabel and numpy, only import it when the Python converter is used.
+
+"""
+
+import logging
+import os
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel
+import numpy
+import pydicom
+
+from pydicom.errors import InvalidDicomError
+
+from common_operators.series_index import MEDIA_STORAGE_DIRECTORY, protocol_name, read_protocols, unmatched_folders
+
+# Maximum relative difference between the spacing of two consecutive slices
+SLICE_SPACING_TOLERANCE = 0.01
+
+
+class UnsupportedSeries(Exception):
+    """Raised when a series cannot be converted by the Python converter"""
+    pass
+
+
+def find_series(session_folder):
+    """Return the path relative to the session folder of the folders containing files, sorted"""
+    series = []
+    for path, _, file_names in os.walk(session_folder):
+        if any(not file_name.startswith('.') for file_name in file_names):
+            series.append(os.path.relpath(path, session_folder))
+    return sorted(series)
+
+
+def _read_headers(series_folder):
+    headers = []
+    for file_name in sorted(os.listdir(series_folder)):
+        path = os.path.join(series_folder, file_name)
+        if file_name.startswith('.') or not os.path.isfile(path):
+            continue
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True)
+        except (InvalidDicomError, EOFError):
+            logging.debug("Not a DICOM file: %s", path)
+            continue
+        if ds.get('SOPClassUID') == MEDIA_STORAGE_DIRECTORY:
+            continue
+        headers.append((path, ds))
+    return headers
+
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'series'
+
+
+def _check_supported(headers):
+    first = headers[0][1]
+    for path, ds in headers:
+        file_meta = getattr(ds, 'file_meta', None)
+        transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+        if transfer_syntax is not None and transfer_syntax.is_compressed:
+            raise UnsupportedSeries("compressed pixel data (%s)" % transfer_syntax.name)
+        if int(ds.get('NumberOfFrames') or 1) > 1:
+            raise UnsupportedSeries("multi-frame image")
+        if 'MOSAIC' in [str(value).upper() for value in ds.get('ImageType') or []]:
+            raise UnsupportedSeries("mosaic image")
+        if int(ds.get('SamplesPerPixel') or 1) != 1:
+            raise UnsupportedSeries("colour image")
+        for keyword in ('ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'Rows', 'Columns'):
+            if ds.get(keyword) is None:
+                raise UnsupportedSeries("missing %s in %s" % (keyword, os.path.basename(path)))
+        if (ds.Rows, ds.Columns) != (first.Rows, first.Columns):
+            raise UnsupportedSeries("images of different sizes")
+        if not numpy.allclose([float(v) for v in ds.ImageOrientationPatient],
+                              [float(v) for v in first.ImageOrientationPatient], atol=1e-4):
+            raise UnsupportedSeries("images with different orientations")
+
+
+def _sort_slices(headers):
+    """Sort the slices along the normal of the image plane, return the sorted headers and the slice step vector"""
+    orientation = numpy.array([float(v) for v in headers[0][1].ImageOrientationPatient])
+    normal = numpy.cross(orientation[:3], orientation[3:])
+    positions = [numpy.array([float(v) for v in ds.ImagePositionPatient]) for _, ds in headers]
+    distances = [float(numpy.dot(position, normal)) for position in positions]
+    order = numpy.argsort(distances, kind='stable')
+    sorted_distances = [distances[i] for i in order]
+
+    if len(headers) == 1:
+        thickness = float(headers[0][1].get('SliceThickness') or 1.0)
+        return headers, normal * thickness
+
+    spacings = numpy.diff(sorted_distances)
+    if numpy.any(numpy.isclose(spacings, 0.0, atol=1e-4)):
+        raise UnsupportedSeries("several volumes in the series")
+    if numpy.max(numpy.abs(spacings - spacings.mean())) > SLICE_SPACING_TOLERANCE * abs(spacings.mean()):
+        raise UnsupportedSeries("slices not evenly spaced")
+    step = (positions[order[-1]] - positions[order[0]]) / (len(headers) - 1)
+    return [headers[i] for i in order], step
+
+
+def _affine(first, step):
+    """Affine transform from the voxel indices to the RAS+ coordinates of the scanner"""
+    orientation = numpy.array([float(v) for v in first.ImageOrientationPatient])
+    row_spacing, column_spacing = [float(v) for v in first.PixelSpacing]
+    affine = numpy.identity(4)
+    # The first voxel index runs along a row (columns), the second index along a column (rows)
+    affine[:3, 0] = orientation[:3] * column_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = [float(v) for v in first.ImagePositionPatient]
+    # DICOM uses LPS+ coordinates, Nifti uses RAS+ coordinates
+    return numpy.diag([-1.0, -1.0, 1.0, 1.0]).dot(affine)
+
+
+def convert_series(session_folder, series, nifti_session_folder, protocols=None):
+    """Convert the DICOM files of a series folder to Nifti files.
+
+    The Nifti files are written to the folder of the same relative path inside nifti_session_folder, one file per
+    DICOM series found in the folder.
+
+    :return: a report of the conversion, with 'result' set to 1 when the series is converted, 0 when it is skipped
+    """
+    start = time.time()
+    report = {'series': series, 'result': 0, 'files': [], 'skipped': []}
+    headers = _read_headers(os.path.join(session_folder, series))
+    by_uid = {}
+    for path, ds in headers:
+        by_uid.setdefault(str(ds.get('SeriesInstanceUID', '')), []).append((path, ds))
+
+    for index, uid in enumerate(sorted(by_uid)):
+        series_headers = by_uid[uid]
+        first = series_headers[0][1]
+        protocol = protocol_name(first)
+        if protocols is not None and protocol not in protocols:
+            report['skipped'].append({'protocol': protocol, 'reason': 'protocol not defined'})
+            continue
+        try:
+            _check_supported(series_headers)
+            series_headers, step = _sort_slices(series_headers)
+        except UnsupportedSeries as e:
+            logging.info("Series %s (%s) not converted: %s", series, protocol, e)
+            report['skipped'].append({'protocol': protocol, 'reason': str(e)})
+            continue
+
+        slices = []
+        slopes = []
+        for path, ds in series_headers:
+            pixels = pydicom.dcmread(path).pixel_array
+            slices.append(pixels.T)
+            slopes.append((float(ds.get('RescaleSlope') or 1.0), float(ds.get('RescaleIntercept') or 0.0)))
+        data = numpy.stack(slices, axis=-1)
+        if len(set(slopes)) > 1:
+            data = numpy.stack([s * slope + intercept for s, (slope, intercept) in zip(slices, slopes)],
+                               axis=-1).astype(numpy.float32)
+            slopes = [(1.0, 0.0)]
+
+        affine = _affine(series_headers[0][1], step)
+        image = nibabel.Nifti1Image(data, affine)
+        image.header.set_xyzt_units('mm', 'sec')
+        image.header.set_slope_inter(*slopes[0])
+        image.set_qform(affine, code=1)
+        image.set_sform(affine, code=1)
+
+        name = '%s_%s' % (_safe_name(protocol), first.get('SeriesNumber', index))
+        if len(by_uid) > 1:
+            name += '_%d' % (index + 1)
+        target_folder = os.path.join(nifti_session_folder, series)
+        os.makedirs(target_folder, exist_ok=True)
+        target = os.path.join(target_folder, name + '.nii')
+        nibabel.save(image, target)
+        report['files'].append(os.path.relpath(target, nifti_session_folder))
+        report['result'] = 1
+
+    report['seconds'] = round(time.time() - start, 3)
+    return report
+
+
+class DicomToNiftiConverter:
+
+    """Convert the DICOM series of a session to Nifti files with a pool of processes.
+
+    :param workers: number of series converted in parallel, 1 to convert them in the current process
+    :param protocols_definition_file: file listing the protocols to convert, all series are converted if empty
+    """
+
+    def __init__(self, workers=1, protocols_definition_file=None):
+        self.workers = max(1, workers)
+        self.protocols = read_protocols(protocols_definition_file)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def convert_session(self, session_folder, nifti_session_folder, folder=None, series_index=None):
+        """Convert all the series folders of the session, or the series folders found in one of its folders given by
+        its relative path, return a report.
+
+        :param series_index: series index of the session, see common_operators.series_index
+        """
+        start = time.time()
+        if folder:
+            all_series = [os.path.normpath(os.path.join(folder, series))
+                          for series in find_series(os.path.join(session_folder, folder))]
+        else:
+            all_series = find_series(session_folder)
+        skipped = []
+        if series_index and self.protocols is not None:
+            unmatched = unmatched_folders(series_index)
+            skipped = [{'series': series, 'result': 0, 'files': [],
+                        'skipped': [{'protocol': s['protocol'], 'reason': 'protocol not defined'}
+                                    for s in series_index['series'] if s['folder'] == series]}
+                       for series in all_series if series in unmatched]
+            all_series = [series for series in all_series if series not in unmatched]
+        if self.executor:
+            futures = [self.executor.submit(convert_series, session_folder, series, nifti_session_folder,
+                                            self.protocols) for series in all_series]
+            converted = [future.result() for future in futures]
+        else:
+            converted = [convert_series(session_folder, series, nifti_session_folder, self.protocols)
+                         for series in all_series]
+        converted += skipped
+        report = {'series': len(converted),
+                  'converted': converted,
+                  'files': sum(len(series['files']) for series in converted),
+                  'seconds': round(time.time() - start, 3)}
+        logging.info("Converted %d Nifti files from %d series folders in %.1fs with %d worker(s)",
+                     report['files'], report['series'], report['seconds'], self.workers)
+        return report
+
+
+def report_output(report):
+    """Summary of a conversion report, one line per series folder"""
+    lines = []
+    for series in report['converted']:
+        for file_name in series['files']:
+            lines.append("%s: converted to %s" % (series['series'], file_name))
+        for skipped in series['skipped']:
+            lines.append("%s: %s not converted, %s" % (series['series'], skipped['protocol'], skipped['reason']))
+    return '\n'.join(lines)
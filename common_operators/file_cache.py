@@ -0,0 +1,229 @@
+"""
+
+Content-addressed cache of the files copied to the local disk.
+
+When a session is processed again, after a failure or with a newer version of the pipelines, its local copy has
+usually been removed by the cleanup step and the whole session would be copied again from the network share. The
+files copied are kept in a cache on the local disk, in a folder objects/<xx>/<sha256 of the content>, and an index
+maps the path, size and modification time of each source file to the content of its copy. A file found in the
+index is hard-linked from the cache instead of being copied again, so copying a session already seen costs only
+metadata operations on the local disk. Files with the same content, for example the same session reorganised in two
+folders, are stored once.
+
+The cache folder must be on the same filesystem as the local copies to hard-link the files. The files in the cache
+are read-only: the local copies share their content with the cache and must not be modified in place.
+
+Files in the cache are evicted in least recently used order when the free space on the local disk drops below a
+threshold. Files still linked from a local copy are never evicted, as removing them would not free any space. The
+cache is evicted by the copy of a session, and by the check_local_free_space sensor before it checks or reserves
+the free space, so that the sessions waiting for space are never blocked by files only held by the cache.
+
+The index is a SQLite database stored in the cache folder. To show the content of the cache or evict files manually:
+
+    python -m common_operators.file_cache stats <cache folder>
+    python -m common_operators.file_cache evict <cache folder> <min free space>
+
+"""
+
+import argparse
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import sys
+import threading
+import time
+
+INDEX_FILE = 'index.sqlite'
+OBJECTS_FOLDER = 'objects'
+TMP_FOLDER = 'tmp'
+
+READ_ONLY = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def content_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileCache:
+
+    """Cache of file contents, indexed by the path, size and modification time of their source.
+
+    The methods can be called from several threads.
+    """
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+        self.enabled = True
+        for folder in [OBJECTS_FOLDER, TMP_FOLDER]:
+            os.makedirs(os.path.join(cache_folder, folder), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_folder, INDEX_FILE), timeout=60, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS source_file (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS object (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS object_by_last_used ON object (last_used);
+            CREATE INDEX IF NOT EXISTS source_file_by_digest ON source_file (digest);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_folder, OBJECTS_FOLDER, digest[:2], digest)
+
+    def link(self, source, source_stat, target):
+        """Hard-link the cached copy of the source file to the target path.
+
+        :return: True if the source file was found in the cache
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            row = self.conn.execute("SELECT digest FROM source_file WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                    (source, source_stat.st_size, source_stat.st_mtime_ns)).fetchone()
+        if not row:
+            return False
+        try:
+            self._replace_with_link(self.object_path(row[0]), target)
+        except FileNotFoundError:
+            # Evicted by another process
+            return False
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE object SET last_used = ? WHERE digest = ?", (time.time(), row[0]))
+        return True
+
+    def add(self, source, source_stat, target):
+        """Store the copy of the source file in the cache. The target file is replaced by a link to the cache."""
+        if not self.enabled:
+            return
+        digest = content_digest(target)
+        object_path = self.object_path(digest)
+        os.chmod(target, stat.S_IMODE(os.stat(target).st_mode) & READ_ONLY)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            os.link(target, object_path)
+        except FileExistsError:
+            # Same content already cached, share it
+            self._replace_with_link(object_path, target)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            logging.warning("Cannot hard-link files from %s to %s, the local cache is disabled: %s",
+                            self.cache_folder, os.path.dirname(target), e)
+            self.enabled = False
+            return
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO source_file (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                              (source, source_stat.st_size, source_stat.st_mtime_ns, digest))
+            self.conn.execute("INSERT OR REPLACE INTO object (digest, size, last_used) VALUES (?, ?, ?)",
+                              (digest, source_stat.st_size, time.time()))
+
+    def _replace_with_link(self, object_path, target):
+        tmp_path = os.path.join(self.cache_folder, TMP_FOLDER, '%d-%d-%s' % (
+            os.getpid(), threading.get_ident(), os.path.basename(object_path)))
+        os.link(object_path, tmp_path)
+        try:
+            os.replace(tmp_path, target)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def free_space_ratio(self):
+        usage = shutil.disk_usage(self.cache_folder)
+        return usage.free / usage.total
+
+    def evict(self, min_free_space):
+        """Evict the least recently used files not linked from a local copy until the ratio of free space on the disk
+        is at least min_free_space.
+
+        :return: the number of files and bytes evicted
+        """
+        evicted_files = 0
+        evicted_bytes = 0
+        if self.free_space_ratio() >= min_free_space:
+            return evicted_files, evicted_bytes
+
+        with self._lock:
+            candidates = self.conn.execute("SELECT digest FROM object ORDER BY last_used").fetchall()
+        for (digest,) in candidates:
+            object_path = self.object_path(digest)
+            try:
+                st = os.stat(object_path)
+                if st.st_nlink > 1:
+                    continue
+                os.remove(object_path)
+                evicted_files += 1
+                evicted_bytes += st.st_size
+            except FileNotFoundError:
+                pass
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM source_file WHERE digest = ?", (digest,))
+                self.conn.execute("DELETE FROM object WHERE digest = ?", (digest,))
+            if self.free_space_ratio() >= min_free_space:
+                break
+
+        logging.info("Local cache %s: evicted %d file(s), %.1f MB", self.cache_folder, evicted_files,
+                     evicted_bytes / 1024 / 1024)
+        return evicted_files, evicted_bytes
+
+    def stats(self):
+        with self._lock:
+            files, size = self.conn.execute("SELECT count(*), coalesce(sum(size), 0) FROM object").fetchone()
+            sources = self.conn.execute("SELECT count(*) FROM source_file").fetchone()[0]
+        return {'files': files, 'bytes': size, 'source_files': sources}
+
+
+def evict_cache(cache_folder, min_free_space):
+    """Evict files from the cache stored in cache_folder until the ratio of free space on the disk is at least
+    min_free_space, see FileCache.evict()"""
+    with FileCache(cache_folder) as cache:
+        return cache.evict(min_free_space)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the local file cache of the copy_to_local step')
+    subparsers = parser.add_subparsers(dest='command')
+    stats_parser = subparsers.add_parser('stats', help='show the content of the cache')
+    stats_parser.add_argument('cache_folder')
+    evict_parser = subparsers.add_parser('evict', help='evict files until the ratio of free space is reached')
+    evict_parser.add_argument('cache_folder')
+    evict_parser.add_argument('min_free_space', type=float, help='ratio of free space to reach, between 0 and 1')
+    args = parser.parse_args(argv)
+
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+    with FileCache(args.cache_folder) as cache:
+        if args.command == 'evict':
+            cache.evict(args.min_free_space)
+        stats = cache.stats()
+        print("%d file(s), %.1f MB, %d source file(s) indexed, %.0f%% free space" % (
+            stats['files'], stats['bytes'] / 1024 / 1024, stats['source_files'], cache.free_space_ratio() * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+
+Fingerprints of the inputs and of the code of a pipeline step.
+
+A fingerprint summarises the state of the files used by a step in a short digest, to detect whether the inputs or the
+pipeline scripts changed since the step was last run:
+
+* data folders are summarised by the path, size and modification time of their files, without reading them. The
+  modification times are rounded to the second, as some copies of the staged data do not preserve the sub-second part
+* code and configuration files (MATLAB scripts, protocols definition file...) are summarised by their content when
+  they are smaller than CONTENT_DIGEST_MAX_SIZE, by their size and modification time otherwise (templates, atlases)
+
+Hidden files and folders, whose name starts with a dot, are ignored.
+
+"""
+
+import hashlib
+import json
+import os
+
+# Files larger than this size are summarised by their size and modification time instead of their content
+CONTENT_DIGEST_MAX_SIZE = 1024 * 1024
+
+
+def _files(path):
+    if os.path.isfile(path):
+        yield os.path.basename(path), path
+        return
+    for folder, folder_names, file_names in os.walk(path):
+        folder_names[:] = sorted(name for name in folder_names if not name.startswith('.'))
+        for file_name in sorted(file_names):
+            if not file_name.startswith('.'):
+                file_path = os.path.join(folder, file_name)
+                yield os.path.relpath(file_path, path), file_path
+
+
+def _file_digest(path, content):
+    stat = os.stat(path)
+    if content and stat.st_size <= CONTENT_DIGEST_MAX_SIZE:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return '%d:%s' % (stat.st_size, digest.hexdigest())
+    return '%d:%d' % (stat.st_size, int(stat.st_mtime))
+
+
+def output_files(output_folder):
+    """Size of each file of an output folder, including the hidden files, by path relative to the folder"""
+    files = {}
+    for folder, _, file_names in os.walk(output_folder):
+        for file_name in file_names:
+            path = os.path.join(folder, file_name)
+            files[os.path.relpath(path, output_folder)] = os.path.getsize(path)
+    return files
+
+
+def path_fingerprint(path, content=False):
+    """Digest of a file or of the files of a folder, '' if the path does not exist.
+
+    :param content: True to digest the content of the small files, False to use only their size and modification time
+    """
+    if not path or not os.path.exists(path):
+        return ''
+    digest = hashlib.sha1()
+    for relative_path, file_path in _files(path):
+        digest.update(('%s=%s\n' % (relative_path, _file_digest(file_path, content))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def step_fingerprint(input_folder=None, code_paths=None, config_files=None, parameters=None):
+    """Fingerprint of a step, as a dict with the digest of each component and the key combining them.
+
+    :param input_folder: folder containing the data processed by the step
+    :param code_paths: folders or files containing the scripts of the step
+    :param config_files: configuration files read by the step
+    :param parameters: JSON serialisable parameters of the step, such as the name of the function called
+    """
+    components = {'input': path_fingerprint(input_folder),
+                  'code': [path_fingerprint(path, content=True) for path in code_paths or []],
+                  'config': [path_fingerprint(path, content=True) for path in config_files or []],
+                  'parameters': parameters or {}}
+    key = hashlib.sha1(json.dumps(components, sort_keys=True).encode('utf-8')).hexdigest()
+    return {'key': key, 'components': components}
+
+
+def changed_components(fingerprint, previous):
+    """Names of the components which differ between two fingerprints"""
+    if not previous:
+        return ['all']
+    return sorted(name for name, value in fingerprint['components'].items()
+                  if previous.get('components', {}).get(name) != value)
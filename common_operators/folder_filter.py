@@ -0,0 +1,95 @@
+"""
+
+Filters on the names of the folders traversed by the scanners.
+
+A FolderFilter accepts a folder if its name fully matches the include pattern and does not fully match the exclude
+pattern defined for its depth, or the default patterns when no pattern is defined for this depth. The depth of a
+folder is counted from the root folder of the scan: the folders directly inside the root folder have a depth of 1.
+
+Used as the accept folder function of the scan operators, which do not traverse the folders rejected, a filter prunes
+whole sub-trees as soon as their top folder is listed.
+
+Configuration variables used, in the pipeline section using the filter:
+
+* FOLDER_FILTER: regex that the folder names should fully match, at any depth. Default to .*
+* FOLDER_EXCLUDE: optional regex that the folder names should not fully match, at any depth
+* FOLDER_FILTER_&lt;depth&gt;: optional regex replacing FOLDER_FILTER for the folders at this depth
+* FOLDER_EXCLUDE_&lt;depth&gt;: optional regex replacing FOLDER_EXCLUDE for the folders at this depth
+
+"""
+
+import os
+import re
+
+ACCEPT_ALL = '.*'
+
+
+def _compile(pattern):
+    if not pattern or pattern == ACCEPT_ALL:
+        return None
+    return re.compile(pattern)
+
+
+class FolderFilter:
+
+    """Filter on the folder names, with include and exclude patterns defined per depth.
+
+    :param include: regex that the folder names should fully match, None or empty to accept all names
+    :param exclude: regex that the folder names should not fully match, None or empty to exclude nothing
+    :param depth_include: dictionary of depth to include regex, overriding include for this depth
+    :param depth_exclude: dictionary of depth to exclude regex, overriding exclude for this depth
+    :param root_folder: root folder of the scan, required to use the patterns per depth
+    """
+
+    def __init__(self, include=None, exclude=None, depth_include=None, depth_exclude=None, root_folder=None):
+        self.include = include
+        self.exclude = exclude
+        self.depth_include = dict(depth_include or {})
+        self.depth_exclude = dict(depth_exclude or {})
+        self.root_folder = root_folder.rstrip(os.sep) if root_folder else None
+        self._root_prefix = self.root_folder + os.sep if root_folder else None
+        self._default_rule = (_compile(include), _compile(exclude))
+        self._depth_rules = {}
+        for depth in set(self.depth_include) | set(self.depth_exclude):
+            self._depth_rules[depth] = (_compile(self.depth_include.get(depth, include)),
+                                        _compile(self.depth_exclude.get(depth, exclude)))
+
+    def __call__(self, path):
+        if self._depth_rules and self._root_prefix and path.startswith(self._root_prefix):
+            depth = path.count(os.sep, len(self.root_folder))
+            include, exclude = self._depth_rules.get(depth, self._default_rule)
+        else:
+            include, exclude = self._default_rule
+        name = path.rpartition(os.sep)[2]
+        if include is not None and include.fullmatch(name) is None:
+            return False
+        return exclude is None or exclude.fullmatch(name) is None
+
+    def __repr__(self):
+        return "FolderFilter(include=%r, exclude=%r, depth_include=%r, depth_exclude=%r)" % (
+            self.include, self.exclude, self.depth_include, self.depth_exclude)
+
+    def describe(self):
+        """Describe the filter in Markdown, for the documentation of the tasks"""
+        lines = ["* include: __%s__" % (self.include or ACCEPT_ALL),
+                 "* exclude: __%s__" % (self.exclude or 'none')]
+        for depth in sorted(set(self.depth_include) | set(self.depth_exclude)):
+            lines.append("* depth %d: include __%s__, exclude __%s__" % (
+                depth, self.depth_include.get(depth, self.include) or ACCEPT_ALL,
+                self.depth_exclude.get(depth, self.exclude) or 'none'))
+        return '\n'.join(lines)
+
+
+def folder_filter_from_config(pipeline_config, root_folder):
+    """Build the folder filter defined by the FOLDER_FILTER and FOLDER_EXCLUDE keys of a pipeline section"""
+    depth_include = {}
+    depth_exclude = {}
+    for key in pipeline_config.options():
+        for prefix, patterns in [('FOLDER_FILTER_', depth_include), ('FOLDER_EXCLUDE_', depth_exclude)]:
+            if key.startswith(prefix) and key[len(prefix):].isdigit():
+                patterns[int(key[len(prefix):])] = pipeline_config.get(key)
+    return FolderFilter(include=pipeline_config.get('FOLDER_FILTER', ACCEPT_ALL),
+                        exclude=pipeline_config.get('FOLDER_EXCLUDE', ''),
+                        depth_include=depth_include,
+                        depth_exclude=depth_exclude,
+                        root_folder=root_folder)
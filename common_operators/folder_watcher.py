@@ -0,0 +1,175 @@
+"""
+
+Watch folders for new files and sub-folders.
+
+FolderWatcher uses inotify when it is available, that is on Linux and for folders located on a local filesystem. On
+network filesystems such as NFS, inotify does not report the changes made by other hosts, so the content of the
+watched folders is polled instead.
+
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+INOTIFY = 'inotify'
+POLL = 'poll'
+
+# Filesystems where inotify does not see the changes made by other hosts
+REMOTE_FILESYSTEMS = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', 'lustre', 'gpfs', 'glusterfs',
+                      'fuse.glusterfs', 'ceph', 'fuse.ceph', 'beegfs', 'afs', '9p']
+
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+
+
+def filesystem_type(path):
+    """Return the type of the filesystem containing path, as listed in /proc/mounts, or None if unknown"""
+    path = os.path.realpath(path)
+    best_mount_point, best_type = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best_mount_point):
+                    best_mount_point, best_type = mount_point, fields[2]
+    except IOError:
+        return None
+    return best_type
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def inotify_supported(path):
+    """Return True if inotify can be used to watch changes in path"""
+    return _load_libc() is not None and filesystem_type(path) not in REMOTE_FILESYSTEMS
+
+
+class FolderWatcher:
+
+    """Watch a set of folders and report the folders where files or sub-folders have been created.
+
+    :param root_folder: folder used to select the watch mode, all watched folders should be on the same filesystem
+    :param poll_interval: time in seconds between two listings of the watched folders when polling
+    :param mode: 'inotify', 'poll' or None to select the best mode available for root_folder
+    """
+
+    def __init__(self, root_folder, poll_interval=5.0, mode=None):
+        self.poll_interval = poll_interval
+        self.mode = mode or (INOTIFY if inotify_supported(root_folder) else POLL)
+        self._fd = None
+        self._folders_by_wd = {}
+        self._listings = {}
+        if self.mode == INOTIFY:
+            self._libc = _load_libc()
+            self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self._fd < 0:
+                logging.warning("Cannot initialise inotify (errno %d), polling folders instead", ctypes.get_errno())
+                self._fd = None
+                self.mode = POLL
+        logging.info("Watch folders under %s using %s", root_folder, self.mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def watched_folders(self):
+        if self.mode == INOTIFY:
+            return set(self._folders_by_wd.values())
+        return set(self._listings.keys())
+
+    def watch(self, folder):
+        """Start watching a folder. Return False if the folder does not exist."""
+        if folder in self.watched_folders():
+            return True
+        if self.mode == INOTIFY:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _WATCH_MASK)
+            if wd < 0:
+                return False
+            self._folders_by_wd[wd] = folder
+        else:
+            try:
+                self._listings[folder] = self._list(folder)
+            except OSError:
+                return False
+        return True
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for changes and return the set of folders where something was created"""
+        if self.mode == INOTIFY:
+            return self._wait_inotify(timeout)
+        return self._wait_poll(timeout)
+
+    def _wait_inotify(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], max(timeout, 0))
+        changed = set()
+        if not readable:
+            return changed
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size + length
+            folder = self._folders_by_wd.get(wd)
+            if folder is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_IGNORED):
+                del self._folders_by_wd[wd]
+            else:
+                changed.add(folder)
+        return changed
+
+    def _wait_poll(self, timeout):
+        time.sleep(max(min(timeout, self.poll_interval), 0))
+        changed = set()
+        for folder, listing in list(self._listings.items()):
+            try:
+                new_listing = self._list(folder)
+            except OSError:
+                del self._listings[folder]
+                continue
+            if new_listing - listing:
+                changed.add(folder)
+            self._listings[folder] = new_listing
+        return changed
+
+    @staticmethod
+    def _list(folder):
+        return set(os.listdir(folder))
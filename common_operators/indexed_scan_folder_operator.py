@@ -0,0 +1,89 @@
+"""
+
+IndexedScanDailyFolderOperator triggers a DAG run for each new session folder found in the daily folder matching
+path root_folder/yyyy/yyyyMMdd, where the date used is the execution date, and remembers the session folders already
+triggered in a scan index.
+
+"""
+
+import logging
+import os
+
+from airflow.exceptions import AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow_scan_folder.operators import ScanDailyFolderOperator
+
+from common_operators.scan_index import ScanFolderMixin, ScanIndex, PENDING, PROCESSING, REJECTED, TRIGGERED
+
+
+class IndexedScanDailyFolderOperator(ScanFolderMixin, ScanDailyFolderOperator):
+
+    """
+    Triggers a DAG run for each new session folder located in the daily folder.
+
+    Unlike ScanDailyFolderOperator, the session folders already triggered are recorded in a scan index and are not
+    checked again. The daily folder is listed only if its modification time changed since the last scan.
+
+    A session folder is ready if the ready marker file is not required for the execution date, or if the ready
+    marker file is found in the daily folder or in the session folder. Session folders containing the processing
+    marker file are ignored.
+
+    :param scan_index_file: path to the SQLite file storing the scan index
+    :type scan_index_file: str
+    :param processing_marker_file: name of the marker file indicating that the processing of a session folder has
+        already started. Default to '.processing'
+    :type processing_marker_file: str
+
+    See ScanDailyFolderOperator for the other parameters.
+    """
+
+    template_fields = tuple()
+    template_ext = tuple()
+    ui_color = '#cceeeb'
+
+    @apply_defaults
+    def __init__(
+            self,
+            scan_index_file,
+            processing_marker_file='.processing',
+            *args, **kwargs):
+        super(IndexedScanDailyFolderOperator, self).__init__(*args, **kwargs)
+        self.scan_index_file = scan_index_file
+        self.processing_marker_file = processing_marker_file
+
+    @provide_session
+    def scan_daily_dirs(self, folder, context, session=None):
+        daily_folder_date = context['execution_date']
+
+        if not os.path.exists(folder):
+            raise AirflowSkipException
+
+        daily_folder = self.build_daily_folder_path_callable(folder, daily_folder_date)
+
+        if not os.path.isdir(daily_folder):
+            raise AirflowSkipException
+
+        look_for_ready_marker_file = self.look_for_ready_marker_file(daily_folder_date)
+        triggered = 0
+
+        with ScanIndex(self.scan_index_file) as scan_index:
+            scan_index.update_daily_folder(daily_folder)
+            for session_folder in scan_index.pending_session_folders(daily_folder):
+                if not self.accept_folder(session_folder):
+                    scan_index.set_state(session_folder, REJECTED)
+                elif os.path.exists(os.path.join(session_folder, self.processing_marker_file)):
+                    scan_index.set_state(session_folder, PROCESSING)
+                elif self.is_ready(daily_folder, session_folder, look_for_ready_marker_file):
+                    logging.info('Prepare trigger for %s : %s', self.trigger_dag_id, session_folder)
+                    self.trigger_dag_run(context, root_folder=self.root_folder(context), folder=session_folder,
+                                         session=session)
+                    self.offset += 1
+                    scan_index.set_state(session_folder, TRIGGERED)
+                    triggered += 1
+                else:
+                    scan_index.set_state(session_folder, PENDING)
+
+            logging.info("%d session folder(s) triggered, %d waiting for the %s marker file in %s", triggered,
+                         len(scan_index.pending_session_folders(daily_folder)), self.ready_marker_file,
+                         daily_folder)
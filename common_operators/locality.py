@@ -0,0 +1,177 @@
+"""
+
+Routing of the tasks of a session to the worker holding its staged data.
+
+copy_to_local stages the session on the local disk of the worker running it, and the next steps read the staged data
+and write their outputs to local folders. With several Celery workers, these steps can run on any worker unless the
+local folders are shared. With locality routing, each worker also consumes a queue of its own, and:
+
+* when the staging task succeeds, the tasks following it in the DAG run are sent to the queue of its worker. The
+  tasks are routed in the post_execute of the staging task, before its success is committed and before the scheduler
+  can queue the next tasks. The queue is pushed to XCom key staging_queue of the staging task
+* when a routed task fails and is retried, its retry is sent to the same queue
+* a watchdog checks which queues are consumed by the workers. When a worker disappears, the DAG runs routed to its
+  queue are cleared from the staging task: the session is staged again on another worker, which processes it
+
+The tasks are routed by updating the queue of their task instances before the scheduler sends them to the workers.
+The workers must consume their own queue in addition to the default queue, for example:
+
+    airflow worker -q default,$(hostname)
+
+When no worker consumes the queue of the staging worker, or when the Celery workers cannot be inspected, the tasks
+are not routed.
+
+"""
+
+import logging
+import socket
+
+from airflow.exceptions import AirflowConfigException
+from airflow.models import DagRun, TaskInstance
+from airflow.utils.db import provide_session
+from airflow.utils.state import State
+
+DEFAULT_QUEUE_TEMPLATE = '{hostname}'
+
+# Maximum time in seconds waited for the answer of the Celery workers
+INSPECT_TIMEOUT = 5
+
+# States of the task instances which are not yet sent to a worker, or which are waiting for a worker
+WAITING_STATES = [State.NONE, State.SCHEDULED, State.QUEUED, State.UP_FOR_RETRY]
+
+
+def locality_cfg(pipeline_config):
+    """Return the queue template of the workers if the pipeline routes the tasks of a session to the worker holding
+    its staged data, None otherwise"""
+    if not pipeline_config.getboolean('LOCALITY_ROUTING'):
+        return None
+    queue_template = pipeline_config.get('LOCALITY_QUEUE')
+    try:
+        queue_template.format(hostname='worker')
+    except (KeyError, IndexError, ValueError):
+        raise AirflowConfigException("Invalid value '%s' for key LOCALITY_QUEUE in section [%s], expected a queue "
+                                     "name with optional {hostname} placeholder" % (queue_template,
+                                                                                    pipeline_config.name))
+    return queue_template
+
+
+def worker_queue(queue_template):
+    """Queue of the current worker"""
+    return queue_template.format(hostname=socket.gethostname())
+
+
+def consumed_queues():
+    """Return the set of queues consumed by the Celery workers, or None if the workers cannot be inspected"""
+    try:
+        from airflow.executors.celery_executor import app
+        active_queues = app.control.inspect(timeout=INSPECT_TIMEOUT).active_queues()
+    except Exception:
+        logging.warning("Cannot inspect the queues of the Celery workers", exc_info=True)
+        return None
+    if not active_queues:
+        return None
+    return set(queue['name'] for queues in active_queues.values() for queue in queues)
+
+
+@provide_session
+def set_queue(dag_id, execution_date, task_ids, queue, states, session=None):
+    """Set the queue of the task instances of a DAG run in one of the given states, return their task ids"""
+    task_instances = session.query(TaskInstance).filter(
+        TaskInstance.dag_id == dag_id,
+        TaskInstance.execution_date == execution_date,
+        TaskInstance.task_id.in_(task_ids)
+    ).all()
+    routed = []
+    for ti in task_instances:
+        if ti.state in states:
+            ti.queue = queue
+            routed.append(ti.task_id)
+    session.commit()
+    return routed
+
+
+class SessionRouter:
+
+    """Routes the tasks following the staging of a session to the queue of the worker holding the staged data.
+
+    :param queue_template: name of the queue of each worker, {hostname} is replaced by the host name of the worker
+    :param staging_task_id: id of the task staging the session on the local disk
+    """
+
+    def __init__(self, queue_template, staging_task_id):
+        self.queue_template = queue_template
+        self.staging_task_id = staging_task_id
+
+    def route(self, context):
+        """Route the tasks following the staging task to the queue of its worker, when the staging task succeeds"""
+        ti = context['ti']
+        queue = worker_queue(self.queue_template)
+        queues = consumed_queues()
+        if queues is None or queue not in queues:
+            logging.warning("No worker consumes queue %s, the next tasks of %s are not routed to this worker",
+                            queue, ti.dag_id)
+            return
+        task_ids = [task.task_id for task in context['task'].get_flat_relatives(upstream=False)]
+        routed = set_queue(ti.dag_id, ti.execution_date, task_ids, queue, [State.NONE, State.SCHEDULED])
+        ti.xcom_push(key='staging_queue', value=queue)
+        logging.info("Session staged on %s, tasks %s routed to queue %s", socket.gethostname(),
+                     ', '.join(sorted(routed)), queue)
+
+    def keep_route(self, context):
+        """Send the retry of a routed task to the queue of the worker holding the staged data"""
+        ti = context['ti']
+        queue = ti.xcom_pull(task_ids=self.staging_task_id, key='staging_queue')
+        if queue:
+            set_queue(ti.dag_id, ti.execution_date, [ti.task_id], queue, [State.UP_FOR_RETRY])
+
+    def post_execute(self, context, *args, **kwargs):
+        """post_execute of the staging task: route the session, then run the post_execute of the operator"""
+        self.route(context)
+        task = context['task']
+        return type(task).post_execute(task, context, *args, **kwargs)
+
+
+def route_staged_session(dag, staging_task, queue_template):
+    """Route the tasks of the DAG runs following the staging task to the worker which staged the session"""
+    router = SessionRouter(queue_template, staging_task.task_id)
+    # on_success_callback runs after the success of the task is committed, when the scheduler may have already
+    # queued the next tasks to the default queue
+    staging_task.post_execute = router.post_execute
+    for task in staging_task.get_flat_relatives(upstream=False):
+        task.on_retry_callback = router.keep_route
+
+
+@provide_session
+def restage_orphaned_sessions(dag_id, staging_task_id, task_queues, session=None):
+    """Clear the DAG runs whose tasks wait in a queue that no worker consumes, from their staging task.
+
+    :param task_queues: dictionary of the ids of the staging task and of the tasks following it to their default
+        queue
+    :return: the number of DAG runs cleared
+    """
+    queues = consumed_queues()
+    if queues is None:
+        logging.warning("The queues consumed by the workers are unknown, the sessions are not checked")
+        return 0
+
+    running_dates = [run.execution_date for run in session.query(DagRun).filter(
+        DagRun.dag_id == dag_id, DagRun.state == State.RUNNING)]
+    cleared = 0
+    for execution_date in running_dates:
+        task_instances = session.query(TaskInstance).filter(
+            TaskInstance.dag_id == dag_id,
+            TaskInstance.execution_date == execution_date,
+            TaskInstance.task_id.in_(list(task_queues))
+        ).all()
+        orphaned = [ti for ti in task_instances if ti.state in WAITING_STATES and ti.queue not in queues
+                    and ti.queue != task_queues[ti.task_id]]
+        if not orphaned:
+            continue
+        logging.warning("No worker consumes queue %s of %s for %s, the session is staged again from task %s",
+                        orphaned[0].queue, dag_id, execution_date, staging_task_id)
+        for ti in task_instances:
+            ti.state = State.NONE
+            ti.queue = task_queues[ti.task_id]
+        cleared += 1
+    session.commit()
+    return cleared
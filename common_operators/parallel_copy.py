@@ -0,0 +1,306 @@
+"""
+
+Copy of a folder tree with parallel streams.
+
+A session of DICOM files is made of thousands of small files. Copied one after the other over NFS, the copy is bound
+by the latency of each file operation and uses a fraction of the bandwidth of the network. ParallelCopy copies the
+files with a pool of threads, each copy using the copy_file_range or sendfile system calls when they are available,
+or large buffers otherwise, then verifies the size or the checksum of the files copied.
+
+Like rsync -a, the permissions and modification times of the files are preserved, symbolic links are copied as links
+and files already present in the target folder with the same size and modification time are not copied again, so a
+failed copy can be resumed. With a FileCache, the files already copied by a previous run are hard-linked from the
+cache instead of being copied again from the network.
+
+When the source and target folders are on the same filesystem, the files can be staged without copying their
+content:
+
+* reflink: the target shares the data blocks of the source until one of them is modified (copy-on-write), on
+  filesystems supporting it such as XFS and btrfs. The content is copied if reflinks are not supported
+* hardlink: the target is a hard link to the source. Only safe when the steps using the copy never modify it in place
+
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+VERIFY_NONE = 'none'
+VERIFY_SIZE = 'size'
+VERIFY_CHECKSUM = 'checksum'
+VERIFY_MODES = [VERIFY_NONE, VERIFY_SIZE, VERIFY_CHECKSUM]
+
+# Size of the chunks copied by one system call or read in one buffer
+BUFFER_SIZE = 8 * 1024 * 1024
+
+STAGING_COPY = 'copy'
+STAGING_REFLINK = 'reflink'
+STAGING_HARDLINK = 'hardlink'
+STAGING_MODES = [STAGING_COPY, STAGING_REFLINK, STAGING_HARDLINK]
+
+COPIED = 'copied'
+CACHED = 'cached'
+LINKED = 'linked'
+SKIPPED = 'skipped'
+
+# ioctl cloning a file on Linux, from linux/fs.h
+FICLONE = 0x40049409
+
+
+class CopyError(Exception):
+    """Raised when a file cannot be copied or is corrupted after the copy"""
+    pass
+
+
+def list_tree(source_folder):
+    """List the folders, files and symbolic links of a tree, as paths relative to the source folder"""
+    folders = []
+    files = []
+    links = []
+    to_list = ['']
+    while to_list:
+        relative_folder = to_list.pop()
+        with os.scandir(os.path.join(source_folder, relative_folder)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_folder, entry.name)
+                if entry.is_symlink():
+                    links.append(relative_path)
+                elif entry.is_dir():
+                    folders.append(relative_path)
+                    to_list.append(relative_path)
+                else:
+                    files.append((relative_path, entry.stat().st_size))
+    return folders, files, links
+
+
+def file_checksum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def top_folder(relative_path):
+    """Return the first folder of a relative path, or '' for a file at the root of the tree"""
+    parts = relative_path.split(os.sep, 1)
+    return parts[0] if len(parts) > 1 else ''
+
+
+def same_filesystem(source_folder, target_folder):
+    """Return True if the folders are on the same filesystem. The target folder may not exist yet."""
+    target_folder = os.path.abspath(target_folder)
+    while not os.path.exists(target_folder):
+        target_folder = os.path.dirname(target_folder)
+    return os.stat(source_folder).st_dev == os.stat(target_folder).st_dev
+
+
+def _reflink(source, target):
+    """Clone a file sharing its data blocks, return False if the filesystem does not support it"""
+    with open(source, 'rb') as fsrc, open(target, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+
+
+def _copy_data(source, target, size):
+    """Copy the content of a file in the kernel when possible, with large buffers otherwise"""
+    with open(source, 'rb') as fsrc, open(target, 'wb') as fdst:
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(BUFFER_SIZE, size - copied))
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                # Not supported between these filesystems, continue with sendfile
+                pass
+        if copied < size and hasattr(os, 'sendfile'):
+            try:
+                while copied < size:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, min(BUFFER_SIZE, size - copied))
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+
+
+class ParallelCopy:
+
+    """Copy a folder tree with a pool of threads.
+
+    :param workers: number of files copied in parallel
+    :param verify: 'none', 'size' to check the size of the files copied, 'checksum' to also compare their MD5
+        checksums
+    :param cache: optional FileCache storing the files copied, used to link the files already copied
+    :param staging: 'copy' to always copy the content of the files, 'reflink' or 'hardlink' to link the files when
+        the source and target folders are on the same filesystem
+    """
+
+    def __init__(self, workers=8, verify=VERIFY_SIZE, cache=None, staging=STAGING_COPY):
+        if verify not in VERIFY_MODES:
+            raise ValueError("Invalid verify mode '%s', expected one of %s" % (verify, ', '.join(VERIFY_MODES)))
+        if staging not in STAGING_MODES:
+            raise ValueError("Invalid staging mode '%s', expected one of %s" % (staging, ', '.join(STAGING_MODES)))
+        self.workers = max(1, workers)
+        self.verify = verify
+        self.cache = cache
+        self.staging = staging
+        self._link_mode = None
+
+    def copy_tree(self, source_folder, target_folder, on_folder_copied=None):
+        """Copy the content of the source folder into the target folder, return a report of the copy.
+
+        :param on_folder_copied: optional callable, called with the name of each folder at the root of the source
+            folder as soon as all the files it contains are copied, from the thread copying its last file. The
+            folders are then copied one after the other, the smallest first
+        """
+        start = time.time()
+        folders, files, links = list_tree(source_folder)
+        self._link_mode = None
+        if self.staging != STAGING_COPY and same_filesystem(source_folder, target_folder):
+            self._link_mode = self.staging
+            logging.info("%s and %s are on the same filesystem, staging the files with %ss", source_folder,
+                         target_folder, self.staging)
+        os.makedirs(target_folder, exist_ok=True)
+        for folder in sorted(folders):
+            os.makedirs(os.path.join(target_folder, folder), exist_ok=True)
+        for link in links:
+            target = os.path.join(target_folder, link)
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(os.path.join(source_folder, link)), target)
+
+        if on_folder_copied:
+            copy_fn = self._folder_tracker(source_folder, target_folder, files, on_folder_copied)
+        else:
+            # Copy the largest files first, so a large file does not delay the end of the copy
+            files.sort(key=lambda f: f[1], reverse=True)
+
+            def copy_fn(f):
+                return self.copy_file(source_folder, target_folder, f[0], f[1])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(copy_fn, files))
+
+        # Preserve the modification times of the folders, updated by the creation of their content
+        for folder in sorted(folders, reverse=True) + ['']:
+            shutil.copystat(os.path.join(source_folder, folder), os.path.join(target_folder, folder))
+
+        seconds = max(time.time() - start, 1e-6)
+        copied_bytes = sum(size for (_, size), result in zip(files, results) if result == COPIED)
+        report = {'files': len(files),
+                  'copied_files': results.count(COPIED),
+                  'cached_files': results.count(CACHED),
+                  'linked_files': results.count(LINKED),
+                  'skipped_files': results.count(SKIPPED),
+                  'bytes': copied_bytes,
+                  'seconds': round(seconds, 3),
+                  'files_per_second': round(len(files) / seconds, 1),
+                  'mb_per_second': round(copied_bytes / seconds / 1024 / 1024, 1),
+                  'workers': self.workers,
+                  'verify': self.verify,
+                  'staging': self._link_mode or STAGING_COPY}
+        logging.info("Copied %(copied_files)d file(s) out of %(files)d, %(cached_files)d linked from the cache, in "
+                     "%(seconds).1fs: %(files_per_second).1f files/s, %(mb_per_second).1f MB/s", report)
+        return report
+
+    def _folder_tracker(self, source_folder, target_folder, files, on_folder_copied):
+        """Sort the files by folder and return a function copying a file and calling on_folder_copied when the last
+        file of a folder is copied"""
+        folder_sizes = Counter()
+        for relative_path, size in files:
+            folder_sizes[top_folder(relative_path)] += size
+        files.sort(key=lambda f: (folder_sizes[top_folder(f[0])], top_folder(f[0]), -f[1]))
+        remaining = Counter(top_folder(relative_path) for relative_path, _ in files)
+        lock = threading.Lock()
+
+        def copy_fn(f):
+            result = self.copy_file(source_folder, target_folder, f[0], f[1])
+            folder = top_folder(f[0])
+            with lock:
+                remaining[folder] -= 1
+                folder_copied = remaining[folder] == 0
+            if folder and folder_copied:
+                on_folder_copied(folder)
+            return result
+
+        return copy_fn
+
+    def copy_file(self, source_folder, target_folder, relative_path, size):
+        """Copy a file, return 'copied', 'cached' if it was linked from the cache, 'linked' if it was staged with a
+        reflink or a hard link, or 'skipped' if an identical copy is already present"""
+        source = os.path.join(source_folder, relative_path)
+        target = os.path.join(target_folder, relative_path)
+        source_stat = os.stat(source)
+        try:
+            target_stat = os.stat(target)
+            if target_stat.st_size == source_stat.st_size and \
+                    int(target_stat.st_mtime) == int(source_stat.st_mtime):
+                return SKIPPED
+            # Never write through an existing file, it may be a link to the cache
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+
+        if self._link_mode and self.link_file(source, target):
+            return LINKED
+        if self.cache and self.cache.link(source, source_stat, target):
+            return CACHED
+
+        try:
+            _copy_data(source, target, source_stat.st_size)
+            shutil.copystat(source, target)
+        except OSError as e:
+            raise CopyError("Cannot copy %s to %s: %s" % (source, target, e))
+        self.verify_file(source, target, source_stat.st_size)
+        if self.cache:
+            self.cache.add(source, source_stat, target)
+        return COPIED
+
+    def link_file(self, source, target):
+        """Stage a file with a hard link or a reflink, return False if the file should be copied"""
+        try:
+            if self._link_mode == STAGING_HARDLINK:
+                os.link(source, target)
+                return True
+            if _reflink(source, target):
+                shutil.copystat(source, target)
+                return True
+            os.remove(target)
+            error = 'reflinks are not supported'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise CopyError("Cannot link %s to %s: %s" % (source, target, e))
+            error = e
+        if self._link_mode:
+            logging.warning("Cannot stage the files with %ss, copying them: %s", self._link_mode, error)
+            self._link_mode = None
+        return False
+
+    def verify_file(self, source, target, size):
+        if self.verify == VERIFY_NONE:
+            return
+        if os.path.getsize(target) != size:
+            os.remove(target)
+            raise CopyError("Size of %s differs from the size of %s after the copy" % (target, source))
+        if self.verify == VERIFY_CHECKSUM and file_checksum(source) != file_checksum(target):
+            os.remove(target)
+            raise CopyError("Checksum of %s differs from the checksum of %s after the copy" % (target, source))
@@ -0,0 +1,100 @@
+"""
+
+ParallelScanFlatFolderOperator triggers a DAG run for each folder found at a given depth in a parent folder, listing
+the sub-folders with a pool of threads.
+
+"""
+
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from airflow.exceptions import AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow_scan_folder.operators import ScanFlatFolderOperator
+
+from common_operators.batch_trigger import BatchTriggerMixin
+from common_operators.scan_index import IGNORED_FOLDERS, ScanFolderMixin
+
+
+class ParallelScanFlatFolderOperator(ScanFolderMixin, BatchTriggerMixin, ScanFlatFolderOperator):
+
+    """
+    Triggers a DAG run for a specified ``dag_id`` for each folder discovered in a parent folder.
+
+    Unlike ScanFlatFolderOperator, the folders are listed by a pool of threads, which hides the latency of network
+    filesystems when the tree contains many folders. The accept folder function is applied to each sub-folder as soon
+    as it is listed, so rejected folders are never traversed, and a DAG run is triggered as soon as a folder at the
+    requested depth is found.
+
+    The traversal is depth first, and at most max_workers * 4 listings are queued at any time.
+
+    :param max_workers: number of threads listing the folders. Default to 8
+    :type max_workers: int
+
+    See BatchTriggerMixin for the parameters controlling the creation of the DAG runs in batches, and
+    ScanFlatFolderOperator for the other parameters.
+    """
+
+    template_fields = tuple()
+    template_ext = tuple()
+    ui_color = '#cceeeb'
+
+    @apply_defaults
+    def __init__(
+            self,
+            max_workers=8,
+            *args, **kwargs):
+        super(ParallelScanFlatFolderOperator, self).__init__(*args, **kwargs)
+        self.max_workers = max(1, max_workers)
+
+    def execute(self, context):
+        self.parallel_scan_dirs(self.root_folder(context), context)
+
+    def list_folders(self, folder):
+        """List the accepted sub-folders of a folder"""
+        try:
+            with os.scandir(folder) as entries:
+                return [entry.path for entry in entries
+                        if entry.name not in IGNORED_FOLDERS and entry.is_dir() and self.accept_folder(entry.path)]
+        except OSError as e:
+            logging.warning("Cannot list folder %s: %s", folder, e)
+            return []
+
+    @provide_session
+    def parallel_scan_dirs(self, folder, context, session=None):
+        if not os.path.isdir(folder):
+            raise AirflowSkipException
+
+        if self.depth == 0:
+            self.trigger(context, folder, session)
+            return
+
+        triggered = 0
+        max_queued = self.max_workers * 4
+        # Stack of (folder, depth) to list, processed depth first to keep it small
+        to_list = [(folder, 0)]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while to_list or running:
+                while to_list and len(running) < max_queued:
+                    path, depth = to_list.pop()
+                    running[executor.submit(self.list_folders, path)] = depth + 1
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = running.pop(future)
+                    for path in future.result():
+                        if depth == self.depth:
+                            self.trigger(context, path, session)
+                            triggered += 1
+                        else:
+                            to_list.append((path, depth))
+
+        logging.info("%d folder(s) triggered from %s", triggered, folder)
+
+    def trigger(self, context, folder, session):
+        logging.info('Prepare trigger for %s : %s', self.trigger_dag_id, folder)
+        self.trigger_dag_run(context, root_folder=self.root_folder(context), folder=folder, session=session)
+        self.offset += 1
@@ -0,0 +1,219 @@
+"""
+
+SPM operators borrowing their MATLAB engine from the engine pool of the worker, or sharing it with a batch of
+sessions. Both pipeline operators can skip a session processed with the same inputs and scripts, see
+common_operators.step_memo, and resume a session from its checkpoint, see common_operators.spm_checkpoint.
+
+Importing this module loads the Matlab engine bindings, only import it when a SPM step is used.
+
+"""
+
+import logging
+import os
+import time
+
+from datetime import datetime
+
+from airflow.exceptions import AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow_spm.operators import SpmOperator, SpmPipelineOperator
+
+from common_operators.fingerprint import step_fingerprint
+from common_operators.spm_batch import BatchEngine
+from common_operators.spm_checkpoint import CheckpointEngine, spm_checkpoint
+from common_operators.spm_engine_pool import borrow_engine, start_engine
+from common_operators.step_memo import StepMemo
+
+
+class PooledSpmOperator(SpmOperator):
+
+    """
+    Executes SPM with a MATLAB engine borrowed from the engine pool of the worker, or with a new engine if no engine
+    is available. The engine is returned to the pool at the end of the task.
+    """
+
+    def pre_execute(self, context):
+        self.engine = borrow_engine(self.matlab_paths)
+        if self.engine:
+            logging.info("SPM started...")
+        else:
+            super(PooledSpmOperator, self).pre_execute(context)
+
+
+class FingerprintSpmPipelineMixin(object):
+
+    """
+    Fingerprint of a SPM pipeline operator, made of the input folder of the session, the MATLAB scripts on its path,
+    its configuration files, the SPM function and the versions of MATLAB and SPM, see common_operators.fingerprint.
+
+    :param fingerprint_config_files: configuration files read by the SPM function
+    :type fingerprint_config_files: list
+    """
+
+    def init_fingerprint(self, fingerprint_config_files):
+        self.fingerprint_config_files = [path for path in fingerprint_config_files or [] if path]
+        self.fingerprint = None
+
+    def step_fingerprint(self):
+        if self.fingerprint is None:
+            self.fingerprint = step_fingerprint(
+                input_folder=self.pipeline_xcoms['folder'],
+                code_paths=[path for path in self.matlab_paths if path],
+                config_files=self.fingerprint_config_files,
+                parameters={'spm_function': self.spm_function,
+                            'versions': [self.pipeline_xcoms.get(key) for key in
+                                         ('matlab_version', 'spm_version', 'spm_revision')]})
+        return self.fingerprint
+
+
+class MemoSpmPipelineMixin(FingerprintSpmPipelineMixin):
+
+    """
+    Skips the SPM function of a pipeline operator when the session was processed by the step with the same
+    fingerprint, and publishes the outputs and provenance of that run, see common_operators.step_memo.
+
+    :param memoise: True to record the runs of the step and skip the runs with the fingerprint of the last run
+    :type memoise: bool
+    :param force_recompute: True to always call the SPM function, the runs are still recorded
+    :type force_recompute: bool
+    """
+
+    def init_memo(self, memoise, force_recompute):
+        self.memoise = memoise
+        self.force_recompute = force_recompute
+
+    def execute(self, context):
+        if not self.memoise or not self.engine:
+            return super(MemoSpmPipelineMixin, self).execute(context)
+
+        output_folder = self.output_folder_callable(*self.op_args, **self.op_kwargs)
+        memo = StepMemo(output_folder, self.step_fingerprint())
+        if self.force_recompute:
+            logging.info("FORCE_RECOMPUTE is set, the memo of %s is not used", output_folder)
+        elif memo.matches():
+            return self.publish_memo(context, memo, output_folder)
+        memo.clear()
+
+        start = time.time()
+        result = super(MemoSpmPipelineMixin, self).execute(context)
+        memo.save(result, self.pipeline_xcoms['output'], self.pipeline_xcoms['error'], time.time() - start,
+                  self.pipeline_xcoms.get('provenance_previous_step_id'))
+        return result
+
+    def publish_memo(self, context, memo, output_folder):
+        record = memo.record
+        relative_context_path = os.path.normpath(self.pipeline_xcoms['relative_context_path'])
+        self.pipeline_xcoms['folder'] = output_folder
+        self.pipeline_xcoms['root_folder'] = os.path.normpath(
+            output_folder + ('/..' * len(relative_context_path.split('/'))))
+        self.pipeline_xcoms['output'] = record['output']
+        self.pipeline_xcoms['error'] = record['error']
+        if record['provenance_step_id'] is not None:
+            self.pipeline_xcoms['provenance_previous_step_id'] = record['provenance_step_id']
+        self.write_pipeline_xcoms(context)
+
+        logging.info("SPM function %s skipped, the inputs and scripts of the step are unchanged since its run of %s "
+                     "which took %ds. Its outputs and provenance are reused", self.spm_function,
+                     datetime.fromtimestamp(record['created']).isoformat(), record['seconds'])
+        return record['result']
+
+
+class CheckpointSpmPipelineMixin(FingerprintSpmPipelineMixin):
+
+    """
+    Resumes the SPM function of a pipeline operator from the checkpoint of the session, see
+    common_operators.spm_checkpoint. Checkpoints are disabled when checkpoint_stages is None.
+
+    :param checkpoint_stages: list of (stage, file patterns) completed by the SPM function, in order. An empty list
+        only keeps the outputs of the SPM function when the task fails after it completed
+    :type checkpoint_stages: list
+    """
+
+    def init_checkpoint(self, checkpoint_stages):
+        self.checkpoint_stages = checkpoint_stages
+        self.checkpoint = None
+
+    def execute(self, context):
+        if self.checkpoint_stages is None or not self.engine:
+            return super(CheckpointSpmPipelineMixin, self).execute(context)
+
+        output_folder = self.output_folder_callable(*self.op_args, **self.op_kwargs)
+        self.checkpoint = spm_checkpoint(output_folder, self.checkpoint_stages, self.step_fingerprint())
+        self.engine = CheckpointEngine(self.engine, self.checkpoint, self.spm_function,
+                                       self.validate_result_callable, self.task_id)
+        try:
+            result = super(CheckpointSpmPipelineMixin, self).execute(context)
+        except AirflowSkipException:
+            self.checkpoint.clear()
+            raise
+        except Exception:
+            # The task may fail after SPM completed, keep its outputs for the next attempt
+            self.checkpoint.harvest()
+            raise
+        self.checkpoint.clear()
+        return result
+
+
+class PooledSpmPipelineOperator(MemoSpmPipelineMixin, CheckpointSpmPipelineMixin, SpmPipelineOperator,
+                                PooledSpmOperator):
+
+    """
+    Executes a pipeline on SPM with a MATLAB engine borrowed from the engine pool of the worker, see
+    SpmPipelineOperator, MemoSpmPipelineMixin and CheckpointSpmPipelineMixin.
+    """
+
+    @apply_defaults
+    def __init__(self, memoise=False, force_recompute=False, checkpoint_stages=None, fingerprint_config_files=None,
+                 *args, **kwargs):
+        super(PooledSpmPipelineOperator, self).__init__(*args, **kwargs)
+        self.init_fingerprint(fingerprint_config_files)
+        self.init_memo(memoise, force_recompute)
+        self.init_checkpoint(checkpoint_stages)
+
+
+class BatchSpmOperator(SpmOperator):
+
+    """
+    Executes SPM in a batch of sessions processed by one MATLAB engine, see common_operators.spm_batch.
+
+    :param batch_queue_file: SQLite file holding the calls waiting for a batch, on the local disk of the worker
+    :type batch_queue_file: str
+    :param batch_size: maximum number of sessions processed in a batch
+    :type batch_size: int
+    :param batch_wait: maximum time in seconds waited for batch_size sessions before processing a smaller batch
+    :type batch_wait: int
+    """
+
+    @apply_defaults
+    def __init__(self, batch_queue_file, batch_size, batch_wait=300, *args, **kwargs):
+        super(BatchSpmOperator, self).__init__(*args, **kwargs)
+        self.batch_queue_file = batch_queue_file
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+    def pre_execute(self, context):
+        ti = context['ti']
+        session_key = '%s/%s/%s' % (ti.dag_id, ti.task_id, ti.execution_date.isoformat())
+        self.engine = BatchEngine(self.batch_queue_file, self.batch_size, self.batch_wait, self.matlab_paths,
+                                  session_key, lambda: start_engine(self.matlab_paths))
+
+
+class BatchSpmPipelineOperator(MemoSpmPipelineMixin, CheckpointSpmPipelineMixin, SpmPipelineOperator,
+                               BatchSpmOperator):
+
+    """
+    Executes a pipeline on SPM in a batch of sessions processed by one MATLAB engine, see SpmPipelineOperator,
+    BatchSpmOperator, MemoSpmPipelineMixin and CheckpointSpmPipelineMixin.
+    """
+
+    @apply_defaults
+    def __init__(self, batch_queue_file, batch_size, batch_wait=300, memoise=False, force_recompute=False,
+                 checkpoint_stages=None, fingerprint_config_files=None, *args, **kwargs):
+        # SpmPipelineOperator initialises SpmOperator directly, bypassing BatchSpmOperator.__init__
+        SpmPipelineOperator.__init__(self, *args, **kwargs)
+        self.batch_queue_file = batch_queue_file
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.init_fingerprint(fingerprint_config_files)
+        self.init_memo(memoise, force_recompute)
+        self.init_checkpoint(checkpoint_stages)
@@ -0,0 +1,131 @@
+"""
+
+Priority weights of the task instances computed from the recorded durations of the steps.
+
+Airflow 1.8 orders the task instances waiting for a slot by their priority weight, set when the DAG run is created to
+the weight of the task plus the weights of all its downstream tasks. The first steps of a DAG therefore get the
+highest priority: the scheduler starts the copy of new sessions while the sessions close to completion wait for a
+slot.
+
+With critical path priorities, the weights of the waiting task instances of the running DAG runs are computed again
+periodically:
+
+* the duration of each step is the median duration of its last successful task instances, 0 if it never completed
+* the remaining time of a task is its duration plus the longest remaining time of its downstream tasks, the
+  remaining critical path of the session
+* the weight of a task instance is the number of minutes saved on the critical path of the DAG when the session
+  reaches the task, plus an ageing boost of `ageing` points per hour since the start of the DAG run
+
+The sessions closest to completion are processed first, and the ageing boost keeps the sessions waiting for a long
+time from being overtaken indefinitely by newer sessions. Until durations are recorded, the sessions are processed in
+the order of their start.
+
+"""
+
+import logging
+
+from datetime import datetime
+
+from airflow.exceptions import AirflowConfigException
+from airflow.models import DagRun, TaskInstance
+from airflow.utils.db import provide_session
+from airflow.utils.state import State
+
+from common_operators.locality import WAITING_STATES
+
+# Number of successful task instances of each step used to estimate its duration
+DURATION_HISTORY = 20
+
+
+def priority_cfg(pipeline_config):
+    """Return the ageing boost of the pipeline if it uses critical path priorities, None otherwise"""
+    if not pipeline_config.getboolean('CRITICAL_PATH_PRIORITY'):
+        return None
+    ageing = pipeline_config.getfloat('PRIORITY_AGEING')
+    if ageing < 0:
+        raise AirflowConfigException("Invalid value '%s' for key PRIORITY_AGEING in section [%s], expected a positive "
+                                     "number" % (ageing, pipeline_config.name))
+    return ageing
+
+
+def dag_graph(dag):
+    """Dictionary of the ids of the tasks of the DAG to the ids of their downstream tasks"""
+    downstream = dict((task.task_id, []) for task in dag.tasks)
+    for task in dag.tasks:
+        for upstream_task in task.upstream_list:
+            downstream[upstream_task.task_id].append(task.task_id)
+    return downstream
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+@provide_session
+def step_durations(dag_id, task_ids, history=DURATION_HISTORY, session=None):
+    """Return the median duration in seconds of the last successful task instances of each task"""
+    durations = {}
+    for task_id in task_ids:
+        recorded = [ti.duration for ti in session.query(TaskInstance).filter(
+            TaskInstance.dag_id == dag_id,
+            TaskInstance.task_id == task_id,
+            TaskInstance.state == State.SUCCESS,
+            TaskInstance.duration.isnot(None)
+        ).order_by(TaskInstance.end_date.desc()).limit(history)]
+        durations[task_id] = _median(recorded) if recorded else 0
+    return durations
+
+
+def remaining_times(downstream, durations):
+    """Return the remaining critical path in seconds from the start of each task to the end of the DAG"""
+    remaining = {}
+
+    def visit(task_id):
+        if task_id not in remaining:
+            remaining[task_id] = durations.get(task_id, 0) + max(
+                [visit(downstream_id) for downstream_id in downstream[task_id]] or [0])
+        return remaining[task_id]
+
+    for task_id in downstream:
+        visit(task_id)
+    return remaining
+
+
+def priority_weight(longest, remaining, age_hours, ageing):
+    """Minutes saved on the critical path of the DAG, plus the ageing boost of the DAG run"""
+    return int(round((longest - remaining) / 60.0 + ageing * age_hours))
+
+
+@provide_session
+def refresh_priority_weights(dag_graphs, history=DURATION_HISTORY, session=None):
+    """Set the priority weight of the waiting task instances of the running DAG runs from the critical path.
+
+    :param dag_graphs: dictionary of DAG id to a dictionary with keys 'downstream', see dag_graph(), and 'ageing'
+    :return: the number of task instances updated
+    """
+    now = datetime.now()
+    refreshed = 0
+    for dag_id, graph in sorted(dag_graphs.items()):
+        downstream = graph['downstream']
+        durations = step_durations(dag_id, list(downstream), history, session=session)
+        remaining = remaining_times(downstream, durations)
+        longest = max(remaining.values() or [0])
+        logging.info("Critical path of %s: %s", dag_id, ', '.join(
+            "%s %ds (remaining %ds)" % (task_id, durations[task_id], remaining[task_id])
+            for task_id in sorted(remaining, key=lambda task_id: -remaining[task_id])))
+
+        for run in session.query(DagRun).filter(DagRun.dag_id == dag_id, DagRun.state == State.RUNNING):
+            age_hours = (now - (run.start_date or run.execution_date)).total_seconds() / 3600
+            for ti in session.query(TaskInstance).filter(
+                    TaskInstance.dag_id == dag_id,
+                    TaskInstance.execution_date == run.execution_date):
+                # The state of the task instances not scheduled yet is NULL, it cannot be matched by IN
+                if ti.state in WAITING_STATES and ti.task_id in remaining:
+                    ti.priority_weight = priority_weight(longest, remaining[ti.task_id], age_hours,
+                                                         graph['ageing'])
+                    refreshed += 1
+    session.commit()
+    logging.info("Priority weights of %d task instances refreshed", refreshed)
+    return refreshed
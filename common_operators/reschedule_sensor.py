@@ -0,0 +1,148 @@
+"""
+
+Sensors waiting for free disk space without holding a worker slot.
+
+The sensors of Airflow keep calling their poke method from the same task until the condition is met, holding a slot
+of the worker and a slot of their pool while they wait. While the local disk is full, the DAG runs waiting for free
+space fill the remote_file_copy pool and the DAG runs of the other datasets cannot start copying their data.
+
+In 'reschedule' mode, the sensors defined here poke once per try. When the condition is not met, the task fails
+with a SpaceNotAvailable exception and is retried after a short delay, releasing its worker slot and its pool slot
+between two checks. The number of retries is computed from the maximum waiting time.
+
+When space is released on the local disk, wake_waiting_tasks() moves the retry of the waiting tasks forward so they
+check again immediately. The scheduler queues the tasks woken up in the order of their priority weight.
+
+"""
+
+import logging
+import os
+
+from datetime import datetime, timedelta
+
+from airflow.exceptions import AirflowConfigException, AirflowException
+from airflow.models import TaskInstance
+from airflow.operators.sensors import BaseSensorOperator
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow.utils.state import State
+
+from common_operators.file_cache import evict_cache
+
+WAIT_POKE = 'poke'
+WAIT_RESCHEDULE = 'reschedule'
+WAIT_MODES = [WAIT_POKE, WAIT_RESCHEDULE]
+
+# Delay between two checks of a sensor in reschedule mode
+RESCHEDULE_INTERVAL = timedelta(minutes=5)
+
+# Maximum time spent waiting by a sensor in reschedule mode
+MAX_WAIT = timedelta(days=7)
+
+
+class SpaceNotAvailable(AirflowException):
+    """Raised by a sensor in reschedule mode to retry later"""
+    pass
+
+
+def parse_wait_mode(value, section):
+    mode = (value or WAIT_POKE).strip().lower()
+    if mode not in WAIT_MODES:
+        raise AirflowConfigException("Invalid value '%s' for key FREE_SPACE_WAIT in section [%s], expected one of %s"
+                                     % (value, section, ', '.join(WAIT_MODES)))
+    return mode
+
+
+def wait_args(mode):
+    """Retry arguments of a sensor waiting for free space in the given mode, set by the sensor in reschedule mode"""
+    if mode == WAIT_RESCHEDULE:
+        return {}
+    return {'retry_delay': timedelta(hours=1), 'retries': 24 * 7}
+
+
+class ReschedulingSensorOperator(BaseSensorOperator):
+
+    """
+    Sensor which either pokes until its condition is met, or checks its condition once and retries later.
+
+    :param mode: 'poke' to wait inside the task like other sensors, 'reschedule' to release the worker slot between
+        two checks
+    :type mode: str
+    :param reschedule_interval: delay between two checks in reschedule mode
+    :type reschedule_interval: timedelta
+    :param max_wait: maximum waiting time in reschedule mode
+    :type max_wait: timedelta
+    """
+
+    @apply_defaults
+    def __init__(self, mode=WAIT_POKE, reschedule_interval=RESCHEDULE_INTERVAL, max_wait=MAX_WAIT, *args, **kwargs):
+        if mode == WAIT_RESCHEDULE:
+            kwargs['retry_delay'] = reschedule_interval
+            kwargs['retries'] = int(max_wait.total_seconds() // reschedule_interval.total_seconds())
+            kwargs['retry_exponential_backoff'] = False
+            kwargs['email_on_retry'] = False
+        super(ReschedulingSensorOperator, self).__init__(*args, **kwargs)
+        self.mode = mode or WAIT_POKE
+
+    def execute(self, context):
+        if self.mode != WAIT_RESCHEDULE:
+            return super(ReschedulingSensorOperator, self).execute(context)
+        if not self.poke(context):
+            raise SpaceNotAvailable("Condition not met, checking again in %s" % self.retry_delay)
+        logging.info("Success criteria met. Exiting.")
+
+
+class LocalFreeSpaceSensor(ReschedulingSensorOperator):
+
+    """
+    Waits until there is enough free space on the disk.
+
+    :param path: path of the disk area to check for free space
+    :type path: str
+    :param free_disk_threshold: minimum ratio of free space on the disk, between 0 and 1
+    :type free_disk_threshold: float
+    :param cache_folder: optional folder of the local file cache on the same disk, evicted before checking the free
+        space, see common_operators.file_cache
+    :type cache_folder: str
+    """
+
+    template_fields = tuple()
+
+    @apply_defaults
+    def __init__(self, path, free_disk_threshold, cache_folder='', *args, **kwargs):
+        super(LocalFreeSpaceSensor, self).__init__(*args, **kwargs)
+        self.path = path
+        self.free_disk_threshold = free_disk_threshold
+        self.cache_folder = cache_folder
+
+    def poke(self, context):
+        if self.cache_folder:
+            evict_cache(self.cache_folder, self.free_disk_threshold)
+        disk = os.statvfs(self.path)
+        free = disk.f_bavail / disk.f_blocks
+        logging.info('Checking if there is enough free space on {0}, expected at least {1:.2%} free, found {2:.2%}'
+                     .format(self.path, self.free_disk_threshold, free))
+        return free >= self.free_disk_threshold
+
+
+WAITING_OPERATORS = ['LocalFreeSpaceSensor', 'SpaceReservationSensor']
+
+
+@provide_session
+def wake_waiting_tasks(operators=None, session=None):
+    """Move forward the next try of the sensors in reschedule mode waiting for free space.
+
+    :return: the number of tasks woken up
+    """
+    wake_end_date = datetime.now() - RESCHEDULE_INTERVAL - timedelta(seconds=1)
+    waiting = session.query(TaskInstance).filter(
+        TaskInstance.state == State.UP_FOR_RETRY,
+        TaskInstance.operator.in_(operators or WAITING_OPERATORS),
+        TaskInstance.end_date > wake_end_date
+    ).order_by(TaskInstance.priority_weight.desc(), TaskInstance.execution_date).all()
+    for ti in waiting:
+        logging.info("Wake up %s.%s for %s, priority %s", ti.dag_id, ti.task_id, ti.execution_date,
+                     ti.priority_weight)
+        ti.end_date = wake_end_date
+    session.commit()
+    return len(waiting)
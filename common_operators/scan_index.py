@@ -0,0 +1,194 @@
+"""
+
+Persistent index of the session folders found by the daily folder scanners.
+
+The index is a SQLite database storing the daily folders and the session folders they contain, with their mtime,
+inode and trigger state. A daily folder is listed again only when its mtime or inode changed, and only the sessions
+not yet triggered are checked for their marker files, so scanning an input folder holding years of sessions does not
+walk the whole tree on every run.
+
+States of a session folder:
+
+* pending: new session folder, or session folder waiting for its .ready marker file
+* triggered: a DAG run has been triggered for the session folder
+* processing: the session folder contains a .processing marker file, it is ignored
+* rejected: the session folder is not accepted by the accept folder function
+
+The index file should be on a local disk, SQLite locking is not reliable on NFS.
+
+ScanFolderMixin holds the checks on the folders found that are shared by the scan operators of this project.
+
+To rebuild the index from the content of the input folder, for example after losing the index file:
+
+    python -m common_operators.scan_index rebuild <index file> <input folder>
+
+By default, all session folders found are marked as triggered to avoid triggering again the processing of old
+sessions. Use --pending to let the scanners check the session folders again.
+
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+PENDING = 'pending'
+TRIGGERED = 'triggered'
+PROCESSING = 'processing'
+REJECTED = 'rejected'
+
+IGNORED_FOLDERS = ['.git', '.svn', '.tmp']
+
+
+class ScanFolderMixin(object):
+
+    """
+    Mixin for the scan operators checking the folders they find.
+
+    Place it before the scan operator class in the bases of an operator. is_ready uses the ready_marker_file
+    attribute of the daily folder scan operators.
+    """
+
+    def accept_folder(self, path):
+        if self.accept_folder_callable is None:
+            return True
+        return bool(self.accept_folder_callable(path=path))
+
+    def is_ready(self, daily_folder, session_folder, look_for_ready_marker_file):
+        if not look_for_ready_marker_file:
+            return True
+        return os.access(os.path.join(daily_folder, self.ready_marker_file), os.R_OK) or \
+            os.access(os.path.join(session_folder, self.ready_marker_file), os.R_OK)
+
+
+class ScanIndex:
+
+    """Index of the daily folders and their session folders, stored in a SQLite database"""
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        index_folder = os.path.dirname(os.path.abspath(index_file))
+        os.makedirs(index_folder, exist_ok=True)
+        self.conn = sqlite3.connect(index_file, timeout=60)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS daily_folder (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                inode INTEGER NOT NULL,
+                scanned REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS session_folder (
+                path TEXT PRIMARY KEY,
+                daily_folder TEXT NOT NULL,
+                mtime REAL,
+                inode INTEGER,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS session_folder_by_daily_folder ON session_folder (daily_folder, state);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def update_daily_folder(self, daily_folder):
+        """Record the session folders of a daily folder, listing its content only if it changed since the last scan.
+
+        :return: True if the content of the daily folder was listed
+        """
+        st = os.stat(daily_folder)
+        row = self.conn.execute("SELECT mtime, inode FROM daily_folder WHERE path = ?", (daily_folder,)).fetchone()
+        if row and row[0] == st.st_mtime and row[1] == st.st_ino:
+            return False
+
+        session_folders = set()
+        for entry in os.scandir(daily_folder):
+            if entry.name not in IGNORED_FOLDERS and entry.is_dir():
+                session_folders.add(entry.path)
+        known_folders = set(r[0] for r in self.conn.execute(
+            "SELECT path FROM session_folder WHERE daily_folder = ?", (daily_folder,)))
+
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("DELETE FROM session_folder WHERE path = ?",
+                                  [(path,) for path in known_folders - session_folders])
+            self.conn.executemany(
+                "INSERT INTO session_folder (path, daily_folder, state, updated) VALUES (?, ?, ?, ?)",
+                [(path, daily_folder, PENDING, now) for path in session_folders - known_folders])
+            self.conn.execute("INSERT OR REPLACE INTO daily_folder (path, mtime, inode, scanned) VALUES (?, ?, ?, ?)",
+                              (daily_folder, st.st_mtime, st.st_ino, now))
+        logging.info("Scan index: %s listed, %d new and %d removed session folder(s)", daily_folder,
+                     len(session_folders - known_folders), len(known_folders - session_folders))
+        return True
+
+    def pending_session_folders(self, daily_folder):
+        return [r[0] for r in self.conn.execute(
+            "SELECT path FROM session_folder WHERE daily_folder = ? AND state = ? ORDER BY path",
+            (daily_folder, PENDING))]
+
+    def set_state(self, session_folder, state):
+        try:
+            st = os.stat(session_folder)
+            mtime, inode = st.st_mtime, st.st_ino
+        except OSError:
+            mtime, inode = None, None
+        with self.conn:
+            self.conn.execute("UPDATE session_folder SET state = ?, mtime = ?, inode = ?, updated = ? WHERE path = ?",
+                              (state, mtime, inode, time.time(), session_folder))
+
+    def count(self, state=None):
+        if state:
+            return self.conn.execute("SELECT count(*) FROM session_folder WHERE state = ?", (state,)).fetchone()[0]
+        return self.conn.execute("SELECT count(*) FROM session_folder").fetchone()[0]
+
+    def rebuild(self, root_folder, state=TRIGGERED, processing_marker_file='.processing'):
+        """Drop the index and rebuild it from the daily folders found in root_folder/<year>/<day>"""
+        with self.conn:
+            self.conn.execute("DELETE FROM session_folder")
+            self.conn.execute("DELETE FROM daily_folder")
+        for year_entry in sorted(os.scandir(root_folder), key=lambda e: e.name):
+            if year_entry.name in IGNORED_FOLDERS or not year_entry.is_dir():
+                continue
+            for day_entry in sorted(os.scandir(year_entry.path), key=lambda e: e.name):
+                if day_entry.name in IGNORED_FOLDERS or not day_entry.is_dir():
+                    continue
+                self.update_daily_folder(day_entry.path)
+                for session_folder in self.pending_session_folders(day_entry.path):
+                    if os.path.exists(os.path.join(session_folder, processing_marker_file)):
+                        self.set_state(session_folder, PROCESSING)
+                    elif state != PENDING:
+                        self.set_state(session_folder, state)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the index of the session folders found by the scanners')
+    subparsers = parser.add_subparsers(dest='command')
+    rebuild_parser = subparsers.add_parser('rebuild', help='rebuild the index from the content of the input folder')
+    rebuild_parser.add_argument('index_file', help='SCAN_INDEX_FILE of the dataset')
+    rebuild_parser.add_argument('folder', help='INPUT_FOLDER of the dataset, containing <year>/<day> folders')
+    rebuild_parser.add_argument('--pending', action='store_true',
+                                help='mark the session folders as pending instead of triggered')
+    stats_parser = subparsers.add_parser('stats', help='show the number of session folders per state')
+    stats_parser.add_argument('index_file', help='SCAN_INDEX_FILE of the dataset')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'rebuild':
+        with ScanIndex(args.index_file) as index:
+            index.rebuild(args.folder, state=PENDING if args.pending else TRIGGERED)
+            logging.info("Scan index rebuilt with %d session folder(s)", index.count())
+    elif args.command == 'stats':
+        with ScanIndex(args.index_file) as index:
+            for state in [PENDING, TRIGGERED, PROCESSING, REJECTED]:
+                print("%-10s %d" % (state, index.count(state)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+
+Index of the DICOM series of a session, built from the headers of the files.
+
+Several steps need to know which series a session contains and which protocol each series matches. The series_index
+step reads the headers of the DICOM files once, in parallel and without the pixel data, and stores a compact index
+of the session in a JSON file:
+
+    {"session_id": "PR00001/01",
+     "folder": "/data/incoming/PR00001/01",
+     "created": "2017-06-01T10:00:00",
+     "files": 1200,
+     "other_files": 2,
+     "series": [{"folder": "al_B1mapping/01",
+                 "uid": "1.3.12.2...",
+                 "number": 5,
+                 "description": "al_B1mapping",
+                 "protocol": "al_B1mapping",
+                 "protocol_match": true,
+                 "acquisition_date": "2017-05-31",
+                 "modality": "MR",
+                 "files": ["IM0001.dcm", ...]}]}
+
+protocol_match is null when no protocols definition file is defined. The files of a series are given relative to the
+folder of the series, which is relative to the session folder.
+
+The index is read by the Python DICOM to Nifti converter and by the Slack notifications. This module does not import
+pydicom until an index is built.
+
+"""
+
+import json
+import logging
+import os
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Tags read from the headers, the rest of the header and the pixel data are not parsed
+INDEX_TAGS = ['SOPClassUID', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName',
+              'AcquisitionDate', 'SeriesDate', 'StudyDate', 'Modality']
+
+# SOP class of the DICOMDIR files, which do not hold images
+MEDIA_STORAGE_DIRECTORY = '1.2.840.10008.1.3.10'
+
+
+def read_protocols(protocols_definition_file):
+    """Return the set of protocol names listed in the protocols definition file, or None if no file is given.
+
+    The file is read as a list of lines '<group>: <protocol>, <protocol>...' or '<group> = <protocol>; <protocol>...',
+    lines containing a single name and comments starting with % or # are also accepted.
+    """
+    if not protocols_definition_file or not os.path.isfile(protocols_definition_file):
+        return None
+    protocols = set()
+    with open(protocols_definition_file) as f:
+        for line in f:
+            line = line.split('%')[0].split('#')[0].strip()
+            if not line:
+                continue
+            names = re.split(r'[:=]', line, maxsplit=1)[-1]
+            for name in re.split(r'[,;]', names):
+                name = name.strip().strip('\'"{}[] ')
+                if name:
+                    protocols.add(name)
+    return protocols
+
+
+def protocol_name(header):
+    """Protocol of a DICOM header, its series description when the protocol name is missing"""
+    return str(header.get('ProtocolName') or header.get('SeriesDescription') or 'unknown').strip()
+
+
+def index_path(index_folder, session_id):
+    return os.path.join(index_folder, session_id + '.json')
+
+
+def _format_date(value):
+    value = str(value or '')
+    if len(value) >= 8 and value[:8].isdigit():
+        return '%s-%s-%s' % (value[:4], value[4:6], value[6:8])
+    return None
+
+
+def _read_header(path):
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+
+    try:
+        header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    except (InvalidDicomError, EOFError, OSError):
+        return None
+    if header.get('SOPClassUID') == MEDIA_STORAGE_DIRECTORY:
+        return None
+    return {'uid': str(header.get('SeriesInstanceUID', '')),
+            'number': int(header.SeriesNumber) if header.get('SeriesNumber') not in (None, '') else None,
+            'description': str(header.get('SeriesDescription') or ''),
+            'protocol': protocol_name(header),
+            'acquisition_date': _format_date(header.get('AcquisitionDate') or header.get('SeriesDate')
+                                             or header.get('StudyDate')),
+            'modality': str(header.get('Modality') or '')}
+
+
+def build_series_index(session_folder, session_id, protocols=None, workers=8):
+    """Read the headers of the files of the session in parallel and return its series index.
+
+    :param protocols: set of protocol names to match, see read_protocols()
+    """
+    start = datetime.now()
+    paths = []
+    for path, folder_names, file_names in os.walk(session_folder):
+        folder_names.sort()
+        paths.extend(os.path.join(path, file_name) for file_name in sorted(file_names)
+                     if not file_name.startswith('.'))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        headers = list(executor.map(_read_header, paths))
+
+    series = {}
+    other_files = 0
+    for path, header in zip(paths, headers):
+        if header is None:
+            other_files += 1
+            continue
+        folder = os.path.relpath(os.path.dirname(path), session_folder)
+        entry = series.get((folder, header['uid']))
+        if entry is None:
+            entry = dict(header, folder=folder, files=[])
+            entry['protocol_match'] = None if protocols is None else header['protocol'] in protocols
+            series[(folder, header['uid'])] = entry
+        entry['files'].append(os.path.basename(path))
+
+    index = {'session_id': session_id,
+             'folder': session_folder,
+             'created': start.isoformat(),
+             'files': len(paths) - other_files,
+             'other_files': other_files,
+             'series': [series[key] for key in sorted(series)]}
+    logging.info("Indexed %d series, %d DICOM files and %d other files of session %s in %.1fs",
+                 len(index['series']), index['files'], other_files, session_id,
+                 (datetime.now() - start).total_seconds())
+    return index
+
+
+def write_series_index(index, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_series_index(path):
+    """Return the series index stored in the file, or None if there is no index"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def unmatched_folders(index):
+    """Series folders of the index containing only series of protocols missing from the protocols definition file"""
+    folders = {}
+    for series in index['series']:
+        folders[series['folder']] = folders.get(series['folder'], True) and series['protocol_match'] is False
+    return set(folder for folder, unmatched in folders.items() if unmatched)
+
+
+def series_summary(index):
+    """Summary of the series index, one line per series"""
+    lines = []
+    for series in index['series']:
+        match = {True: '', False: ', protocol not defined', None: ''}[series['protocol_match']]
+        lines.append("%s: %s (%s%s), %d file(s)%s" % (
+            series['folder'], series['description'] or '?', series['protocol'], match, len(series['files']),
+            ', acquired on %s' % series['acquisition_date'] if series['acquisition_date'] else ''))
+    return '\n'.join(lines)
+
+
+def notification_series_summary(dataset, session_id):
+    """Summary of the series index of a session for the notifications, empty if the dataset does not index its
+    sessions. Used as a macro in the templates of the notification DAGs."""
+    from airflow import configuration
+
+    section = 'data-factory:%s:preprocessing:series_index' % dataset
+    if not dataset or not session_id or not configuration.has_option(section, 'OUTPUT_FOLDER'):
+        return ''
+    index = load_series_index(index_path(configuration.get(section, 'OUTPUT_FOLDER'), session_id))
+    return series_summary(index) if index else ''
@@ -0,0 +1,91 @@
+"""
+
+Copy of a session overlapping with the conversion of its series.
+
+The conversion of a session usually starts once all its files have been copied to the local disk. For large sessions
+made of many series, the conversion then waits for the last file of the last series while the first series could
+already be converted. SeriesPipeline copies the session with ParallelCopy one series folder after the other, and
+puts each series folder in a work queue as soon as its last file is copied. Converter threads take the series from
+the queue and convert them while the next series are copied.
+
+"""
+
+import logging
+import threading
+import time
+
+from queue import Queue
+
+
+class SeriesPipeline:
+
+    """Copy a session and convert each of its series as soon as it is copied.
+
+    :param copy_engine: ParallelCopy used to copy the session
+    :param convert_fn: callable converting one series, called with the local session folder and the name of the
+        series folder. The value returned is collected in the 'converted' list of the report
+    :param converters: number of series converted in parallel
+    """
+
+    def __init__(self, copy_engine, convert_fn, converters=1):
+        self.copy_engine = copy_engine
+        self.convert_fn = convert_fn
+        self.converters = max(1, converters)
+
+    def run(self, source_folder, target_folder):
+        """Copy the source folder into the target folder and convert its series, return a report"""
+        start = time.time()
+        queue = Queue()
+        converted = []
+        errors = []
+        conversion_seconds = [0.0]
+        lock = threading.Lock()
+
+        def convert_worker():
+            while True:
+                series = queue.get()
+                if series is None:
+                    return
+                if errors:
+                    # Stop converting after the first failure, but let the copy complete
+                    continue
+                series_start = time.time()
+                try:
+                    logging.info("Series %s copied, converting it", series)
+                    result = self.convert_fn(target_folder, series)
+                except Exception as e:
+                    logging.error("Conversion of series %s failed: %s", series, e)
+                    errors.append(e)
+                    continue
+                with lock:
+                    converted.append(result)
+                    conversion_seconds[0] += time.time() - series_start
+
+        workers = [threading.Thread(target=convert_worker, name='series-converter-%d' % i)
+                   for i in range(self.converters)]
+        for worker in workers:
+            worker.start()
+        try:
+            copy_report = self.copy_engine.copy_tree(source_folder, target_folder, on_folder_copied=queue.put)
+            copy_end = time.time()
+        finally:
+            for _ in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+
+        seconds = time.time() - start
+        report = {'copy': copy_report,
+                  'series': len(converted),
+                  'converted': converted,
+                  'seconds': round(seconds, 3),
+                  'copy_seconds': round(copy_end - start, 3),
+                  'conversion_seconds': round(conversion_seconds[0], 3),
+                  # Time saved compared to a conversion starting after the copy, with the same converters
+                  'overlap_seconds': round(max(copy_end - start + conversion_seconds[0] / self.converters - seconds,
+                                               0), 3)}
+        logging.info("Copied and converted %(series)d series in %(seconds).1fs: copy %(copy_seconds).1fs, "
+                     "conversion %(conversion_seconds).1fs, overlap %(overlap_seconds).1fs", report)
+        return report
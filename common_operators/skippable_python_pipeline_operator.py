@@ -0,0 +1,54 @@
+"""
+
+SkippablePythonPipelineOperator is a PythonPipelineOperator which can skip a session and notify it.
+
+PythonPipelineOperator triggers on_failure_trigger_dag_id for any exception raised by its python callable, including
+AirflowSkipException. Like SpmPipelineOperator, this operator triggers on_skip_trigger_dag_id instead when the
+callable skips the session.
+
+"""
+
+from airflow.exceptions import AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow_pipeline.operators import PythonPipelineOperator
+
+
+class SkippablePythonPipelineOperator(PythonPipelineOperator):
+
+    """
+    A PythonPipelineOperator whose python callable can raise AirflowSkipException to skip the session.
+
+    :param on_skip_trigger_dag_id: the dag_id to trigger if the python callable skips the session,
+        i.e. when it raises AirflowSkipException.
+    :type on_skip_trigger_dag_id: str
+
+    See PythonPipelineOperator for the other parameters.
+    """
+
+    @apply_defaults
+    def __init__(self, on_skip_trigger_dag_id=None, *args, **kwargs):
+        super(SkippablePythonPipelineOperator, self).__init__(*args, **kwargs)
+        self.on_skip_trigger_dag_id = on_skip_trigger_dag_id
+
+    def execute(self, context):
+        python_callable = self.python_callable
+        skipped = []
+
+        def skippable_callable(*args, **kwargs):
+            try:
+                return python_callable(*args, **kwargs)
+            except AirflowSkipException as e:
+                # Hidden from PythonPipelineOperator, which would report the session as failed
+                skipped.append(e)
+                return None
+
+        self.python_callable = skippable_callable
+        try:
+            return_value = super(SkippablePythonPipelineOperator, self).execute(context)
+        finally:
+            self.python_callable = python_callable
+
+        if skipped:
+            self.trigger_dag(context, self.on_skip_trigger_dag_id, str(skipped[0]))
+            raise skipped[0]
+        return return_value
@@ -0,0 +1,264 @@
+"""
+
+Ledger of the disk space reserved on the local disk by the pipelines in progress.
+
+Checking the free space on the local disk when a session starts is not enough: sessions starting together all see
+the same free space, pass the check, then fill the disk together. Instead, each DAG run reserves the space it expects
+to use on the local disk before copying its input data, and a reservation is accepted only if the free space minus the
+space already reserved by the other DAG runs stays above the minimum free space. Reservations are checked and made
+in one SQLite transaction, so two DAG runs cannot reserve the same space.
+
+The space expected is estimated from the size of the input folder and the ratio between the size of the outputs of
+each step and the size of its input, learned from the sessions already processed and 1 by default.
+
+The space reserved by a DAG run is released once its steps writing on the local disk are done, whether they succeeded
+or failed. Reservations not released, for example when a worker was lost, expire after a delay.
+
+DAG runs that cannot reserve their space yet wait in a queue, ordered by priority then by arrival. A DAG run can
+reserve its space only if enough space is also left for the DAG runs waiting before it, so large sessions are not
+starved by a flow of smaller ones. Waiters that did not try again recently are removed from the queue.
+
+The ledger file should be on the local disk, SQLite locking is not reliable on NFS. To show the reservations:
+
+    python -m common_operators.space_ledger <ledger file>
+
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+# Reservations of DAG runs that did not release them expire after this delay, in seconds
+RESERVATION_TTL = 48 * 3600
+
+# Waiters that did not try to reserve space again during this delay leave the queue, in seconds
+WAITER_TTL = 30 * 60
+
+DEFAULT_OUTPUT_RATIO = 1.0
+
+
+def folder_size(folder):
+    """Return the total size in bytes of the files in a folder, 0 if it does not exist"""
+    size = 0
+    to_list = [folder]
+    while to_list:
+        try:
+            with os.scandir(to_list.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        to_list.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def reservation_key(dag_run):
+    """Key of the reservation of a DAG run, the same for all the tries of its tasks"""
+    return '%s/%s' % (dag_run.dag_id, dag_run.run_id)
+
+
+def session_output_folder(output_folder, conf):
+    """Output folder of a step for the session described by the configuration of a DAG run"""
+    return os.path.join(output_folder, conf.get('session_id') or conf.get('relative_context_path') or '')
+
+
+class SpaceLedger:
+
+    """Reservations of disk space, stored in a SQLite database"""
+
+    def __init__(self, ledger_file, reservation_ttl=RESERVATION_TTL):
+        self.ledger_file = ledger_file
+        self.reservation_ttl = reservation_ttl
+        ledger_folder = os.path.dirname(os.path.abspath(ledger_file))
+        os.makedirs(ledger_folder, exist_ok=True)
+        # Transactions are managed explicitly, to lock the ledger while a reservation is checked and made
+        self.conn = sqlite3.connect(ledger_file, timeout=60, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS reservation (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                input_bytes INTEGER NOT NULL,
+                reserved_bytes INTEGER NOT NULL,
+                used_bytes INTEGER NOT NULL,
+                created REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS waiter (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                reserved_bytes INTEGER NOT NULL,
+                since REAL NOT NULL,
+                last_seen REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS step_ratio (
+                step TEXT PRIMARY KEY,
+                input_bytes INTEGER NOT NULL,
+                output_bytes INTEGER NOT NULL,
+                sessions INTEGER NOT NULL);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def output_ratio(self, step):
+        row = self.conn.execute("SELECT input_bytes, output_bytes FROM step_ratio WHERE step = ?", (step,)).fetchone()
+        if not row or row[0] <= 0:
+            return DEFAULT_OUTPUT_RATIO
+        return row[1] / row[0]
+
+    def estimate(self, input_bytes, steps):
+        """Estimate the space used on the local disk by the outputs of the steps for an input of the given size"""
+        return int(input_bytes * sum(self.output_ratio(step) for step in steps))
+
+    def reserved_bytes(self, path):
+        """Space reserved on the disk hosting path and not used yet"""
+        return self.conn.execute(
+            "SELECT coalesce(sum(max(reserved_bytes - used_bytes, 0)), 0) FROM reservation WHERE path = ?",
+            (path,)).fetchone()[0]
+
+    def reserve(self, key, path, input_bytes, reserved_bytes, min_free_space, priority=0):
+        """Reserve space on the disk hosting path if the free space left stays above min_free_space, after the
+        space needed by the waiters queued before this one. If the space cannot be reserved, the key waits in the
+        queue.
+
+        Reserving again with the same key keeps the existing reservation.
+
+        :param min_free_space: minimum ratio of free space on the disk, between 0 and 1
+        :param priority: priority in the queue of waiters, the highest priority first
+        :return: True if the space is reserved
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            self.conn.execute("DELETE FROM reservation WHERE created < ?", (now - self.reservation_ttl,))
+            self.conn.execute("DELETE FROM waiter WHERE last_seen < ?", (now - WAITER_TTL,))
+            if self.conn.execute("SELECT 1 FROM reservation WHERE key = ?", (key,)).fetchone():
+                self.conn.execute("DELETE FROM waiter WHERE key = ?", (key,))
+                self.conn.execute("COMMIT")
+                logging.info("Space already reserved for %s", key)
+                return True
+            row = self.conn.execute("SELECT since FROM waiter WHERE key = ?", (key,)).fetchone()
+            since = row[0] if row else now
+            waiting_before = self.conn.execute(
+                "SELECT count(*), coalesce(sum(reserved_bytes), 0) FROM waiter "
+                "WHERE path = ? AND key != ? AND (priority > ? OR (priority = ? AND since < ?))",
+                (path, key, priority, priority, since)).fetchone()
+            usage = shutil.disk_usage(path)
+            other_reservations = self.reserved_bytes(path)
+            available = usage.free - other_reservations - waiting_before[1] - min_free_space * usage.total
+            if reserved_bytes > available:
+                self.conn.execute("INSERT OR REPLACE INTO waiter (key, path, priority, reserved_bytes, since, "
+                                  "last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (key, path, priority, reserved_bytes, since, now))
+                self.conn.execute("COMMIT")
+                logging.info("Cannot reserve %.1f MB on %s: %.1f MB free, %.1f MB reserved by other DAG runs, "
+                             "%.1f MB for %d DAG run(s) waiting before, %.0f%% of the disk should stay free",
+                             reserved_bytes / 1024 / 1024, path, usage.free / 1024 / 1024,
+                             other_reservations / 1024 / 1024, waiting_before[1] / 1024 / 1024, waiting_before[0],
+                             min_free_space * 100)
+                return False
+            self.conn.execute("INSERT INTO reservation (key, path, input_bytes, reserved_bytes, used_bytes, created) "
+                              "VALUES (?, ?, ?, ?, 0, ?)", (key, path, input_bytes, reserved_bytes, now))
+            self.conn.execute("DELETE FROM waiter WHERE key = ?", (key,))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        logging.info("Reserved %.1f MB on %s for %s", reserved_bytes / 1024 / 1024, path, key)
+        return True
+
+    def reservation(self, key):
+        """Return the reservation as a dictionary, or None"""
+        row = self.conn.execute("SELECT path, input_bytes, reserved_bytes, used_bytes, created FROM reservation "
+                                "WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return dict(zip(['path', 'input_bytes', 'reserved_bytes', 'used_bytes', 'created'], row))
+
+    def use(self, key, used_bytes):
+        """Record the space already written on the disk by the owner of a reservation"""
+        self.conn.execute("UPDATE reservation SET used_bytes = ? WHERE key = ?", (used_bytes, key))
+
+    def release(self, key, step_outputs=None):
+        """Release a reservation, learning the output ratios of the steps from the size of their outputs.
+
+        :param step_outputs: dictionary of step name to the size in bytes of its outputs for this reservation
+        """
+        reservation = self.reservation(key)
+        if not reservation:
+            logging.info("No space reserved for %s", key)
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if reservation['input_bytes'] > 0:
+                for step, output_bytes in (step_outputs or {}).items():
+                    if output_bytes <= 0:
+                        continue
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO step_ratio (step, input_bytes, output_bytes, sessions) "
+                        "VALUES (?, 0, 0, 0)", (step,))
+                    self.conn.execute(
+                        "UPDATE step_ratio SET input_bytes = input_bytes + ?, output_bytes = output_bytes + ?, "
+                        "sessions = sessions + 1 WHERE step = ?", (reservation['input_bytes'], output_bytes, step))
+            self.conn.execute("DELETE FROM reservation WHERE key = ?", (key,))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        logging.info("Released %.1f MB on %s for %s", reservation['reserved_bytes'] / 1024 / 1024,
+                     reservation['path'], key)
+
+    def reservations(self):
+        return [dict(zip(['key', 'path', 'input_bytes', 'reserved_bytes', 'used_bytes', 'created'], row))
+                for row in self.conn.execute("SELECT key, path, input_bytes, reserved_bytes, used_bytes, created "
+                                             "FROM reservation ORDER BY created")]
+
+    def waiters(self, path=None):
+        """Return the waiters in the order of the queue"""
+        columns = ['key', 'path', 'priority', 'reserved_bytes', 'since']
+        rows = self.conn.execute("SELECT %s FROM waiter WHERE last_seen >= ? AND (? IS NULL OR path = ?) "
+                                 "ORDER BY priority DESC, since" % ', '.join(columns),
+                                 (time.time() - WAITER_TTL, path, path))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def step_ratios(self):
+        rows = self.conn.execute("SELECT step, input_bytes, output_bytes, sessions FROM step_ratio ORDER BY step")
+        return [{'step': step, 'ratio': output_bytes / input_bytes if input_bytes else 0, 'sessions': sessions}
+                for step, input_bytes, output_bytes, sessions in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the space reserved on the local disk by the DAG runs')
+    parser.add_argument('ledger_file')
+    args = parser.parse_args(argv)
+
+    with SpaceLedger(args.ledger_file) as ledger:
+        print("%-60s %12s %12s %20s" % ('reservation', 'reserved MB', 'used MB', 'created'))
+        for r in ledger.reservations():
+            print("%-60s %12.1f %12.1f %20s" % (r['key'], r['reserved_bytes'] / 1024 / 1024,
+                                                r['used_bytes'] / 1024 / 1024,
+                                                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['created']))))
+        print()
+        print("%-60s %12s %12s %20s" % ('waiter', 'needed MB', 'priority', 'since'))
+        for w in ledger.waiters():
+            print("%-60s %12.1f %12d %20s" % (w['key'], w['reserved_bytes'] / 1024 / 1024, w['priority'],
+                                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(w['since']))))
+        print()
+        print("%-30s %10s %10s" % ('step', 'ratio', 'sessions'))
+        for r in ledger.step_ratios():
+            print("%-30s %10.2f %10d" % (r['step'], r['ratio'], r['sessions']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""
+
+SpaceReservationSensor waits until the disk space expected to be used by a DAG run can be reserved on the local disk.
+In reschedule mode, it releases its worker slot between two checks and waits in the queue of the space ledger.
+
+"""
+
+import logging
+import os
+import shutil
+
+from airflow.utils import apply_defaults
+
+from common_operators.file_cache import evict_cache
+from common_operators.parallel_copy import same_filesystem
+from common_operators.reschedule_sensor import ReschedulingSensorOperator
+from common_operators.space_ledger import SpaceLedger, folder_size, reservation_key
+
+
+class SpaceReservationSensor(ReschedulingSensorOperator):
+
+    """
+    Waits until the disk space expected to be used by the DAG run is reserved in the space ledger.
+
+    The space expected is estimated from the size of the input folder of the DAG run, read from the 'folder' key of
+    the configuration of the DAG run, and from the output ratios of the steps writing their outputs on the disk
+    hosting path. The reservation is released once the steps writing on the local disk are done.
+
+    A DAG run which cannot reserve its space waits in the queue of the ledger with the priority weight of this task.
+
+    :param ledger_file: path to the SQLite file storing the space ledger
+    :type ledger_file: str
+    :param path: path of the disk area where the space is reserved
+    :type path: str
+    :param free_disk_threshold: minimum ratio of free space on the disk, between 0 and 1
+    :type free_disk_threshold: float
+    :param output_folders: dictionary of step name to the output folder of the step
+    :type output_folders: dict
+    :param cache_folder: optional folder of the local file cache on the same disk, evicted to make room for the
+        reservations before reserving the space, see common_operators.file_cache
+    :type cache_folder: str
+    """
+
+    template_fields = tuple()
+    ui_color = '#e8d8f5'
+
+    @apply_defaults
+    def __init__(self, ledger_file, path, free_disk_threshold, output_folders, cache_folder='', *args, **kwargs):
+        super(SpaceReservationSensor, self).__init__(*args, **kwargs)
+        self.ledger_file = ledger_file
+        self.path = path
+        self.free_disk_threshold = free_disk_threshold
+        self.output_folders = output_folders
+        self.cache_folder = cache_folder
+        self._input_bytes = None
+
+    def local_steps(self):
+        """Steps writing their outputs on the disk hosting path"""
+        os.makedirs(self.path, exist_ok=True)
+        return sorted(step for step, output_folder in self.output_folders.items()
+                      if same_filesystem(self.path, output_folder))
+
+    def poke(self, context):
+        dag_run = context['dag_run']
+        if self._input_bytes is None:
+            self._input_bytes = folder_size(dag_run.conf['folder'])
+        with SpaceLedger(self.ledger_file) as ledger:
+            steps = self.local_steps()
+            reserved_bytes = ledger.estimate(self._input_bytes, steps)
+            logging.info("Input folder %s: %.1f MB, expected %.1f MB on %s for steps %s", dag_run.conf['folder'],
+                         self._input_bytes / 1024 / 1024, reserved_bytes / 1024 / 1024, self.path, ', '.join(steps))
+            if self.cache_folder:
+                # Keep room in the cache for the space reserved and for this reservation
+                usage = shutil.disk_usage(self.path)
+                evict_cache(self.cache_folder, min(1.0, self.free_disk_threshold + float(
+                    ledger.reserved_bytes(self.path) + reserved_bytes) / usage.total))
+            return ledger.reserve(reservation_key(dag_run), self.path, self._input_bytes, reserved_bytes,
+                                  self.free_disk_threshold, priority=context['ti'].priority_weight or 0)
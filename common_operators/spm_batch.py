@@ -0,0 +1,291 @@
+"""
+
+Batches of sessions processed by one MATLAB engine.
+
+Each SPM task of a session starts MATLAB, sets its path and loads the templates of its pipeline before processing a
+single session. When thousands of sessions are reprocessed, this overhead is paid for each session. In batch mode, the
+SPM tasks do not start MATLAB. Each task registers the call of its SPM function in a batch queue, then one of the tasks
+waiting on the worker claims up to BATCH_SIZE calls registered with the same function and MATLAB path, starts one
+engine, and calls the SPM function for each session in a loop. The result, output and errors of each call are stored
+in the queue, where the task of each session reads them back and completes as if it had called SPM itself: the result
+is validated, provenance is recorded and the mri_notify_* DAGs are triggered for each session.
+
+A batch is started when BATCH_SIZE calls are waiting or when the oldest call waited BATCH_WAIT seconds. The tasks of
+the sessions in a batch wait for their result, so a batch cannot group more sessions than the slots of the pool of the
+step. Calls claimed by a task which stopped updating its heartbeat are returned to the queue.
+
+The queue is a SQLite database which should be on the local disk of the worker, sessions are batched with the other
+sessions processed on the same worker. To show the calls in the queue:
+
+    python -m common_operators.spm_batch <queue file>
+
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from io import StringIO
+
+from airflow.exceptions import AirflowConfigException
+
+WAITING = 'waiting'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+# Delay between two checks of the queue by a waiting task, in seconds
+POLL_INTERVAL = 5
+# Delay between two updates of the heartbeat of a task running a batch, in seconds
+HEARTBEAT_INTERVAL = 30
+# Calls claimed by a task without heartbeat during this delay are returned to the queue, in seconds
+STALE_CLAIM = 10 * 60
+
+
+def spm_batch_cfg(pipeline_config, step_config):
+    """Return the arguments of BatchSpmPipelineOperator for the step, or None if the step does not run in batches"""
+    batch_size = step_config.getint('BATCH_SIZE')
+    if batch_size <= 1:
+        return None
+    queue_file = pipeline_config.get('SPM_BATCH_QUEUE_FILE')
+    if not queue_file:
+        raise AirflowConfigException("BATCH_SIZE in section [%s] requires SPM_BATCH_QUEUE_FILE in section [%s]"
+                                     % (step_config.name, pipeline_config.name))
+    return {'batch_queue_file': queue_file,
+            'batch_size': batch_size,
+            'batch_wait': step_config.getint('BATCH_WAIT')}
+
+
+class SpmBatchQueue:
+
+    """Queue of SPM function calls, stored in a SQLite database"""
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        os.makedirs(os.path.dirname(os.path.abspath(queue_file)), exist_ok=True)
+        # Transactions are managed explicitly, to lock the queue while calls are claimed
+        self.conn = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS call (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_key TEXT NOT NULL,
+                session_key TEXT NOT NULL,
+                function TEXT NOT NULL,
+                arguments TEXT NOT NULL,
+                state TEXT NOT NULL,
+                registered REAL NOT NULL,
+                claimed_by TEXT,
+                heartbeat REAL,
+                result REAL,
+                output TEXT,
+                error TEXT);
+            CREATE INDEX IF NOT EXISTS call_by_batch ON call (batch_key, state, registered);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def register(self, batch_key, session_key, function, arguments):
+        """Register a call, replacing the previous call of the same session, return its id"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("DELETE FROM call WHERE session_key = ?", (session_key,))
+            call_id = self.conn.execute(
+                "INSERT INTO call (batch_key, session_key, function, arguments, state, registered) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (batch_key, session_key, function, json.dumps(arguments), WAITING, time.time())).lastrowid
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return call_id
+
+    def call(self, call_id):
+        columns = ['id', 'session_key', 'function', 'arguments', 'state', 'result', 'output', 'error']
+        row = self.conn.execute("SELECT %s FROM call WHERE id = ?" % ', '.join(columns), (call_id,)).fetchone()
+        if not row:
+            return None
+        call = dict(zip(columns, row))
+        call['arguments'] = json.loads(call['arguments'])
+        return call
+
+    def claim(self, batch_key, batch_size, batch_wait, claimed_by):
+        """Claim up to batch_size waiting calls if batch_size calls are waiting or if the oldest call waited
+        batch_wait seconds.
+
+        :return: the calls claimed
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            self.conn.execute("UPDATE call SET state = ?, claimed_by = NULL WHERE state = ? AND heartbeat < ?",
+                              (WAITING, CLAIMED, now - STALE_CLAIM))
+            rows = self.conn.execute("SELECT id, registered FROM call WHERE batch_key = ? AND state = ? "
+                                     "ORDER BY registered LIMIT ?", (batch_key, WAITING, batch_size)).fetchall()
+            if not rows or (len(rows) < batch_size and rows[0][1] > now - batch_wait):
+                self.conn.execute("COMMIT")
+                return []
+            ids = [row[0] for row in rows]
+            self.conn.execute("UPDATE call SET state = ?, claimed_by = ?, heartbeat = ? WHERE id IN (%s)"
+                              % ', '.join('?' * len(ids)), [CLAIMED, claimed_by, now] + ids)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [self.call(call_id) for call_id in ids]
+
+    def heartbeat(self, claimed_by):
+        self.conn.execute("UPDATE call SET heartbeat = ? WHERE claimed_by = ? AND state = ?",
+                          (time.time(), claimed_by, CLAIMED))
+
+    def finish(self, call_id, state, result, output, error):
+        self.conn.execute("UPDATE call SET state = ?, result = ?, output = ?, error = ? WHERE id = ?",
+                          (state, result, output, error, call_id))
+
+    def remove(self, call_id):
+        self.conn.execute("DELETE FROM call WHERE id = ?", (call_id,))
+
+    def calls(self):
+        columns = ['id', 'session_key', 'function', 'state', 'registered', 'claimed_by']
+        rows = self.conn.execute("SELECT %s FROM call ORDER BY registered" % ', '.join(columns))
+        return [dict(zip(columns, row)) for row in rows]
+
+
+class BatchEngine:
+
+    """Stands for a MATLAB engine in a SPM task running in batch mode.
+
+    Calling a function registers the call in the batch queue, runs batches of calls until the call is done, and
+    returns its result. The output and errors of the call are written to the stdout and stderr streams.
+
+    :param start_engine_fn: callable returning a new MATLAB engine, called when the task runs a batch
+    """
+
+    def __init__(self, queue_file, batch_size, batch_wait, matlab_paths, session_key, start_engine_fn):
+        self.queue_file = queue_file
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.matlab_paths = matlab_paths
+        self.session_key = session_key
+        self.start_engine_fn = start_engine_fn
+        self.claimed_by = '%s:%d:%s' % (socket.gethostname(), os.getpid(), session_key)
+        self.engine = None
+        self.batches = 0
+        self.calls = 0
+
+    def __getattr__(self, function):
+        if function.startswith('_'):
+            raise AttributeError(function)
+
+        def call(*arguments, stdout=None, stderr=None, **kwargs):
+            return self.run(function, list(arguments), stdout, stderr)
+
+        return call
+
+    def run(self, function, arguments, stdout=None, stderr=None):
+        batch_key = json.dumps([function] + list(self.matlab_paths))
+        with SpmBatchQueue(self.queue_file) as queue:
+            call_id = queue.register(batch_key, self.session_key, function, arguments)
+            logging.info("Registered the call of %s for %s in the batch queue %s", function, self.session_key,
+                         self.queue_file)
+            while True:
+                call = queue.call(call_id)
+                if call is None:
+                    raise RuntimeError("Call of %s for %s removed from the batch queue"
+                                       % (function, self.session_key))
+                if call['state'] in (DONE, FAILED):
+                    break
+                batch = queue.claim(batch_key, self.batch_size, self.batch_wait, self.claimed_by)
+                if batch:
+                    self.run_batch(queue, batch)
+                else:
+                    time.sleep(POLL_INTERVAL)
+            queue.remove(call_id)
+
+        if stdout is not None:
+            stdout.write(call['output'] or '')
+        if stderr is not None:
+            stderr.write(call['error'] or '')
+        if call['state'] == FAILED:
+            # SpmPipelineOperator does not stop the engine on failure, stop the engine started for earlier batches
+            self.exit()
+            raise RuntimeError("%s failed for %s: %s" % (function, self.session_key, call['error']))
+        return call['result']
+
+    def run_batch(self, queue, batch):
+        logging.info("Running a batch of %d call(s) of %s: %s", len(batch), batch[0]['function'],
+                     ', '.join(call['session_key'] for call in batch))
+        self.batches += 1
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            with SpmBatchQueue(self.queue_file) as heartbeat_queue:
+                while not stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+                    heartbeat_queue.heartbeat(self.claimed_by)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, name='spm-batch-heartbeat')
+        heartbeat_thread.start()
+        try:
+            for call in batch:
+                self.run_call(queue, call)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+    def run_call(self, queue, call):
+        out = StringIO()
+        err = StringIO()
+        start = time.time()
+        try:
+            if self.engine is None:
+                self.engine = self.start_engine_fn()
+            result = getattr(self.engine, call['function'])(*call['arguments'], stdout=out, stderr=err)
+        except Exception as e:
+            logging.error("%s failed for %s: %s", call['function'], call['session_key'], e)
+            queue.finish(call['id'], FAILED, None, out.getvalue(), err.getvalue() + str(e))
+            # The engine may be in an unknown state, start a new one for the next call
+            self.exit()
+            return
+        self.calls += 1
+        logging.info("%s returned %s for %s in %.1fs", call['function'], result, call['session_key'],
+                     time.time() - start)
+        queue.finish(call['id'], DONE, float(result), out.getvalue(), err.getvalue())
+
+    def exit(self):
+        if self.engine is not None:
+            try:
+                self.engine.exit()
+            except Exception as e:
+                logging.warning("Cannot stop the MATLAB engine: %s", e)
+            self.engine = None
+
+    quit = exit
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("Usage: python -m common_operators.spm_batch <queue file>")
+        return 1
+    with SpmBatchQueue(argv[0]) as queue:
+        print("%-8s %-70s %-30s %-10s %20s" % ('id', 'session', 'function', 'state', 'registered'))
+        for call in queue.calls():
+            print("%-8d %-70s %-30s %-10s %20s" % (
+                call['id'], call['session_key'], call['function'], call['state'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(call['registered']))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""
+
+Checkpoints of the SPM steps, to resume a session after a failure instead of running it again from the start.
+
+The MPM and NeuroMorphometric pipelines run for hours per session, and a retry starts from an empty output folder:
+SpmPipelineOperator removes the output folder before calling SPM and after a failure. With checkpoints, the artefacts
+of the stages completed by an attempt are kept aside and restored for the next attempt of the session:
+
+* the stages of the step are declared in the configuration as an ordered list of stages, each stage being complete
+  when all its file patterns match at least one file of the output folder, for example
+  'segmentation: c1*.nii c2*.nii; maps: *_R1.nii *_MT.nii'
+* when an attempt fails, returns an invalid result or is killed, the files of the completed stages are moved to the
+  checkpoint folder of the session, OUTPUT_FOLDER/.checkpoints/&lt;session&gt;, and described in its manifest.json
+  file
+* the next attempt restores these files to the output folder before calling SPM, the SPM scripts can then skip the
+  stages whose outputs are present
+* when SPM completes, its outputs are hard-linked to the checkpoint folder. If the task fails afterwards, for example
+  while recording provenance, the next attempt restores the whole output folder and reuses the result of SPM without
+  calling it again
+
+The manifest records the fingerprint of the step, see common_operators.fingerprint: the SPM function, the content of
+the MATLAB scripts and configuration files and the files of the input folder. A checkpoint is discarded when the
+fingerprint changes, so a new version of the pipeline or new input data always start from scratch. The checkpoint is
+removed when the task succeeds.
+
+The time spent to reach each stage is recorded, and the logs compare the duration of a resumed attempt with the
+duration of a full rerun.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+
+from fnmatch import fnmatch
+
+from airflow.exceptions import AirflowConfigException
+
+from common_operators.fingerprint import changed_components, output_files
+
+CHECKPOINTS_FOLDER = '.checkpoints'
+MANIFEST = 'manifest.json'
+COMPLETE = 'complete'
+
+
+def parse_stages(value, section):
+    """Parse the CHECKPOINT_STAGES value 'stage: pattern pattern; stage: pattern' into a list of (stage, patterns)"""
+    stages = []
+    for definition in (value or '').split(';'):
+        if not definition.strip():
+            continue
+        name, _, patterns = definition.partition(':')
+        name, patterns = name.strip(), patterns.split()
+        if not name or not patterns or name == COMPLETE or name in [stage for stage, _ in stages]:
+            raise AirflowConfigException("Invalid value '%s' for key CHECKPOINT_STAGES in section [%s], expected "
+                                         "'<stage>: <file pattern> <file pattern>...; <stage>: ...'"
+                                         % (value, section))
+        stages.append((name, patterns))
+    return stages
+
+
+def spm_checkpoint_cfg(step_config):
+    """Return the checkpoint arguments of the SPM pipeline operators for the step, empty if the step does not use
+    checkpoints"""
+    if not step_config.getboolean('CHECKPOINTS'):
+        return {}
+    return {'checkpoint_stages': parse_stages(step_config.get('CHECKPOINT_STAGES'), step_config.name)}
+
+
+def checkpoint_folder(output_folder):
+    """Checkpoint folder of a session output folder"""
+    output_folder = os.path.normpath(output_folder)
+    return os.path.join(os.path.dirname(output_folder), CHECKPOINTS_FOLDER, os.path.basename(output_folder))
+
+
+def _duration(seconds):
+    return '%dh%02dm%02ds' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def _move_files(files, source_folder, target_folder):
+    for relative_path in files:
+        target = os.path.join(target_folder, relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(os.path.join(source_folder, relative_path), target)
+
+
+def _link_files(files, source_folder, target_folder):
+    """Hard-link the files to the target folder, copying them when they cannot be linked"""
+    for relative_path in files:
+        source = os.path.join(source_folder, relative_path)
+        target = os.path.join(target_folder, relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+
+def _present(files, folder):
+    return all(os.path.isfile(os.path.join(folder, relative_path))
+               and os.path.getsize(os.path.join(folder, relative_path)) == size
+               for relative_path, size in files.items())
+
+
+class SessionCheckpoint:
+
+    """Checkpoint of a session for a SPM step.
+
+    :param output_folder: output folder of the session
+    :param stages: list of (stage, file patterns), in the order the SPM function completes them
+    :param fingerprint: fingerprint of the step, see common_operators.fingerprint.step_fingerprint()
+    """
+
+    def __init__(self, output_folder, stages, fingerprint):
+        self.output_folder = output_folder
+        self.stages = stages
+        self.fingerprint = fingerprint
+        self.folder = checkpoint_folder(output_folder)
+        self.files_folder = os.path.join(self.folder, 'files')
+        self.manifest = self._load()
+
+    def _new_manifest(self):
+        return {'fingerprint': self.fingerprint, 'stages': [], COMPLETE: None, 'attempts': []}
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.folder, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return self._new_manifest()
+        if manifest.get('fingerprint', {}).get('key') != self.fingerprint['key']:
+            logging.info("Checkpoint of %s discarded, changed since it was recorded: %s", self.output_folder,
+                         ', '.join(changed_components(self.fingerprint, manifest.get('fingerprint'))))
+            self.clear()
+            return self._new_manifest()
+        return manifest
+
+    def _save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = os.path.join(self.folder, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.folder, MANIFEST))
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @property
+    def complete(self):
+        return self.manifest[COMPLETE] is not None
+
+    @property
+    def last_stage(self):
+        """Last checkpointed stage, COMPLETE if SPM completed, None if there is no checkpoint"""
+        if self.complete:
+            return COMPLETE
+        return self.manifest['stages'][-1]['name'] if self.manifest['stages'] else None
+
+    def stage_seconds(self, name):
+        if name == COMPLETE:
+            return self.manifest[COMPLETE]['seconds']
+        return next((stage['seconds'] for stage in self.manifest['stages'] if stage['name'] == name), 0)
+
+    def harvest(self):
+        """Move the checkpointed artefacts found in the output folder to the checkpoint folder.
+
+        Called after a failed attempt or an invalid result, and before each attempt, in case the previous attempt
+        was killed.
+        """
+        # Without a previous attempt, the output folder holds the outputs of an earlier run of the task
+        if not os.path.isdir(self.output_folder) or not self.manifest['attempts']:
+            return
+        files = output_files(self.output_folder)
+        if self.complete:
+            # The outputs were linked to the checkpoint folder when SPM completed
+            if not _present(self.manifest[COMPLETE]['files'], self.files_folder):
+                logging.warning("Outputs of the completed SPM function missing, checkpoint %s discarded", self.folder)
+                self.manifest[COMPLETE] = None
+            self._save()
+            return
+
+        attempt = self.manifest['attempts'][-1]
+        done = [stage['name'] for stage in self.manifest['stages']]
+        for stage in self.manifest['stages']:
+            # Files of the stages restored for the attempt
+            if _present(stage['files'], self.output_folder):
+                _move_files(stage['files'], self.output_folder, self.files_folder)
+            for path in stage['files']:
+                files.pop(path, None)
+        for name, patterns in self.stages:
+            if name in done:
+                continue
+            stage_files = {}
+            for pattern in patterns:
+                matches = {path: size for path, size in files.items() if fnmatch(os.path.basename(path), pattern)}
+                if not matches:
+                    break
+                stage_files.update(matches)
+            else:
+                for path in stage_files:
+                    files.pop(path)
+                last_write = max(os.path.getmtime(os.path.join(self.output_folder, path)) for path in stage_files)
+                seconds = attempt['base_seconds'] + max(0, last_write - attempt['started'])
+                _move_files(stage_files, self.output_folder, self.files_folder)
+                self.manifest['stages'].append({'name': name, 'files': stage_files, 'seconds': round(seconds)})
+                logging.info("Checkpoint of stage '%s' recorded with %d file(s) in %s",
+                             name, len(stage_files), self.folder)
+                continue
+            break
+        self._save()
+
+    def restore(self):
+        """Move the checkpointed artefacts back to the output folder, return the last stage restored or None"""
+        if self.complete:
+            _move_files(self.manifest[COMPLETE]['files'], self.files_folder, self.output_folder)
+            return COMPLETE
+        restored = []
+        for stage in self.manifest['stages']:
+            if not _present(stage['files'], self.files_folder):
+                logging.warning("Files of stage '%s' missing from checkpoint %s, resuming from the previous stage",
+                                stage['name'], self.folder)
+                break
+            _move_files(stage['files'], self.files_folder, self.output_folder)
+            restored.append(stage)
+        self.manifest['stages'] = restored
+        self._save()
+        return restored[-1]['name'] if restored else None
+
+    def start_attempt(self, resumed_from):
+        self.manifest['attempts'].append({'started': time.time(),
+                                          'resumed_from': resumed_from,
+                                          'base_seconds': self.stage_seconds(resumed_from) if resumed_from else 0})
+        self._save()
+
+    def finish_attempt(self, result=None, output='', error=''):
+        """Record the end of the current attempt, and the outputs of SPM when it completed with result.
+
+        The outputs are hard-linked to the checkpoint folder, as the pipeline operator removes the output folder when
+        the task fails.
+        """
+        attempt = self.manifest['attempts'][-1]
+        attempt['seconds'] = round(time.time() - attempt['started'])
+        if result is not None:
+            files = output_files(self.output_folder)
+            _link_files(files, self.output_folder, self.files_folder)
+            self.manifest[COMPLETE] = {'result': result, 'output': output, 'error': error, 'files': files,
+                                       'seconds': attempt['base_seconds'] + attempt['seconds']}
+        self._save()
+        return attempt
+
+    def previous_seconds(self):
+        """Time spent by the previous attempts"""
+        return sum(attempt.get('seconds', 0) for attempt in self.manifest['attempts'][:-1])
+
+
+class CheckpointEngine:
+
+    """Wraps the MATLAB engine of a SPM pipeline operator to restore the checkpoint of the session before calling
+    the SPM function, and to record a checkpoint when the call fails or completes.
+
+    The SPM function is not called when a previous attempt completed it, its result and outputs are reused.
+    """
+
+    def __init__(self, engine, checkpoint, spm_function, validate_result_fn, task_id):
+        self.engine = engine
+        self.checkpoint = checkpoint
+        self.spm_function = spm_function
+        self.validate_result_fn = validate_result_fn
+        self.task_id = task_id
+
+    def __getattr__(self, name):
+        if name != self.spm_function:
+            return getattr(self.engine, name)
+        return self._call
+
+    def _call(self, *args, **kwargs):
+        checkpoint = self.checkpoint
+        resumed_from = checkpoint.restore()
+        checkpoint.start_attempt(resumed_from)
+
+        if resumed_from == COMPLETE:
+            complete = checkpoint.manifest[COMPLETE]
+            if kwargs.get('stdout'):
+                kwargs['stdout'].write(complete['output'])
+            if kwargs.get('stderr'):
+                kwargs['stderr'].write(complete['error'])
+            checkpoint.finish_attempt()
+            logging.info("SPM function %s completed by a previous attempt in %s, its result is reused from the "
+                         "checkpoint", self.spm_function, _duration(complete['seconds']))
+            return complete['result']
+
+        if resumed_from:
+            logging.info("Resuming SPM function %s from checkpoint '%s', reached after %s by the previous attempts",
+                         self.spm_function, resumed_from, _duration(checkpoint.stage_seconds(resumed_from)))
+        try:
+            result = getattr(self.engine, self.spm_function)(*args, **kwargs)
+        except Exception:
+            checkpoint.finish_attempt()
+            checkpoint.harvest()
+            logging.info("SPM function %s failed, checkpoint: %s", self.spm_function,
+                         checkpoint.last_stage or 'none')
+            raise
+
+        valid = self._valid(result)
+        attempt = checkpoint.finish_attempt(result if valid else None,
+                                            kwargs['stdout'].getvalue() if kwargs.get('stdout') else '',
+                                            kwargs['stderr'].getvalue() if kwargs.get('stderr') else '')
+        if not valid:
+            # The pipeline operator fails and removes the output folder, keep the stages completed
+            checkpoint.harvest()
+            logging.info("SPM function %s returned an invalid result, checkpoint: %s", self.spm_function,
+                         checkpoint.last_stage or 'none')
+            return result
+        if resumed_from:
+            full_seconds = attempt['base_seconds'] + attempt['seconds']
+            logging.info("SPM function %s completed in %s after resuming from checkpoint '%s', a full rerun would "
+                         "have taken about %s (%s saved). The previous attempts ran for %s",
+                         self.spm_function, _duration(attempt['seconds']), resumed_from, _duration(full_seconds),
+                         _duration(attempt['base_seconds']), _duration(checkpoint.previous_seconds()))
+        return result
+
+    def _valid(self, result):
+        try:
+            return bool(self.validate_result_fn(result, self.task_id))
+        except Exception:
+            return False
+
+
+def spm_checkpoint(output_folder, stages, fingerprint):
+    """Return the checkpoint of the session, after moving to it the artefacts left in the output folder by a previous
+    attempt"""
+    checkpoint = SessionCheckpoint(output_folder, stages, fingerprint)
+    checkpoint.harvest()
+    return checkpoint
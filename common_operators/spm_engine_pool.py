@@ -0,0 +1,407 @@
+"""
+
+Pool of MATLAB engines started in advance on a worker, with SPM loaded.
+
+Each SPM step starts a new MATLAB engine, adds its scripts and SPM to the MATLAB path and loads SPM before calling
+its function, which takes tens of seconds for each task. The tasks of Airflow run in separate processes, so the
+engines are kept by a daemon running on each worker:
+
+    python -m common_operators.spm_engine_pool serve <pool folder> --size 2 --path <MISC_LIBRARY_PATH>
+
+The daemon starts the engines, adds SPM and the paths given to the MATLAB path, loads SPM, and shares each engine
+under a name with matlab.engine.shareEngine. The SPM steps connect to a shared engine with matlab.engine.connect_matlab
+instead of starting a new one, and lock it with a file lock while they use it. When a task returns the engine, the
+MATLAB path and working folder are restored and the variables are cleared. When no engine is free, or when the pool
+is not configured, the task starts its own engine as before.
+
+The daemon checks the idle engines regularly. An engine is restarted when it does not answer, after a number of uses,
+or when the memory used by its MATLAB process grows above a limit.
+
+The pool records the number of engines borrowed and the startup time saved. To show them:
+
+    python -m common_operators.spm_engine_pool stats <pool folder>
+
+"""
+
+import argparse
+import fcntl
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import time
+
+STATE_FILE = 'pool.sqlite'
+ENGINE_PREFIX = 'airflow_spm_'
+
+READY = 'ready'
+STARTING = 'starting'
+RECYCLE = 'recycle'
+
+DEFAULT_MAX_USES = 50
+DEFAULT_MAX_MEMORY_MB = 8 * 1024
+# Delay between two health checks of the idle engines, in seconds
+DEFAULT_CHECK_INTERVAL = 60
+# Maximum time for an engine to answer a health check, in seconds
+HEALTH_CHECK_TIMEOUT = 30
+
+
+def engine_pool_folder():
+    """Return the folder of the engine pool of this worker, from key SPM_ENGINE_POOL_FOLDER in section
+    [data-factory] of the Airflow configuration, or '' if there is no pool"""
+    from airflow import configuration
+    if configuration.has_option('data-factory', 'SPM_ENGINE_POOL_FOLDER'):
+        return configuration.get('data-factory', 'SPM_ENGINE_POOL_FOLDER')
+    return ''
+
+
+def process_memory_mb(pid):
+    """Return the resident memory of a process in MB, 0 if unknown"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class EnginePoolState:
+
+    """State of the engines of a pool and usage statistics, stored in a SQLite database in the pool folder"""
+
+    def __init__(self, pool_folder):
+        self.pool_folder = pool_folder
+        os.makedirs(pool_folder, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(pool_folder, STATE_FILE), timeout=60)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS engine (
+                name TEXT PRIMARY KEY,
+                pid INTEGER,
+                state TEXT NOT NULL,
+                started REAL NOT NULL,
+                startup_seconds REAL NOT NULL,
+                uses INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS counter (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def lock_file(self, name):
+        return os.path.join(self.pool_folder, name + '.lock')
+
+    def engines(self, state=None):
+        columns = ['name', 'pid', 'state', 'started', 'startup_seconds', 'uses']
+        rows = self.conn.execute("SELECT %s FROM engine WHERE ? IS NULL OR state = ? ORDER BY uses, name"
+                                 % ', '.join(columns), (state, state))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def set_engine(self, name, pid, state, startup_seconds=0):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO engine (name, pid, state, started, startup_seconds, uses) "
+                              "VALUES (?, ?, ?, ?, ?, 0)", (name, pid, state, time.time(), startup_seconds))
+
+    def set_state(self, name, state):
+        with self.conn:
+            self.conn.execute("UPDATE engine SET state = ? WHERE name = ?", (state, name))
+
+    def remove_engine(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM engine WHERE name = ?", (name,))
+
+    def record_use(self, name):
+        with self.conn:
+            self.conn.execute("UPDATE engine SET uses = uses + 1 WHERE name = ?", (name,))
+            startup_seconds = self.conn.execute("SELECT startup_seconds FROM engine WHERE name = ?",
+                                                (name,)).fetchone()[0]
+            self._increment('borrowed', 1)
+            self._increment('saved_seconds', startup_seconds)
+
+    def increment(self, counter, value=1):
+        with self.conn:
+            self._increment(counter, value)
+
+    def _increment(self, counter, value):
+        self.conn.execute("INSERT OR IGNORE INTO counter (name, value) VALUES (?, 0)", (counter,))
+        self.conn.execute("UPDATE counter SET value = value + ? WHERE name = ?", (value, counter))
+
+    def counters(self):
+        counters = {'borrowed': 0, 'saved_seconds': 0, 'not_available': 0, 'recycled': 0, 'health_failures': 0}
+        counters.update(self.conn.execute("SELECT name, value FROM counter").fetchall())
+        return counters
+
+
+class PooledEngine:
+
+    """MATLAB engine borrowed from the pool. Calling exit() or quit() returns the engine to the pool."""
+
+    def __init__(self, engine, name, pid, lock_fd, pool_folder, max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+        self._engine = engine
+        self._name = name
+        self._pid = pid
+        self._lock_fd = lock_fd
+        self._pool_folder = pool_folder
+        self._max_memory_mb = max_memory_mb
+        self._path = engine.path()
+        self._cwd = engine.pwd()
+
+    def __getattr__(self, attr):
+        return getattr(self._engine, attr)
+
+    def exit(self):
+        if self._lock_fd is None:
+            return
+        try:
+            self._engine.eval("close all force; clear variables; clear global;", nargout=0)
+            self._engine.cd(self._cwd, nargout=0)
+            self._engine.path(self._path, nargout=0)
+            if process_memory_mb(self._pid) > self._max_memory_mb:
+                with EnginePoolState(self._pool_folder) as state:
+                    state.set_state(self._name, RECYCLE)
+        except Exception as e:
+            logging.warning("Cannot reset the MATLAB engine %s, it will be restarted: %s", self._name, e)
+            with EnginePoolState(self._pool_folder) as state:
+                state.set_state(self._name, RECYCLE)
+        finally:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self._engine = None
+            logging.info("MATLAB engine %s returned to the pool", self._name)
+
+    quit = exit
+
+
+def borrow_engine(matlab_paths=None, pool_folder=None):
+    """Borrow a free engine from the pool and add matlab_paths to its path.
+
+    :return: a PooledEngine, or None if the pool is not configured or no engine is free
+    """
+    pool_folder = engine_pool_folder() if pool_folder is None else pool_folder
+    if not pool_folder or not os.path.exists(os.path.join(pool_folder, STATE_FILE)):
+        return None
+    import matlab.engine
+
+    with EnginePoolState(pool_folder) as state:
+        shared = set(matlab.engine.find_matlab())
+        for engine_info in state.engines(READY):
+            name = engine_info['name']
+            if name not in shared:
+                continue
+            lock_fd = os.open(state.lock_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock_fd)
+                continue
+            try:
+                engine = PooledEngine(matlab.engine.connect_matlab(name), name, engine_info['pid'], lock_fd,
+                                      pool_folder)
+                for path in matlab_paths or []:
+                    if path:
+                        engine.addpath(path, nargout=0)
+            except Exception as e:
+                logging.warning("Cannot connect to the MATLAB engine %s: %s", name, e)
+                os.close(lock_fd)
+                state.set_state(name, RECYCLE)
+                continue
+            state.record_use(name)
+            logging.info("Borrowed MATLAB engine %s from the pool, saved %.1fs of startup", name,
+                         engine_info['startup_seconds'])
+            return engine
+        state.increment('not_available')
+    logging.info("No MATLAB engine available in the pool %s", pool_folder)
+    return None
+
+
+def start_engine(matlab_paths=None, pool_folder=None):
+    """Borrow an engine from the pool, or start a new engine with SPM and matlab_paths on its path"""
+    engine = borrow_engine(matlab_paths, pool_folder)
+    if engine:
+        return engine
+    import matlab.engine
+    from airflow import configuration
+
+    engine = matlab.engine.start_matlab()
+    for path in (matlab_paths or []) + [str(configuration.get('spm', 'SPM_DIR'))]:
+        if path:
+            engine.addpath(path, nargout=0)
+    return engine
+
+
+class EnginePoolDaemon:
+
+    """Starts the engines of the pool, checks and restarts them.
+
+    :param pool_folder: folder storing the state of the pool and the locks of the engines
+    :param size: number of engines
+    :param matlab_paths: paths added to the MATLAB path of the engines, with SPM
+    :param spm_dir: folder containing SPM
+    :param max_uses: number of uses after which an engine is restarted
+    :param max_memory_mb: memory of the MATLAB process above which an engine is restarted
+    """
+
+    def __init__(self, pool_folder, size, matlab_paths, spm_dir, max_uses=DEFAULT_MAX_USES,
+                 max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+        self.state = EnginePoolState(pool_folder)
+        self.size = size
+        self.matlab_paths = [path for path in matlab_paths if path] + [spm_dir]
+        self.max_uses = max_uses
+        self.max_memory_mb = max_memory_mb
+        self.engines = {}
+        self.running = True
+
+    def start(self, name):
+        import matlab.engine
+
+        self.state.set_engine(name, None, STARTING)
+        start = time.time()
+        engine = matlab.engine.start_matlab()
+        for path in self.matlab_paths:
+            engine.addpath(path, nargout=0)
+        # Load SPM and its defaults
+        engine.spm('defaults', 'fmri', nargout=0)
+        pid = int(engine.feature('getpid'))
+        engine.matlab.engine.shareEngine(name, nargout=0)
+        startup_seconds = time.time() - start
+        self.engines[name] = engine
+        self.state.set_engine(name, pid, READY, startup_seconds)
+        logging.info("Started MATLAB engine %s, pid %d, in %.1fs", name, pid, startup_seconds)
+
+    def stop(self, name):
+        engine = self.engines.pop(name, None)
+        self.state.remove_engine(name)
+        if engine:
+            try:
+                engine.quit()
+            except Exception as e:
+                logging.warning("Cannot stop the MATLAB engine %s: %s", name, e)
+
+    def check(self, name, engine_info):
+        """Check an idle engine, return the reason to restart it or None"""
+        if engine_info['state'] == RECYCLE:
+            return 'marked for recycling'
+        if engine_info['uses'] >= self.max_uses:
+            return 'used %d times' % engine_info['uses']
+        memory_mb = process_memory_mb(engine_info['pid'])
+        if memory_mb > self.max_memory_mb:
+            return 'using %.0f MB' % memory_mb
+        try:
+            result = self.engines[name].sqrt(4.0, background=True).result(timeout=HEALTH_CHECK_TIMEOUT)
+            if int(result) != 2:
+                raise RuntimeError("sqrt(4) returned %s" % result)
+        except Exception as e:
+            self.state.increment('health_failures')
+            if engine_info['pid']:
+                try:
+                    os.kill(engine_info['pid'], signal.SIGKILL)
+                except OSError:
+                    pass
+            return 'health check failed: %s' % e
+        return None
+
+    def maintain(self):
+        engines_info = dict((e['name'], e) for e in self.state.engines())
+        for i in range(self.size):
+            name = '%s%d' % (ENGINE_PREFIX, i)
+            if name not in self.engines:
+                self.start(name)
+                continue
+            # Only check the engines which are not borrowed
+            lock_fd = os.open(self.state.lock_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock_fd)
+                continue
+            try:
+                reason = self.check(name, engines_info.get(name, {'state': RECYCLE}))
+                if reason:
+                    logging.info("Restarting MATLAB engine %s: %s", name, reason)
+                    self.stop(name)
+                    self.state.increment('recycled')
+                    self.start(name)
+            finally:
+                os.close(lock_fd)
+
+    def serve(self, check_interval=DEFAULT_CHECK_INTERVAL):
+        def shutdown(signum, frame):
+            self.running = False
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        # Engines started by a previous daemon have stopped with it
+        for engine_info in self.state.engines():
+            self.state.remove_engine(engine_info['name'])
+        try:
+            while self.running:
+                self.maintain()
+                for _ in range(check_interval):
+                    if not self.running:
+                        break
+                    time.sleep(1)
+        finally:
+            for name in list(self.engines):
+                self.stop(name)
+            self.state.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pool of MATLAB engines with SPM loaded')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='start the engines and keep them running')
+    serve_parser.add_argument('pool_folder')
+    serve_parser.add_argument('--size', type=int, default=2, help='number of engines')
+    serve_parser.add_argument('--path', action='append', default=[],
+                              help='path added to the MATLAB path of the engines, can be repeated')
+    serve_parser.add_argument('--spm-dir', help='SPM folder, default to SPM_DIR in section [spm] of Airflow')
+    serve_parser.add_argument('--max-uses', type=int, default=DEFAULT_MAX_USES,
+                              help='number of uses after which an engine is restarted')
+    serve_parser.add_argument('--max-memory-mb', type=int, default=DEFAULT_MAX_MEMORY_MB,
+                              help='memory of MATLAB in MB above which an engine is restarted')
+    serve_parser.add_argument('--check-interval', type=int, default=DEFAULT_CHECK_INTERVAL,
+                              help='delay between two health checks in seconds')
+    stats_parser = subparsers.add_parser('stats', help='show the engines and the startup time saved')
+    stats_parser.add_argument('pool_folder')
+    args = parser.parse_args(argv)
+
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'serve':
+        spm_dir = args.spm_dir
+        if not spm_dir:
+            from airflow import configuration
+            spm_dir = configuration.get('spm', 'SPM_DIR')
+        EnginePoolDaemon(args.pool_folder, args.size, args.path, spm_dir, args.max_uses,
+                         args.max_memory_mb).serve(args.check_interval)
+        return 0
+
+    with EnginePoolState(args.pool_folder) as state:
+        print("%-20s %8s %10s %8s %12s %10s" % ('engine', 'pid', 'state', 'uses', 'startup (s)', 'memory MB'))
+        for e in state.engines():
+            print("%-20s %8s %10s %8d %12.1f %10.0f" % (
+                e['name'], e['pid'] or '', e['state'], e['uses'], e['startup_seconds'],
+                process_memory_mb(e['pid'] or 0)))
+        counters = state.counters()
+        print()
+        print("%(borrowed)d engine(s) borrowed, %(saved_seconds).0fs of startup saved, %(not_available)d task(s) "
+              "started their own engine, %(recycled)d engine(s) restarted, %(health_failures)d failed health "
+              "check(s)" % counters)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
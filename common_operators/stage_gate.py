@@ -0,0 +1,150 @@
+"""
+
+Gates of the stages of a pipeline, for the stage-pipelined execution of the sessions.
+
+By default, the number of sessions processed at the same time is bounded by MAX_ACTIVE_RUNS, whatever the step they
+are in. With a small MAX_ACTIVE_RUNS, the CPU-bound steps wait while the sessions are copied and converted. With a
+large one, all the sessions are copied to the local disk long before the CPU-bound steps can process them.
+
+In stage-pipelined mode, a StageGateSensor is placed before each stage of the pipeline. A session enters the stage
+when:
+
+* less than `slots` sessions are in the stage: they passed the gate of the stage and the task of the stage is not
+  finished
+* the sessions in the stage and the sessions which completed the stage and wait at the gate of the next stage, its
+  hand-off queue, are less than `slots + queue_size`
+
+A stage producing sessions faster than the next stage can process them stops when its hand-off queue is full, so
+the copy of the session N+2 and the conversion of the session N+1 run while the session N is in mpm_maps, without
+copying the whole backlog to the local disk.
+
+The gates check their stage in reschedule mode, without holding a worker slot while they wait. When a gate opens,
+the other gates waiting are woken up to check their stage again. The gates woken up together are admitted in the
+order of their start: a running gate of the stage counts as a session in the stage for the gates started after it,
+so that they do not all see the same free slot.
+
+"""
+
+import logging
+
+from datetime import timedelta
+
+from airflow.exceptions import AirflowConfigException
+from airflow.models import DagRun, TaskInstance
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow.utils.state import State
+
+from common_operators.reschedule_sensor import ReschedulingSensorOperator, WAIT_RESCHEDULE, wake_waiting_tasks
+
+# Delay between two checks of a closed gate, a gate is also checked again when another gate opens
+GATE_INTERVAL = timedelta(minutes=1)
+
+# Maximum time spent by a session waiting at a gate
+MAX_GATE_WAIT = timedelta(days=7)
+
+FINISHED_STATES = [State.SUCCESS, State.FAILED, State.SKIPPED, State.UPSTREAM_FAILED]
+
+
+def gate_task_id(stage):
+    return 'stage_gate_' + stage
+
+
+def stage_limits(step_config):
+    """Return the (slots, queue size) of the stage configured in the section of the step"""
+    slots = step_config.getint('STAGE_SLOTS')
+    if slots < 1:
+        raise AirflowConfigException("Invalid value '%s' for key STAGE_SLOTS in section [%s], expected a positive "
+                                     "integer" % (slots, step_config.name))
+    queue_size = step_config.getint('STAGE_QUEUE')
+    if queue_size < 0:
+        raise AirflowConfigException("Invalid value '%s' for key STAGE_QUEUE in section [%s], expected a positive "
+                                     "integer or 0" % (queue_size, step_config.name))
+    return slots, queue_size
+
+
+def gate_open(in_stage, handed_off, slots, queue_size):
+    """True if a new session can enter a stage holding in_stage sessions, whose handed_off sessions wait for the
+    next stage"""
+    return in_stage < slots and in_stage + handed_off < slots + queue_size
+
+
+@provide_session
+def stage_occupancy(dag_id, gate_task_id, stage_task_id, next_gate_task_id=None, admitted_before=None,
+                    session=None):
+    """Return the number of running DAG runs in the stage, and the number of running DAG runs which completed the
+    stage and wait at the gate of the next stage.
+
+    :param admitted_before: (start date, execution date) of the gate checking the stage. The gates of the stage
+        running and started before it count as in the stage
+    """
+    running_dates = [run.execution_date for run in session.query(DagRun).filter(
+        DagRun.dag_id == dag_id, DagRun.state == State.RUNNING)]
+    if not running_dates:
+        return 0, 0
+    task_ids = [task_id for task_id in (gate_task_id, stage_task_id, next_gate_task_id) if task_id]
+    states = {}
+    gate_starts = {}
+    for ti in session.query(TaskInstance).filter(
+            TaskInstance.dag_id == dag_id,
+            TaskInstance.task_id.in_(task_ids),
+            TaskInstance.execution_date.in_(running_dates)):
+        states.setdefault(ti.execution_date, {})[ti.task_id] = ti.state
+        if ti.task_id == gate_task_id and ti.state == State.RUNNING and ti.start_date:
+            gate_starts[ti.execution_date] = (ti.start_date, ti.execution_date)
+
+    in_stage = 0
+    handed_off = 0
+    for execution_date, run_states in states.items():
+        gate_state = run_states.get(gate_task_id)
+        if gate_state == State.RUNNING:
+            # Admitted first if the gate passes
+            if admitted_before and execution_date in gate_starts and gate_starts[execution_date] < admitted_before:
+                in_stage += 1
+        elif gate_state == State.SUCCESS and run_states.get(stage_task_id) not in FINISHED_STATES:
+            in_stage += 1
+        elif next_gate_task_id and run_states.get(stage_task_id) == State.SUCCESS and \
+                run_states.get(next_gate_task_id) not in FINISHED_STATES:
+            handed_off += 1
+    return in_stage, handed_off
+
+
+class StageGateSensor(ReschedulingSensorOperator):
+
+    """
+    Waits until the session can enter a stage of the pipeline, see common_operators.stage_gate.
+
+    :param stage_task_id: id of the last task of the stage
+    :type stage_task_id: str
+    :param slots: maximum number of sessions in the stage
+    :type slots: int
+    :param queue_size: maximum number of sessions which completed the stage and wait at the gate of the next stage
+    :type queue_size: int
+    :param next_gate_task_id: id of the gate of the next stage, None for the last stage
+    :type next_gate_task_id: str
+    """
+
+    template_fields = tuple()
+    ui_color = '#f5e8d8'
+
+    @apply_defaults
+    def __init__(self, stage_task_id, slots, queue_size, next_gate_task_id=None, *args, **kwargs):
+        super(StageGateSensor, self).__init__(mode=WAIT_RESCHEDULE, reschedule_interval=GATE_INTERVAL,
+                                              max_wait=MAX_GATE_WAIT, *args, **kwargs)
+        self.stage_task_id = stage_task_id
+        self.slots = slots
+        self.queue_size = queue_size
+        self.next_gate_task_id = next_gate_task_id
+
+    def poke(self, context):
+        ti = context['ti']
+        in_stage, handed_off = stage_occupancy(self.dag_id, self.task_id, self.stage_task_id,
+                                               self.next_gate_task_id, (ti.start_date, ti.execution_date))
+        logging.info("Stage %s: %d/%d sessions, %d/%d sessions waiting for the next stage", self.stage_task_id,
+                     in_stage, self.slots, handed_off, self.queue_size)
+        return gate_open(in_stage, handed_off, self.slots, self.queue_size)
+
+    def execute(self, context):
+        super(StageGateSensor, self).execute(context)
+        # The session left the hand-off queue of the previous stage
+        wake_waiting_tasks(operators=[self.__class__.__name__])
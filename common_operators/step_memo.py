@@ -0,0 +1,89 @@
+"""
+
+Memoisation of the results of the pipeline steps of a session.
+
+A session is processed again from the start when it is triggered again, after a rescan of the input folder, a new
+.ready marker or a new reorganisation of the files, even when nothing changed since its last successful run. After a
+successful run, the step records in a memo the fingerprint of the step (see common_operators.fingerprint), the files of
+its output folder, its result and output, and the provenance step recorded in the data catalog. When the step runs
+again for the session with the same fingerprint and its output files are unchanged, the step is skipped: the previous
+outputs and provenance are published to the next steps as if the step had run.
+
+The memo of a session is stored in OUTPUT_FOLDER/.memo/&lt;session&gt;.json, next to the output folder of the session.
+
+"""
+
+import json
+import logging
+import os
+import time
+
+from common_operators.fingerprint import changed_components, output_files
+
+MEMO_FOLDER = '.memo'
+
+
+def memo_cfg(pipeline_config):
+    """Return the memoisation arguments of the SPM pipeline operators for the steps of the pipeline"""
+    return {'memoise': True,
+            'force_recompute': pipeline_config.getboolean('FORCE_RECOMPUTE')}
+
+
+def memo_path(output_folder):
+    """Memo file of a session output folder"""
+    output_folder = os.path.normpath(output_folder)
+    return os.path.join(os.path.dirname(output_folder), MEMO_FOLDER, os.path.basename(output_folder) + '.json')
+
+
+class StepMemo:
+
+    """Memo of the last successful run of a step for a session.
+
+    :param output_folder: output folder of the session
+    :param fingerprint: fingerprint of the step, see common_operators.fingerprint.step_fingerprint()
+    """
+
+    def __init__(self, output_folder, fingerprint):
+        self.output_folder = output_folder
+        self.fingerprint = fingerprint
+        self.path = memo_path(output_folder)
+        try:
+            with open(self.path) as f:
+                self.record = json.load(f)
+        except (OSError, ValueError):
+            self.record = None
+
+    def matches(self):
+        """True if the last successful run used the same fingerprint and its outputs are unchanged"""
+        if not self.record:
+            return False
+        if self.record['fingerprint']['key'] != self.fingerprint['key']:
+            logging.info("Memo of %s not used, changed since the last run: %s", self.output_folder,
+                         ', '.join(changed_components(self.fingerprint, self.record['fingerprint'])))
+            return False
+        if not os.path.isdir(self.output_folder) or output_files(self.output_folder) != self.record['files']:
+            logging.info("Memo of %s not used, the output folder changed since the last run", self.output_folder)
+            return False
+        return True
+
+    def save(self, result, output, error, seconds, provenance_step_id=None):
+        self.record = {'fingerprint': self.fingerprint,
+                       'created': time.time(),
+                       'seconds': round(seconds),
+                       'result': result,
+                       'output': output,
+                       'error': error,
+                       'files': output_files(self.output_folder),
+                       'provenance_step_id': provenance_step_id}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.record, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.record = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
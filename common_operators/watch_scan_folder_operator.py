@@ -0,0 +1,163 @@
+"""
+
+WatchDailyFolderOperator watches the daily folder matching path root_folder/yyyy/yyyyMMdd, where the date used is the
+execution date, and triggers a DAG run as soon as a session folder becomes ready for processing.
+
+"""
+
+import logging
+import os
+
+from datetime import datetime, timedelta
+
+from airflow.exceptions import AirflowSkipException
+from airflow.utils import apply_defaults
+from airflow.utils.db import provide_session
+from airflow_scan_folder.operators import ScanDailyFolderOperator
+
+from common_operators.folder_watcher import FolderWatcher
+from common_operators.scan_index import ScanFolderMixin, ScanIndex, IGNORED_FOLDERS, PENDING, PROCESSING, REJECTED, \
+    TRIGGERED
+
+
+class WatchDailyFolderOperator(ScanFolderMixin, ScanDailyFolderOperator):
+
+    """
+    Watches the daily folder for session folders ready for processing and triggers a DAG run for each of them.
+
+    The operator first checks the session folders already present in the daily folder, then it waits for the
+    creation of new session folders and ready marker files until watch_duration has elapsed. Changes are detected with
+    inotify when the input folder is on a local filesystem, otherwise the watched folders are polled every
+    poll_interval seconds.
+
+    The daily folders for the execution date and for the current date are watched, to follow the creation of a new
+    daily folder after midnight.
+
+    A session folder is ready if the ready marker file is not required for its date, or if the ready marker file is
+    found in the daily folder or in the session folder. Session folders containing the processing marker file are
+    ignored. Each session folder is triggered at most once by an operator run, and at most once overall when
+    scan_index_file is defined.
+
+    :param watch_duration: how long to watch the daily folder
+    :type watch_duration: timedelta
+    :param poll_interval: time in seconds between two listings of the watched folders when inotify is not available
+    :type poll_interval: float
+    :param watch_mode: 'inotify' or 'poll' to force a mode, None to use inotify when it is supported
+    :type watch_mode: str
+    :param scan_index_file: optional path to the SQLite file storing the scan index
+    :type scan_index_file: str
+    :param processing_marker_file: name of the marker file indicating that the processing of a session folder has
+        already started. Default to '.processing'
+    :type processing_marker_file: str
+
+    See ScanDailyFolderOperator for the other parameters.
+    """
+
+    template_fields = tuple()
+    template_ext = tuple()
+    ui_color = '#cceeeb'
+
+    @apply_defaults
+    def __init__(
+            self,
+            watch_duration=timedelta(minutes=9),
+            poll_interval=5.0,
+            watch_mode=None,
+            scan_index_file=None,
+            processing_marker_file='.processing',
+            *args, **kwargs):
+        super(WatchDailyFolderOperator, self).__init__(*args, **kwargs)
+        self.watch_duration = watch_duration
+        self.poll_interval = poll_interval
+        self.watch_mode = watch_mode
+        self.scan_index_file = scan_index_file
+        self.processing_marker_file = processing_marker_file
+
+    def daily_folders(self, folder, context):
+        """Return the daily folders to watch, as a dictionary of daily folder path to date"""
+        dates = [context['execution_date'], datetime.now()]
+        return dict((self.build_daily_folder_path_callable(folder, date), date) for date in reversed(dates))
+
+    def execute(self, context):
+        self.watch_daily_dirs(self.folder, context)
+
+    @provide_session
+    def watch_daily_dirs(self, folder, context, session=None):
+        if not os.path.exists(folder):
+            raise AirflowSkipException
+
+        scan_index = ScanIndex(self.scan_index_file) if self.scan_index_file else None
+
+        deadline = datetime.now() + self.watch_duration
+        triggered = set()
+        triggered_count = 0
+        try:
+            with FolderWatcher(folder, poll_interval=self.poll_interval, mode=self.watch_mode) as watcher:
+                changed_folders = None
+                while True:
+                    for daily_folder, date in self.daily_folders(folder, context).items():
+                        new_daily_folder = daily_folder not in watcher.watched_folders()
+                        if not watcher.watch(daily_folder):
+                            self.watch_parent_folder(watcher, folder, daily_folder)
+                            continue
+                        if changed_folders is None or new_daily_folder or daily_folder in changed_folders:
+                            candidates = self.session_folders(daily_folder, triggered, scan_index)
+                        else:
+                            candidates = [f for f in changed_folders
+                                          if os.path.dirname(f) == daily_folder and f not in triggered]
+                        look_for_ready_marker_file = self.look_for_ready_marker_file(date)
+                        for session_folder in candidates:
+                            if self.check_session_folder(context, daily_folder, session_folder,
+                                                         look_for_ready_marker_file, watcher, scan_index, session):
+                                triggered.add(session_folder)
+                                triggered_count += 1
+
+                    remaining = (deadline - datetime.now()).total_seconds()
+                    if remaining <= 0:
+                        break
+                    changed_folders = watcher.wait(remaining)
+        finally:
+            if scan_index:
+                scan_index.close()
+
+        logging.info("%d session folder(s) triggered while watching %s", triggered_count, folder)
+
+    @staticmethod
+    def watch_parent_folder(watcher, root_folder, daily_folder):
+        """Watch the closest existing parent of a daily folder, to see the daily folder created"""
+        parent_folder = os.path.dirname(daily_folder)
+        while not watcher.watch(parent_folder) and parent_folder.startswith(root_folder.rstrip('/') + '/'):
+            parent_folder = os.path.dirname(parent_folder)
+
+    def session_folders(self, daily_folder, triggered, scan_index):
+        """List the session folders of a daily folder that have not been triggered yet"""
+        if scan_index:
+            scan_index.update_daily_folder(daily_folder)
+            return [f for f in scan_index.pending_session_folders(daily_folder) if f not in triggered]
+        session_folders = []
+        for entry in os.scandir(daily_folder):
+            if entry.name not in IGNORED_FOLDERS and entry.is_dir() and entry.path not in triggered:
+                session_folders.append(entry.path)
+        return sorted(session_folders)
+
+    def check_session_folder(self, context, daily_folder, session_folder, look_for_ready_marker_file, watcher,
+                             scan_index, session):
+        """Trigger a DAG run for the session folder if it is ready. Return True if a DAG run was triggered."""
+        if not self.accept_folder(session_folder):
+            state = REJECTED
+        elif os.path.exists(os.path.join(session_folder, self.processing_marker_file)):
+            state = PROCESSING
+        else:
+            # Watch the session folder before looking for the ready marker file, to not miss its creation
+            watcher.watch(session_folder)
+            state = PENDING
+            if self.is_ready(daily_folder, session_folder, look_for_ready_marker_file):
+                logging.info('Prepare trigger for %s : %s', self.trigger_dag_id, session_folder)
+                self.trigger_dag_run(context, root_folder=self.root_folder(context), folder=session_folder,
+                                     session=session)
+                self.offset += 1
+                state = TRIGGERED
+
+        if scan_index and state != PENDING:
+            scan_index.set_state(session_folder, state)
+        return state == TRIGGERED
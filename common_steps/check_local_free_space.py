@@ -6,57 +6,124 @@ Configuration variables used:
 
 * :<pipeline> section
     * MIN_FREE_SPACE
+    * SPACE_LEDGER_FILE: optional path to the space ledger. When defined, the space expected to be used by the DAG run
+      is reserved in the ledger instead of checking the free space on the disk
+    * FREE_SPACE_WAIT: 'poke' to wait for free space inside the task, 'reschedule' to check again every few minutes
+      without holding a worker slot and a slot of the remote_file_copy pool between two checks
 * :<pipeline>:<step> section (first match in a list of steps)
     * OUTPUT_FOLDER
+* :<pipeline>:copy_to_local section
+    * CACHE_FOLDER: optional folder of the local file cache, evicted before checking the free space
 
 """
 
-from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow.exceptions import AirflowConfigException
 from airflow_freespace.operators import FreeSpaceSensor
 
+from common_operators.reschedule_sensor import LocalFreeSpaceSensor, WAIT_RESCHEDULE, parse_wait_mode, wait_args
+from common_operators.space_reservation_sensor import SpaceReservationSensor
 from common_steps import Step
 
 
-def check_local_free_space_cfg(dag, upstream_step, pipeline_section, step_sections):
-    min_free_space = configuration.getfloat(pipeline_section, 'MIN_FREE_SPACE')
-    local_folder = None
-    for step_section in step_sections:
-        try:
-            local_folder = configuration.get(step_section, "OUTPUT_FOLDER")
-            if local_folder:
-                break
-        except AirflowConfigException:
-            pass
+def check_local_free_space_cfg(dag, upstream_step, pipeline_config, step_names):
+    min_free_space = pipeline_config.getfloat('MIN_FREE_SPACE')
+    local_folder = pipeline_config.first_output_folder(step_names)
 
     if not local_folder:
-        raise AirflowConfigException("No output folder defined in sections %s" % (','.join(step_sections)))
+        raise AirflowConfigException("No output folder defined in sections %s" % (','.join(
+            pipeline_config.name + ':' + step_name for step_name in step_names)))
+
+    wait_mode = parse_wait_mode(pipeline_config.get('FREE_SPACE_WAIT', ''), pipeline_config.name)
+    ledger_file = pipeline_config.get('SPACE_LEDGER_FILE', '')
+    cache_folder = ''
+    if 'copy_to_local' in pipeline_config.pipelines and 'copy_to_local' in pipeline_config.steps:
+        cache_folder = pipeline_config.step('copy_to_local').get('CACHE_FOLDER', '')
+    if ledger_file:
+        output_folders = pipeline_config.output_folders(step_names)
+        return reserve_local_space_step(dag, upstream_step, min_free_space, local_folder, ledger_file,
+                                        output_folders, wait_mode, cache_folder)
+
+    return check_local_free_space_step(dag, upstream_step, min_free_space, local_folder, wait_mode, cache_folder)
+
+
+def _wait_doc(wait_mode):
+    if wait_mode == WAIT_RESCHEDULE:
+        return " The check is retried every few minutes without holding a worker slot while waiting."
+    return ""
+
+
+def _cache_doc(cache_folder):
+    if cache_folder:
+        return " Files only held by the local cache %s are evicted first." % cache_folder
+    return ""
+
+
+def check_local_free_space_step(dag, upstream_step, min_free_space, local_folder, wait_mode=None, cache_folder=''):
+
+    if wait_mode == WAIT_RESCHEDULE or cache_folder:
+        # FreeSpaceSensor cannot evict the local cache
+        check_local_free_space = LocalFreeSpaceSensor(
+            task_id='check_local_free_space',
+            path=local_folder,
+            free_disk_threshold=min_free_space,
+            cache_folder=cache_folder,
+            mode=wait_mode,
+            pool='remote_file_copy',
+            priority_weight=upstream_step.priority_weight,
+            dag=dag,
+            **wait_args(wait_mode)
+        )
+    else:
+        check_local_free_space = FreeSpaceSensor(
+            task_id='check_local_free_space',
+            path=local_folder,
+            free_disk_threshold=min_free_space,
+            pool='remote_file_copy',
+            priority_weight=upstream_step.priority_weight,
+            dag=dag,
+            **wait_args(wait_mode)
+        )
 
-    return check_local_free_space_step(dag, upstream_step, min_free_space, local_folder)
+    if upstream_step.task:
+        check_local_free_space.set_upstream(upstream_step.task)
 
+    check_local_free_space.doc_md = dedent("""\
+    # Check free space
 
-def check_local_free_space_step(dag, upstream_step, min_free_space, local_folder):
+    Check that there is at least %.0f%% free space on the disk hosting folder %s for processing, wait otherwise.%s%s
+    """ % (min_free_space, local_folder, _cache_doc(cache_folder), _wait_doc(wait_mode)))
 
-    check_local_free_space = FreeSpaceSensor(
+    return Step(check_local_free_space, check_local_free_space.task_id, upstream_step.priority_weight + 10)
+
+
+def reserve_local_space_step(dag, upstream_step, min_free_space, local_folder, ledger_file, output_folders,
+                             wait_mode=None, cache_folder=''):
+
+    check_local_free_space = SpaceReservationSensor(
         task_id='check_local_free_space',
+        ledger_file=ledger_file,
         path=local_folder,
         free_disk_threshold=min_free_space,
-        retry_delay=timedelta(hours=1),
-        retries=24 * 7,
+        output_folders=output_folders,
+        cache_folder=cache_folder,
+        mode=wait_mode,
         pool='remote_file_copy',
-        dag=dag
+        priority_weight=upstream_step.priority_weight,
+        dag=dag,
+        **wait_args(wait_mode)
     )
 
     if upstream_step.task:
         check_local_free_space.set_upstream(upstream_step.task)
 
     check_local_free_space.doc_md = dedent("""\
-    # Check free space
+    # Reserve local disk space
 
-    Check that there is at least %.0f%% free space on the disk hosting folder %s for processing, wait otherwise.
-    """ % (min_free_space, local_folder))
+    Estimate the space used on the disk hosting folder %s by the steps %s from the size of the input folder, and
+    wait until this space can be reserved in the space ledger %s while keeping at least %.0f%% free space.%s%s
+    """ % (local_folder, ', '.join(sorted(output_folders)), ledger_file, min_free_space, _cache_doc(cache_folder),
+           _wait_doc(wait_mode)))
 
     return Step(check_local_free_space, check_local_free_space.task_id, upstream_step.priority_weight + 10)
@@ -0,0 +1,153 @@
+"""
+
+Cache for the DAGs built by df_pipelines_init.
+
+The DAG files are parsed again and again by the scheduler, the webserver and the workers, and each parse rebuilds the
+DAGs of all datasets. The DAGs built for a dataset are kept here and reused as long as the configuration sections of
+that dataset and the code of the pipeline and step modules do not change.
+
+This module lives in sys.modules and survives the reload of the DAG files by the DagBag. Processes parsing the DAG
+files only once (e.g. the DAG file processors of the scheduler) can share DAGs through a cache folder, where the
+DAGs are pickled with dill, as done by Airflow itself when pickling DAGs.
+
+Configuration variables used:
+
+* data-factory section
+    * DAG_CACHE_FOLDER: optional, folder where DAGs are persisted between processes. Disabled if empty.
+
+"""
+
+import glob
+import hashlib
+import logging
+import os
+
+from airflow import configuration
+
+
+# Sections used by the DAGs of all datasets
+GLOBAL_SECTIONS = ['data-factory', 'spm', 'mipmap']
+
+# Packages containing the code used to build the DAGs
+CODE_PACKAGES = ['common_steps', 'common_operators',
+                 'preprocessing_pipelines', 'preprocessing_steps',
+                 'reorganisation_pipelines', 'reorganisation_steps',
+                 'metadata_pipelines', 'metadata_steps',
+                 'ehr_pipelines', 'ehr_steps']
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def code_version():
+    """Hash of the source code of the modules used to build the DAGs"""
+    md5 = hashlib.md5()
+    files = [os.path.join(ROOT_FOLDER, 'df_pipelines_init.py')]
+    for package in CODE_PACKAGES:
+        files.extend(sorted(glob.glob(os.path.join(ROOT_FOLDER, package, '*.py'))))
+    for path in files:
+        md5.update(path.encode('utf-8'))
+        with open(path, 'rb') as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def config_fingerprint(section=None):
+    """Hash of the configuration of the global sections, plus a section and its sub-sections if given"""
+    md5 = hashlib.md5()
+    for s in sorted(configuration.conf.sections()):
+        if s in GLOBAL_SECTIONS or (section and (s == section or s.startswith(section + ':'))):
+            md5.update(('[%s]' % s).encode('utf-8'))
+            for key, value in sorted(configuration.conf.items(s, raw=True)):
+                md5.update(('%s=%s\n' % (key, value)).encode('utf-8'))
+    for key, value in sorted(os.environ.items()):
+        if key.startswith('AIRFLOW__'):
+            md5.update(('%s=%s\n' % (key, value)).encode('utf-8'))
+    return md5.hexdigest()
+
+
+class DagCache(object):
+
+    def __init__(self):
+        self.entries = dict()
+        self.code_version = None
+        self.cache_folder = None
+        self.hits = 0
+        self.misses = 0
+
+    def begin_parse(self):
+        self.code_version = code_version()
+        self.cache_folder = None
+        if configuration.has_option('data-factory', 'DAG_CACHE_FOLDER'):
+            self.cache_folder = configuration.get('data-factory', 'DAG_CACHE_FOLDER') or None
+        self.hits = 0
+        self.misses = 0
+
+    def end_parse(self):
+        logging.info("DAG cache: %d hit(s), %d miss(es)", self.hits, self.misses)
+
+    def key(self, section=None):
+        return hashlib.md5((self.code_version + config_fingerprint(section)).encode('utf-8')).hexdigest()
+
+    def dags(self, name, build_dags_callable, section=None):
+        """Return the DAGs cached under name, building them only if the configuration or the code changed.
+
+        :param name: name of the cache entry
+        :param build_dags_callable: function returning the list of DAGs to cache
+        :param section: configuration section used to build the DAGs, global sections are always checked
+        """
+        key = self.key(section)
+        entry = self.entries.get(name)
+        if entry and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+
+        dags = self._load(name, key)
+        if dags is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            logging.info("DAG cache: build DAGs for %s", name)
+            dags = build_dags_callable()
+            self._store(name, key, dags)
+
+        self.entries[name] = (key, dags)
+        return dags
+
+    def _cache_file(self, name, key):
+        return os.path.join(self.cache_folder, '%s-%s.pkl' % (name.replace(':', '_'), key))
+
+    def _load(self, name, key):
+        if not self.cache_folder:
+            return None
+        cache_file = self._cache_file(name, key)
+        if not os.path.isfile(cache_file):
+            return None
+        import dill
+        try:
+            with open(cache_file, 'rb') as f:
+                return dill.load(f)
+        except Exception:
+            logging.warning("DAG cache: cannot load %s, DAGs will be rebuilt", cache_file, exc_info=True)
+            return None
+
+    def _store(self, name, key, dags):
+        if not self.cache_folder:
+            return
+        import dill
+        cache_file = self._cache_file(name, key)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            for old_file in glob.glob(self._cache_file(name, '?' * len(key))):
+                if old_file != cache_file:
+                    os.remove(old_file)
+            with open(tmp_file, 'wb') as f:
+                dill.dump(dags, f)
+            os.rename(tmp_file, cache_file)
+        except Exception:
+            logging.warning("DAG cache: cannot store DAGs in %s", cache_file, exc_info=True)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+dag_cache = DagCache()
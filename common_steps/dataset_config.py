@@ -0,0 +1,283 @@
+"""
+
+Snapshot of the configuration of a dataset.
+
+The configuration of a dataset is read once from the Airflow configuration, with the default values resolved and the
+values validated, then it is passed to the DAG and step builders. The Airflow configuration itself is never modified.
+
+Configuration variables used:
+
+* data-factory section
+* data-factory:&lt;dataset&gt; section
+    * DATASET_LABEL
+* data-factory:&lt;dataset&gt;:reorganisation, :preprocessing, :metadata and :ehr sections and their step sections,
+  see the documentation of each pipeline and step.
+
+"""
+
+from airflow import configuration
+from airflow.exceptions import AirflowConfigException
+
+
+def _spm_step_defaults(spm_function, pipeline_folder):
+    return [('SPM_FUNCTION', spm_function, False),
+            ('PIPELINE_PATH', lambda pipeline, step: pipeline.get('PIPELINES_PATH') + pipeline_folder, True),
+            ('MISC_LIBRARY_PATH', lambda pipeline, step: pipeline.get('MISC_LIBRARY_PATH'), True),
+            ('PROTOCOLS_DEFINITION_FILE', lambda pipeline, step: pipeline.get('PROTOCOLS_DEFINITION_FILE'), True),
+            ('BACKUP_FOLDER', '', False)]
+
+
+# Sessions processed by one MATLAB engine in batch mode, 1 to disable the batch mode
+SPM_BATCH_DEFAULTS = [('BATCH_SIZE', '1', True),
+                      ('BATCH_WAIT', '300', True)]
+
+# Checkpoints of the sessions of the SPM steps, see common_operators.spm_checkpoint
+SPM_CHECKPOINT_DEFAULTS = [('CHECKPOINTS', 'False', True),
+                           ('CHECKPOINT_STAGES', '', False)]
+
+
+def _stage_defaults(slots):
+    """Limits of a stage of the pipeline in stage-pipelined mode, see common_operators.stage_gate"""
+    return [('STAGE_SLOTS', slots, True),
+            ('STAGE_QUEUE', '2', True)]
+
+
+# Default values for each pipeline section, as a list of (key, default value, fill empty value)
+
+REORGANISATION_DEFAULTS = [('INPUT_CONFIG', '', False),
+                           ('INPUT_FOLDER_DEPTH', '0', False),
+                           ('SCAN_WORKERS', '8', True),
+                           ('CRITICAL_PATH_PRIORITY', 'False', True),
+                           ('PRIORITY_AGEING', '60', True)]
+
+PREPROCESSING_DEFAULTS = [('INPUT_CONFIG', '', False),
+                          ('PIPELINES_PATH', '.', False),
+                          ('SCANNERS', 'daily', False),
+                          ('CONTINUOUS_SCAN_MODE', 'poll', True),
+                          ('WATCH_POLL_INTERVAL', '5', True),
+                          ('BACKFILL_ORDER', 'newest', True),
+                          ('BACKFILL_WORKERS', '8', True),
+                          ('SPM_BATCH_QUEUE_FILE', '', False),
+                          ('FORCE_RECOMPUTE', 'False', True),
+                          ('LOCALITY_ROUTING', 'False', True),
+                          ('LOCALITY_QUEUE', '{hostname}', True),
+                          ('STAGE_PIPELINING', 'False', True),
+                          ('CRITICAL_PATH_PRIORITY', 'False', True),
+                          ('PRIORITY_AGEING', '60', True),
+                          ('PIPELINES', 'copy_to_local,dicom_to_nifti,mpm_maps,neuro_morphometric_atlas', False)]
+
+METADATA_DEFAULTS = [('INPUT_FOLDER_DEPTH', '1', False)]
+
+EHR_DEFAULTS = [('SCANNERS', '', False),
+                ('INPUT_FOLDER_DEPTH', '1', False),
+                ('SCAN_WORKERS', '8', True),
+                ('BACKFILL_ORDER', 'newest', True),
+                ('BACKFILL_WORKERS', '8', True),
+                ('CRITICAL_PATH_PRIORITY', 'False', True),
+                ('PRIORITY_AGEING', '60', True)]
+
+# Default values for the steps of a pipeline. Default values can be computed from the pipeline and the step
+# configurations, and they are resolved in order.
+
+REORGANISATION_STEP_DEFAULTS = {
+    'dicom_reorganise': [('DOCKER_INPUT_DIR', '/input_folder', False),
+                         ('DOCKER_OUTPUT_DIR', '/output_folder', False),
+                         ('ALLOWED_FIELD_VALUES', '', False)],
+    'nifti_reorganise': [('DOCKER_INPUT_DIR', '/input_folder', False),
+                         ('DOCKER_OUTPUT_DIR', '/output_folder', False),
+                         ('ALLOWED_FIELD_VALUES', '', False)],
+    'copy_to_local': [('STAGING_MODE', 'reflink', True)],
+    'trigger_preprocessing': [('DEPTH', '1', False)],
+    'trigger_metadata': [('DEPTH', '0', False)],
+    'trigger_ehr': [('DEPTH', '0', False)]
+}
+
+PREPROCESSING_STEP_DEFAULTS = {
+    'copy_to_local': [('COPY_ENGINE', 'rsync', True),
+                      ('COPY_WORKERS', '8', True),
+                      ('COPY_VERIFY', 'size', True),
+                      ('CACHE_FOLDER', '', False),
+                      ('STAGING_MODE', 'reflink', True)] + _stage_defaults('2'),
+    'dicom_to_nifti': _spm_step_defaults('DCM2NII_LREN', '/Nifti_Conversion_Pipeline') + [
+        ('DCM2NII_PROGRAM', lambda pipeline, step: step['PIPELINE_PATH'] + '/dcm2nii', False),
+        ('PIPELINED_COPY', 'False', True),
+        ('CONVERTER', 'spm', True),
+        ('CONVERTER_WORKERS', '4', True)] + _stage_defaults('2'),
+    'series_index': [
+        ('INDEX_WORKERS', '8', True),
+        ('PROTOCOLS_DEFINITION_FILE', lambda pipeline, step: pipeline.get('PROTOCOLS_DEFINITION_FILE', ''), True)],
+    'mpm_maps': _spm_step_defaults(
+        'Preproc_mpm_maps', '/MPMs_Pipeline') + SPM_BATCH_DEFAULTS + SPM_CHECKPOINT_DEFAULTS + _stage_defaults('6'),
+    'neuro_morphometric_atlas': _spm_step_defaults(
+        'NeuroMorphometric_pipeline', '/NeuroMorphometric_Pipeline/NeuroMorphometric_tbx/label') + [
+        ('TPM_TEMPLATE', lambda pipeline, step: configuration.get('spm', 'SPM_DIR') + '/tpm/TPM.nii', False)
+    ] + SPM_BATCH_DEFAULTS + SPM_CHECKPOINT_DEFAULTS + _stage_defaults('4')
+}
+
+# The NeuroMorphometric pipeline uses the scripts of the MPM pipeline
+PREPROCESSING_STEP_DEPENDENCIES = {'neuro_morphometric_atlas': ['mpm_maps']}
+
+
+def _split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _parse_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if value.strip().lower() in ['true', 'yes', 'on', '1']:
+        return True
+    if value.strip().lower() in ['false', 'no', 'off', '0', '']:
+        return False
+    raise ValueError("Not a boolean: %s" % value)
+
+
+class SectionConfig:
+
+    """Read-only snapshot of a section of the Airflow configuration, with its default values resolved"""
+
+    __slots__ = ('name', '_values')
+
+    def __init__(self, name, defaults=None, pipeline=None):
+        values = {}
+        if configuration.conf.has_section(name.lower()):
+            for key in configuration.conf.options(name.lower()):
+                values[key.upper()] = configuration.get(name, key)
+        for key, default, fill_empty in defaults or []:
+            if key not in values or (fill_empty and not values[key]):
+                values[key] = default(pipeline, values) if callable(default) else default
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_values', values)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Configuration of section %s is read-only" % self.name)
+
+    def has_option(self, key):
+        return key.upper() in self._values
+
+    def options(self):
+        return sorted(self._values.keys())
+
+    def get(self, key, fallback=None):
+        value = self._values.get(key.upper(), fallback)
+        if value is None:
+            raise AirflowConfigException("section/key [%s/%s] not found in config" % (self.name, key))
+        return value
+
+    def getint(self, key, fallback=None):
+        return self._convert(key, int, fallback)
+
+    def getfloat(self, key, fallback=None):
+        return self._convert(key, float, fallback)
+
+    def getboolean(self, key, fallback=None):
+        return self._convert(key, _parse_boolean, fallback)
+
+    def getlist(self, key, fallback=None):
+        return _split_list(self.get(key, fallback))
+
+    def _convert(self, key, convert_fn, fallback):
+        value = self.get(key, fallback)
+        try:
+            return convert_fn(value)
+        except ValueError:
+            raise AirflowConfigException("Invalid value '%s' for key %s in section [%s]" % (value, key, self.name))
+
+
+class PipelineConfig(SectionConfig):
+
+    """Configuration of a pipeline and of its steps.
+
+    The steps are read from the sub-sections of the pipeline section. Default values are applied only to the steps
+    listed in PIPELINES and to the steps they depend on.
+    """
+
+    __slots__ = ('input_config', 'max_active_runs', 'pipelines', 'scanners', 'steps')
+
+    def __init__(self, name, all_sections, defaults=None, step_defaults=None, step_dependencies=None):
+        super(PipelineConfig, self).__init__(name, defaults)
+        object.__setattr__(self, 'input_config', [flag.strip() for flag in self.get('INPUT_CONFIG', '').split(',')])
+        object.__setattr__(self, 'max_active_runs', self.getint('MAX_ACTIVE_RUNS'))
+        object.__setattr__(self, 'pipelines', self.getlist('PIPELINES', ''))
+        object.__setattr__(self, 'scanners', self.getlist('SCANNERS', ''))
+
+        step_defaults = step_defaults or {}
+        used_steps = set(self.pipelines)
+        for step_name in self.pipelines:
+            used_steps.update((step_dependencies or {}).get(step_name, []))
+        prefix = name.lower() + ':'
+        step_names = set(s[len(prefix):] for s in all_sections if s.startswith(prefix) and ':' not in s[len(prefix):])
+        step_names.update(used_steps)
+
+        steps = {}
+        for step_name in sorted(step_names):
+            defaults = step_defaults.get(step_name) if step_name in used_steps else None
+            steps[step_name] = SectionConfig(name + ':' + step_name, defaults, self)
+        object.__setattr__(self, 'steps', steps)
+
+    def step(self, step_name):
+        try:
+            return self.steps[step_name]
+        except KeyError:
+            raise AirflowConfigException("Section [%s:%s] is not defined" % (self.name, step_name))
+
+    def output_folders(self, step_names):
+        """Return the output folders defined by the steps used in the pipeline, as a dictionary of step to folder"""
+        output_folders = {}
+        for step_name in step_names:
+            step = self.steps.get(step_name)
+            if step_name in self.pipelines and step and step.get('OUTPUT_FOLDER', ''):
+                output_folders[step_name] = step.get('OUTPUT_FOLDER')
+        return output_folders
+
+    def first_output_folder(self, step_names):
+        """Return the first output folder defined by a list of steps, or None"""
+        for step_name in step_names:
+            step = self.steps.get(step_name)
+            if step and step.get('OUTPUT_FOLDER', ''):
+                return step.get('OUTPUT_FOLDER')
+        return None
+
+
+class DatasetConfig:
+
+    """Configuration of a dataset, built once from the data-factory:&lt;dataset&gt; section and its sub-sections.
+
+    Pipelines that are not configured for the dataset are set to None.
+    """
+
+    __slots__ = ('dataset', 'section', 'label', 'data_factory',
+                 'reorganisation', 'preprocessing', 'metadata', 'ehr')
+
+    def __init__(self, dataset, data_factory=None):
+        section = 'data-factory:%s' % dataset
+        all_sections = [s.lower() for s in configuration.conf.sections()]
+        dataset_section = SectionConfig(section)
+
+        object.__setattr__(self, 'dataset', dataset)
+        object.__setattr__(self, 'section', section)
+        object.__setattr__(self, 'label', dataset_section.get('DATASET_LABEL'))
+        object.__setattr__(self, 'data_factory', data_factory or SectionConfig('data-factory'))
+
+        reorganisation = None
+        if configuration.has_option(section + ':reorganisation', 'INPUT_FOLDER'):
+            reorganisation = PipelineConfig(section + ':reorganisation', all_sections,
+                                            REORGANISATION_DEFAULTS, REORGANISATION_STEP_DEFAULTS)
+        object.__setattr__(self, 'reorganisation', reorganisation)
+
+        object.__setattr__(self, 'preprocessing', PipelineConfig(section + ':preprocessing', all_sections,
+                                                                 PREPROCESSING_DEFAULTS, PREPROCESSING_STEP_DEFAULTS,
+                                                                 PREPROCESSING_STEP_DEPENDENCIES))
+
+        metadata = None
+        if configuration.has_option(section + ':metadata', 'INPUT_FOLDER'):
+            metadata = PipelineConfig(section + ':metadata', all_sections, METADATA_DEFAULTS)
+        object.__setattr__(self, 'metadata', metadata)
+
+        ehr = None
+        if configuration.has_option(section + ':ehr', 'SCANNERS'):
+            ehr = PipelineConfig(section + ':ehr', all_sections, EHR_DEFAULTS)
+        object.__setattr__(self, 'ehr', ehr)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Configuration of dataset %s is read-only" % self.dataset)
@@ -0,0 +1,51 @@
+"""
+
+Common step: wait until the session can enter a stage of the pipeline, in stage-pipelined mode.
+
+Configuration variables used:
+
+* :<pipeline> section
+    * STAGE_PIPELINING: True to bound the sessions in each stage of the pipeline instead of the whole DAG runs
+* :<pipeline>:<step> section (for each stage)
+    * STAGE_SLOTS: maximum number of sessions in the stage
+    * STAGE_QUEUE: maximum number of sessions which completed the stage and wait for the next stage
+
+"""
+
+from textwrap import dedent
+
+from common_operators.stage_gate import StageGateSensor, gate_task_id, stage_limits
+from common_steps import Step
+
+
+def stage_gate_cfg(dag, upstream_step, step_config, stage, stage_task_id, next_stage=None):
+    slots, queue_size = stage_limits(step_config)
+    return stage_gate_step(dag, upstream_step, stage, stage_task_id, slots, queue_size, next_stage)
+
+
+def stage_gate_step(dag, upstream_step, stage, stage_task_id, slots, queue_size, next_stage=None):
+
+    next_gate_task_id = gate_task_id(next_stage) if next_stage else None
+
+    stage_gate = StageGateSensor(
+        task_id=gate_task_id(stage),
+        stage_task_id=stage_task_id,
+        slots=slots,
+        queue_size=queue_size,
+        next_gate_task_id=next_gate_task_id,
+        priority_weight=upstream_step.priority_weight,
+        dag=dag
+    )
+
+    if upstream_step.task:
+        stage_gate.set_upstream(upstream_step.task)
+
+    stage_gate.doc_md = dedent("""\
+    # Enter stage %s
+
+    Wait until less than %d sessions are in the stage ending with task __%s__, and less than %d sessions are in the
+    stage or wait for the next stage%s. The check is retried every minute without holding a worker slot.
+    """ % (stage, slots, stage_task_id, slots + queue_size,
+           ' (gate __%s__)' % next_gate_task_id if next_gate_task_id else ''))
+
+    return Step(stage_gate, stage_gate.task_id, upstream_step.priority_weight + 10)
@@ -3,25 +3,17 @@
 # Please keep keywords airflow and DAG in this file, otherwise the safe mode in DagBag may skip this file
 
 import logging
+import sys
+import time
 
-from airflow import configuration
+from common_operators.batch_trigger import trigger_args_from_config
 from common_steps import default_config
+from common_steps.dag_cache import dag_cache
+from common_steps.dataset_config import DatasetConfig, SectionConfig
 
-from preprocessing_pipelines.mri_notify_failed_processing import mri_notify_failed_processing_dag
-from preprocessing_pipelines.mri_notify_skipped_processing import mri_notify_skipped_processing_dag
-from preprocessing_pipelines.mri_notify_successful_processing import mri_notify_successful_processing_dag
-from preprocessing_pipelines.pre_process_continuously_scan_input_folder \
-    import pre_process_continuously_scan_input_folder_dag
-from preprocessing_pipelines.pre_process_daily_scan_input_folder import pre_process_daily_scan_input_folder_dag
-from preprocessing_pipelines.pre_process_scan_input_folder import pre_process_scan_input_folder_dag
-from preprocessing_pipelines.pre_process_images import pre_process_images_dag
-from ehr_pipelines.ehr_daily_scan_input_folder import ehr_daily_scan_input_folder_dag
-from ehr_pipelines.ehr_scan_input_folder import ehr_scan_input_folder_dag
-from ehr_pipelines.ehr_to_i2b2 import ehr_to_i2b2_dag
-from reorganisation_pipelines.reorganisation_scan_input_folder import reorganisation_scan_input_folder_dag
-from reorganisation_pipelines.reorganise_files import reorganise_files_dag
-from metadata_pipelines.metadata_import import metadata_import_dag
-from metadata_pipelines.metadata_scan_folder import metadata_scan_folder_dag
+
+# Modules that should not be loaded while parsing the DAGs, they are needed only when the tasks are executed
+HEAVY_MODULES = ['matlab', 'matlab.engine', 'docker', 'i2b2_import']
 
 
 def register_dag(dag):
@@ -32,138 +24,258 @@ def register_dag(dag):
     return dag_id
 
 
-def register_reorganisation_dags(dataset, dataset_section, email_errors_to):
-    reorganisation_section = dataset_section + ':reorganisation'
-    default_config(reorganisation_section, 'INPUT_FOLDER_DEPTH', '0')
-
-    reorganisation_input_folder = configuration.get(reorganisation_section, 'INPUT_FOLDER')
-    depth = int(configuration.get(reorganisation_section, 'INPUT_FOLDER_DEPTH'))
-    folder_filter = configuration.get(reorganisation_section, 'FOLDER_FILTER')
-    max_active_runs = int(configuration.get(reorganisation_section, 'MAX_ACTIVE_RUNS'))
-    reorganisation_pipelines = configuration.get(reorganisation_section, 'PIPELINES').split(',')
-
-    if reorganisation_pipelines and len(reorganisation_pipelines) > 0 and reorganisation_pipelines[0] != '':
-        reorganisation_dag_id = register_dag(reorganise_files_dag(dataset=dataset,
-                                                                  section=reorganisation_section,
-                                                                  email_errors_to=email_errors_to,
-                                                                  max_active_runs=max_active_runs,
-                                                                  reorganisation_pipelines=reorganisation_pipelines))
-        register_dag(reorganisation_scan_input_folder_dag(
-            dataset=dataset,
-            folder=reorganisation_input_folder,
-            depth=depth,
+def notification_dags():
+    from preprocessing_pipelines.mri_notify_failed_processing import mri_notify_failed_processing_dag
+    from preprocessing_pipelines.mri_notify_skipped_processing import mri_notify_skipped_processing_dag
+    from preprocessing_pipelines.mri_notify_successful_processing import mri_notify_successful_processing_dag
+
+    return [mri_notify_failed_processing_dag(),
+            mri_notify_skipped_processing_dag(),
+            mri_notify_successful_processing_dag()]
+
+
+def reorganisation_dags(dataset_config, email_errors_to):
+    from reorganisation_pipelines.reorganisation_scan_input_folder import reorganisation_scan_input_folder_dag
+    from reorganisation_pipelines.reorganise_files import reorganise_files_dag
+    from common_operators.folder_filter import folder_filter_from_config
+
+    dags = []
+    reorganisation_config = dataset_config.reorganisation
+
+    if reorganisation_config.pipelines:
+        reorganisation_dag = reorganise_files_dag(dataset=dataset_config.dataset,
+                                                  reorganisation_config=reorganisation_config,
+                                                  email_errors_to=email_errors_to,
+                                                  max_active_runs=reorganisation_config.max_active_runs,
+                                                  reorganisation_pipelines=reorganisation_config.pipelines)
+        dags.append(reorganisation_dag)
+        dags.append(reorganisation_scan_input_folder_dag(
+            dataset=dataset_config.dataset,
+            folder=reorganisation_config.get('INPUT_FOLDER'),
+            depth=reorganisation_config.getint('INPUT_FOLDER_DEPTH'),
             email_errors_to=email_errors_to,
-            trigger_dag_id=reorganisation_dag_id,
-            folder_filter=folder_filter))
+            trigger_dag_id=reorganisation_dag.dag_id,
+            folder_filter=folder_filter_from_config(reorganisation_config, reorganisation_config.get('INPUT_FOLDER')),
+            scan_workers=reorganisation_config.getint('SCAN_WORKERS'),
+            trigger_args=trigger_args_from_config(reorganisation_config)))
     # endif
 
+    return dags
+
 
-def register_preprocessing_dags(dataset, dataset_section, email_errors_to):
-    dataset_label = configuration.get(dataset_section, 'DATASET_LABEL')
-    preprocessing_section = dataset_section + ':preprocessing'
-    # Set the default configuration for the preprocessing of the dataset
-    default_config(preprocessing_section, 'SCANNERS', 'daily')
-    default_config(preprocessing_section, 'PIPELINES',
-                   'copy_to_local,dicom_to_nifti,mpm_maps,neuro_morphometric_atlas')
-    preprocessing_input_folder = configuration.get(
-        preprocessing_section, 'INPUT_FOLDER')
-    preprocessing_scanners = configuration.get(
-        preprocessing_section, 'SCANNERS').split(',')
-    preprocessing_pipelines = configuration.get(
-        preprocessing_section, 'PIPELINES').split(',')
-    max_active_runs = int(configuration.get(preprocessing_section, 'MAX_ACTIVE_RUNS'))
+def preprocessing_dags(dataset_config, email_errors_to):
+    from preprocessing_pipelines.pre_process_continuously_scan_input_folder \
+        import pre_process_continuously_scan_input_folder_dag
+    from preprocessing_pipelines.pre_process_daily_scan_input_folder import pre_process_daily_scan_input_folder_dag
+    from preprocessing_pipelines.pre_process_scan_input_folder import pre_process_scan_input_folder_dag
+    from preprocessing_pipelines.pre_process_backfill_daily_folders import pre_process_backfill_daily_folders_dag
+    from preprocessing_pipelines.pre_process_images import pre_process_images_dag, staging_task_id
+    from preprocessing_pipelines.pre_process_locality_watchdog import pre_process_locality_watchdog_dag
+    from common_operators.locality import locality_cfg
+
+    dags = []
+    dataset = dataset_config.dataset
+    preprocessing_config = dataset_config.preprocessing
+    preprocessing_input_folder = preprocessing_config.get('INPUT_FOLDER')
+    scan_index_file = preprocessing_config.get('SCAN_INDEX_FILE', '')
+    preprocessing_scanners = preprocessing_config.scanners
+    preprocessing_pipelines = preprocessing_config.pipelines
     logging.info("Create pipelines for dataset %s using scannners %s and pipelines %s",
-                 dataset_label, preprocessing_scanners, preprocessing_pipelines)
+                 dataset_config.label, preprocessing_scanners, preprocessing_pipelines)
 
-    if preprocessing_pipelines and len(preprocessing_pipelines) > 0 and preprocessing_pipelines[0] != '':
-        pre_process_images_dag_id = register_dag(
-            pre_process_images_dag(dataset=dataset, section=preprocessing_section, email_errors_to=email_errors_to,
-                                   max_active_runs=max_active_runs, preprocessing_pipelines=preprocessing_pipelines))
+    if preprocessing_pipelines:
+        pre_process_images = pre_process_images_dag(dataset=dataset,
+                                                    data_factory_config=dataset_config.data_factory,
+                                                    preprocessing_config=preprocessing_config,
+                                                    email_errors_to=email_errors_to,
+                                                    max_active_runs=preprocessing_config.max_active_runs,
+                                                    preprocessing_pipelines=preprocessing_pipelines)
+        dags.append(pre_process_images)
+        staging_task = staging_task_id(preprocessing_config, preprocessing_pipelines)
+        if staging_task and locality_cfg(preprocessing_config):
+            dags.append(pre_process_locality_watchdog_dag(
+                dataset=dataset,
+                email_errors_to=email_errors_to,
+                pre_process_images_dag=pre_process_images,
+                staging_task_id=staging_task))
         if 'continuous' in preprocessing_scanners:
-            register_dag(pre_process_continuously_scan_input_folder_dag(
+            dags.append(pre_process_continuously_scan_input_folder_dag(
                 dataset=dataset,
                 folder=preprocessing_input_folder,
                 email_errors_to=email_errors_to,
-                trigger_dag_id=pre_process_images_dag_id))
+                trigger_dag_id=pre_process_images.dag_id,
+                scan_index_file=scan_index_file,
+                scan_mode=preprocessing_config.get('CONTINUOUS_SCAN_MODE'),
+                watch_poll_interval=preprocessing_config.getfloat('WATCH_POLL_INTERVAL')))
         if 'daily' in preprocessing_scanners:
-            register_dag(pre_process_daily_scan_input_folder_dag(
+            dags.append(pre_process_daily_scan_input_folder_dag(
                 dataset=dataset,
                 folder=preprocessing_input_folder,
                 email_errors_to=email_errors_to,
-                trigger_dag_id=pre_process_images_dag_id))
+                trigger_dag_id=pre_process_images.dag_id,
+                scan_index_file=scan_index_file))
         if 'once' in preprocessing_scanners:
-            register_dag(pre_process_scan_input_folder_dag(
+            dags.append(pre_process_scan_input_folder_dag(
                 dataset=dataset,
                 folder=preprocessing_input_folder,
                 email_errors_to=email_errors_to,
-                trigger_dag_id=pre_process_images_dag_id))
+                trigger_dag_id=pre_process_images.dag_id,
+                trigger_args=trigger_args_from_config(preprocessing_config)))
+        if 'backfill' in preprocessing_scanners:
+            dags.append(pre_process_backfill_daily_folders_dag(
+                dataset=dataset,
+                folder=preprocessing_input_folder,
+                email_errors_to=email_errors_to,
+                trigger_dag_id=pre_process_images.dag_id,
+                from_date=preprocessing_config.get('BACKFILL_FROM'),
+                to_date=preprocessing_config.get('BACKFILL_TO', ''),
+                order=preprocessing_config.get('BACKFILL_ORDER'),
+                workers=preprocessing_config.getint('BACKFILL_WORKERS'),
+                trigger_args=trigger_args_from_config(preprocessing_config)))
     # endif
 
+    return dags
+
 
-def register_metadata_dags(dataset, dataset_section, email_errors_to):
-    metadata_section = dataset_section + ':metadata'
-    default_config(metadata_section, 'INPUT_FOLDER_DEPTH', '1')
-    metadata_input_folder = configuration.get(metadata_section, 'INPUT_FOLDER')
-    max_active_runs = int(configuration.get(metadata_section, 'MAX_ACTIVE_RUNS'))
+def metadata_dags(dataset_config, email_errors_to):
+    from metadata_pipelines.metadata_import import metadata_import_dag
+    from metadata_pipelines.metadata_scan_folder import metadata_scan_folder_dag
+
+    dags = []
+    metadata_config = dataset_config.metadata
+    metadata_input_folder = metadata_config.get('INPUT_FOLDER')
 
     if metadata_input_folder != '':
-        metadata_dag_id = register_dag(metadata_import_dag(dataset=dataset,
-                                                           section='data-factory',
-                                                           email_errors_to=email_errors_to,
-                                                           max_active_runs=max_active_runs))
-        register_dag(metadata_scan_folder_dag(
-            dataset=dataset,
+        metadata_dag = metadata_import_dag(dataset=dataset_config.dataset,
+                                           data_factory_config=dataset_config.data_factory,
+                                           email_errors_to=email_errors_to,
+                                           max_active_runs=metadata_config.max_active_runs)
+        dags.append(metadata_dag)
+        dags.append(metadata_scan_folder_dag(
+            dataset=dataset_config.dataset,
             folder=metadata_input_folder,
             email_errors_to=email_errors_to,
-            trigger_dag_id=metadata_dag_id))
-
-
-def register_ehr_dags(dataset, dataset_section, email_errors_to):
-    ehr_section = dataset_section + ':ehr'
-    # Set the default configuration for the preprocessing of the dataset
-    default_config(ehr_section, 'SCANNERS', '')
-    default_config(ehr_section, 'INPUT_FOLDER_DEPTH', '1')
-    ehr_scanners = configuration.get(ehr_section, 'SCANNERS')
-    max_active_runs = int(configuration.get(ehr_section, 'MAX_ACTIVE_RUNS'))
-    if ehr_scanners != '':
-        ehr_scanners = ehr_scanners.split(',')
-        ehr_input_folder = configuration.get(ehr_section, 'INPUT_FOLDER')
-
-        ehr_to_i2b2_dag_id = register_dag(ehr_to_i2b2_dag(dataset=dataset, section=ehr_section,
-                                                          email_errors_to=email_errors_to,
-                                                          max_active_runs=max_active_runs))
+            trigger_dag_id=metadata_dag.dag_id))
+
+    return dags
+
+
+def ehr_dags(dataset_config, email_errors_to):
+    from ehr_pipelines.ehr_daily_scan_input_folder import ehr_daily_scan_input_folder_dag
+    from ehr_pipelines.ehr_scan_input_folder import ehr_scan_input_folder_dag
+    from ehr_pipelines.ehr_backfill_daily_folders import ehr_backfill_daily_folders_dag
+    from ehr_pipelines.ehr_to_i2b2 import ehr_to_i2b2_dag
+
+    dags = []
+    dataset = dataset_config.dataset
+    ehr_config = dataset_config.ehr
+    ehr_scanners = ehr_config.scanners
+    if ehr_scanners:
+        ehr_input_folder = ehr_config.get('INPUT_FOLDER')
+
+        ehr_to_i2b2 = ehr_to_i2b2_dag(dataset=dataset, ehr_config=ehr_config,
+                                      email_errors_to=email_errors_to,
+                                      max_active_runs=ehr_config.max_active_runs)
+        dags.append(ehr_to_i2b2)
         if 'daily' in ehr_scanners:
-            register_dag(ehr_daily_scan_input_folder_dag(
+            dags.append(ehr_daily_scan_input_folder_dag(
                 dataset=dataset, folder=ehr_input_folder, email_errors_to=email_errors_to,
-                trigger_dag_id=ehr_to_i2b2_dag_id))
+                trigger_dag_id=ehr_to_i2b2.dag_id))
 
         if 'once' in ehr_scanners:
-            ehr_input_folder_depth = int(configuration.get(ehr_section, 'INPUT_FOLDER_DEPTH'))
-            register_dag(ehr_scan_input_folder_dag(
-                dataset=dataset, folder=ehr_input_folder, depth=ehr_input_folder_depth,
+            dags.append(ehr_scan_input_folder_dag(
+                dataset=dataset, folder=ehr_input_folder, depth=ehr_config.getint('INPUT_FOLDER_DEPTH'),
                 email_errors_to=email_errors_to,
-                trigger_dag_id=ehr_to_i2b2_dag_id))
+                trigger_dag_id=ehr_to_i2b2.dag_id,
+                scan_workers=ehr_config.getint('SCAN_WORKERS'),
+                trigger_args=trigger_args_from_config(ehr_config)))
+
+        if 'backfill' in ehr_scanners:
+            dags.append(ehr_backfill_daily_folders_dag(
+                dataset=dataset, folder=ehr_input_folder, email_errors_to=email_errors_to,
+                trigger_dag_id=ehr_to_i2b2.dag_id,
+                from_date=ehr_config.get('BACKFILL_FROM'),
+                to_date=ehr_config.get('BACKFILL_TO', ''),
+                order=ehr_config.get('BACKFILL_ORDER'),
+                workers=ehr_config.getint('BACKFILL_WORKERS'),
+                trigger_args=trigger_args_from_config(ehr_config)))
     # endif
 
+    return dags
+
+
+def priority_dags(dataset_config, email_errors_to, dags):
+    from preprocessing_pipelines.refresh_priority_weights import refresh_priority_weights_dag
+    from common_operators.priority_weights import priority_cfg
+
+    dataset_prefix = dataset_config.dataset.lower().replace(" ", "_")
+    pipeline_dags = [(dataset_config.reorganisation, dataset_prefix + '_reorganise_files'),
+                     (dataset_config.preprocessing, dataset_prefix + '_pre_process_images'),
+                     (dataset_config.ehr, dataset_prefix + '_ehr_to_i2b2')]
+    dags_by_id = dict((dag.dag_id, dag) for dag in dags)
+
+    dag_ageing = []
+    for pipeline_config, dag_id in pipeline_dags:
+        ageing = priority_cfg(pipeline_config) if pipeline_config and dag_id in dags_by_id else None
+        if ageing is not None:
+            dag_ageing.append((dags_by_id[dag_id], ageing))
+    if not dag_ageing:
+        return []
+
+    return [refresh_priority_weights_dag(dataset=dataset_config.dataset,
+                                         email_errors_to=email_errors_to,
+                                         dag_ageing=dag_ageing)]
+
+
+def dataset_dags(dataset_config, email_errors_to):
+    dags = []
+    if dataset_config.reorganisation:
+        dags.extend(reorganisation_dags(dataset_config, email_errors_to))
+    dags.extend(preprocessing_dags(dataset_config, email_errors_to))
+    if dataset_config.metadata:
+        dags.extend(metadata_dags(dataset_config, email_errors_to))
+    if dataset_config.ehr:
+        dags.extend(ehr_dags(dataset_config, email_errors_to))
+    dags.extend(priority_dags(dataset_config, email_errors_to, dags))
+    return dags
+
+
+def check_parse_time(start_time, loaded_modules, parse_time_budget):
+    """Log the time spent to build the DAGs and warn if it exceeds the budget"""
+    parse_time = time.time() - start_time
+    new_modules = len(sys.modules) - loaded_modules
+    logging.info("DAGs built in %.2f s, %d module(s) imported", parse_time, new_modules)
+    if parse_time > parse_time_budget:
+        heavy_modules = [m for m in HEAVY_MODULES if m in sys.modules]
+        logging.warning("Building the DAGs took %.2f s, more than the budget of %.2f s set by DAG_PARSE_TIME_BUDGET. "
+                        "Heavy modules loaded: %s", parse_time, parse_time_budget, ', '.join(heavy_modules) or 'none')
+
 
 def init_pipelines():
+    start_time = time.time()
+    loaded_modules = len(sys.modules)
+
     default_config('mipmap', 'DB_CONFIG_FILE', '/dev/null')
-    dataset_sections = configuration.get('data-factory', 'DATASETS')
-    email_errors_to = configuration.get('data-factory', 'EMAIL_ERRORS_TO')
-    register_dag(mri_notify_failed_processing_dag())
-    register_dag(mri_notify_skipped_processing_dag())
-    register_dag(mri_notify_successful_processing_dag())
+    data_factory_config = SectionConfig('data-factory')
+    email_errors_to = data_factory_config.get('EMAIL_ERRORS_TO')
+    parse_time_budget = data_factory_config.getfloat('DAG_PARSE_TIME_BUDGET', '10')
+
+    # DAGs are rebuilt only for the datasets whose configuration or code has changed since the last parse
+    dag_cache.begin_parse()
 
-    for dataset in dataset_sections.split(','):
+    for dag in dag_cache.dags('notifications', notification_dags):
+        register_dag(dag)
+
+    for dataset in data_factory_config.getlist('DATASETS'):
         dataset_section = 'data-factory:%s' % dataset
 
-        if configuration.has_option(dataset_section + ':reorganisation', 'INPUT_FOLDER'):
-            register_reorganisation_dags(dataset, dataset_section, email_errors_to)
-        register_preprocessing_dags(dataset, dataset_section, email_errors_to)
-        if configuration.has_option(dataset_section + ':metadata', 'INPUT_FOLDER'):
-            register_metadata_dags(dataset, dataset_section, email_errors_to)
-        if configuration.has_option(dataset_section + ':ehr', 'SCANNERS'):
-            register_ehr_dags(dataset, dataset_section, email_errors_to)
+        for dag in dag_cache.dags(dataset_section,
+                                  lambda: dataset_dags(DatasetConfig(dataset, data_factory_config), email_errors_to),
+                                  section=dataset_section):
+            register_dag(dag)
+
+    dag_cache.end_parse()
+    check_parse_time(start_time, loaded_modules, parse_time_budget)
 
 
 init_pipelines()
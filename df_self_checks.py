@@ -12,6 +12,8 @@ from airflow_spm.operators import SpmOperator
 from airflow_freespace.operators import FreeSpaceSensor
 from airflow import configuration
 
+from common_operators.reschedule_sensor import LocalFreeSpaceSensor, WAIT_RESCHEDULE, parse_wait_mode, wait_args
+from common_steps.dataset_config import DatasetConfig, SectionConfig
 from preprocessing_pipelines.pre_process_images import steps_with_file_outputs
 
 # constants
@@ -19,7 +21,7 @@ from preprocessing_pipelines.pre_process_images import steps_with_file_outputs
 DAG_NAME = 'mri_self_checks'
 
 spm_config_folder = configuration.get('spm', 'SPM_DIR')
-dataset_sections = configuration.get('data-factory', 'DATASETS')
+data_factory_config = SectionConfig('data-factory')
 
 # functions
 
@@ -110,28 +112,31 @@ check_spm.doc_md = """\
 Checks that SPM is running as expected.
 """
 
-for dataset in dataset_sections.split(','):
-    dataset_section = 'data-factory:%s' % dataset
-
-    dataset_name = configuration.get(dataset_section, 'DATASET_LABEL')
-    min_free_space_local_folder = configuration.getfloat(
-        dataset_section + ':preprocessing', 'MIN_FREE_SPACE')
-    local_folder = '/'
-    for section in steps_with_file_outputs:
-        try:
-            local_folder = configuration.get(dataset_section + ':preprocessing:' + section, 'OUTPUT_FOLDER')
-            break
-        except Exception:
-            pass
-
-    check_free_space = FreeSpaceSensor(
-        task_id='%s_check_free_space' % dataset_name.lower().replace(" ", "_"),
-        path=local_folder,
-        free_disk_threshold=min_free_space_local_folder,
-        retry_delay=timedelta(hours=1),
-        retries=24 * 7,
-        dag=dag
-    )
+for dataset in data_factory_config.getlist('DATASETS'):
+    dataset_config = DatasetConfig(dataset, data_factory_config)
+
+    dataset_name = dataset_config.label
+    min_free_space_local_folder = dataset_config.preprocessing.getfloat('MIN_FREE_SPACE')
+    local_folder = dataset_config.preprocessing.first_output_folder(steps_with_file_outputs) or '/'
+    wait_mode = parse_wait_mode(dataset_config.preprocessing.get('FREE_SPACE_WAIT', ''),
+                                dataset_config.preprocessing.name)
+
+    if wait_mode == WAIT_RESCHEDULE:
+        check_free_space = LocalFreeSpaceSensor(
+            task_id='%s_check_free_space' % dataset_name.lower().replace(" ", "_"),
+            path=local_folder,
+            free_disk_threshold=min_free_space_local_folder,
+            mode=wait_mode,
+            dag=dag
+        )
+    else:
+        check_free_space = FreeSpaceSensor(
+            task_id='%s_check_free_space' % dataset_name.lower().replace(" ", "_"),
+            path=local_folder,
+            free_disk_threshold=min_free_space_local_folder,
+            dag=dag,
+            **wait_args(wait_mode)
+        )
 
     check_free_space.set_upstream(check_spm)
 
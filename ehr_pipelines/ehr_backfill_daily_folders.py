@@ -0,0 +1,81 @@
+"""
+
+Backfill the processing of the daily EHR database extracts for a range of dates.
+
+We assume that CSV files are already anonymised and organised with the following directory structure:
+
+  2016
+     _ 20160407
+        _ patients.csv
+        _ diseases.csv
+        _ ...
+
+The daily folders are scanned concurrently and a DAG run is triggered for each daily folder found, in the order
+defined by the backfill order.
+
+"""
+
+from datetime import datetime, timedelta, time
+from textwrap import dedent
+from airflow import DAG
+
+from common_operators.backfill_scan_folder_operator import BackfillDailyFolderOperator
+from common_operators.backfill_scan_folder_operator import parse_backfill_date, parse_backfill_order
+from common_operators.batch_trigger import trigger_execution_timeout, describe_trigger_args
+
+
+def ehr_backfill_daily_folders_dag(dataset, folder, email_errors_to, trigger_dag_id, from_date, to_date=None,
+                                   order='newest', workers=8, trigger_args=None):
+    # Folder containing the daily EHR-extract folders to backfill.
+
+    # Define the DAG
+
+    start = datetime.utcnow()
+    start = datetime.combine(start.date(), time(start.hour, 0))
+
+    dag_name = '%s_ehr_backfill_daily_folders' % dataset.lower().replace(" ", "_")
+
+    default_args = {
+        'owner': 'airflow',
+        'depends_on_past': False,
+        'start_date': start,
+        'retries': 1,
+        'retry_delay': timedelta(seconds=120),
+        'email': email_errors_to,
+        'email_on_failure': True,
+        'email_on_retry': True
+    }
+
+    dag = DAG(dag_id=dag_name,
+              default_args=default_args,
+              schedule_interval='@once')
+
+    trigger_args = trigger_args or {}
+
+    backfill_dirs = BackfillDailyFolderOperator(
+        task_id='backfill_daily_folders',
+        folder=folder,
+        trigger_dag_id=trigger_dag_id,
+        depth=0,
+        from_date=parse_backfill_date(from_date, 'BACKFILL_FROM'),
+        to_date=parse_backfill_date(to_date, 'BACKFILL_TO'),
+        order=parse_backfill_order(order),
+        max_workers=workers,
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(hours=2)),
+        dataset=dataset,
+        dag=dag,
+        **trigger_args)
+
+    backfill_dirs.doc_md = dedent("""\
+    # Backfill daily folders
+
+    Scan the daily folders located inside folder %s (defined by variable __ehr_data_folder__), from __%s__ to __%s__
+    (defined by variables __backfill_from__ and __backfill_to__), using %s threads.
+
+    DAG runs are triggered for the __%s__ days first. Trigger this DAG with the configuration
+    {"from": "yyyy-mm-dd", "to": "yyyy-mm-dd", "order": "newest|oldest"} to backfill another range of dates.
+
+    %s
+    """ % (folder, from_date, to_date or 'yesterday', workers, order, describe_trigger_args(trigger_args)))
+
+    return dag
@@ -18,10 +18,13 @@ or a date folder with a date older than today.
 from datetime import datetime, timedelta, time
 from textwrap import dedent
 from airflow import DAG
-from airflow_scan_folder.operators import ScanFlatFolderOperator
 
+from common_operators.batch_trigger import trigger_execution_timeout, describe_trigger_args
+from common_operators.parallel_scan_folder_operator import ParallelScanFlatFolderOperator
 
-def ehr_scan_input_folder_dag(dataset, folder, depth, email_errors_to, trigger_dag_id):
+
+def ehr_scan_input_folder_dag(dataset, folder, depth, email_errors_to, trigger_dag_id, scan_workers=8,
+                              trigger_args=None):
     # Folder to scan for new incoming daily EHR-extract folders containing CSV files and other kinds of clinical data.
 
     # Define the DAG
@@ -46,20 +49,27 @@ def ehr_scan_input_folder_dag(dataset, folder, depth, email_errors_to, trigger_d
               default_args=default_args,
               schedule_interval='@once')
 
-    scan_dirs = ScanFlatFolderOperator(
+    trigger_args = trigger_args or {}
+
+    scan_dirs = ParallelScanFlatFolderOperator(
         task_id='scan_dirs',
         folder=folder,
         depth=depth,
+        max_workers=scan_workers,
         trigger_dag_id=trigger_dag_id,
-        execution_timeout=timedelta(minutes=30),
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(minutes=30)),
         dataset=dataset,
-        dag=dag)
+        dag=dag,
+        **trigger_args)
 
     scan_dirs.doc_md = dedent("""\
     # Scan directories for processing
 
     Scan the folders located inside folder %s (defined by variable __ehr_data_folder__), up to a depth of %s.
 
-    """ % (folder, depth))
+    Folders are listed by %s threads (defined by variable __scan_workers__).
+
+    %s
+    """ % (folder, depth, scan_workers, describe_trigger_args(trigger_args)))
 
     return dag
@@ -29,7 +29,7 @@ from ehr_steps.version_incoming_ehr import version_incoming_ehr_pipeline_cfg
 steps_with_file_outputs = ['version_incoming_ehr']
 
 
-def ehr_to_i2b2_dag(dataset, section, email_errors_to, max_active_runs):
+def ehr_to_i2b2_dag(dataset, ehr_config, email_errors_to, max_active_runs):
 
     # Define the DAG
 
@@ -52,20 +52,20 @@ def ehr_to_i2b2_dag(dataset, section, email_errors_to, max_active_runs):
         schedule_interval=None,
         max_active_runs=max_active_runs)
 
-    upstream_step = check_local_free_space_cfg(dag, initial_step, section,
-                                               map(lambda p: section + ':' + p, steps_with_file_outputs))
+    upstream_step = check_local_free_space_cfg(dag, initial_step, ehr_config, steps_with_file_outputs)
 
     upstream_step = prepare_pipeline(dag, upstream_step, False)
 
-    upstream_step = version_incoming_ehr_pipeline_cfg(dag, upstream_step, section, section + ':version_incoming_ehr')
+    upstream_step = version_incoming_ehr_pipeline_cfg(dag, upstream_step, ehr_config,
+                                                      ehr_config.step('version_incoming_ehr'))
 
     # TODO Next: Python to build provenance_details
 
     # Call MipMap on versioned folder
-    map_ehr_to_i2b2_pipeline_cfg(dag, upstream_step, section, section + ':map_ehr_to_i2b2')
+    map_ehr_to_i2b2_pipeline_cfg(dag, upstream_step, ehr_config, ehr_config.step('map_ehr_to_i2b2'))
 
     # TODO Call MipMap to convert original data in I2B2 format to the MIP CDE (Common Data Elements)
     # also in I2B2 format but stored in another database
-    # map_i2b2_to_mip_i2b2_pipeline_cfg(dag, upstream_step, section, section + ':map_i2b2_to_mip_i2b2')
+    # map_i2b2_to_mip_i2b2_pipeline_cfg(dag, upstream_step, ehr_config, ehr_config.step('map_i2b2_to_mip_i2b2'))
 
     return dag
@@ -16,8 +16,6 @@ from airflow import configuration
 
 from airflow_pipeline.operators import PythonPipelineOperator
 
-from i2b2_import import meta_files_import
-
 
 def metadata_files_to_i2b2_dag(dataset, section, email_errors_to, max_active_runs):
 
@@ -28,6 +26,8 @@ def metadata_files_to_i2b2_dag(dataset, section, email_errors_to, max_active_run
         return [metadata_folder, i2b2_db]
 
     def metadata_files_to_i2b2_fn(folder, i2b2_conn, **kwargs):
+        from i2b2_import import meta_files_import
+
         meta_files_import.folder2db(folder, i2b2_conn, dataset)
 
     # Define the DAG
@@ -12,20 +12,20 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_pipeline.operators import DockerPipelineOperator
-
 from common_steps import Step
 
 
-def map_ehr_to_i2b2_pipeline_cfg(dag, upstream_step, ehr_section, step_section):
-    docker_image = configuration.get(step_section, 'DOCKER_IMAGE')
+def map_ehr_to_i2b2_pipeline_cfg(dag, upstream_step, ehr_config, step_config):
+    docker_image = step_config.get('DOCKER_IMAGE')
 
     return map_ehr_to_i2b2_pipeline_step(dag, upstream_step, docker_image)
 
 
 def map_ehr_to_i2b2_pipeline_step(dag, upstream_step, docker_image=''):
 
+    # The Docker client is only needed by the pipelines running Docker containers
+    from airflow_pipeline.operators import DockerPipelineOperator
+
     map_ehr_to_i2b2_pipeline = DockerPipelineOperator(
         task_id='map_ehr_to_i2b2_pipeline',
         image=docker_image,
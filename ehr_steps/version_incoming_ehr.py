@@ -16,15 +16,14 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow_pipeline.operators import BashPipelineOperator
 
 from common_steps import Step
 
 
-def version_incoming_ehr_pipeline_cfg(dag, upstream_step, ehr_section, step_section):
-    min_free_space = configuration.get(ehr_section, 'MIN_FREE_SPACE')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
+def version_incoming_ehr_pipeline_cfg(dag, upstream_step, ehr_config, step_config):
+    min_free_space = ehr_config.get('MIN_FREE_SPACE')
+    output_folder = step_config.get('OUTPUT_FOLDER')
 
     return version_incoming_ehr_pipeline_step(dag, upstream_step, output_folder, min_free_space)
 
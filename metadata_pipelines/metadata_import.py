@@ -9,7 +9,7 @@ from common_steps.prepare_pipeline import prepare_pipeline
 from metadata_steps.metadata_to_i2b2 import metadata_to_i2b2_pipeline_cfg
 
 
-def metadata_import_dag(dataset, section, email_errors_to, max_active_runs):
+def metadata_import_dag(dataset, data_factory_config, email_errors_to, max_active_runs):
 
     # Define the DAG
 
@@ -33,6 +33,6 @@ def metadata_import_dag(dataset, section, email_errors_to, max_active_runs):
         max_active_runs=max_active_runs)
 
     upstream_step = prepare_pipeline(dag, initial_step, False)
-    metadata_to_i2b2_pipeline_cfg(dag, upstream_step, section)
+    metadata_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config)
 
     return dag
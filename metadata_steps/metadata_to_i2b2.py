@@ -16,16 +16,13 @@ import logging
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow_pipeline.operators import PythonPipelineOperator
 
 from common_steps import Step
 
-from i2b2_import import meta_files_import
 
-
-def metadata_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_section):
-    i2b2_conn = configuration.get(data_factory_section, 'I2B2_SQL_ALCHEMY_CONN')
+def metadata_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config):
+    i2b2_conn = data_factory_config.get('I2B2_SQL_ALCHEMY_CONN')
 
     return metadata_to_i2b2_pipeline_step(dag, upstream_step, i2b2_conn)
 
@@ -33,6 +30,8 @@ def metadata_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_section):
 def metadata_to_i2b2_pipeline_step(dag, upstream_step, i2b2_conn):
 
     def metadata_to_i2b2_fn(folder, dataset, **kwargs):
+        from i2b2_import import meta_files_import
+
         logging.info("Launching metadata import from %s", folder)
         meta_files_import.folder2db(folder, i2b2_conn, dataset)
         return "ok"
@@ -3,6 +3,8 @@
 
 import os
 
+from common_operators.folder_filter import FolderFilter
+
 
 def lren_build_daily_folder_path_callable(folder, date):
     daily_folder = os.path.join(folder, date.strftime('%Y'), date.strftime('%Y%m%d'))
@@ -14,7 +16,5 @@ def lren_build_daily_folder_path_callable(folder, date):
     return daily_folder
 
 
-def lren_accept_folder(path):
-    session_id = os.path.basename(path)
-    sid = session_id.strip().lower()
-    return not ('delete' in sid) and not ('phantom' in sid)
+# Ignore the sessions marked for deletion and the phantom scans
+lren_accept_folder = FolderFilter(exclude=r'(?is).*(delete|phantom).*')
@@ -4,6 +4,8 @@ from datetime import datetime, timedelta
 from airflow import DAG, configuration
 from airflow.operators.slack_operator import SlackAPIPostOperator
 
+from common_operators.series_index import notification_series_summary
+
 
 def mri_notify_failed_processing_dag():
 
@@ -29,7 +31,8 @@ def mri_notify_failed_processing_dag():
     dag = DAG(
         dag_id=dag_name,
         default_args=default_args,
-        schedule_interval=None)
+        schedule_interval=None,
+        user_defined_macros={'series_summary': notification_series_summary})
 
     post_on_slack = SlackAPIPostOperator(
         task_id='post_on_slack',
@@ -45,7 +48,9 @@ def mri_notify_failed_processing_dag():
              + '> Output:\n'
              + '> ```\n\n{{ dag_run.conf["spm_output"] | default("?") }}\n\n```\n'
              + '> Errors:\n'
-             + '> ```\n\n{{ dag_run.conf["spm_error"] | default("?") }}\n\n```',
+             + '> ```\n\n{{ dag_run.conf["spm_error"] | default("?") }}\n\n```'
+             + '{% set series = series_summary(dag_run.conf["dataset"], dag_run.conf["session_id"]) %}'
+             + '{% if series %}\n> Series:\n> ```\n\n{{ series }}\n\n```{% endif %}',
         icon_url='https://raw.githubusercontent.com/airbnb/airflow/master/airflow/www/static/pin_100.png',
         dag=dag
     )
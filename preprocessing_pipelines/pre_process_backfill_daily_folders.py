@@ -0,0 +1,103 @@
+"""
+
+Backfill the processing of the session folders located in the daily folders of a range of dates.
+
+We assume that Dicom files are already processed by the hierarchize.sh script with the following directory structure:
+
+  2016
+     _ 20160407
+        _ PR01471_CC082251
+           _ .ready
+           _ 1
+              _ al_B1mapping_v2d
+              _ gre_field_mapping_1acq_rl
+              _ localizer
+
+The daily folders are scanned concurrently and a DAG run is triggered for each session folder found, in the order
+defined by the backfill order. Use this DAG to onboard a new site instead of letting the daily scanner catch up day
+by day.
+
+"""
+
+from datetime import datetime, timedelta, time
+from textwrap import dedent
+from airflow import DAG
+from airflow_scan_folder.operators.common import extract_context_from_session_path, default_look_for_ready_marker_file
+from airflow_scan_folder.operators.common import session_folder_trigger_dagrun
+from airflow_scan_folder.operators.common import default_build_daily_folder_path_callable
+
+from common_operators.backfill_scan_folder_operator import BackfillDailyFolderOperator
+from common_operators.backfill_scan_folder_operator import parse_backfill_date, parse_backfill_order
+from common_operators.batch_trigger import trigger_execution_timeout, describe_trigger_args
+from preprocessing_pipelines import lren_accept_folder, lren_build_daily_folder_path_callable
+
+
+def pre_process_backfill_daily_folders_dag(dataset, folder, email_errors_to, trigger_dag_id, from_date, to_date=None,
+                                           order='newest', workers=8, trigger_args=None):
+    # Folder containing the daily folders to backfill.
+
+    start = datetime.utcnow()
+    start = datetime.combine(start.date(), time(start.hour, 0))
+
+    dag_name = '%s_pre_process_backfill_daily_folders' % dataset.lower().replace(" ", "_")
+
+    # Define the DAG
+
+    default_args = {
+        'owner': 'airflow',
+        'depends_on_past': False,
+        'start_date': start,
+        'retries': 1,
+        'retry_delay': timedelta(seconds=120),
+        'email': email_errors_to,
+        'email_on_failure': True,
+        'email_on_retry': True
+    }
+
+    # Run the backfill once, it can be triggered again with another range of dates
+    dag = DAG(dag_id=dag_name,
+              default_args=default_args,
+              schedule_interval='@once')
+
+    accept_folder_fn = None
+    build_daily_folder_path_callable = default_build_daily_folder_path_callable
+
+    if dataset.lower() == 'lren':
+        accept_folder_fn = lren_accept_folder
+        build_daily_folder_path_callable = lren_build_daily_folder_path_callable
+
+    trigger_args = trigger_args or {}
+
+    backfill_dirs = BackfillDailyFolderOperator(
+        task_id='backfill_daily_folders',
+        dataset=dataset,
+        folder=folder,
+        trigger_dag_id=trigger_dag_id,
+        trigger_dag_run_callable=session_folder_trigger_dagrun,
+        extract_context_callable=extract_context_from_session_path,
+        accept_folder_callable=accept_folder_fn,
+        build_daily_folder_path_callable=build_daily_folder_path_callable,
+        look_for_ready_marker_file=default_look_for_ready_marker_file,
+        depth=1,
+        from_date=parse_backfill_date(from_date, 'BACKFILL_FROM'),
+        to_date=parse_backfill_date(to_date, 'BACKFILL_TO'),
+        order=parse_backfill_order(order),
+        max_workers=workers,
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(hours=2)),
+        dag=dag,
+        **trigger_args)
+
+    backfill_dirs.doc_md = dedent("""\
+    # Backfill daily folders
+
+    Scan the session folders located inside folder %s (defined by variable __preprocessing_data_folder__) and organised
+    by daily folders, from __%s__ to __%s__ (defined by variables __backfill_from__ and __backfill_to__), using %s
+    threads.
+
+    DAG runs are triggered for the __%s__ days first. Trigger this DAG with the configuration
+    {"from": "yyyy-mm-dd", "to": "yyyy-mm-dd", "order": "newest|oldest"} to backfill another range of dates.
+
+    %s
+    """ % (folder, from_date, to_date or 'yesterday', workers, order, describe_trigger_args(trigger_args)))
+
+    return dag
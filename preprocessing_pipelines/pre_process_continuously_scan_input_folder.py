@@ -15,6 +15,11 @@ We assume that Dicom files are already processed by the hierarchize.sh script wi
 
 We are looking for the presence of the .ready marker file indicating that pre-processing of an MRI session is complete.
 
+With scan_mode='watch', each run of the DAG watches the daily folder for almost the whole schedule interval and
+triggers the processing of a session folder a few seconds after its .ready marker file is created. Changes are
+detected with inotify, or by polling the daily folder every watch_poll_interval seconds when the input folder is on a
+filesystem without inotify support, such as NFS.
+
 """
 
 from datetime import datetime, timedelta, time
@@ -28,7 +33,8 @@ from airflow_scan_folder.operators.common import default_build_daily_folder_path
 from preprocessing_pipelines import lren_accept_folder, lren_build_daily_folder_path_callable
 
 
-def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id):
+def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id,
+                                                   scan_index_file=None, scan_mode='poll', watch_poll_interval=5.0):
     # Param folder to scan for new incoming session folders containing DICOM images.
 
     start = datetime.utcnow()
@@ -49,10 +55,11 @@ def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors
         'email_on_retry': True
     }
 
-    # Run the DAG every 10 minutes
+    # Run the DAG every 10 minutes. In watch mode, a run watches the input folder until the next run starts
     dag = DAG(dag_id=dag_name,
               default_args=default_args,
-              schedule_interval='0 */10 * * *')
+              schedule_interval='*/10 * * * *',
+              max_active_runs=1 if scan_mode == 'watch' else 16)
 
     accept_folder_fn = None
     build_daily_folder_path_callable = default_build_daily_folder_path_callable
@@ -61,7 +68,22 @@ def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors
         accept_folder_fn = lren_accept_folder
         build_daily_folder_path_callable = lren_build_daily_folder_path_callable
 
-    scan_ready_dirs = ScanDailyFolderOperator(
+    scan_operator_class = ScanDailyFolderOperator
+    scan_args = {}
+    if scan_mode == 'watch':
+        # Trigger the processing of the session folders as soon as they are ready
+        from common_operators.watch_scan_folder_operator import WatchDailyFolderOperator
+        scan_operator_class = WatchDailyFolderOperator
+        scan_args['watch_duration'] = timedelta(minutes=9)
+        scan_args['poll_interval'] = watch_poll_interval
+        scan_args['scan_index_file'] = scan_index_file or None
+    elif scan_index_file:
+        # Remember the session folders already seen to avoid walking the whole daily folder on each run
+        from common_operators.indexed_scan_folder_operator import IndexedScanDailyFolderOperator
+        scan_operator_class = IndexedScanDailyFolderOperator
+        scan_args['scan_index_file'] = scan_index_file
+
+    scan_ready_dirs = scan_operator_class(
         task_id='scan_dirs_ready_for_preprocessing',
         dataset=dataset,
         folder=folder,
@@ -71,8 +93,9 @@ def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors
         accept_folder_callable=accept_folder_fn,
         build_daily_folder_path_callable=build_daily_folder_path_callable,
         look_for_ready_marker_file=default_look_for_ready_marker_file,
-        execution_timeout=timedelta(minutes=10),
-        dag=dag)
+        execution_timeout=timedelta(minutes=15 if scan_mode == 'watch' else 10),
+        dag=dag,
+        **scan_args)
 
     scan_ready_dirs.doc_md = dedent("""\
     # Scan directories ready for processing
@@ -82,6 +105,10 @@ def pre_process_continuously_scan_input_folder_dag(dataset, folder, email_errors
 
     It looks for the presence of a .ready marker file to mark that session folder as ready for processing, but it
     will skip it if contains the marker file .processing indicating that processing has already started.
-    """ % folder)
+
+    Scan mode: __%s__
+
+    Scan index: __%s__
+    """ % (folder, scan_mode, scan_index_file or 'none'))
 
     return dag
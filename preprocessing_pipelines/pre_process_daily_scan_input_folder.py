@@ -29,7 +29,7 @@ from airflow_scan_folder.operators.common import default_build_daily_folder_path
 from preprocessing_pipelines import lren_accept_folder, lren_build_daily_folder_path_callable
 
 
-def pre_process_daily_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id):
+def pre_process_daily_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id, scan_index_file=None):
     # Folder to scan for new incoming session folders containing DICOM images.
 
     start = datetime.utcnow()
@@ -62,7 +62,15 @@ def pre_process_daily_scan_input_folder_dag(dataset, folder, email_errors_to, tr
         accept_folder_fn = lren_accept_folder
         build_daily_folder_path_callable = lren_build_daily_folder_path_callable
 
-    scan_dirs = ScanDailyFolderOperator(
+    scan_operator_class = ScanDailyFolderOperator
+    scan_index_args = {}
+    if scan_index_file:
+        # Remember the session folders already seen to avoid walking the whole daily folder on each run
+        from common_operators.indexed_scan_folder_operator import IndexedScanDailyFolderOperator
+        scan_operator_class = IndexedScanDailyFolderOperator
+        scan_index_args['scan_index_file'] = scan_index_file
+
+    scan_dirs = scan_operator_class(
         task_id='scan_dirs',
         dataset=dataset,
         folder=folder,
@@ -73,7 +81,8 @@ def pre_process_daily_scan_input_folder_dag(dataset, folder, email_errors_to, tr
         build_daily_folder_path_callable=build_daily_folder_path_callable,
         look_for_ready_marker_file=default_look_for_ready_marker_file,
         execution_timeout=timedelta(minutes=30),
-        dag=dag)
+        dag=dag,
+        **scan_index_args)
 
     scan_dirs.doc_md = dedent("""\
     # Scan directories for processing
@@ -83,6 +92,8 @@ def pre_process_daily_scan_input_folder_dag(dataset, folder, email_errors_to, tr
 
     Daily folders older than today are always processed, and today's folder content is skipped unless a .ready marker
     file is found.
-    """ % folder)
+
+    Scan index: __%s__
+    """ % (folder, scan_index_file or 'none'))
 
     return dag
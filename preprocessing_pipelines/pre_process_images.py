@@ -4,22 +4,26 @@ from datetime import datetime, timedelta
 
 from airflow import DAG
 
+from common_operators.locality import locality_cfg, route_staged_session
 from common_steps import initial_step
 from common_steps.check_local_free_space import check_local_free_space_cfg
 from common_steps.prepare_pipeline import prepare_pipeline
+from common_steps.stage_gate import stage_gate_cfg
 from preprocessing_steps.catalog_to_i2b2 import catalog_to_i2b2_pipeline_cfg
 from preprocessing_steps.cleanup_local import cleanup_local_cfg
 from preprocessing_steps.copy_to_local import copy_to_local_cfg
-from preprocessing_steps.dicom_to_nifti import dicom_to_nifti_pipeline_cfg
+from preprocessing_steps.dicom_to_nifti import dicom_to_nifti_pipeline_cfg, pipelined_dicom_to_nifti_cfg
 from preprocessing_steps.features_to_i2b2 import features_to_i2b2_pipeline_cfg
 from preprocessing_steps.mpm_maps import mpm_maps_pipeline_cfg
 from preprocessing_steps.neuro_morphometric_atlas import neuro_morphometric_atlas_pipeline_cfg
 from preprocessing_steps.notify_success import notify_success
 from preprocessing_steps.register_local import register_local_cfg
+from preprocessing_steps.release_local_space import release_local_space_cfg
+from preprocessing_steps.series_index import series_index_cfg
 
 
 shared_preparation_steps = ['copy_to_local']
-dicom_preparation_steps = ['dicom_to_nitfi']
+dicom_preparation_steps = ['dicom_to_nifti']
 preprocessing_steps = ['mpm_maps', 'neuro_morphometric_atlas']
 finalisation_steps = ['export_features', 'catalog_to_i2b2']
 
@@ -30,7 +34,54 @@ all_preprocessing_steps = shared_preparation_steps + dicom_preparation_steps + \
     preprocessing_steps + finalisation_steps
 
 
-def pre_process_images_dag(dataset, section, email_errors_to, max_active_runs, preprocessing_pipelines=''):
+def pipelined_copy_enabled(preprocessing_config, preprocessing_pipelines):
+    """True if the session is copied and converted to Nifti in one step, the conversion overlapping with the copy"""
+    return 'copy_to_local' in preprocessing_pipelines and \
+        bool(set(preprocessing_pipelines).intersection(set(dicom_preparation_steps))) and \
+        preprocessing_config.step('dicom_to_nifti').getboolean('PIPELINED_COPY', 'False')
+
+
+def staging_task_id(preprocessing_config, preprocessing_pipelines):
+    """Id of the task staging the session on the local disk of the worker, None if the session is not staged"""
+    if 'copy_to_local' not in preprocessing_pipelines:
+        return None
+    if pipelined_copy_enabled(preprocessing_config, preprocessing_pipelines):
+        return 'dicom_to_nifti_pipeline'
+    return 'copy_to_local'
+
+
+def pipeline_stages(preprocessing_config, preprocessing_pipelines):
+    """Stages of the stage-pipelined execution, as a list of (step, id of the last task of the stage)"""
+    if not preprocessing_config.getboolean('STAGE_PIPELINING'):
+        return []
+    stages = []
+    if 'copy_to_local' in preprocessing_pipelines:
+        stages.append(('copy_to_local', staging_task_id(preprocessing_config, preprocessing_pipelines)))
+    if 'dicom_to_nifti' in preprocessing_pipelines and \
+            not pipelined_copy_enabled(preprocessing_config, preprocessing_pipelines):
+        stages.append(('dicom_to_nifti', 'dicom_to_nifti_pipeline'))
+    for step in preprocessing_steps:
+        if step in preprocessing_pipelines:
+            stages.append((step, step + '_pipeline'))
+    return stages
+
+
+def _stage_gate(dag, upstream_step, preprocessing_config, stages, i):
+    stage, stage_task_id = stages[i]
+    next_stage = stages[i + 1][0] if i + 1 < len(stages) else None
+    return stage_gate_cfg(dag, upstream_step, preprocessing_config.step(stage), stage, stage_task_id, next_stage)
+
+
+def enter_stage(dag, upstream_step, preprocessing_config, stages, stage):
+    """Add the gate of the stage if it is pipelined. The gate of the first stage starts the DAG"""
+    stage_names = [name for name, _ in stages]
+    if stage not in stage_names[1:]:
+        return upstream_step
+    return _stage_gate(dag, upstream_step, preprocessing_config, stages, stage_names.index(stage))
+
+
+def pre_process_images_dag(dataset, data_factory_config, preprocessing_config, email_errors_to, max_active_runs,
+                           preprocessing_pipelines=''):
 
     # Define the DAG
 
@@ -53,45 +104,88 @@ def pre_process_images_dag(dataset, section, email_errors_to, max_active_runs, p
         schedule_interval=None,
         max_active_runs=max_active_runs)
 
-    upstream_step = check_local_free_space_cfg(dag, initial_step, section,
-                                               map(lambda p: section + ':' + p, steps_with_file_outputs))
+    # Sessions enter the pipeline at the gate of its first stage, before reserving space on the local disk
+    stages = pipeline_stages(preprocessing_config, preprocessing_pipelines)
+    upstream_step = initial_step
+    if stages:
+        upstream_step = _stage_gate(dag, upstream_step, preprocessing_config, stages, 0)
+    # endif
+
+    upstream_step = check_local_free_space_cfg(dag, upstream_step, preprocessing_config, steps_with_file_outputs)
 
     upstream_step = prepare_pipeline(dag, upstream_step, True)
 
     copy_to_local = 'copy_to_local' in preprocessing_pipelines
     dicom_to_nifti = 'dicom_to_nifti' in preprocessing_pipelines or bool(
         set(preprocessing_pipelines).intersection(set(dicom_preparation_steps)))
+    # Copy the session and convert its series to Nifti in one step, the conversion overlapping with the copy
+    pipelined_copy = pipelined_copy_enabled(preprocessing_config, preprocessing_pipelines)
+    staging_step = None
+    cleanup_step = None
+
+    if not copy_to_local:
+        upstream_step = register_local_cfg(dag, upstream_step, preprocessing_config)
+    elif not pipelined_copy:
+        upstream_step = copy_to_local_cfg(dag, upstream_step, preprocessing_config,
+                                          preprocessing_config.step('copy_to_local'))
+        staging_step = upstream_step
+    # endif
 
-    if copy_to_local:
-        upstream_step = copy_to_local_cfg(dag, upstream_step, section, section + ':copy_to_local')
-    else:
-        upstream_step = register_local_cfg(dag, upstream_step, section)
+    if 'series_index' in preprocessing_pipelines:
+        # With PIPELINED_COPY, the session is indexed in the input folder before its copy
+        upstream_step = series_index_cfg(dag, upstream_step, preprocessing_config,
+                                         preprocessing_config.step('series_index'))
     # endif
 
     if dicom_to_nifti:
-        upstream_step = dicom_to_nifti_pipeline_cfg(dag, upstream_step, section, section + ':dicom_to_nifti')
+        if pipelined_copy:
+            upstream_step = pipelined_dicom_to_nifti_cfg(dag, upstream_step, preprocessing_config,
+                                                         preprocessing_config.step('copy_to_local'),
+                                                         preprocessing_config.step('dicom_to_nifti'))
+            staging_step = upstream_step
+        else:
+            upstream_step = enter_stage(dag, upstream_step, preprocessing_config, stages, 'dicom_to_nifti')
+            upstream_step = dicom_to_nifti_pipeline_cfg(dag, upstream_step, preprocessing_config,
+                                                        preprocessing_config.step('dicom_to_nifti'))
+        # endif
         if copy_to_local:
-            copy_step = cleanup_local_cfg(dag, upstream_step, section + ':copy_to_local')
-            upstream_step.priority_weight = copy_step.priority_weight
+            cleanup_step = cleanup_local_cfg(dag, upstream_step, preprocessing_config.step('copy_to_local'))
         # endif
     # endif
 
     if 'mpm_maps' in preprocessing_pipelines:
-        upstream_step = mpm_maps_pipeline_cfg(dag, upstream_step, section, section + ':mpm_maps')
+        upstream_step = enter_stage(dag, upstream_step, preprocessing_config, stages, 'mpm_maps')
+        upstream_step = mpm_maps_pipeline_cfg(dag, upstream_step, preprocessing_config,
+                                              preprocessing_config.step('mpm_maps'))
     # endif
+    last_local_step = upstream_step
 
     if 'neuro_morphometric_atlas' in preprocessing_pipelines:
-        upstream_step = neuro_morphometric_atlas_pipeline_cfg(dag, upstream_step, section,
-                                                              section + ':neuro_morphometric_atlas')
+        upstream_step = enter_stage(dag, upstream_step, preprocessing_config, stages, 'neuro_morphometric_atlas')
+        upstream_step = neuro_morphometric_atlas_pipeline_cfg(dag, upstream_step, preprocessing_config,
+                                                              preprocessing_config.step('neuro_morphometric_atlas'))
+        last_local_step = upstream_step
+
         if 'export_features' in preprocessing_pipelines:
-            upstream_step = features_to_i2b2_pipeline_cfg(dag, upstream_step, 'data-factory', section)
+            upstream_step = features_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config,
+                                                          preprocessing_config)
         # endif
 
         if 'catalog_to_i2b2' in preprocessing_pipelines:
-            upstream_step = catalog_to_i2b2_pipeline_cfg(dag, upstream_step, 'data-factory')
+            upstream_step = catalog_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config)
         # endif
     # endif
 
+    # The space reserved on the local disk is released once the last step writing on it is done, even if it failed
+    release_local_space_cfg(dag, [step for step in [last_local_step, cleanup_step] if step], preprocessing_config,
+                            steps_with_file_outputs)
+
     notify_success(dag, upstream_step)
 
+    # Process the session on the worker holding its staged data
+    locality_queue = locality_cfg(preprocessing_config)
+    if locality_queue and staging_step:
+        route_staged_session(dag, staging_step.task, locality_queue)
+    # endif
+
     return dag
@@ -0,0 +1,65 @@
+"""
+
+Stage again the sessions routed to a worker which disappeared.
+
+With locality routing, the tasks following the staging of a session are sent to the queue of the worker holding the
+staged data, see common_operators.locality. When that worker stops, the tasks of the session wait in a queue that no
+worker consumes. Every 10 minutes, this DAG clears these DAG runs from their staging task, so that the session is
+staged and processed again on another worker.
+
+"""
+
+from datetime import datetime, timedelta, time
+from textwrap import dedent
+from airflow import DAG
+from airflow.operators.python_operator import PythonOperator
+
+from common_operators.locality import restage_orphaned_sessions
+
+
+def pre_process_locality_watchdog_dag(dataset, email_errors_to, pre_process_images_dag, staging_task_id):
+
+    start = datetime.utcnow()
+    start = datetime.combine(start.date(), time(start.hour, 0))
+
+    dag_name = '%s_pre_process_locality_watchdog' % dataset.lower().replace(" ", "_")
+
+    # Define the DAG
+
+    default_args = {
+        'owner': 'airflow',
+        'depends_on_past': False,
+        'start_date': start,
+        'retries': 1,
+        'retry_delay': timedelta(seconds=120),
+        'email': email_errors_to,
+        'email_on_failure': True,
+        'email_on_retry': True
+    }
+
+    dag = DAG(dag_id=dag_name,
+              default_args=default_args,
+              schedule_interval='*/10 * * * *',
+              max_active_runs=1)
+
+    staging_task = pre_process_images_dag.get_task(staging_task_id)
+    routed_tasks = [staging_task] + staging_task.get_flat_relatives(upstream=False)
+    task_queues = {task.task_id: task.queue for task in routed_tasks}
+
+    restage_sessions = PythonOperator(
+        task_id='restage_orphaned_sessions',
+        python_callable=restage_orphaned_sessions,
+        op_kwargs={'dag_id': pre_process_images_dag.dag_id,
+                   'staging_task_id': staging_task_id,
+                   'task_queues': task_queues},
+        execution_timeout=timedelta(minutes=5),
+        dag=dag)
+
+    restage_sessions.doc_md = dedent("""\
+    # Stage again the sessions routed to a worker which disappeared
+
+    Clears the runs of DAG __%s__ whose tasks wait in the queue of a worker that no longer consumes it, from task
+    __%s__.
+    """ % (pre_process_images_dag.dag_id, staging_task_id))
+
+    return dag
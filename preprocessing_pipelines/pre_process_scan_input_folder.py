@@ -16,14 +16,15 @@ We assume that Dicom files are already processed by the hierarchize.sh script wi
 from datetime import datetime, timedelta, time
 from textwrap import dedent
 from airflow import DAG
-from airflow_scan_folder.operators import ScanFlatFolderOperator
 from airflow_scan_folder.operators.common import extract_context_from_session_path
 from airflow_scan_folder.operators.common import session_folder_trigger_dagrun
 
+from common_operators.batch_trigger import trigger_execution_timeout, describe_trigger_args
+from common_operators.parallel_scan_folder_operator import ParallelScanFlatFolderOperator
 from preprocessing_pipelines import lren_accept_folder
 
 
-def pre_process_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id):
+def pre_process_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id, trigger_args=None):
     # Folder to scan for new incoming session folders containing DICOM images.
 
     start = datetime.utcnow()
@@ -53,7 +54,9 @@ def pre_process_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_
     if dataset.lower() == 'lren':
         accept_folder_fn = lren_accept_folder
 
-    scan_dirs = ScanFlatFolderOperator(
+    trigger_args = trigger_args or {}
+
+    scan_dirs = ParallelScanFlatFolderOperator(
         task_id='scan_dirs',
         dataset=dataset,
         folder=folder,
@@ -61,13 +64,16 @@ def pre_process_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_
         trigger_dag_run_callable=session_folder_trigger_dagrun,
         extract_context_callable=extract_context_from_session_path,
         accept_folder_callable=accept_folder_fn,
-        execution_timeout=timedelta(minutes=30),
-        dag=dag)
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(minutes=30)),
+        dag=dag,
+        **trigger_args)
 
     scan_dirs.doc_md = dedent("""\
     # Scan directories for processing
 
     Scan the session folders located inside folder %s (defined by variable __preprocessing_data_folder__).
-    """ % folder)
+
+    %s
+    """ % (folder, describe_trigger_args(trigger_args)))
 
     return dag
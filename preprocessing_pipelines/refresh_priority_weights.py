@@ -0,0 +1,66 @@
+"""
+
+Refresh the priority weights of the waiting tasks of the processing DAGs of a dataset.
+
+Every 10 minutes, the priority weights of the waiting task instances of the running DAG runs of pre_process_images,
+reorganise_files and ehr_to_i2b2 are computed again from the remaining critical path of their session and from the
+age of their DAG run, see common_operators.priority_weights. Only the DAGs of the pipelines with
+CRITICAL_PATH_PRIORITY enabled are refreshed.
+
+"""
+
+from datetime import datetime, timedelta, time
+from textwrap import dedent
+from airflow import DAG
+from airflow.operators.python_operator import PythonOperator
+
+from common_operators.priority_weights import dag_graph, refresh_priority_weights
+
+
+def refresh_priority_weights_dag(dataset, email_errors_to, dag_ageing):
+    """
+    :param dag_ageing: list of (DAG, ageing boost in points per hour) of the DAGs to refresh
+    """
+
+    start = datetime.utcnow()
+    start = datetime.combine(start.date(), time(start.hour, 0))
+
+    dag_name = '%s_refresh_priority_weights' % dataset.lower().replace(" ", "_")
+
+    # Define the DAG
+
+    default_args = {
+        'owner': 'airflow',
+        'depends_on_past': False,
+        'start_date': start,
+        'retries': 1,
+        'retry_delay': timedelta(seconds=120),
+        'email': email_errors_to,
+        'email_on_failure': True,
+        'email_on_retry': True
+    }
+
+    dag = DAG(dag_id=dag_name,
+              default_args=default_args,
+              schedule_interval='*/10 * * * *',
+              max_active_runs=1)
+
+    dag_graphs = dict((processing_dag.dag_id, {'downstream': dag_graph(processing_dag), 'ageing': ageing})
+                      for processing_dag, ageing in dag_ageing)
+
+    refresh_weights = PythonOperator(
+        task_id='refresh_priority_weights',
+        python_callable=refresh_priority_weights,
+        op_kwargs={'dag_graphs': dag_graphs},
+        execution_timeout=timedelta(minutes=5),
+        dag=dag)
+
+    refresh_weights.doc_md = dedent("""\
+    # Refresh the priority weights from the critical path
+
+    Sets the priority weights of the waiting tasks of the running DAG runs of %s from the median duration of the
+    steps: the sessions closest to completion are processed first, with a boost for the oldest DAG runs.
+    """ % ', '.join('__%s__ (ageing %g per hour)' % (processing_dag.dag_id, ageing)
+                    for processing_dag, ageing in dag_ageing))
+
+    return dag
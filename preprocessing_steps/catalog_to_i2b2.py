@@ -16,17 +16,14 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow_pipeline.operators import PythonPipelineOperator
 
 from common_steps import Step
 
-from i2b2_import import data_catalog_import
 
-
-def catalog_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_section):
-    data_catalog_conn = configuration.get(data_factory_section, 'DATA_CATALOG_SQL_ALCHEMY_CONN')
-    i2b2_conn = configuration.get(data_factory_section, 'I2B2_SQL_ALCHEMY_CONN')
+def catalog_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config):
+    data_catalog_conn = data_factory_config.get('DATA_CATALOG_SQL_ALCHEMY_CONN')
+    i2b2_conn = data_factory_config.get('I2B2_SQL_ALCHEMY_CONN')
 
     return catalog_to_i2b2_pipeline_step(dag, upstream_step, data_catalog_conn, i2b2_conn)
 
@@ -35,6 +32,8 @@ def catalog_to_i2b2_pipeline_step(dag, upstream_step, data_catalog_conn, i2b2_co
 
     def catalog_to_i2b2_fn(**kwargs):
         """Import meta-data from data catalog DB to I2B2 DB"""
+        from i2b2_import import data_catalog_import
+
         data_catalog_import.catalog2i2b2(data_catalog_conn, i2b2_conn)
 
         return "ok"
@@ -44,6 +43,7 @@ def catalog_to_i2b2_pipeline_step(dag, upstream_step, data_catalog_conn, i2b2_co
         parent_task=upstream_step.task_id,
         python_callable=catalog_to_i2b2_fn,
         pool='io_intensive',
+        priority_weight=upstream_step.priority_weight,
         execution_timeout=timedelta(hours=6),
         on_failure_trigger_dag_id='mri_notify_failed_processing',
         dag=dag,
@@ -15,14 +15,13 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow.operators.bash_operator import BashOperator
 
 from common_steps import Step
 
 
-def cleanup_local_cfg(dag, upstream_step, step_section=None):
-    cleanup_folder = configuration.get(step_section, "OUTPUT_FOLDER")
+def cleanup_local_cfg(dag, upstream_step, step_config):
+    cleanup_folder = step_config.get('OUTPUT_FOLDER')
 
     return cleanup_local_step(dag, upstream_step, cleanup_folder)
 
@@ -9,49 +9,154 @@ Configuration variables used:
 * :preprocessing section
     * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
     * MIN_FREE_SPACE: minimum percentage of free space available on local disk
+    * SPACE_LEDGER_FILE: optional path to the space ledger. When defined, the space has already been reserved and the
+      free space is not checked again
+    * LOCALITY_ROUTING: True to send the next tasks of the session to the queue of the worker holding the local copy,
+      see common_operators.locality
+    * LOCALITY_QUEUE: name of the queue of each worker, {hostname} is replaced by the host name of the worker.
+      Default to {hostname}
 * :preprocessing:copy_to_local section
     * OUTPUT_FOLDER: destination folder for the local copy
+    * STAGING_MODE: how the files are staged when the input folder and OUTPUT_FOLDER are on the same filesystem:
+      copy to copy them, reflink to clone them with copy-on-write (XFS, btrfs), copying them if the filesystem does
+      not support it, or hardlink to link them, only if the files are never modified in place. Default to reflink
+    * COPY_ENGINE: rsync to copy the files with rsync, or parallel to copy them with parallel streams. Default to rsync
+    * COPY_WORKERS: number of files copied in parallel by the parallel copy engine. Default to 8
+    * COPY_VERIFY: verification of the files copied by the parallel copy engine: none, size or checksum.
+      Default to size
+    * CACHE_FOLDER: optional folder on the same disk as OUTPUT_FOLDER storing the files copied by the parallel copy
+      engine, to link them instead of copying them again when a session is processed again
+    * STAGE_SLOTS, STAGE_QUEUE: limits of the stage when STAGE_PIPELINING is set in the preprocessing section,
+      see common_operators.stage_gate. Default to 2 and 2
 
 """
 
 
+import os
+import shutil
+
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_pipeline.operators import BashPipelineOperator
-
-from common_steps import Step, default_config
-
-
-def copy_to_local_cfg(dag, upstream_step, preprocessing_section, step_section):
-    default_config(preprocessing_section, 'INPUT_CONFIG', '')
-
-    dataset_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
-    min_free_space = configuration.getfloat(preprocessing_section, 'MIN_FREE_SPACE')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
-
-    return copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config)
-
-
-def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config):
+from airflow.exceptions import AirflowConfigException, AirflowException
+from airflow_pipeline.operators import BashPipelineOperator, PythonPipelineOperator
+
+from common_operators.file_cache import FileCache
+from common_operators.parallel_copy import ParallelCopy, STAGING_MODES, STAGING_REFLINK, VERIFY_MODES
+from common_operators.space_ledger import SpaceLedger, reservation_key
+from common_steps import Step
+
+RSYNC_ENGINE = 'rsync'
+PARALLEL_ENGINE = 'parallel'
+
+
+def copy_to_local_cfg(dag, upstream_step, preprocessing_config, step_config):
+    dataset_config = preprocessing_config.input_config
+    min_free_space = preprocessing_config.getfloat('MIN_FREE_SPACE')
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    copy_engine = step_config.get('COPY_ENGINE', RSYNC_ENGINE)
+    cache_folder = step_config.get('CACHE_FOLDER', '')
+    staging_mode = step_config.get('STAGING_MODE', STAGING_REFLINK)
+    ledger_file = preprocessing_config.get('SPACE_LEDGER_FILE', '')
+    if staging_mode not in STAGING_MODES:
+        raise AirflowConfigException("Invalid value '%s' for key STAGING_MODE in section [%s], expected one of %s"
+                                     % (staging_mode, step_config.name, ', '.join(STAGING_MODES)))
+
+    if copy_engine == PARALLEL_ENGINE:
+        copy_workers, copy_verify = parallel_copy_cfg(step_config)
+        return parallel_copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config,
+                                           copy_workers, copy_verify, cache_folder, staging_mode, ledger_file)
+    if copy_engine != RSYNC_ENGINE:
+        raise AirflowConfigException("Invalid value '%s' for key COPY_ENGINE in section [%s], expected %s or %s"
+                                     % (copy_engine, step_config.name, RSYNC_ENGINE, PARALLEL_ENGINE))
+    if cache_folder:
+        raise AirflowConfigException("CACHE_FOLDER in section [%s] requires COPY_ENGINE = %s"
+                                     % (step_config.name, PARALLEL_ENGINE))
+
+    return copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config, staging_mode,
+                              bool(ledger_file))
+
+
+def parallel_copy_cfg(step_config):
+    """Return the number of workers and the verification mode of the parallel copy engine"""
+    copy_workers = step_config.getint('COPY_WORKERS', '8')
+    copy_verify = step_config.get('COPY_VERIFY', 'size')
+    if copy_verify not in VERIFY_MODES:
+        raise AirflowConfigException("Invalid value '%s' for key COPY_VERIFY in section [%s], expected one of %s"
+                                     % (copy_verify, step_config.name, ', '.join(VERIFY_MODES)))
+    return copy_workers, copy_verify
+
+
+def parallel_copy_session(copy_session_fn, target_folder, dag_run, min_free_space, copy_workers, copy_verify,
+                          cache_folder='', staging_mode=STAGING_REFLINK, ledger_file=''):
+    """Copy a session to the local disk with the parallel copy engine.
+
+    Checks the free space on the local disk, or records the space used in the space ledger, and keeps the local
+    cache under the minimum free space.
+
+    :param copy_session_fn: callable running the copy with the ParallelCopy given as argument, returns the report of
+        the copy and the result returned by this function
+    """
+    os.makedirs(target_folder, exist_ok=True)
+    cache = FileCache(cache_folder) if cache_folder else None
+    try:
+        if cache:
+            cache.evict(min_free_space)
+        if not ledger_file:
+            usage = shutil.disk_usage(target_folder)
+            if 100.0 * usage.free / usage.total < min_free_space * 100:
+                raise AirflowException("Not enough space left, cannot continue")
+
+        report, result = copy_session_fn(ParallelCopy(workers=copy_workers, verify=copy_verify, cache=cache,
+                                                      staging=staging_mode))
+        if cache:
+            cache.evict(min_free_space)
+        if ledger_file:
+            # The files linked from the source or from the cache use no space
+            with SpaceLedger(ledger_file) as ledger:
+                ledger.use(reservation_key(dag_run), report['bytes'])
+    finally:
+        if cache:
+            cache.close()
+    return result
+
+
+def copy_report_output(report):
+    return "Copied %(copied_files)d file(s) out of %(files)d, %(linked_files)d linked on the same filesystem, " \
+           "%(cached_files)d linked from the local cache, in %(seconds).1fs: %(files_per_second).1f files/s, " \
+           "%(mb_per_second).1f MB/s" % report
+
+
+def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config,
+                       staging_mode=STAGING_REFLINK, space_reserved=False):
 
     copy_to_local_cmd = dedent("""
         set -e
         mkdir -p $AIRFLOW_OUTPUT_DIR/
+        {% if not params['space_reserved'] -%}
         used="$(df -h $AIRFLOW_OUTPUT_DIR/ | grep '/' | grep -Po '[^ ]*(?=%)')"
         is_full=$(echo "101 - used < {{ params['min_free_space']|float * 100 }}" | bc)
         if [ "$is_full" == 1 ]; then
           echo "Not enough space left, cannot continue"
           exit 1
         fi
-        rsync -av $AIRFLOW_INPUT_DIR/ $AIRFLOW_OUTPUT_DIR/
+        {% endif -%}
+        if [ "{{ params['staging_mode'] }}" != "copy" ] && \\
+            [ "$(stat -c %d $AIRFLOW_INPUT_DIR/)" == "$(stat -c %d $AIRFLOW_OUTPUT_DIR/)" ]; then
+          if [ "{{ params['staging_mode'] }}" == "hardlink" ]; then
+            cp -a --link --remove-destination -v $AIRFLOW_INPUT_DIR/. $AIRFLOW_OUTPUT_DIR/
+          else
+            cp -a --reflink=auto --remove-destination -v $AIRFLOW_INPUT_DIR/. $AIRFLOW_OUTPUT_DIR/
+          fi
+        else
+          rsync -av $AIRFLOW_INPUT_DIR/ $AIRFLOW_OUTPUT_DIR/
+        fi
     """)
 
     copy_to_local = BashPipelineOperator(
         task_id='copy_to_local',
         bash_command=copy_to_local_cmd,
-        params={'min_free_space': min_free_space},
+        params={'min_free_space': min_free_space, 'staging_mode': staging_mode, 'space_reserved': space_reserved},
         output_folder_callable=lambda session_id, **kwargs: output_folder + '/' + session_id,
         pool='remote_file_copy',
         parent_task=upstream_step.task_id,
@@ -72,8 +177,57 @@ def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, datase
         Speed-up the processing of DICOM files by first copying them from a shared folder to the local hard-drive.
 
         * Target folder: __%s__
+        * Staging on the same filesystem: __%s__
+
+        Depends on: __%s__
+    """ % (output_folder, staging_mode, upstream_step.task_id))
+
+    return Step(copy_to_local, copy_to_local.task_id, upstream_step.priority_weight + 10)
+
+
+def parallel_copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config, copy_workers,
+                                copy_verify, cache_folder='', staging_mode=STAGING_REFLINK, ledger_file=''):
+
+    def copy_to_local_fn(folder, session_id, dag_run, **kwargs):
+        target_folder = output_folder + '/' + session_id
+
+        def copy_session_fn(copy_engine):
+            report = copy_engine.copy_tree(folder, target_folder)
+            return report, report
+
+        report = parallel_copy_session(copy_session_fn, target_folder, dag_run, min_free_space, copy_workers,
+                                       copy_verify, cache_folder, staging_mode, ledger_file)
+        return {'folder': target_folder, 'output': copy_report_output(report), 'error': '', 'copy_report': report}
+
+    copy_to_local = PythonPipelineOperator(
+        task_id='copy_to_local',
+        python_callable=copy_to_local_fn,
+        pool='remote_file_copy',
+        parent_task=upstream_step.task_id,
+        priority_weight=upstream_step.priority_weight,
+        execution_timeout=timedelta(hours=3),
+        on_failure_trigger_dag_id='mri_notify_failed_processing',
+        dataset_config=dataset_config,
+        dag=dag,
+        organised_folder=False
+    )
+
+    if upstream_step.task:
+        copy_to_local.set_upstream(upstream_step.task)
+
+    copy_to_local.doc_md = dedent("""\
+        # Copy DICOM files to a local folder
+
+        Speed-up the processing of DICOM files by first copying them from a shared folder to the local hard-drive.
+
+        Files are copied by __%d__ parallel streams, verification of the files copied: __%s__. The throughput of the
+        copy is pushed to XCom key __copy_report__.
+
+        * Target folder: __%s__
+        * Staging on the same filesystem: __%s__
+        * Local cache: __%s__
 
         Depends on: __%s__
-    """ % (output_folder, upstream_step.task_id))
+    """ % (copy_workers, copy_verify, output_folder, staging_mode, cache_folder or 'none', upstream_step.task_id))
 
     return Step(copy_to_local, copy_to_local.task_id, upstream_step.priority_weight + 10)
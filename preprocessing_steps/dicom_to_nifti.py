@@ -9,6 +9,8 @@ Configuration variables used:
 * :preprocessing section
     * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
     * PIPELINES_PATH: Path to the root folder containing the Matlab scripts for the pipelines.
+    * FORCE_RECOMPUTE: True to convert the sessions again with SPM even when they were converted with the same inputs
+      and scripts, see common_operators.step_memo. Default to False
 * :preprocessing:dicom_to_nifti section
     * OUTPUT_FOLDER: destination folder for the Nitfi images
     * BACKUP_FOLDER: backup folder for the Nitfi images
@@ -20,42 +22,74 @@ Configuration variables used:
     * PROTOCOLS_DEFINITION_FILE: path to the Protocols definition file defining the protocols used on the scanner.
       Default to PROTOCOLS_DEFINITION_FILE value in [data-factory:&lt;dataset&gt;:preprocessing] section.
     * DCM2NII_PROGRAM: Path to DCM2NII program. Default to PIPELINE_PATH + '/dcm2nii'
+    * CONVERTER: 'spm' to convert the session with SPM_FUNCTION in MATLAB, 'python' to convert the series of
+      standard anatomical protocols in Python with common_operators.dicom_converter, without MATLAB. Default to 'spm'
+    * CONVERTER_WORKERS: number of series converted in parallel by the Python converter. Default to 4
+    * PIPELINED_COPY: True to copy the session to the local disk and convert each series as soon as its copy
+      completes, in one task replacing copy_to_local. Requires COPY_ENGINE = parallel in the copy_to_local section.
+      Default to False
+    * STAGE_SLOTS, STAGE_QUEUE: limits of the stage when STAGE_PIPELINING is set in the preprocessing section,
+      see common_operators.stage_gate. Default to 2 and 2
+* :preprocessing:series_index section, when series_index is used
+    * OUTPUT_FOLDER: folder of the series indexes, used by the Python converter to skip the series of the protocols
+      not defined without reading their files
+* :preprocessing:copy_to_local section, when PIPELINED_COPY is enabled
+    * OUTPUT_FOLDER, STAGING_MODE, COPY_WORKERS, COPY_VERIFY, CACHE_FOLDER: see copy_to_local
 
 """
 
 import os
+import shutil
 
 from datetime import timedelta
+from io import StringIO
 from textwrap import dedent
 
-from airflow import configuration
+from airflow.exceptions import AirflowConfigException, AirflowSkipException
 
-from airflow_spm.operators import SpmPipelineOperator
+from common_operators.parallel_copy import STAGING_MODES, STAGING_REFLINK
+from common_operators.series_index import index_path, load_series_index
+from common_operators.series_pipeline import SeriesPipeline
+from common_operators.skippable_python_pipeline_operator import SkippablePythonPipelineOperator
+from common_operators.spm_engine_pool import start_engine
+from common_operators.step_memo import memo_cfg
+from common_steps import Step
+from preprocessing_steps.copy_to_local import PARALLEL_ENGINE, RSYNC_ENGINE, copy_report_output, parallel_copy_cfg, \
+    parallel_copy_session
+from preprocessing_steps.series_index import series_index_folder
 
-from common_steps import Step, default_config
+SPM_CONVERTER = 'spm'
+PYTHON_CONVERTER = 'python'
+CONVERTERS = [SPM_CONVERTER, PYTHON_CONVERTER]
 
 
-def dicom_to_nifti_pipeline_cfg(dag, upstream_step, preprocessing_section, step_section):
-    default_config(preprocessing_section, 'INPUT_CONFIG', '')
-    default_config(preprocessing_section, 'PIPELINES_PATH', '.')
-    default_config(step_section, 'SPM_FUNCTION', 'DCM2NII_LREN')
-    default_config(step_section, 'PIPELINE_PATH', configuration.get(
-        preprocessing_section, 'PIPELINES_PATH') + '/Nifti_Conversion_Pipeline', fill_empty=True)
-    default_config(step_section, 'MISC_LIBRARY_PATH', configuration.get(
-        preprocessing_section, 'MISC_LIBRARY_PATH'), fill_empty=True)
-    default_config(step_section, 'PROTOCOLS_DEFINITION_FILE',
-                   configuration.get(preprocessing_section, 'PROTOCOLS_DEFINITION_FILE'), fill_empty=True)
-    default_config(step_section, 'DCM2NII_PROGRAM', configuration.get(step_section, 'PIPELINE_PATH') + '/dcm2nii')
-    default_config(step_section, 'BACKUP_FOLDER', '')
+def converter_cfg(step_config):
+    converter = step_config.get('CONVERTER', SPM_CONVERTER)
+    if converter not in CONVERTERS:
+        raise AirflowConfigException("Invalid value '%s' for key CONVERTER in section [%s], expected one of %s"
+                                     % (converter, step_config.name, ', '.join(CONVERTERS)))
+    return converter, step_config.getint('CONVERTER_WORKERS', '4')
 
-    dataset_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
-    pipeline_path = configuration.get(step_section, 'PIPELINE_PATH')
-    misc_library_path = configuration.get(step_section, 'MISC_LIBRARY_PATH')
-    spm_function = configuration.get(step_section, 'SPM_FUNCTION')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
-    backup_folder = configuration.get(step_section, 'BACKUP_FOLDER')
-    protocols_definition_file = configuration.get(step_section, 'PROTOCOLS_DEFINITION_FILE')
-    dcm2nii_program = configuration.get(step_section, 'DCM2NII_PROGRAM')
+
+def dicom_to_nifti_pipeline_cfg(dag, upstream_step, preprocessing_config, step_config):
+    dataset_config = preprocessing_config.input_config
+    converter, converter_workers = converter_cfg(step_config)
+    pipeline_path = step_config.get('PIPELINE_PATH')
+    misc_library_path = step_config.get('MISC_LIBRARY_PATH')
+    spm_function = step_config.get('SPM_FUNCTION')
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    backup_folder = step_config.get('BACKUP_FOLDER')
+    protocols_definition_file = step_config.get('PROTOCOLS_DEFINITION_FILE')
+    dcm2nii_program = step_config.get('DCM2NII_PROGRAM')
+
+    if converter == PYTHON_CONVERTER:
+        return python_dicom_to_nifti_step(dag, upstream_step,
+                                          dataset_config=dataset_config,
+                                          output_folder=output_folder,
+                                          backup_folder=backup_folder,
+                                          protocols_definition_file=protocols_definition_file,
+                                          converter_workers=converter_workers,
+                                          series_index_folder=series_index_folder(preprocessing_config))
 
     return dicom_to_nifti_pipeline_step(dag, upstream_step,
                                         dataset_config=dataset_config,
@@ -65,7 +99,8 @@ def dicom_to_nifti_pipeline_cfg(dag, upstream_step, preprocessing_section, step_
                                         output_folder=output_folder,
                                         backup_folder=backup_folder,
                                         protocols_definition_file=protocols_definition_file,
-                                        dcm2nii_program=dcm2nii_program)
+                                        dcm2nii_program=dcm2nii_program,
+                                        spm_memo=memo_cfg(preprocessing_config))
 
 
 def dicom_to_nifti_pipeline_step(dag, upstream_step,
@@ -76,7 +111,11 @@ def dicom_to_nifti_pipeline_step(dag, upstream_step,
                                  output_folder=None,
                                  backup_folder=None,
                                  protocols_definition_file=None,
-                                 dcm2nii_program=None):
+                                 dcm2nii_program=None,
+                                 spm_memo=None):
+
+    # Importing the SPM operator loads the Matlab engine bindings, only do it when the step is used
+    from common_operators.pooled_spm_operator import PooledSpmPipelineOperator
 
     if dataset_config is None:
         dataset_config = []
@@ -95,7 +134,7 @@ def dicom_to_nifti_pipeline_step(dag, upstream_step,
                 protocols_definition_file,
                 dcm2nii_program]
 
-    dicom_to_nifti_pipeline = SpmPipelineOperator(
+    dicom_to_nifti_pipeline = PooledSpmPipelineOperator(
         task_id='dicom_to_nifti_pipeline',
         spm_function=spm_function,
         spm_arguments_callable=arguments_fn,
@@ -109,7 +148,9 @@ def dicom_to_nifti_pipeline_step(dag, upstream_step,
         on_failure_trigger_dag_id='mri_notify_failed_processing',
         dataset_config=dataset_config,
         dag=dag,
-        organised_folder=True
+        organised_folder=True,
+        fingerprint_config_files=[protocols_definition_file],
+        **(spm_memo or {})
     )
 
     if upstream_step.task:
@@ -132,3 +173,257 @@ def dicom_to_nifti_pipeline_step(dag, upstream_step,
     """ % (spm_function, output_folder, backup_folder, upstream_step.task_id))
 
     return Step(dicom_to_nifti_pipeline, dicom_to_nifti_pipeline.task_id, upstream_step.priority_weight + 10)
+
+
+def backup_nifti_folder(nifti_folder, backup_folder, session_id):
+    """Copy the Nifti files of the session to the backup folder, like the SPM functions do"""
+    if backup_folder:
+        backup_session_folder = backup_folder + '/' + session_id
+        shutil.rmtree(backup_session_folder, ignore_errors=True)
+        shutil.copytree(nifti_folder, backup_session_folder)
+
+
+def python_dicom_to_nifti_step(dag, upstream_step,
+                               dataset_config=None,
+                               output_folder=None,
+                               backup_folder=None,
+                               protocols_definition_file=None,
+                               converter_workers=4,
+                               series_index_folder=None):
+
+    if dataset_config is None:
+        dataset_config = []
+
+    def dicom_to_nifti_fn(folder, session_id, **kwargs):
+        """Convert the DICOM series of the session to Nifti format in Python, see common_operators.dicom_converter"""
+        # Importing the converter loads pydicom, nibabel and numpy, only do it when the step is executed
+        from common_operators.dicom_converter import DicomToNiftiConverter, report_output
+
+        nifti_folder = output_folder + '/' + session_id
+        series_index = load_series_index(index_path(series_index_folder, session_id)) if series_index_folder \
+            else None
+        shutil.rmtree(nifti_folder, ignore_errors=True)
+        try:
+            with DicomToNiftiConverter(converter_workers, protocols_definition_file) as converter:
+                report = converter.convert_session(folder, nifti_folder, series_index=series_index)
+            if not report['files']:
+                raise AirflowSkipException("No series converted to Nifti")
+            backup_nifti_folder(nifti_folder, backup_folder, session_id)
+        except Exception:
+            shutil.rmtree(nifti_folder, ignore_errors=True)
+            raise
+
+        return {'folder': nifti_folder, 'output': report_output(report), 'error': '', 'conversion_report': report}
+
+    dicom_to_nifti_pipeline = SkippablePythonPipelineOperator(
+        task_id='dicom_to_nifti_pipeline',
+        python_callable=dicom_to_nifti_fn,
+        pool='io_intensive',
+        parent_task=upstream_step.task_id,
+        priority_weight=upstream_step.priority_weight,
+        execution_timeout=timedelta(hours=24),
+        on_skip_trigger_dag_id='mri_notify_skipped_processing',
+        on_failure_trigger_dag_id='mri_notify_failed_processing',
+        software_versions={'fn_called': 'common_operators.dicom_converter'},
+        dataset_config=dataset_config,
+        dag=dag,
+        organised_folder=True
+    )
+
+    if upstream_step.task:
+        dicom_to_nifti_pipeline.set_upstream(upstream_step.task)
+
+    dicom_to_nifti_pipeline.doc_md = dedent("""\
+    # DICOM to Nitfi conversion in Python
+
+    The series of the session are converted to Nifti format by __%d__ processes, without MATLAB. The slices of each
+    series are sorted using the geometry in the DICOM headers and stacked into a volume. The series which are not
+    single-frame 3D volumes, and the series of protocols missing from the protocols definition file, are not converted
+    and are listed in XCom key __conversion_report__.
+
+    * Protocols definition file: __%s__
+    * Target folder: __%s__
+    * Remote folder: __%s__
+
+    Depends on: __%s__
+    """ % (converter_workers, protocols_definition_file, output_folder, backup_folder, upstream_step.task_id))
+
+    return Step(dicom_to_nifti_pipeline, dicom_to_nifti_pipeline.task_id, upstream_step.priority_weight + 10)
+
+
+def pipelined_dicom_to_nifti_cfg(dag, upstream_step, preprocessing_config, copy_step_config, step_config):
+    if copy_step_config.get('COPY_ENGINE', RSYNC_ENGINE) != PARALLEL_ENGINE:
+        raise AirflowConfigException("PIPELINED_COPY in section [%s] requires COPY_ENGINE = %s in section [%s]"
+                                     % (step_config.name, PARALLEL_ENGINE, copy_step_config.name))
+    copy_workers, copy_verify = parallel_copy_cfg(copy_step_config)
+    converter, converter_workers = converter_cfg(step_config)
+    staging_mode = copy_step_config.get('STAGING_MODE', STAGING_REFLINK)
+    if staging_mode not in STAGING_MODES:
+        raise AirflowConfigException("Invalid value '%s' for key STAGING_MODE in section [%s], expected one of %s"
+                                     % (staging_mode, copy_step_config.name, ', '.join(STAGING_MODES)))
+
+    return pipelined_dicom_to_nifti_step(dag, upstream_step,
+                                         dataset_config=preprocessing_config.input_config,
+                                         min_free_space=preprocessing_config.getfloat('MIN_FREE_SPACE'),
+                                         ledger_file=preprocessing_config.get('SPACE_LEDGER_FILE', ''),
+                                         local_folder=copy_step_config.get('OUTPUT_FOLDER'),
+                                         copy_workers=copy_workers,
+                                         copy_verify=copy_verify,
+                                         cache_folder=copy_step_config.get('CACHE_FOLDER', ''),
+                                         staging_mode=staging_mode,
+                                         pipeline_path=step_config.get('PIPELINE_PATH'),
+                                         misc_library_path=step_config.get('MISC_LIBRARY_PATH'),
+                                         spm_function=step_config.get('SPM_FUNCTION'),
+                                         output_folder=step_config.get('OUTPUT_FOLDER'),
+                                         backup_folder=step_config.get('BACKUP_FOLDER'),
+                                         protocols_definition_file=step_config.get('PROTOCOLS_DEFINITION_FILE'),
+                                         dcm2nii_program=step_config.get('DCM2NII_PROGRAM'),
+                                         converter=converter,
+                                         converter_workers=converter_workers,
+                                         series_index_folder=series_index_folder(preprocessing_config))
+
+
+def pipelined_dicom_to_nifti_step(dag, upstream_step,
+                                  dataset_config=None,
+                                  min_free_space=0.3,
+                                  ledger_file='',
+                                  local_folder=None,
+                                  copy_workers=8,
+                                  copy_verify='size',
+                                  cache_folder='',
+                                  staging_mode=STAGING_REFLINK,
+                                  spm_function='DCM2NII_LREN',
+                                  pipeline_path=None,
+                                  misc_library_path=None,
+                                  output_folder=None,
+                                  backup_folder=None,
+                                  protocols_definition_file=None,
+                                  dcm2nii_program=None,
+                                  converter=SPM_CONVERTER,
+                                  converter_workers=4,
+                                  series_index_folder=None):
+
+    if dataset_config is None:
+        dataset_config = []
+
+    matlab_paths = [misc_library_path, pipeline_path]
+    python_converter = converter == PYTHON_CONVERTER
+
+    def dicom_to_nifti_fn(folder, session_id, dag_run, **kwargs):
+        """Copy the DICOM files of the session to the local folder and convert each series to Nifti format as soon
+        as its copy completes.
+
+        The SPM function converts all the series found in parent_folder/session_id, so each series is presented to
+        it alone in a folder parent_folder/session_id/series linking to the local copy of the series. The Python
+        converter converts the series folder directly.
+        """
+        from airflow_spm.errors import SPMError
+
+        session_folder = local_folder + '/' + session_id
+        series_folder = local_folder + '/.series/' + session_id
+        nifti_folder = output_folder + '/' + session_id
+        out = StringIO()
+        err = StringIO()
+        engine = []
+        python_converters = []
+        series_index = load_series_index(index_path(series_index_folder, session_id)) if series_index_folder \
+            else None
+
+        # Some SPM scripts can break if they find unexpected data in the output folder
+        shutil.rmtree(nifti_folder, ignore_errors=True)
+        shutil.rmtree(series_folder, ignore_errors=True)
+
+        def convert_series(local_session_folder, series):
+            if python_converters:
+                converted = python_converters[0].convert_session(local_session_folder, nifti_folder, series,
+                                                                 series_index)
+                out.write(report_output(converted) + '\n')
+                return {'series': series, 'result': 1 if converted['files'] else 0,
+                        'converted': converted['converted']}
+            if not engine:
+                # Matlab starts while the first series is copied
+                engine.append(start_engine(matlab_paths))
+            parent_folder = os.path.join(series_folder, series)
+            os.makedirs(os.path.join(parent_folder, session_id))
+            os.symlink(os.path.join(local_session_folder, series), os.path.join(parent_folder, session_id, series))
+            result = getattr(engine[0], spm_function)(parent_folder, session_id, output_folder, backup_folder,
+                                                      protocols_definition_file, dcm2nii_program,
+                                                      stdout=out, stderr=err)
+            if result < 0:
+                raise SPMError("%s failed on series %s" % (spm_function, series))
+            return {'series': series, 'result': result}
+
+        def copy_session_fn(copy_engine):
+            converters = converter_workers if python_converters else 1
+            report = SeriesPipeline(copy_engine, convert_series, converters).run(folder, session_folder)
+            return report['copy'], report
+
+        try:
+            if python_converter:
+                # Importing the converter loads pydicom, nibabel and numpy, only do it when the step is executed
+                from common_operators.dicom_converter import DicomToNiftiConverter, report_output
+                python_converters.append(DicomToNiftiConverter(converter_workers, protocols_definition_file))
+            report = parallel_copy_session(copy_session_fn, session_folder, dag_run, min_free_space, copy_workers,
+                                           copy_verify, cache_folder, staging_mode, ledger_file)
+        except Exception:
+            shutil.rmtree(nifti_folder, ignore_errors=True)
+            raise
+        finally:
+            if engine:
+                engine[0].exit()
+            if python_converters:
+                python_converters[0].close()
+            shutil.rmtree(series_folder, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(series_folder))
+            except OSError:
+                # Used by other sessions
+                pass
+
+        if not any(converted['result'] > 0 for converted in report['converted']):
+            raise AirflowSkipException("No series converted to Nifti")
+        if python_converter:
+            backup_nifti_folder(nifti_folder, backup_folder, session_id)
+
+        report['copy_output'] = copy_report_output(report['copy'])
+        return {'folder': nifti_folder, 'output': out.getvalue(), 'error': err.getvalue(), 'copy_report': report}
+
+    dicom_to_nifti_pipeline = SkippablePythonPipelineOperator(
+        task_id='dicom_to_nifti_pipeline',
+        python_callable=dicom_to_nifti_fn,
+        pool='io_intensive',
+        parent_task=upstream_step.task_id,
+        priority_weight=upstream_step.priority_weight,
+        execution_timeout=timedelta(hours=27),
+        on_skip_trigger_dag_id='mri_notify_skipped_processing',
+        on_failure_trigger_dag_id='mri_notify_failed_processing',
+        software_versions={'fn_called': spm_function, 'matlab_paths': matlab_paths},
+        dataset_config=dataset_config,
+        dag=dag,
+        organised_folder=True
+    )
+
+    if upstream_step.task:
+        dicom_to_nifti_pipeline.set_upstream(upstream_step.task)
+
+    dicom_to_nifti_pipeline.doc_md = dedent("""\
+    # Copy DICOM files to a local folder and convert them to Nifti
+
+    SPM function: __%s__
+
+    The DICOM files are copied to the local folder by __%d__ parallel streams, one series after the other, and each
+    series is converted to Nifti format by the SPM function as soon as its copy completes. The copy of the next series
+    overlaps with the conversion of the series already copied. The duration of the copy and of the conversion is
+    pushed to XCom key __copy_report__.
+
+    * Local folder: __%s__
+    * Staging on the same filesystem: __%s__
+    * Local cache: __%s__
+    * Target folder: __%s__
+    * Remote folder: __%s__
+
+    Depends on: __%s__
+    """ % (spm_function, copy_workers, local_folder, staging_mode, cache_folder or 'none', output_folder,
+           backup_folder, upstream_step.task_id))
+
+    return Step(dicom_to_nifti_pipeline, dicom_to_nifti_pipeline.task_id, upstream_step.priority_weight + 10)
@@ -16,17 +16,14 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow_pipeline.operators import PythonPipelineOperator
 
 from common_steps import Step
 
-from i2b2_import import features_csv_import
 
-
-def features_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_section, preprocessing_section):
-    input_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
-    i2b2_conn = configuration.get(data_factory_section, 'I2B2_SQL_ALCHEMY_CONN')
+def features_to_i2b2_pipeline_cfg(dag, upstream_step, data_factory_config, preprocessing_config):
+    input_config = preprocessing_config.input_config
+    i2b2_conn = data_factory_config.get('I2B2_SQL_ALCHEMY_CONN')
 
     return features_to_i2b2_pipeline_step(dag, upstream_step, i2b2_conn, input_config)
 
@@ -35,6 +32,8 @@ def features_to_i2b2_pipeline_step(dag, upstream_step, i2b2_conn, input_config=N
 
     def features_to_i2b2_fn(folder, dataset, **kwargs):
         """Import neuroimaging features from CSV files to I2B2 DB"""
+        from i2b2_import import features_csv_import
+
         features_csv_import.folder2db(folder, i2b2_conn, dataset, input_config)
 
         return "ok"
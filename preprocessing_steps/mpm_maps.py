@@ -10,6 +10,10 @@ Configuration variables used:
 * :preprocessing section
     * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
     * PIPELINES_PATH: Path to the root folder containing the Matlab scripts for the pipelines.
+    * SPM_BATCH_QUEUE_FILE: SQLite file on the local disk of the workers holding the sessions waiting for a batch.
+      Required when BATCH_SIZE is larger than 1.
+    * FORCE_RECOMPUTE: True to process the sessions again even when they were processed with the same inputs and
+      scripts, see common_operators.step_memo. Default to False
 * :preprocessing:mpm_maps section
     * OUTPUT_FOLDER: destination folder for the MPMs and brain segmentation
     * BACKUP_FOLDER: backup folder for the MPMs and brain segmentation
@@ -20,6 +24,16 @@ Configuration variables used:
       Default to MISC_LIBRARY_PATH value in [data-factory:&lt;dataset&gt;:preprocessing] section.
     * PROTOCOLS_DEFINITION_FILE: path to the Protocols definition file defining the protocols used on the scanner.
       Default to PROTOCOLS_DEFINITION_FILE value in [data-factory:&lt;dataset&gt;:preprocessing] section.
+    * BATCH_SIZE: number of sessions processed by one MATLAB engine, see common_operators.spm_batch.
+      Default to 1, each session starts its own engine
+    * BATCH_WAIT: maximum time in seconds waited for BATCH_SIZE sessions before processing a smaller batch.
+      Default to 300
+    * CHECKPOINTS: True to resume a session from the checkpoint recorded by its previous attempt,
+      see common_operators.spm_checkpoint. Default to False
+    * CHECKPOINT_STAGES: stages completed by the SPM function, as a list of '&lt;stage&gt;: &lt;file pattern&gt;...'
+      separated by ';'. When empty, only the outputs of a completed SPM function are kept if the task fails later.
+    * STAGE_SLOTS, STAGE_QUEUE: limits of the stage when STAGE_PIPELINING is set in the preprocessing section,
+      see common_operators.stage_gate. Default to 6 and 2
 
 """
 
@@ -28,31 +42,23 @@ import os
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_spm.operators import SpmPipelineOperator
+from common_operators.spm_batch import spm_batch_cfg
+from common_operators.spm_checkpoint import spm_checkpoint_cfg
+from common_operators.step_memo import memo_cfg
+from common_steps import Step
 
-from common_steps import Step, default_config
 
-
-def mpm_maps_pipeline_cfg(dag, upstream_step, preprocessing_section, step_section):
-    default_config(preprocessing_section, 'INPUT_CONFIG', '')
-    default_config(preprocessing_section, 'PIPELINES_PATH', '.')
-    default_config(step_section, 'SPM_FUNCTION', 'Preproc_mpm_maps')
-    default_config(step_section, 'PIPELINE_PATH', configuration.get(
-        preprocessing_section, 'PIPELINES_PATH') + '/MPMs_Pipeline', fill_empty=True)
-    default_config(step_section, 'MISC_LIBRARY_PATH', configuration.get(
-        preprocessing_section, 'MISC_LIBRARY_PATH'), fill_empty=True)
-    default_config(step_section, 'PROTOCOLS_DEFINITION_FILE',
-                   configuration.get(preprocessing_section, 'PROTOCOLS_DEFINITION_FILE'), fill_empty=True)
-    default_config(step_section, 'BACKUP_FOLDER', '')
-
-    dataset_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
-    pipeline_path = configuration.get(step_section, 'PIPELINE_PATH')
-    misc_library_path = configuration.get(step_section, 'MISC_LIBRARY_PATH')
-    spm_function = configuration.get(step_section, 'SPM_FUNCTION')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
-    backup_folder = configuration.get(step_section, 'BACKUP_FOLDER')
-    protocols_definition_file = configuration.get(step_section, 'PROTOCOLS_DEFINITION_FILE')
+def mpm_maps_pipeline_cfg(dag, upstream_step, preprocessing_config, step_config):
+    dataset_config = preprocessing_config.input_config
+    pipeline_path = step_config.get('PIPELINE_PATH')
+    misc_library_path = step_config.get('MISC_LIBRARY_PATH')
+    spm_function = step_config.get('SPM_FUNCTION')
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    backup_folder = step_config.get('BACKUP_FOLDER')
+    protocols_definition_file = step_config.get('PROTOCOLS_DEFINITION_FILE')
+    spm_batch = spm_batch_cfg(preprocessing_config, step_config)
+    spm_checkpoint = spm_checkpoint_cfg(step_config)
+    spm_memo = memo_cfg(preprocessing_config)
 
     return mpm_maps_pipeline_step(dag, upstream_step,
                                   dataset_config=dataset_config,
@@ -61,7 +67,10 @@ def mpm_maps_pipeline_cfg(dag, upstream_step, preprocessing_section, step_sectio
                                   spm_function=spm_function,
                                   output_folder=output_folder,
                                   backup_folder=backup_folder,
-                                  protocols_definition_file=protocols_definition_file)
+                                  protocols_definition_file=protocols_definition_file,
+                                  spm_batch=spm_batch,
+                                  spm_checkpoint=spm_checkpoint,
+                                  spm_memo=spm_memo)
 
 
 def mpm_maps_pipeline_step(dag, upstream_step,
@@ -71,7 +80,12 @@ def mpm_maps_pipeline_step(dag, upstream_step,
                            misc_library_path=None,
                            output_folder=None,
                            backup_folder=None,
-                           protocols_definition_file=None):
+                           protocols_definition_file=None,
+                           spm_batch=None,
+                           spm_checkpoint=None,
+                           spm_memo=None):
+
+    from common_operators.pooled_spm_operator import BatchSpmPipelineOperator, PooledSpmPipelineOperator
 
     if dataset_config is None:
         dataset_config = []
@@ -90,7 +104,11 @@ def mpm_maps_pipeline_step(dag, upstream_step,
                 pipeline_params_config_file,
                 backup_folder]
 
-    mpm_maps_pipeline = SpmPipelineOperator(
+    # In batch mode, the task also waits for the sessions processed before its own in the batch
+    batch_size = spm_batch['batch_size'] if spm_batch else 1
+    operator_class = BatchSpmPipelineOperator if spm_batch else PooledSpmPipelineOperator
+
+    mpm_maps_pipeline = operator_class(
         task_id='mpm_maps_pipeline',
         spm_function=spm_function,
         spm_arguments_callable=arguments_fn,
@@ -98,13 +116,17 @@ def mpm_maps_pipeline_step(dag, upstream_step,
         output_folder_callable=lambda session_id, **kwargs: output_folder + '/' + session_id,
         parent_task=upstream_step.task_id,
         priority_weight=upstream_step.priority_weight,
-        execution_timeout=timedelta(hours=24),
+        execution_timeout=timedelta(hours=24 * batch_size),
         pool='image_preprocessing',
         on_skip_trigger_dag_id='mri_notify_skipped_processing',
         on_failure_trigger_dag_id='mri_notify_failed_processing',
         dataset_config=dataset_config,
         dag=dag,
-        organised_folder=True
+        organised_folder=True,
+        fingerprint_config_files=[protocols_definition_file],
+        **(spm_batch or {}),
+        **(spm_checkpoint or {}),
+        **(spm_memo or {})
     )
 
     mpm_maps_pipeline.set_upstream(upstream_step.task)
@@ -125,5 +147,15 @@ def mpm_maps_pipeline_step(dag, upstream_step,
 
             Depends on: __%s__
             """ % (spm_function, output_folder, backup_folder, upstream_step.task_id))
+    if spm_batch:
+        mpm_maps_pipeline.doc_md += dedent("""\
+
+            Sessions are processed in batches of up to __%d__ sessions sharing one MATLAB engine.
+            """ % batch_size)
+    if spm_checkpoint:
+        mpm_maps_pipeline.doc_md += dedent("""\
+
+            A failed session resumes from its checkpoint, stages: __%s__
+            """ % (', '.join(name for name, _ in spm_checkpoint['checkpoint_stages']) or 'none'))
 
     return Step(mpm_maps_pipeline, mpm_maps_pipeline.task_id, upstream_step.priority_weight + 10)
@@ -17,6 +17,10 @@ Configuration variables used:
 * :preprocessing section
     * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
     * PIPELINES_PATH: Path to the root folder containing the Matlab scripts for the pipelines.
+    * SPM_BATCH_QUEUE_FILE: SQLite file on the local disk of the workers holding the sessions waiting for a batch.
+      Required when BATCH_SIZE is larger than 1.
+    * FORCE_RECOMPUTE: True to process the sessions again even when they were processed with the same inputs and
+      scripts, see common_operators.step_memo. Default to False
 * :preprocessing:mpm_maps section
     * PIPELINE_PATH: path to the folder containing the SPM script for this pipeline.
       Default to PIPELINES_PATH + '/MPMs_Pipeline'
@@ -34,8 +38,18 @@ Configuration variables used:
       Default to MISC_LIBRARY_PATH value in [data-factory:&lt;dataset&gt;:preprocessing] section.
     * PROTOCOLS_DEFINITION_FILE: path to the Protocols definition file defining the protocols used on the scanner.
       Default to PROTOCOLS_DEFINITION_FILE value in [data-factory:&lt;dataset&gt;:preprocessing] section.
+    * BATCH_SIZE: number of sessions processed by one MATLAB engine, see common_operators.spm_batch.
+      Default to 1, each session starts its own engine
+    * BATCH_WAIT: maximum time in seconds waited for BATCH_SIZE sessions before processing a smaller batch.
+      Default to 300
+    * CHECKPOINTS: True to resume a session from the checkpoint recorded by its previous attempt,
+      see common_operators.spm_checkpoint. Default to False
+    * CHECKPOINT_STAGES: stages completed by the SPM function, as a list of '&lt;stage&gt;: &lt;file pattern&gt;...'
+      separated by ';'. When empty, only the outputs of a completed SPM function are kept if the task fails later.
     * TPM_TEMPLATE: Path to the the template used for segmentation step in case the image is not segmented.
       Default to SPM_DIR + '/tpm/nwTPM_sl3.nii'
+    * STAGE_SLOTS, STAGE_QUEUE: limits of the stage when STAGE_PIPELINING is set in the preprocessing section,
+      see common_operators.stage_gate. Default to 4 and 2
 
 """
 
@@ -44,45 +58,25 @@ import os
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_spm.operators import SpmPipelineOperator
-from common_steps import Step, default_config
-
-
-def neuro_morphometric_atlas_pipeline_cfg(dag, upstream_step, preprocessing_section, step_section):
-    default_config(preprocessing_section, 'INPUT_CONFIG', '')
-    default_config(preprocessing_section, 'PIPELINES_PATH', '.')
-    default_config(step_section, 'SPM_FUNCTION', 'NeuroMorphometric_pipeline')
-    default_config(step_section, 'PIPELINE_PATH', configuration.get(
-        preprocessing_section, 'PIPELINES_PATH') + '/NeuroMorphometric_Pipeline/NeuroMorphometric_tbx/label',
-        fill_empty=True)
-    default_config(step_section, 'MISC_LIBRARY_PATH', configuration.get(
-        preprocessing_section, 'MISC_LIBRARY_PATH'), fill_empty=True)
-    default_config(step_section, 'PROTOCOLS_DEFINITION_FILE',
-                   configuration.get(preprocessing_section, 'PROTOCOLS_DEFINITION_FILE'), fill_empty=True)
-    default_config(step_section, 'TPM_TEMPLATE',
-                   configuration.get('spm', 'SPM_DIR') + '/tpm/TPM.nii')
-    default_config(step_section, 'BACKUP_FOLDER', '')
-    mpm_maps_section = preprocessing_section + ':mpm_maps'
-    try:
-        default_config(mpm_maps_section, 'PIPELINE_PATH', configuration.get(
-            preprocessing_section, 'PIPELINES_PATH') + '/MPMs_Pipeline')
-    except Exception:
-        # No need to do anything
-        pass
-
-    dataset_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
-    pipeline_path = configuration.get(step_section, 'PIPELINE_PATH')
-    misc_library_path = configuration.get(step_section, 'MISC_LIBRARY_PATH')
-    spm_function = configuration.get(step_section, 'SPM_FUNCTION')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
-    backup_folder = configuration.get(step_section, 'BACKUP_FOLDER')
-    protocols_definition_file = configuration.get(step_section, 'PROTOCOLS_DEFINITION_FILE')
-    tpm_template = configuration.get(step_section, 'TPM_TEMPLATE')
-    try:
-        mpm_maps_pipeline_path = configuration.get(mpm_maps_section, 'PIPELINE_PATH')
-    except Exception:
-        mpm_maps_pipeline_path = configuration.get(preprocessing_section, 'PIPELINES_PATH') + '/MPMs_Pipeline'
+from common_operators.spm_batch import spm_batch_cfg
+from common_operators.spm_checkpoint import spm_checkpoint_cfg
+from common_operators.step_memo import memo_cfg
+from common_steps import Step
+
+
+def neuro_morphometric_atlas_pipeline_cfg(dag, upstream_step, preprocessing_config, step_config):
+    dataset_config = preprocessing_config.input_config
+    pipeline_path = step_config.get('PIPELINE_PATH')
+    misc_library_path = step_config.get('MISC_LIBRARY_PATH')
+    spm_function = step_config.get('SPM_FUNCTION')
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    backup_folder = step_config.get('BACKUP_FOLDER')
+    protocols_definition_file = step_config.get('PROTOCOLS_DEFINITION_FILE')
+    spm_batch = spm_batch_cfg(preprocessing_config, step_config)
+    tpm_template = step_config.get('TPM_TEMPLATE')
+    spm_checkpoint = spm_checkpoint_cfg(step_config)
+    spm_memo = memo_cfg(preprocessing_config)
+    mpm_maps_pipeline_path = preprocessing_config.step('mpm_maps').get('PIPELINE_PATH')
 
     # check that file exists if absolute path
     if len(tpm_template) > 0 and tpm_template[0] is '/':
@@ -98,7 +92,10 @@ def neuro_morphometric_atlas_pipeline_cfg(dag, upstream_step, preprocessing_sect
                                                   backup_folder=backup_folder,
                                                   protocols_definition_file=protocols_definition_file,
                                                   tpm_template=tpm_template,
-                                                  mpm_maps_pipeline_path=mpm_maps_pipeline_path)
+                                                  mpm_maps_pipeline_path=mpm_maps_pipeline_path,
+                                                  spm_batch=spm_batch,
+                                                  spm_checkpoint=spm_checkpoint,
+                                                  spm_memo=spm_memo)
 
 
 def neuro_morphometric_atlas_pipeline_step(dag, upstream_step,
@@ -110,7 +107,12 @@ def neuro_morphometric_atlas_pipeline_step(dag, upstream_step,
                                            backup_folder='',
                                            protocols_definition_file=None,
                                            tpm_template='nwTPM_sl3.nii',
-                                           mpm_maps_pipeline_path=None):
+                                           mpm_maps_pipeline_path=None,
+                                           spm_batch=None,
+                                           spm_checkpoint=None,
+                                           spm_memo=None):
+
+    from common_operators.pooled_spm_operator import BatchSpmPipelineOperator, PooledSpmPipelineOperator
 
     def arguments_fn(folder, session_id, **kwargs):
         """Prepare the arguments for the pipeline that selects T1 files from DICOM.
@@ -128,7 +130,11 @@ def neuro_morphometric_atlas_pipeline_step(dag, upstream_step,
                 table_format,
                 tpm_template]
 
-    neuro_morphometric_atlas_pipeline = SpmPipelineOperator(
+    # In batch mode, the task also waits for the sessions processed before its own in the batch
+    batch_size = spm_batch['batch_size'] if spm_batch else 1
+    operator_class = BatchSpmPipelineOperator if spm_batch else PooledSpmPipelineOperator
+
+    neuro_morphometric_atlas_pipeline = operator_class(
         task_id='neuro_morphometric_atlas_pipeline',
         spm_function=spm_function,
         spm_arguments_callable=arguments_fn,
@@ -139,12 +145,16 @@ def neuro_morphometric_atlas_pipeline_step(dag, upstream_step,
         pool='image_preprocessing',
         parent_task=upstream_step.task_id,
         priority_weight=upstream_step.priority_weight,
-        execution_timeout=timedelta(hours=24),
+        execution_timeout=timedelta(hours=24 * batch_size),
         on_skip_trigger_dag_id='mri_notify_skipped_processing',
         on_failure_trigger_dag_id='mri_notify_failed_processing',
         dataset_config=dataset_config,
         dag=dag,
-        organised_folder=True
+        organised_folder=True,
+        fingerprint_config_files=[protocols_definition_file, tpm_template],
+        **(spm_batch or {}),
+        **(spm_checkpoint or {}),
+        **(spm_memo or {})
     )
     neuro_morphometric_atlas_pipeline.set_upstream(upstream_step.task)
 
@@ -170,6 +180,16 @@ def neuro_morphometric_atlas_pipeline_step(dag, upstream_step,
 
             Depends on: __%s__
             """ % (spm_function, output_folder, backup_folder, upstream_step.task_id))
+    if spm_batch:
+        neuro_morphometric_atlas_pipeline.doc_md += dedent("""\
+
+            Sessions are processed in batches of up to __%d__ sessions sharing one MATLAB engine.
+            """ % batch_size)
+    if spm_checkpoint:
+        neuro_morphometric_atlas_pipeline.doc_md += dedent("""\
+
+            A failed session resumes from its checkpoint, stages: __%s__
+            """ % (', '.join(name for name, _ in spm_checkpoint['checkpoint_stages']) or 'none'))
 
     return Step(neuro_morphometric_atlas_pipeline, neuro_morphometric_atlas_pipeline.task_id,
                 upstream_step.priority_weight + 10)
@@ -23,7 +23,7 @@ def notify_success(dag, upstream_step):
         task_id='notify_success',
         trigger_dag_id='mri_notify_successful_processing',
         python_callable=pipeline_trigger(upstream_step.task_id),
-        priority_weight=999,
+        priority_weight=upstream_step.priority_weight,
         dag=dag
     )
 
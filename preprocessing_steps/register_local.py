@@ -13,16 +13,13 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow_pipeline.operators import BashPipelineOperator
 
-from common_steps import Step, default_config
+from common_steps import Step
 
 
-def register_local_cfg(dag, upstream_step, preprocessing_section):
-    default_config(preprocessing_section, 'INPUT_CONFIG', '')
-
-    dataset_config = [flag.strip() for flag in configuration.get(preprocessing_section, 'INPUT_CONFIG').split(',')]
+def register_local_cfg(dag, upstream_step, preprocessing_config):
+    dataset_config = preprocessing_config.input_config
 
     return register_local_step(dag, upstream_step, dataset_config)
 
@@ -0,0 +1,77 @@
+"""
+
+Pre processing step: release the local disk space reserved by the DAG run.
+
+Releases the space reserved in the space ledger by check_local_free_space once all the steps writing on the local disk
+are done, whether they succeeded or failed, and wakes up the DAG runs waiting for disk space in reschedule mode.
+
+Configuration variables used:
+
+* :preprocessing section
+    * SPACE_LEDGER_FILE: optional path to the space ledger. The step is added only when it is defined
+* :preprocessing:<step> section
+    * OUTPUT_FOLDER: the size of the outputs of the session is recorded to estimate the space used by the next DAG runs
+
+"""
+
+
+from datetime import timedelta
+from textwrap import dedent
+
+from airflow.operators.python_operator import PythonOperator
+from airflow.utils.trigger_rule import TriggerRule
+
+from common_operators.reschedule_sensor import wake_waiting_tasks
+from common_operators.space_ledger import SpaceLedger, folder_size, reservation_key, session_output_folder
+from common_steps import Step
+
+
+def release_local_space_cfg(dag, upstream_steps, preprocessing_config, step_names):
+    ledger_file = preprocessing_config.get('SPACE_LEDGER_FILE', '')
+    if not ledger_file:
+        return None
+
+    output_folders = preprocessing_config.output_folders(step_names)
+    return release_local_space_step(dag, upstream_steps, ledger_file, output_folders)
+
+
+def release_local_space_step(dag, upstream_steps, ledger_file, output_folders):
+
+    def release_local_space_fn(dag_run, **kwargs):
+        step_outputs = dict((step, folder_size(session_output_folder(output_folder, dag_run.conf)))
+                            for step, output_folder in output_folders.items())
+        with SpaceLedger(ledger_file) as ledger:
+            reservation = ledger.reservation(reservation_key(dag_run))
+            if reservation and reservation['used_bytes'] and not step_outputs.get('copy_to_local', -1):
+                # The local copy is already removed by cleanup_local, use the space recorded by copy_to_local
+                step_outputs['copy_to_local'] = reservation['used_bytes']
+            ledger.release(reservation_key(dag_run), step_outputs)
+        wake_waiting_tasks()
+
+    priority_weight = max(step.priority_weight for step in upstream_steps)
+
+    release_local_space = PythonOperator(
+        task_id='release_local_space',
+        python_callable=release_local_space_fn,
+        provide_context=True,
+        trigger_rule=TriggerRule.ALL_DONE,
+        priority_weight=priority_weight,
+        execution_timeout=timedelta(hours=1),
+        dag=dag
+    )
+
+    for upstream_step in upstream_steps:
+        if upstream_step.task:
+            release_local_space.set_upstream(upstream_step.task)
+
+    release_local_space.doc_md = dedent("""\
+        # Release the local disk space
+
+        Release the disk space reserved for this DAG run in the space ledger %s once the steps writing on the local
+        disk are done, even if they failed. The DAG runs waiting for disk space in reschedule mode are woken up.
+
+        The size of the outputs of the steps %s is recorded to estimate the space used by the next DAG runs. The
+        local copy being removed by cleanup_local, its size is the space recorded by copy_to_local.
+        """ % (ledger_file, ', '.join(sorted(output_folders))))
+
+    return Step(release_local_space, release_local_space.task_id, priority_weight + 10)
@@ -0,0 +1,99 @@
+"""
+
+Pre processing step: index the DICOM series of the session.
+
+Reads the headers of the DICOM files of the session in parallel, without the pixel data, and stores the series they
+belong to, the protocol of each series and its files in a JSON file, see common_operators.series_index. The index is
+read by the Python DICOM to Nifti converter and by the notifications of skipped or failed sessions.
+
+Configuration variables used:
+
+* :preprocessing section
+    * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
+* :preprocessing:series_index section
+    * OUTPUT_FOLDER: destination folder for the series indexes, stored in OUTPUT_FOLDER/&lt;session_id&gt;.json
+    * INDEX_WORKERS: number of files read in parallel. Default to 8
+    * PROTOCOLS_DEFINITION_FILE: path to the Protocols definition file defining the protocols used on the scanner.
+      Default to PROTOCOLS_DEFINITION_FILE value in [data-factory:&lt;dataset&gt;:preprocessing] section.
+
+"""
+
+
+from datetime import timedelta
+from textwrap import dedent
+
+from airflow_pipeline.operators import PythonPipelineOperator
+
+from common_operators.series_index import build_series_index, index_path, read_protocols, series_summary, \
+    write_series_index
+from common_steps import Step
+
+
+def series_index_folder(preprocessing_config):
+    """Folder of the series indexes of the dataset, or None if the sessions are not indexed"""
+    if 'series_index' not in preprocessing_config.pipelines:
+        return None
+    return preprocessing_config.step('series_index').get('OUTPUT_FOLDER')
+
+
+def series_index_cfg(dag, upstream_step, preprocessing_config, step_config):
+    dataset_config = preprocessing_config.input_config
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    index_workers = step_config.getint('INDEX_WORKERS', '8')
+    protocols_definition_file = step_config.get('PROTOCOLS_DEFINITION_FILE', '')
+
+    return series_index_step(dag, upstream_step,
+                             dataset_config=dataset_config,
+                             output_folder=output_folder,
+                             index_workers=index_workers,
+                             protocols_definition_file=protocols_definition_file)
+
+
+def series_index_step(dag, upstream_step,
+                      dataset_config=None,
+                      output_folder=None,
+                      index_workers=8,
+                      protocols_definition_file=None):
+
+    if dataset_config is None:
+        dataset_config = []
+
+    def series_index_fn(folder, session_id, **kwargs):
+        """Index the DICOM series of the session folder.
+
+        The folder passed to the next step is not changed.
+        """
+        index = build_series_index(folder, session_id, read_protocols(protocols_definition_file), index_workers)
+        path = index_path(output_folder, session_id)
+        write_series_index(index, path)
+        return {'series_index': path, 'output': series_summary(index)}
+
+    series_index = PythonPipelineOperator(
+        task_id='series_index',
+        python_callable=series_index_fn,
+        parent_task=upstream_step.task_id,
+        priority_weight=upstream_step.priority_weight,
+        execution_timeout=timedelta(hours=1),
+        on_failure_trigger_dag_id='mri_notify_failed_processing',
+        dataset_config=dataset_config,
+        dag=dag,
+        organised_folder=True
+    )
+
+    if upstream_step.task:
+        series_index.set_upstream(upstream_step.task)
+
+    series_index.doc_md = dedent("""\
+        # Index the DICOM series of the session
+
+        Reads the headers of the DICOM files of the session with __%d__ threads and stores the series, their protocol
+        and their files in the series index of the session. The path of the index is pushed to XCom key
+        __series_index__.
+
+        * Index folder: __%s__
+        * Protocols definition file: __%s__
+
+        Depends on: __%s__
+        """ % (index_workers, output_folder, protocols_definition_file or 'none', upstream_step.task_id))
+
+    return Step(series_index, series_index.task_id, upstream_step.priority_weight + 10)
@@ -3,13 +3,14 @@
 from datetime import datetime, timedelta, time
 from textwrap import dedent
 from airflow import DAG
-from os.path import basename
-from re import fullmatch
-from airflow_scan_folder.operators.scan_folder_operator import ScanFlatFolderOperator
+
+from common_operators.batch_trigger import trigger_execution_timeout, describe_trigger_args
+from common_operators.folder_filter import FolderFilter
+from common_operators.parallel_scan_folder_operator import ParallelScanFlatFolderOperator
 
 
 def reorganisation_scan_input_folder_dag(dataset, folder, email_errors_to, trigger_dag_id,
-                                         depth=1, folder_filter=".*"):
+                                         depth=1, folder_filter=".*", scan_workers=8, trigger_args=None):
 
     start = datetime.utcnow()
     start = datetime.combine(start.date(), time(start.hour, 0))
@@ -33,20 +34,37 @@ def reorganisation_scan_input_folder_dag(dataset, folder, email_errors_to, trigg
               default_args=default_args,
               schedule_interval='@once')
 
-    scan_dirs = ScanFlatFolderOperator(
+    trigger_args = trigger_args or {}
+
+    # Filter given as a regex on the folder names, at any depth
+    if not isinstance(folder_filter, FolderFilter):
+        folder_filter = FolderFilter(include=folder_filter, root_folder=folder)
+
+    scan_dirs = ParallelScanFlatFolderOperator(
         task_id='scan_dirs',
         folder=folder,
         trigger_dag_id=trigger_dag_id,
         dataset=dataset,
         depth=depth,
-        execution_timeout=timedelta(minutes=30),
-        accept_folder_callable=lambda path: fullmatch(folder_filter, basename(path)),
-        dag=dag)
+        max_workers=scan_workers,
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(minutes=30)),
+        accept_folder_callable=folder_filter,
+        dag=dag,
+        **trigger_args)
 
     scan_dirs.doc_md = dedent("""\
     # Reorganise directories for processing
 
     Reorganise folder %s (defined by variable __input_folder__ in section __[data-factory:%s:reorganisation]__).
-    """ % (folder, dataset.lower().replace(" ", "_")))
+
+    Folders are listed by %s threads (defined by variable __scan_workers__).
+
+    Folders accepted, defined by variables __folder_filter__ and __folder_exclude__:
+
+    %s
+
+    %s
+    """) % (folder, dataset.lower().replace(" ", "_"), scan_workers, folder_filter.describe(),
+            describe_trigger_args(trigger_args))
 
     return dag
@@ -22,7 +22,7 @@ finalisation_steps = ['trigger_preprocessing', 'trigger_metadata', 'trigger_ehr'
 steps_with_file_outputs = preparation_steps + reorganisation_steps
 
 
-def reorganise_files_dag(dataset, section, email_errors_to, max_active_runs,
+def reorganise_files_dag(dataset, reorganisation_config, email_errors_to, max_active_runs,
                          reorganisation_pipelines=''):
 
     # Define the DAG
@@ -46,34 +46,39 @@ def reorganise_files_dag(dataset, section, email_errors_to, max_active_runs,
         schedule_interval=None,
         max_active_runs=max_active_runs)
 
-    upstream_step = check_local_free_space_cfg(dag, initial_step, section,
-                                               map(lambda p: section + ':' + p, steps_with_file_outputs))
+    upstream_step = check_local_free_space_cfg(dag, initial_step, reorganisation_config, steps_with_file_outputs)
 
     upstream_step = prepare_pipeline(dag, upstream_step, True)
 
     if 'copy_to_local' in reorganisation_pipelines:
-        upstream_step = copy_to_local_cfg(dag, upstream_step, section, section + ':copy_to_local')
+        upstream_step = copy_to_local_cfg(dag, upstream_step, reorganisation_config,
+                                          reorganisation_config.step('copy_to_local'))
 
     if 'dicom_reorganise' in reorganisation_pipelines:
-        upstream_step = reorganise_cfg(dag, upstream_step, section, section + ':dicom_reorganise')
+        upstream_step = reorganise_cfg(dag, upstream_step, reorganisation_config,
+                                       reorganisation_config.step('dicom_reorganise'))
     elif 'nifti_reorganise' in reorganisation_pipelines:
-        upstream_step = reorganise_cfg(dag, upstream_step, section, section + ':nifti_reorganise')
+        upstream_step = reorganise_cfg(dag, upstream_step, reorganisation_config,
+                                       reorganisation_config.step('nifti_reorganise'))
 
     # Cleanup step is used only to remove DICOM files or Nifti files copied locally.
     if 'copy_to_local' in reorganisation_pipelines:
-        cleanup_step = cleanup_all_local_cfg(dag, upstream_step, section + ':copy_to_local')
-        upstream_step.priority_weight = cleanup_step.priority_weight
+        cleanup_all_local_cfg(dag, upstream_step, reorganisation_config.step('copy_to_local'),
+                              reorganisation_config, steps_with_file_outputs)
 
     if 'trigger_preprocessing' in reorganisation_pipelines:
-        trigger_preprocessing_pipeline_cfg(dag, upstream_step, dataset, section, section + ':trigger_preprocessing')
+        trigger_preprocessing_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config,
+                                           reorganisation_config.step('trigger_preprocessing'))
     # endif
 
     if 'trigger_metadata' in reorganisation_pipelines:
-        trigger_metadata_pipeline_cfg(dag, upstream_step, dataset, section + ':trigger_metadata')
+        trigger_metadata_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config,
+                                      reorganisation_config.step('trigger_metadata'))
     # endif
 
     if 'trigger_ehr' in reorganisation_pipelines:
-        trigger_ehr_pipeline_cfg(dag, upstream_step, dataset, section, section + ':trigger_ehr')
+        trigger_ehr_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config,
+                                 reorganisation_config.step('trigger_ehr'))
     # endif
 
     return dag
@@ -6,23 +6,35 @@ Cleanup the local data (for the whole data-set) created during copy_to_local ste
 
 Configuration variables used:
 
+* :reorganisation section
+    * SPACE_LEDGER_FILE: optional path to the space ledger, the space reserved for the DAG run is released
 * :reorganisation:copy_to_local section
     * OUTPUT_FOLDER: destination folder for the local copy
 
 """
 
 
+import os
+import shutil
+
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
 from airflow.operators.bash_operator import BashOperator
+from airflow.operators.python_operator import PythonOperator
 
+from common_operators.reschedule_sensor import wake_waiting_tasks
+from common_operators.space_ledger import SpaceLedger, folder_size, reservation_key, session_output_folder
 from common_steps import Step
 
 
-def cleanup_all_local_cfg(dag, upstream_step, step_section=None):
-    cleanup_folder = configuration.get(step_section, "OUTPUT_FOLDER")
+def cleanup_all_local_cfg(dag, upstream_step, step_config, reorganisation_config=None, step_names=None):
+    cleanup_folder = step_config.get('OUTPUT_FOLDER')
+    ledger_file = reorganisation_config.get('SPACE_LEDGER_FILE', '') if reorganisation_config else ''
+
+    if ledger_file:
+        output_folders = reorganisation_config.output_folders(step_names or [])
+        return release_all_local_step(dag, upstream_step, cleanup_folder, ledger_file, output_folders)
 
     return cleanup_all_local_step(dag, upstream_step, cleanup_folder)
 
@@ -52,3 +64,48 @@ def cleanup_all_local_step(dag, upstream_step, cleanup_folder):
         """)
 
     return Step(cleanup_all_local, cleanup_all_local.task_id, upstream_step.priority_weight + 10)
+
+
+def release_all_local_step(dag, upstream_step, cleanup_folder, ledger_file, output_folders):
+
+    def cleanup_all_local_fn(dag_run, **kwargs):
+        step_outputs = dict((step, folder_size(session_output_folder(output_folder, dag_run.conf)))
+                            for step, output_folder in output_folders.items())
+        with SpaceLedger(ledger_file) as ledger:
+            ledger.release(reservation_key(dag_run), step_outputs)
+        # Like rm -rf cleanup_folder/*, hidden files are kept
+        for entry in os.scandir(cleanup_folder):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    # Removed concurrently, ignored like the errors of rmtree above
+                    pass
+        wake_waiting_tasks()
+
+    cleanup_all_local = PythonOperator(
+        task_id='cleanup_all_local',
+        python_callable=cleanup_all_local_fn,
+        provide_context=True,
+        priority_weight=upstream_step.priority_weight,
+        execution_timeout=timedelta(hours=1),
+        dag=dag
+    )
+
+    if upstream_step.task:
+        cleanup_all_local.set_upstream(upstream_step.task)
+
+    cleanup_all_local.doc_md = dedent("""\
+        # Cleanup all local files
+
+        Remove locally stored files as they have been already reorganised, and release the disk space reserved for
+        this DAG run in the space ledger %s. The DAG runs waiting for disk space in reschedule mode are woken up.
+
+        The size of the outputs of the steps %s is recorded to estimate the space used by the next DAG runs.
+        """ % (ledger_file, ', '.join(sorted(output_folders))))
+
+    return Step(cleanup_all_local, cleanup_all_local.task_id, upstream_step.priority_weight + 10)
@@ -9,8 +9,13 @@ Configuration variables used:
 * :reorganisation section
     * INPUT_CONFIG: List of flags defining how incoming imaging data are organised.
     * MIN_FREE_SPACE: minimum percentage of free space available on local disk
+    * SPACE_LEDGER_FILE: optional path to the space ledger. When defined, the space has already been reserved and the
+      free space is not checked again
 * :reorganisation:copy_to_local section
     * OUTPUT_FOLDER: destination folder for the local copy
+    * STAGING_MODE: how the files are staged when the input folder and OUTPUT_FOLDER are on the same filesystem:
+      copy to copy them, reflink to clone them with copy-on-write (XFS, btrfs), copying them if the filesystem does
+      not support it, or hardlink to link them, only if the files are never modified in place. Default to reflink
 
 """
 
@@ -18,40 +23,57 @@ Configuration variables used:
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
+from airflow.exceptions import AirflowConfigException
 from airflow_pipeline.operators import BashPipelineOperator
 
-from common_steps import Step, default_config
+from common_operators.parallel_copy import STAGING_MODES, STAGING_REFLINK
+from common_steps import Step
 
 
-def copy_to_local_cfg(dag, upstream_step, reorganisation_section, step_section):
-    default_config(reorganisation_section, 'INPUT_CONFIG', '')
+def copy_to_local_cfg(dag, upstream_step, reorganisation_config, step_config):
+    dataset_config = reorganisation_config.input_config
+    min_free_space = reorganisation_config.getfloat('MIN_FREE_SPACE')
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    staging_mode = step_config.get('STAGING_MODE', STAGING_REFLINK)
+    space_reserved = bool(reorganisation_config.get('SPACE_LEDGER_FILE', ''))
+    if staging_mode not in STAGING_MODES:
+        raise AirflowConfigException("Invalid value '%s' for key STAGING_MODE in section [%s], expected one of %s"
+                                     % (staging_mode, step_config.name, ', '.join(STAGING_MODES)))
 
-    dataset_config = [flag.strip() for flag in configuration.get(reorganisation_section, 'INPUT_CONFIG').split(',')]
-    min_free_space = configuration.getfloat(reorganisation_section, 'MIN_FREE_SPACE')
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
+    return copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config, staging_mode,
+                              space_reserved)
 
-    return copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config)
 
-
-def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config):
+def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, dataset_config,
+                       staging_mode=STAGING_REFLINK, space_reserved=False):
 
     copy_to_local_cmd = dedent("""
         set -e
         mkdir -p $AIRFLOW_OUTPUT_DIR/
+        {% if not params['space_reserved'] -%}
         used="$(df -h $AIRFLOW_OUTPUT_DIR/ | grep '/' | grep -Po '[^ ]*(?=%)')"
         is_full=$(echo "101 - used < {{ params['min_free_space']|float * 100 }}" | bc)
         if [ "$is_full" == 1 ]; then
           echo "Not enough space left, cannot continue"
           exit 1
         fi
-        rsync -av $AIRFLOW_INPUT_DIR/ $AIRFLOW_OUTPUT_DIR/
+        {% endif -%}
+        if [ "{{ params['staging_mode'] }}" != "copy" ] && \\
+            [ "$(stat -c %d $AIRFLOW_INPUT_DIR/)" == "$(stat -c %d $AIRFLOW_OUTPUT_DIR/)" ]; then
+          if [ "{{ params['staging_mode'] }}" == "hardlink" ]; then
+            cp -a --link --remove-destination -v $AIRFLOW_INPUT_DIR/. $AIRFLOW_OUTPUT_DIR/
+          else
+            cp -a --reflink=auto --remove-destination -v $AIRFLOW_INPUT_DIR/. $AIRFLOW_OUTPUT_DIR/
+          fi
+        else
+          rsync -av $AIRFLOW_INPUT_DIR/ $AIRFLOW_OUTPUT_DIR/
+        fi
     """)
 
     copy_to_local = BashPipelineOperator(
         task_id='copy_to_local',
         bash_command=copy_to_local_cmd,
-        params={'min_free_space': min_free_space},
+        params={'min_free_space': min_free_space, 'staging_mode': staging_mode, 'space_reserved': space_reserved},
         output_folder_callable=lambda relative_context_path, **kwargs: output_folder + '/' + relative_context_path,
         parent_task=upstream_step.task_id,
         priority_weight=upstream_step.priority_weight,
@@ -71,8 +93,9 @@ def copy_to_local_step(dag, upstream_step, min_free_space, output_folder, datase
         hard-drive.
 
         * Target folder: __%s__
+        * Staging on the same filesystem: __%s__
 
         Depends on: __%s__
-    """ % (output_folder, upstream_step.task_id))
+    """ % (output_folder, staging_mode, upstream_step.task_id))
 
     return Step(copy_to_local, copy_to_local.task_id, upstream_step.priority_weight + 10)
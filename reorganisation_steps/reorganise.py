@@ -23,29 +23,21 @@ import re
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_pipeline.operators import DockerPipelineOperator
+from common_steps import Step
 
-from common_steps import Step, default_config
 
+def reorganise_cfg(dag, upstream_step, reorganisation_config, step_config):
+    dataset_config = reorganisation_config.input_config
+    output_folder = step_config.get('OUTPUT_FOLDER')
+    meta_output_folder = step_config.get('META_OUTPUT_FOLDER')
+    output_folder_structure = step_config.get('OUTPUT_FOLDER_STRUCTURE')
+    allowed_field_values = step_config.get('ALLOWED_FIELD_VALUES')
+    docker_image = step_config.get('DOCKER_IMAGE')
+    docker_input_dir = step_config.get('DOCKER_INPUT_DIR')
+    docker_output_dir = step_config.get('DOCKER_OUTPUT_DIR')
+    docker_user = step_config.get('DOCKER_USER')
 
-def reorganise_cfg(dag, upstream_step, reorganisation_section, step_section):
-    default_config(reorganisation_section, 'INPUT_CONFIG', '')
-    default_config(step_section, "DOCKER_INPUT_DIR", "/input_folder")
-    default_config(step_section, "DOCKER_OUTPUT_DIR", "/output_folder")
-    default_config(step_section, "ALLOWED_FIELD_VALUES", '')
-
-    dataset_config = [flag.strip() for flag in configuration.get(reorganisation_section, 'INPUT_CONFIG').split(',')]
-    output_folder = configuration.get(step_section, 'OUTPUT_FOLDER')
-    meta_output_folder = configuration.get(step_section, 'META_OUTPUT_FOLDER')
-    output_folder_structure = configuration.get(step_section, 'OUTPUT_FOLDER_STRUCTURE')
-    allowed_field_values = configuration.get(step_section, 'ALLOWED_FIELD_VALUES')
-    docker_image = configuration.get(step_section, 'DOCKER_IMAGE')
-    docker_input_dir = configuration.get(step_section, 'DOCKER_INPUT_DIR')
-    docker_output_dir = configuration.get(step_section, 'DOCKER_OUTPUT_DIR')
-    docker_user = configuration.get(step_section, 'DOCKER_USER')
-
-    m = re.search('.*:reorganisation:(.*)_reorganise', step_section)
+    m = re.search('.*:reorganisation:(.*)_reorganise', step_config.name)
     dataset_type = m.group(1).upper()
 
     return reorganise_pipeline_step(dag, upstream_step, dataset_config,
@@ -68,6 +60,8 @@ def reorganise_pipeline_step(
         docker_output_dir='/output_folder',
         docker_user='root'):
 
+    from airflow_pipeline.operators import DockerPipelineOperator
+
     incoming_dataset_param = "{{ dag_run.conf['dataset'] }}"
     type_of_images_param = "--type '" + dataset_type + "'"
     structure_param = "--output_folder_organisation '" + output_folder_structure + "'"
@@ -1,37 +1,37 @@
 from textwrap import dedent
 
-from airflow import configuration
+from common_operators.batch_scan_folder_pipeline_operator import BatchScanFlatFolderPipelineOperator
+from common_operators.batch_trigger import trigger_args_from_config, describe_trigger_args
+from common_steps import Step
 
-from airflow_scan_folder.operators import ScanFlatFolderPipelineOperator
 
-from common_steps import Step, default_config
-
-
-def trigger_ehr_pipeline_cfg(dag, upstream_step, dataset, section, step_section):
-    default_config(section, 'INPUT_CONFIG', '')
-    default_config(step_section, 'DEPTH', '0')
-
-    dataset_config = [flag.strip() for flag in configuration.get(section, 'INPUT_CONFIG').split(',')]
-    depth = int(configuration.get(step_section, 'DEPTH'))
+def trigger_ehr_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config, step_config):
+    dataset_config = reorganisation_config.input_config
+    depth = step_config.getint('DEPTH')
+    trigger_args = trigger_args_from_config(reorganisation_config)
 
     return trigger_ehr_pipeline_step(dag, upstream_step, dataset=dataset,
                                      dataset_config=dataset_config,
-                                     depth=depth)
+                                     depth=depth,
+                                     trigger_args=trigger_args)
 
 
-def trigger_ehr_pipeline_step(dag, upstream_step, dataset, dataset_config, depth=1):
+def trigger_ehr_pipeline_step(dag, upstream_step, dataset, dataset_config, depth=1, trigger_args=None):
 
     trigger_dag_id = '%s_mri_flat_ehr_incoming' % dataset.lower().replace(" ", "_")
 
-    trigger_ehr_pipeline = ScanFlatFolderPipelineOperator(
+    trigger_args = trigger_args or {}
+
+    trigger_ehr_pipeline = BatchScanFlatFolderPipelineOperator(
         task_id="trigger_ehr_pipeline",
         trigger_dag_id=trigger_dag_id,
         depth=depth,
         dataset_config=dataset_config,
         parent_task=upstream_step.task_id,
-        priority_weight=999,
+        priority_weight=upstream_step.priority_weight,
         dag=dag,
-        organised_folder=False
+        organised_folder=False,
+        **trigger_args
     )
 
     trigger_ehr_pipeline.set_upstream(upstream_step.task)
@@ -40,6 +40,8 @@ def trigger_ehr_pipeline_step(dag, upstream_step, dataset, dataset_config, depth
     # Trigger EHR pipelines
 
     Trigger EHR pipelines.
-    """)
+
+    %s
+    """) % describe_trigger_args(trigger_args)
 
     return Step(trigger_ehr_pipeline, trigger_ehr_pipeline.task_id, upstream_step.priority_weight + 10)
@@ -1,25 +1,28 @@
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-from airflow_scan_folder.operators import ScanFlatFolderPipelineOperator
 from airflow_scan_folder.operators.common import default_extract_context
 from airflow_scan_folder.operators.common import default_trigger_dagrun
 
-from common_steps import Step, default_config
+from common_operators.batch_scan_folder_pipeline_operator import BatchScanFlatFolderPipelineOperator
+from common_operators.batch_trigger import trigger_args_from_config, trigger_execution_timeout
+from common_operators.batch_trigger import describe_trigger_args
+from common_steps import Step
 
 
-def trigger_metadata_pipeline_cfg(dag, upstream_step, dataset, step_section):
-    default_config(step_section, 'DEPTH', '0')
-    depth = int(configuration.get(step_section, 'DEPTH'))
-    return trigger_metadata_pipeline_step(dag, upstream_step, dataset=dataset, depth=depth)
+def trigger_metadata_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config, step_config):
+    depth = step_config.getint('DEPTH')
+    trigger_args = trigger_args_from_config(reorganisation_config)
+    return trigger_metadata_pipeline_step(dag, upstream_step, dataset=dataset, depth=depth, trigger_args=trigger_args)
 
 
-def trigger_metadata_pipeline_step(dag, upstream_step, dataset, depth=0):
+def trigger_metadata_pipeline_step(dag, upstream_step, dataset, depth=0, trigger_args=None):
 
     trigger_dag_id = '%s_metadata_import' % dataset.lower().replace(" ", "_")
 
-    trigger_metadata_pipeline = ScanFlatFolderPipelineOperator(
+    trigger_args = trigger_args or {}
+
+    trigger_metadata_pipeline = BatchScanFlatFolderPipelineOperator(
         task_id='trigger_metadata_pipeline',
         trigger_dag_id=trigger_dag_id,
         trigger_dag_run_callable=default_trigger_dagrun,
@@ -27,10 +30,11 @@ def trigger_metadata_pipeline_step(dag, upstream_step, dataset, depth=0):
         source_folder_param='metadata_folder',
         depth=depth,
         parent_task=upstream_step.task_id,
-        execution_timeout=timedelta(minutes=30),
-        priority_weight=999,
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(minutes=30)),
+        priority_weight=upstream_step.priority_weight,
         dag=dag,
-        organised_folder=False
+        organised_folder=False,
+        **trigger_args
     )
 
     trigger_metadata_pipeline.set_upstream(upstream_step.task)
@@ -39,6 +43,8 @@ def trigger_metadata_pipeline_step(dag, upstream_step, dataset, depth=0):
     # Trigger metadata pipelines
 
     Trigger metadata pipelines.
-    """)
+
+    %s
+    """) % describe_trigger_args(trigger_args)
 
     return Step(trigger_metadata_pipeline, trigger_metadata_pipeline.task_id, upstream_step.priority_weight + 10)
@@ -1,33 +1,33 @@
 from datetime import timedelta
 from textwrap import dedent
 
-from airflow import configuration
-
-from airflow_scan_folder.operators import ScanFlatFolderPipelineOperator
-
 from airflow_scan_folder.operators.common import extract_context_from_session_path
 from airflow_scan_folder.operators.common import session_folder_trigger_dagrun
 
-from common_steps import Step, default_config
-
+from common_operators.batch_scan_folder_pipeline_operator import BatchScanFlatFolderPipelineOperator
+from common_operators.batch_trigger import trigger_args_from_config, trigger_execution_timeout
+from common_operators.batch_trigger import describe_trigger_args
+from common_steps import Step
 
-def trigger_preprocessing_pipeline_cfg(dag, upstream_step, dataset, section, step_section):
-    default_config(section, 'INPUT_CONFIG', '')
-    default_config(step_section, 'DEPTH', '1')
 
-    dataset_config = [flag.strip() for flag in configuration.get(section, 'INPUT_CONFIG').split(',')]
-    depth = int(configuration.get(step_section, 'DEPTH'))
+def trigger_preprocessing_pipeline_cfg(dag, upstream_step, dataset, reorganisation_config, step_config):
+    dataset_config = reorganisation_config.input_config
+    depth = step_config.getint('DEPTH')
+    trigger_args = trigger_args_from_config(reorganisation_config)
 
     return trigger_preprocessing_pipeline_step(dag, upstream_step, dataset=dataset,
                                                dataset_config=dataset_config,
-                                               depth=depth)
+                                               depth=depth,
+                                               trigger_args=trigger_args)
 
 
-def trigger_preprocessing_pipeline_step(dag, upstream_step, dataset, dataset_config, depth=1):
+def trigger_preprocessing_pipeline_step(dag, upstream_step, dataset, dataset_config, depth=1, trigger_args=None):
 
     trigger_dag_id = '%s_pre_process_images' % dataset.lower().replace(" ", "_")
 
-    trigger_preprocessing_pipeline = ScanFlatFolderPipelineOperator(
+    trigger_args = trigger_args or {}
+
+    trigger_preprocessing_pipeline = BatchScanFlatFolderPipelineOperator(
         task_id='trigger_preprocessing_pipeline',
         trigger_dag_id=trigger_dag_id,
         trigger_dag_run_callable=session_folder_trigger_dagrun,
@@ -35,10 +35,11 @@ def trigger_preprocessing_pipeline_step(dag, upstream_step, dataset, dataset_con
         depth=depth,
         dataset_config=dataset_config,
         parent_task=upstream_step.task_id,
-        execution_timeout=timedelta(minutes=30),
-        priority_weight=999,
+        execution_timeout=trigger_execution_timeout(trigger_args, timedelta(minutes=30)),
+        priority_weight=upstream_step.priority_weight,
         dag=dag,
-        organised_folder=False
+        organised_folder=False,
+        **trigger_args
     )
 
     trigger_preprocessing_pipeline.set_upstream(upstream_step.task)
@@ -47,7 +48,9 @@ def trigger_preprocessing_pipeline_step(dag, upstream_step, dataset, dataset_con
     # Trigger pre-processing pipelines
 
     Trigger pre-processing pipelines.
-    """)
+
+    %s
+    """) % describe_trigger_args(trigger_args)
 
     return Step(trigger_preprocessing_pipeline, trigger_preprocessing_pipeline.task_id,
                 upstream_step.priority_weight + 10)
@@ -0,0 +1,214 @@
+"""Tests of the batched creation of the DAG runs, with the stubs of the benchmarks and an in-memory session"""
+
+import os
+import sys
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from benchmarks import stubs
+from common_operators.batch_trigger import BatchTriggerMixin
+
+
+class Column(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return lambda row: getattr(row, self.name) == value
+
+    def __ge__(self, value):
+        return lambda row: getattr(row, self.name) >= value
+
+    def __le__(self, value):
+        return lambda row: getattr(row, self.name) <= value
+
+    def in_(self, values):
+        values = list(values)
+        return lambda row: getattr(row, self.name) in values
+
+    __hash__ = object.__hash__
+
+
+class FakeDagRun(object):
+
+    dag_id = Column('dag_id')
+    run_id = Column('run_id')
+    execution_date = Column('execution_date')
+    state = Column('state')
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.dag = None
+        self.verified_with = None
+
+    def verify_integrity(self, session=None):
+        self.verified_with = self.dag
+
+
+class FakeQuery(object):
+
+    def __init__(self, rows, entity, filters=()):
+        self.rows = rows
+        self.entity = entity
+        self.filters = filters
+
+    def filter(self, *filters):
+        return FakeQuery(self.rows, self.entity, self.filters + filters)
+
+    def __iter__(self):
+        for row in self.rows:
+            if all(f(row) for f in self.filters):
+                yield (getattr(row, self.entity.name),) if isinstance(self.entity, Column) else row
+
+    def count(self):
+        return len(list(self))
+
+
+class FakeSession(object):
+
+    """Keeps the DAG runs committed in a list, unique by (dag_id, run_id) and by (dag_id, execution_date)"""
+
+    def __init__(self, concurrent_dag_runs=()):
+        self.dag_runs = []
+        self.pending = []
+        self.concurrent_dag_runs = list(concurrent_dag_runs)
+
+    def query(self, entity):
+        return FakeQuery(self.dag_runs, entity)
+
+    def add(self, dag_run):
+        self.pending.append(dag_run)
+
+    def add_all(self, dag_runs):
+        self.pending.extend(dag_runs)
+
+    def commit(self):
+        # DAG runs created by another scan between the query and the commit of a batch
+        self.dag_runs.extend(self.concurrent_dag_runs)
+        self.concurrent_dag_runs = []
+        for key in ['run_id', 'execution_date']:
+            keys = set((r.dag_id, getattr(r, key)) for r in self.dag_runs)
+            if any((r.dag_id, getattr(r, key)) in keys for r in self.pending):
+                raise sys.modules['sqlalchemy.exc'].IntegrityError()
+        self.dag_runs.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+class FakeDagBag(object):
+
+    loads = 0
+
+    def __init__(self, dag_folder):
+        FakeDagBag.loads += 1
+
+    def get_dag(self, dag_id):
+        return 'dag:' + dag_id
+
+
+class FrozenDatetime(datetime):
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2018, 3, 1, 12, 30, 15)
+
+
+class BatchScanOperator(BatchTriggerMixin, stubs.ScanFlatFolderOperator):
+
+    def trigger_folders(self, folders):
+        for folder in folders:
+            self.trigger_dag_run({'params': {}}, root_folder='/data', folder=folder)
+            self.offset += 1
+        self.post_execute({})
+
+
+def setUpModule():
+    stubs.install(os.devnull)
+    models = sys.modules['airflow.models']
+    models.DagRun = FakeDagRun
+    models.DagBag = FakeDagBag
+
+
+class BatchTriggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        sys.modules['airflow.settings'].Session = lambda: self.session
+        FakeDagBag.loads = 0
+        patcher = mock.patch('common_operators.batch_trigger.datetime', FrozenDatetime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def operator(self, **kwargs):
+        return BatchScanOperator(task_id='scan', dataset='Demo', folder='/data', trigger_dag_id='pre_process',
+                                 trigger_dag_run_callable=lambda context, dro: dro, **kwargs)
+
+    def test_batches_create_task_instances(self):
+        self.operator(trigger_batch_size=2).trigger_folders(['S1', 'S2', 'S3'])
+
+        self.assertEqual(3, len(self.session.dag_runs))
+        self.assertEqual(3, len(set(r.execution_date for r in self.session.dag_runs)))
+        self.assertEqual(['dag:pre_process'] * 3, [r.verified_with for r in self.session.dag_runs])
+        self.assertEqual(1, FakeDagBag.loads)
+
+    def test_existing_dag_runs_skipped(self):
+        operator = self.operator(trigger_batch_size=10)
+        operator.trigger_folders(['S1', 'S2'])
+        operator.offset = 1
+        operator.trigger_folders(['S1', 'S2', 'S3'])
+
+        self.assertEqual(3, len(self.session.dag_runs))
+        self.assertEqual(3, len(set(r.run_id for r in self.session.dag_runs)))
+
+    def test_concurrent_dag_runs_not_verified(self):
+        operator = self.operator(trigger_batch_size=10)
+        operator.trigger_folders(['S1', 'S2'])
+        conflict = self.session.dag_runs.pop(0)
+        self.session.concurrent_dag_runs = [FakeDagRun(dag_id=conflict.dag_id, run_id=conflict.run_id,
+                                                       execution_date=conflict.execution_date)]
+        operator.offset = 1
+        operator.trigger_folders(['S1', 'S2', 'S3'])
+
+        self.assertEqual(3, len(self.session.dag_runs))
+        self.assertEqual(['dag:pre_process', None, 'dag:pre_process'],
+                         [r.verified_with for r in self.session.dag_runs])
+
+    def test_shifted_dates_checked_in_database(self):
+        # An earlier scan used the minutes before the dates of the batch
+        self.session.dag_runs = [FakeDagRun(dag_id='pre_process', run_id='earlier%d' % minutes, execution_date=date)
+                                 for minutes, date in enumerate(self.dates(1, 12))]
+        self.operator(trigger_batch_size=10).trigger_folders(['S1', 'S2'])
+
+        self.assertEqual(14, len(self.session.dag_runs))
+        self.assertEqual(14, len(set(r.execution_date for r in self.session.dag_runs)))
+        self.assertEqual(['trig__%s' % date.isoformat() for date in self.dates(1, 2)],
+                         [r.run_id for r in self.session.dag_runs[12:]])
+
+    def test_concurrent_execution_date_retried(self):
+        operator = self.operator(trigger_batch_size=10)
+        # A concurrent scan uses the execution date of the first DAG run of the batch for another folder
+        self.session.concurrent_dag_runs = [FakeDagRun(dag_id='pre_process', run_id='concurrent',
+                                                       execution_date=self.dates(1, 1)[0])]
+        operator.trigger_folders(['S1', 'S2'])
+
+        self.assertEqual(3, len(self.session.dag_runs))
+        self.assertEqual(3, len(set(r.execution_date for r in self.session.dag_runs)))
+        self.assertEqual([None, 'dag:pre_process', 'dag:pre_process'],
+                         [r.verified_with for r in self.session.dag_runs])
+
+    def dates(self, first_offset, count):
+        """Execution dates given by the scan operators for offsets first_offset to first_offset + count - 1"""
+        start = datetime(2018, 3, 1, 12, 31)
+        return [start - timedelta(minutes=offset) for offset in range(first_offset, first_offset + count)]
+
+
+if __name__ == '__main__':
+    unittest.main()
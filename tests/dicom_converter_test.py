@@ -0,0 +1,228 @@
+"""Tests of the Python DICOM to Nifti converter on synthetic series"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+try:
+    import nibabel
+    import numpy
+
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    from common_operators import dicom_converter
+except ImportError:
+    numpy = None
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+AXIAL = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+SAGITTAL = [0.0, 1.0, 0.0, 0.0, 0.0, -1.0]
+
+
+def oblique_orientation(angle):
+    """Axial orientation rotated around the left-right axis"""
+    cos, sin = numpy.cos(angle), numpy.sin(angle)
+    return [1.0, 0.0, 0.0, 0.0, float(cos), float(sin)]
+
+
+def slice_header(orientation, position, pixel_spacing=(0.5, 0.8), rows=3, columns=4, series_uid='1.2.3',
+                 protocol='t1_mprage', slope=None, intercept=None, thickness=None):
+    ds = Dataset()
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = 5
+    ds.ProtocolName = protocol
+    ds.ImageOrientationPatient = [float(v) for v in orientation]
+    ds.ImagePositionPatient = [float(v) for v in position]
+    ds.PixelSpacing = [float(v) for v in pixel_spacing]
+    ds.Rows = rows
+    ds.Columns = columns
+    if thickness is not None:
+        ds.SliceThickness = thickness
+    if slope is not None:
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+    return ds
+
+
+def write_slice(path, ds, pixels):
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.astype(numpy.uint16).tobytes()
+    ds.preamble = b'\0' * 128
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def lps_to_ras(point):
+    return numpy.array([-point[0], -point[1], point[2]])
+
+
+def dicom_position(ds, row, column):
+    """Position in LPS+ coordinates of a pixel, from the definition of the DICOM standard (C.7.6.2.1.1)"""
+    orientation = numpy.array([float(v) for v in ds.ImageOrientationPatient])
+    row_spacing, column_spacing = [float(v) for v in ds.PixelSpacing]
+    return (numpy.array([float(v) for v in ds.ImagePositionPatient]) +
+            orientation[:3] * column_spacing * column + orientation[3:] * row_spacing * row)
+
+
+@unittest.skipIf(numpy is None, "pydicom, nibabel and numpy are required by the Python DICOM converter")
+class AffineTest(unittest.TestCase):
+
+    def test_axial(self):
+        first = slice_header(AXIAL, [-100.0, -120.0, -50.0])
+        affine = dicom_converter._affine(first, numpy.array([0.0, 0.0, 2.0]))
+        numpy.testing.assert_allclose(affine, [[-0.8, 0.0, 0.0, 100.0],
+                                               [0.0, -0.5, 0.0, 120.0],
+                                               [0.0, 0.0, 2.0, -50.0],
+                                               [0.0, 0.0, 0.0, 1.0]])
+
+    def test_voxels_match_dicom_positions(self):
+        for orientation in [AXIAL, SAGITTAL, oblique_orientation(0.3)]:
+            first = slice_header(orientation, [12.5, -40.0, 33.0], pixel_spacing=(0.9, 1.1))
+            step = numpy.cross(orientation[:3], orientation[3:]) * 1.5
+            affine = dicom_converter._affine(first, step)
+            for row, column, k in [(0, 0, 0), (2, 3, 0), (1, 2, 4)]:
+                expected = lps_to_ras(dicom_position(first, row, column) + k * step)
+                # The first voxel index runs along the columns of the image, the second along its rows
+                numpy.testing.assert_allclose(affine.dot([column, row, k, 1.0])[:3], expected, atol=1e-6)
+
+
+@unittest.skipIf(numpy is None, "pydicom, nibabel and numpy are required by the Python DICOM converter")
+class SortSlicesTest(unittest.TestCase):
+
+    def headers(self, orientation, distances, origin=(10.0, -20.0, 30.0)):
+        normal = numpy.cross(orientation[:3], orientation[3:])
+        return [('slice%d' % i, slice_header(orientation, numpy.array(origin) + normal * distance))
+                for i, distance in enumerate(distances)]
+
+    def test_sorted_along_the_normal(self):
+        for orientation in [AXIAL, SAGITTAL, oblique_orientation(-0.4)]:
+            headers = self.headers(orientation, [4.0, -2.0, 0.0, 2.0, 6.0])
+            random.Random(1).shuffle(headers)
+            sorted_headers, step = dicom_converter._sort_slices(headers)
+            normal = numpy.cross(orientation[:3], orientation[3:])
+            distances = [numpy.dot([float(v) for v in ds.ImagePositionPatient], normal) for _, ds in sorted_headers]
+            numpy.testing.assert_allclose(numpy.diff(distances), [2.0] * 4, atol=1e-6)
+            numpy.testing.assert_allclose(step, normal * 2.0, atol=1e-6)
+
+    def test_single_slice_uses_slice_thickness(self):
+        headers = [('slice', slice_header(AXIAL, [0.0, 0.0, 0.0], thickness=3.0))]
+        sorted_headers, step = dicom_converter._sort_slices(headers)
+        self.assertEqual(headers, sorted_headers)
+        numpy.testing.assert_allclose(step, [0.0, 0.0, 3.0])
+
+    def test_several_volumes(self):
+        with self.assertRaisesRegex(dicom_converter.UnsupportedSeries, 'several volumes'):
+            dicom_converter._sort_slices(self.headers(AXIAL, [0.0, 2.0, 2.0, 4.0]))
+
+    def test_uneven_spacing(self):
+        with self.assertRaisesRegex(dicom_converter.UnsupportedSeries, 'not evenly spaced'):
+            dicom_converter._sort_slices(self.headers(AXIAL, [0.0, 2.0, 4.0, 7.0]))
+
+
+@unittest.skipIf(numpy is None, "pydicom, nibabel and numpy are required by the Python DICOM converter")
+class ConvertSeriesTest(unittest.TestCase):
+
+    rows = 3
+    columns = 4
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.session_folder = os.path.join(self.folder, 'dicom')
+        self.nifti_folder = os.path.join(self.folder, 'nifti')
+        os.makedirs(os.path.join(self.session_folder, 'series'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def pixels(self, k):
+        return numpy.arange(self.rows * self.columns).reshape(self.rows, self.columns) + 100 * (k + 1)
+
+    def write_series(self, orientation, count, rescales=None, step=2.0):
+        """Write the slices in a shuffled order, return their headers ordered along the normal"""
+        normal = numpy.cross(orientation[:3], orientation[3:])
+        headers = []
+        for k in range(count):
+            slope, intercept = rescales[k] if rescales else (None, None)
+            headers.append(slice_header(orientation, numpy.array([-30.0, 15.0, 7.0]) + normal * step * k,
+                                        rows=self.rows, columns=self.columns, slope=slope, intercept=intercept))
+        files = list(range(count))
+        random.Random(2).shuffle(files)
+        for name, k in enumerate(files):
+            write_slice(os.path.join(self.session_folder, 'series', '%03d.dcm' % name), headers[k], self.pixels(k))
+        return headers
+
+    def convert(self):
+        report = dicom_converter.convert_series(self.session_folder, 'series', self.nifti_folder)
+        self.assertEqual(1, report['result'], report)
+        self.assertEqual(1, len(report['files']))
+        return nibabel.load(os.path.join(self.nifti_folder, report['files'][0]))
+
+    def test_round_trip(self):
+        for orientation in [AXIAL, oblique_orientation(0.25)]:
+            shutil.rmtree(self.nifti_folder, ignore_errors=True)
+            for file_name in os.listdir(os.path.join(self.session_folder, 'series')):
+                os.remove(os.path.join(self.session_folder, 'series', file_name))
+            headers = self.write_series(orientation, 4)
+            image = self.convert()
+            data = numpy.asanyarray(image.dataobj)
+
+            self.assertEqual((self.columns, self.rows, 4), data.shape)
+            for k in range(4):
+                numpy.testing.assert_array_equal(data[:, :, k], self.pixels(k).T)
+            for row, column, k in [(0, 0, 0), (2, 3, 1), (1, 2, 3)]:
+                expected = lps_to_ras(dicom_position(headers[k], row, column))
+                numpy.testing.assert_allclose(image.affine.dot([column, row, k, 1.0])[:3], expected, atol=1e-4)
+                numpy.testing.assert_allclose(image.get_qform().dot([column, row, k, 1.0])[:3], expected,
+                                              atol=1e-4)
+
+    def test_same_rescale(self):
+        self.write_series(AXIAL, 3, rescales=[(2.0, -10.0)] * 3)
+        image = self.convert()
+        # nibabel moves the scaling of the header to the array proxy when loading the file
+        self.assertEqual((2.0, -10.0), (float(image.dataobj.slope), float(image.dataobj.inter)))
+        self.assertEqual(numpy.uint16, image.get_data_dtype())
+        for k in range(3):
+            numpy.testing.assert_allclose(image.get_fdata()[:, :, k], self.pixels(k).T * 2.0 - 10.0)
+
+    def test_mixed_rescale(self):
+        rescales = [(1.0, 0.0), (0.5, 3.0), (2.0, -100.0)]
+        self.write_series(AXIAL, 3, rescales=rescales)
+        image = self.convert()
+        self.assertEqual(numpy.float32, image.get_data_dtype())
+        self.assertEqual((1.0, 0.0), (float(image.dataobj.slope), float(image.dataobj.inter)))
+        for k, (slope, intercept) in enumerate(rescales):
+            numpy.testing.assert_allclose(image.get_fdata()[:, :, k], self.pixels(k).T * slope + intercept)
+
+    def test_different_orientations_skipped(self):
+        write_slice(os.path.join(self.session_folder, 'series', '1.dcm'),
+                    slice_header(AXIAL, [0.0, 0.0, 0.0], rows=self.rows, columns=self.columns), self.pixels(0))
+        write_slice(os.path.join(self.session_folder, 'series', '2.dcm'),
+                    slice_header(SAGITTAL, [0.0, 0.0, 2.0], rows=self.rows, columns=self.columns), self.pixels(1))
+        report = dicom_converter.convert_series(self.session_folder, 'series', self.nifti_folder)
+        self.assertEqual(0, report['result'])
+        self.assertEqual([{'protocol': 't1_mprage', 'reason': 'images with different orientations'}],
+                         report['skipped'])
+
+
+if __name__ == '__main__':
+    unittest.main()
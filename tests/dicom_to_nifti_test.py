@@ -0,0 +1,94 @@
+"""Tests of the DAGs triggered by the DICOM to Nifti steps, with the stubs of the benchmarks"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import stubs
+
+try:
+    import nibabel  # noqa: F401
+    import numpy
+    import pydicom  # noqa: F401
+except ImportError:
+    numpy = None
+
+SKIPPED_DAG = 'mri_notify_skipped_processing'
+FAILED_DAG = 'mri_notify_failed_processing'
+
+
+def setUpModule():
+    global AirflowSkipException, Step, SkippablePythonPipelineOperator, dicom_to_nifti
+    stubs.install(os.devnull)
+    from airflow.exceptions import AirflowSkipException
+    from common_steps import Step
+    from common_operators.skippable_python_pipeline_operator import SkippablePythonPipelineOperator
+    from preprocessing_steps import dicom_to_nifti
+
+
+class SkippablePythonPipelineOperatorTest(unittest.TestCase):
+
+    def operator(self, python_callable):
+        return SkippablePythonPipelineOperator(task_id='convert', python_callable=python_callable,
+                                               on_skip_trigger_dag_id=SKIPPED_DAG,
+                                               on_failure_trigger_dag_id=FAILED_DAG)
+
+    def test_skip_triggers_skipped_dag(self):
+        def skip(**kwargs):
+            raise AirflowSkipException("Nothing to do")
+
+        operator = self.operator(skip)
+        with self.assertRaises(AirflowSkipException):
+            operator.execute({})
+        self.assertEqual([SKIPPED_DAG], operator.triggered_dags)
+
+    def test_failure_triggers_failed_dag(self):
+        def fail(**kwargs):
+            raise ValueError("Broken")
+
+        operator = self.operator(fail)
+        with self.assertRaises(ValueError):
+            operator.execute({})
+        self.assertEqual([FAILED_DAG], operator.triggered_dags)
+
+    def test_success_triggers_nothing(self):
+        operator = self.operator(lambda **kwargs: {'folder': '/data/nifti'})
+        self.assertEqual({'folder': '/data/nifti'}, operator.execute({}))
+        self.assertEqual([], operator.triggered_dags)
+
+
+@unittest.skipIf(numpy is None, "pydicom, nibabel and numpy are required by the Python DICOM converter")
+class DicomToNiftiSkipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.session_folder = os.path.join(self.folder, 'dicom', 'session1')
+        os.makedirs(os.path.join(self.session_folder, 'empty_series'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_python_converter_notifies_skipped_session(self):
+        step = dicom_to_nifti.python_dicom_to_nifti_step(stubs.DAG('pre_process'), Step(None, 'upstream', 1),
+                                                         output_folder=os.path.join(self.folder, 'nifti'),
+                                                         converter_workers=1)
+        with self.assertRaises(AirflowSkipException):
+            step.task.execute({'folder': self.session_folder, 'session_id': 'session1'})
+        self.assertEqual([SKIPPED_DAG], step.task.triggered_dags)
+
+    def test_pipelined_copy_notifies_skipped_session(self):
+        step = dicom_to_nifti.pipelined_dicom_to_nifti_step(stubs.DAG('pre_process'), Step(None, 'upstream', 1),
+                                                            min_free_space=0.0,
+                                                            local_folder=os.path.join(self.folder, 'local'),
+                                                            copy_workers=1,
+                                                            output_folder=os.path.join(self.folder, 'nifti'),
+                                                            converter=dicom_to_nifti.PYTHON_CONVERTER,
+                                                            converter_workers=1)
+        with self.assertRaises(AirflowSkipException):
+            step.task.execute({'folder': self.session_folder, 'session_id': 'session1', 'dag_run': None})
+        self.assertEqual([SKIPPED_DAG], step.task.triggered_dags)
+
+
+if __name__ == '__main__':
+    unittest.main()